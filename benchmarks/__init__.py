@@ -0,0 +1,14 @@
+"""
+Performance benchmarks for Yocto.
+
+The suite seeds a database with users and links, then drives the redirect,
+create, login and My Links endpoints through the Flask test client and a
+real WSGI server, reporting latency percentiles, requests per second and
+database operations per request as JSON. Run against a local mongod with::
+
+    python -m benchmarks.run --users 100 --links 10000 --output results.json
+
+and compare the output of two commits with::
+
+    python -m benchmarks.compare before.json after.json
+"""
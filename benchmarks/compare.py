@@ -0,0 +1,65 @@
+import argparse
+import json
+
+METRICS = [
+    ("p50", lambda result: result["latency_ms"]["p50"]),
+    ("p95", lambda result: result["latency_ms"]["p95"]),
+    ("p99", lambda result: result["latency_ms"]["p99"]),
+    ("req/s", lambda result: result["requests_per_second"]),
+    ("db ops/req", lambda result: result["db_ops_per_request"]),
+]
+
+def change(before, after):
+    """
+    Format the relative change between two values.
+
+    :return: The change as a signed percentage, or "n/a".
+    :rtype: str
+    """
+    if before is None or after is None or before == 0:
+        return "n/a"
+    return f"{(after - before) / before:+.1%}"
+
+def compare(before, after):
+    """
+    Tabulate the change in each metric between two benchmark reports.
+
+    Only scenarios present in both reports are compared.
+
+    :param dict before: The report of the baseline run.
+    :param dict after: The report of the new run.
+
+    :return: The lines of the table.
+    :rtype: list[str]
+    """
+    baseline = {(r["driver"], r["scenario"]): r for r in before["results"]}
+    lines = [
+        f"{'driver':12} {'scenario':10} {'metric':10} {'before':>10} {'after':>10} {'change':>8}"
+    ]
+    for result in after["results"]:
+        key = (result["driver"], result["scenario"])
+        if key not in baseline:
+            continue
+        for name, metric in METRICS:
+            old = metric(baseline[key])
+            new = metric(result)
+            lines.append(
+                f"{key[0]:12} {key[1]:10} {name:10} {old!s:>10} {new!s:>10} {change(old, new):>8}"
+            )
+    return lines
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.compare",
+        description="Compare two benchmark reports written by benchmarks.run.",
+    )
+    parser.add_argument("before", type=argparse.FileType("r"))
+    parser.add_argument("after", type=argparse.FileType("r"))
+    args = parser.parse_args(argv)
+    before = json.load(args.before)
+    after = json.load(args.after)
+    print(f"before: {before.get('commit')}\nafter:  {after.get('commit')}")
+    print("\n".join(compare(before, after)))
+
+if __name__ == "__main__":
+    main()
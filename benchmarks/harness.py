@@ -0,0 +1,297 @@
+import http.client
+import http.cookies
+import math
+import threading
+import time
+import urllib.parse
+
+from pymongo import monitoring
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+class CommandCounter(monitoring.CommandListener):
+    """
+    Count the commands sent to MongoDB.
+
+    Register with `pymongo.monitoring.register` before the application (and
+    so its client) is created.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def started(self, event):
+        with self._lock:
+            self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+def percentile(ordered, q):
+    """
+    Nearest-rank percentile of sorted values.
+
+    :param list[float] ordered: The values, in ascending order.
+    :param float q: The percentile, between 0 and 100.
+
+    :return: The smallest value not exceeded by `q` percent of the values,
+        or `None` if there are no values.
+    :rtype: float
+    """
+    if not ordered:
+        return None
+    rank = max(math.ceil(q / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+def summarize(latencies, elapsed, errors, commands):
+    """
+    Summarize the timings of one scenario.
+
+    :param list[float] latencies: The duration of each request in seconds.
+    :param float elapsed: The wall-clock duration of the scenario.
+    :param int errors: The number of requests with an unexpected status.
+    :param int commands: The number of database commands sent.
+
+    :return: Latency percentiles in milliseconds, throughput and database
+        commands per request.
+    :rtype: dict
+    """
+    ordered = sorted(latencies)
+    count = len(ordered)
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        "requests": count,
+        "errors": errors,
+        "latency_ms": {
+            "p50": ms(percentile(ordered, 50)),
+            "p95": ms(percentile(ordered, 95)),
+            "p99": ms(percentile(ordered, 99)),
+            "mean": ms(sum(ordered) / count if count else None),
+            "max": ms(ordered[-1] if count else None),
+        },
+        "requests_per_second": round(count / elapsed, 1) if elapsed > 0 else None,
+        "db_ops_per_request": round(commands / count, 3) if count else None,
+    }
+
+class TestClientSession:
+    def __init__(self, app):
+        """
+        Client which calls the application in-process with the Flask test
+        client, keeping cookies between requests.
+
+        :param flask.Flask app: The application.
+        """
+        self._client = app.test_client()
+
+    def request(self, method, path, data=None):
+        """
+        Send a request and read the whole response.
+
+        :param str method: The HTTP method.
+        :param str path: The path, with query string.
+        :param dict data: Form data for the body.
+
+        :return: The response status code.
+        :rtype: int
+        """
+        response = self._client.open(path, method=method, data=data)
+        response.get_data()
+        response.close()
+        return response.status_code
+
+    def close(self):
+        pass
+
+class HTTPSession:
+    def __init__(self, host, port):
+        """
+        Client which sends requests to a server over HTTP, keeping cookies
+        between requests.
+
+        :param str host: The server host.
+        :param int port: The server port.
+        """
+        self._connection = http.client.HTTPConnection(host, port)
+        self._cookies = http.cookies.SimpleCookie()
+
+    def request(self, method, path, data=None):
+        """
+        Send a request and read the whole response.
+
+        :param str method: The HTTP method.
+        :param str path: The path, with query string.
+        :param dict data: Form data for the body.
+
+        :return: The response status code.
+        :rtype: int
+        """
+        headers = {}
+        body = None
+        if data is not None:
+            body = urllib.parse.urlencode(data)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        if self._cookies:
+            headers["Cookie"] = "; ".join(
+                f"{name}={morsel.value}" for name, morsel in self._cookies.items()
+            )
+        self._connection.request(method, path, body=body, headers=headers)
+        response = self._connection.getresponse()
+        response.read()
+        for header in response.headers.get_all("Set-Cookie") or []:
+            self._cookies.load(header)
+        if response.will_close:
+            self._connection.close()
+        return response.status
+
+    def close(self):
+        self._connection.close()
+
+class TestClientDriver:
+    """Drive the application in-process with the Flask test client."""
+
+    name = "test-client"
+
+    def __init__(self, app):
+        self.app = app
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def session(self):
+        return TestClientSession(self.app)
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """Request handler keeping connections alive, without an access log."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+class ServerDriver:
+    """Drive the application over HTTP through a threaded WSGI server."""
+
+    name = "server"
+
+    def __init__(self, app, host="127.0.0.1", port=0):
+        self.app = app
+        self.host = host
+        self.port = port
+        self._server = None
+        self._thread = None
+
+    def __enter__(self):
+        self._server = make_server(
+            self.host,
+            self.port,
+            self.app,
+            threaded=True,
+            request_handler=QuietRequestHandler,
+        )
+        self.port = self._server.server_port
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="benchmark-server", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def session(self):
+        return HTTPSession(self.host, self.port)
+
+class Scenario:
+    def __init__(self, name, request, setup=None, expected_status=(200,)):
+        """
+        A request repeated against the application.
+
+        :param str name: The name in the results.
+        :param request: Function of `(session, worker, i)` which sends the
+            `i`th request of a worker and returns the status code.
+        :param setup: Function of `(session, worker)` run once per worker
+            before timing starts, e.g. to log in (default none).
+        :param tuple[int] expected_status: The status codes of a successful
+            request.
+        """
+        self.name = name
+        self.request = request
+        self.setup = setup
+        self.expected_status = expected_status
+
+def run_scenario(driver, scenario, requests, concurrency, counter, before_stop=None):
+    """
+    Send `requests` requests of a scenario from `concurrency` threads.
+
+    Each thread has its own session. Database commands are counted from the
+    start of timing until `before_stop` (e.g. a flush of buffered writes)
+    has run.
+
+    :param driver: The driver giving sessions with the application.
+    :param Scenario scenario: The scenario to run.
+    :param int requests: The total number of requests.
+    :param int concurrency: The number of threads sending requests.
+    :param CommandCounter counter: The database command counter.
+    :param before_stop: Function run after the last request, whose database
+        commands are included (default none).
+
+    :return: The summary of the run (see `summarize`).
+    :rtype: dict
+    """
+    sessions = [driver.session() for _ in range(concurrency)]
+    if scenario.setup is not None:
+        for worker, session in enumerate(sessions):
+            scenario.setup(session, worker)
+    latencies = [[] for _ in range(concurrency)]
+    errors = [0] * concurrency
+    barrier = threading.Barrier(concurrency + 1)
+
+    def work(worker):
+        session = sessions[worker]
+        barrier.wait()
+        # Spread the remainder over the first workers
+        for i in range(worker, requests, concurrency):
+            start = time.perf_counter()
+            try:
+                status = scenario.request(session, worker, i)
+            except Exception:
+                # e.g. the connection was dropped
+                status = None
+            latencies[worker].append(time.perf_counter() - start)
+            if status not in scenario.expected_status:
+                errors[worker] += 1
+
+    threads = [
+        threading.Thread(target=work, args=(worker,), name=f"benchmark-{worker}")
+        for worker in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    commands_before = counter.count
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if before_stop is not None:
+        before_stop()
+    commands = counter.count - commands_before
+    for session in sessions:
+        session.close()
+    return summarize(
+        [latency for worker in latencies for latency in worker],
+        elapsed,
+        sum(errors),
+        commands,
+    )
@@ -0,0 +1,237 @@
+import argparse
+import contextlib
+import datetime
+import json
+import platform
+import random
+import subprocess
+import sys
+import uuid
+
+from pymongo import monitoring
+
+from benchmarks.harness import (
+    CommandCounter,
+    Scenario,
+    ServerDriver,
+    TestClientDriver,
+    run_scenario,
+)
+from benchmarks.seed import PASSWORD, seed, username
+
+DRIVERS = {
+    TestClientDriver.name: TestClientDriver,
+    ServerDriver.name: ServerDriver,
+}
+
+def make_scenarios(short_ids, users):
+    """
+    Build the benchmarked scenarios.
+
+    The create scenario shortens URLs unique to this call, so that every
+    request stores a new link. The redirect_blueprint scenario sends the
+    same requests as the redirect scenario, and is run with the redirect
+    fast path unmounted (see `blueprint_redirects`) for comparison.
+
+    :param list[str] short_ids: The seeded short IDs to redirect from.
+    :param int users: The number of seeded users.
+
+    :return: The scenarios by name.
+    :rtype: dict[str, benchmarks.harness.Scenario]
+    """
+    run_id = uuid.uuid4().hex
+
+    def login(session, worker):
+        status = session.request(
+            "POST",
+            "/pages/login/",
+            {"uname": username(worker % users), "pw": PASSWORD},
+        )
+        if status != 302:
+            raise RuntimeError(f"Login as {username(worker % users)} failed with status {status}")
+
+    def redirect(session, worker, i):
+        return session.request("GET", "/" + random.choice(short_ids))
+
+    def create(session, worker, i):
+        return session.request(
+            "POST",
+            "/pages/create/",
+            {"url": f"https://www.example.com/created/{run_id}/{i}"},
+        )
+
+    def authenticate(session, worker, i):
+        return session.request(
+            "POST",
+            "/pages/login/",
+            {"uname": username(i % users), "pw": PASSWORD},
+        )
+
+    def my_links(session, worker, i):
+        return session.request("GET", "/pages/my-links/")
+
+    return {
+        "redirect": Scenario("redirect", redirect, expected_status=(302,)),
+        "redirect_blueprint": Scenario("redirect_blueprint", redirect, expected_status=(302,)),
+        "create": Scenario("create", create, setup=login),
+        "login": Scenario("login", authenticate, expected_status=(302,)),
+        "my_links": Scenario("my_links", my_links, setup=login),
+    }
+
+@contextlib.contextmanager
+def blueprint_redirects(app):
+    """
+    Serve redirects through the `short` blueprint while in the context, by
+    unmounting the redirect fast path if the app has it.
+
+    :param flask.Flask app: The application.
+    """
+    from yocto.fastpath import RedirectFastPath
+
+    wsgi_app = app.wsgi_app
+    if isinstance(wsgi_app, RedirectFastPath):
+        app.wsgi_app = wsgi_app.wsgi_app
+    try:
+        yield
+    finally:
+        app.wsgi_app = wsgi_app
+
+def current_commit():
+    """
+    Find the commit of the working tree, if in a git repository.
+
+    :return: The commit hash, or `None`.
+    :rtype: str
+    """
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.run",
+        description="Benchmark the Yocto endpoints against a local MongoDB.",
+    )
+    parser.add_argument("--config", default="BenchmarkConfig",
+                        help="Configuration class from yocto.config (default %(default)s).")
+    parser.add_argument("--users", type=int, default=100,
+                        help="Number of users to seed (default %(default)s).")
+    parser.add_argument("--links", type=int, default=10000,
+                        help="Number of links to seed (default %(default)s).")
+    parser.add_argument("--requests", type=int, default=1000,
+                        help="Requests per scenario and driver (default %(default)s).")
+    parser.add_argument("--login-requests", type=int, default=100,
+                        help="Requests for the login scenario, which is "
+                             "dominated by password hashing (default %(default)s).")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="Number of client threads (default %(default)s).")
+    parser.add_argument("--scenarios", nargs="+",
+                        default=["redirect", "redirect_blueprint", "create", "login", "my_links"],
+                        choices=["redirect", "redirect_blueprint", "create", "login", "my_links"],
+                        help="Scenarios to run (default all).")
+    parser.add_argument("--drivers", nargs="+", default=list(DRIVERS), choices=list(DRIVERS),
+                        help="Ways of calling the application (default all).")
+    parser.add_argument("--no-seed", action="store_true",
+                        help="Reuse the data seeded by an earlier run.")
+    parser.add_argument("--output", type=argparse.FileType("w"), default=sys.stdout,
+                        help="File to write the JSON results to (default stdout).")
+    args = parser.parse_args(argv)
+    if args.users < 1 or args.links < 1 or args.concurrency < 1:
+        parser.error("--users, --links and --concurrency must be at least 1")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    counter = CommandCounter()
+    # Registered before the app creates its client, so the client reports
+    # to the counter
+    monitoring.register(counter)
+
+    from yocto import create_app
+    from yocto.db import get_db, init_db
+    from yocto.hashing import get_password_hasher
+    from yocto.lib.utils import SHORT_ID_IDENTIFIER
+    from yocto.visits import get_visit_counter
+
+    app = create_app(args.config)
+    with app.app_context():
+        db = get_db()
+        if args.no_seed:
+            short_ids = [
+                link[SHORT_ID_IDENTIFIER]
+                for link in db.urls.find({}, {SHORT_ID_IDENTIFIER: True, "_id": False})
+            ]
+        else:
+            init_db()
+            print(f"Seeding {args.users} users and {args.links} links...", file=sys.stderr)
+            short_ids = seed(
+                db,
+                args.users,
+                args.links,
+                get_password_hasher().hash(PASSWORD),
+                length=app.config["SHORT_ID_LENGTH"],
+            )
+    if not short_ids:
+        raise SystemExit("No links in the database to redirect from.")
+
+    def flush_visits():
+        with app.app_context():
+            visit_counter = get_visit_counter()
+            if visit_counter is not None:
+                visit_counter.flush()
+
+    results = []
+    for driver_name in args.drivers:
+        # Fresh scenarios, so that each driver creates new links
+        scenarios = make_scenarios(short_ids, args.users)
+        with DRIVERS[driver_name](app) as driver:
+            for name in args.scenarios:
+                requests = args.login_requests if name == "login" else args.requests
+                with contextlib.ExitStack() as stack:
+                    if name == "redirect_blueprint":
+                        stack.enter_context(blueprint_redirects(app))
+                    summary = run_scenario(
+                        driver,
+                        scenarios[name],
+                        requests,
+                        args.concurrency,
+                        counter,
+                        before_stop=flush_visits,
+                    )
+                results.append({"driver": driver_name, "scenario": name, **summary})
+                latency = summary["latency_ms"]
+                print(
+                    f"{driver_name:12} {name:18} p50 {latency['p50']:8.2f}ms "
+                    f"p95 {latency['p95']:8.2f}ms p99 {latency['p99']:8.2f}ms "
+                    f"{summary['requests_per_second']:8.1f} req/s "
+                    f"{summary['db_ops_per_request']:6.2f} db ops/req "
+                    f"{summary['errors']} errors",
+                    file=sys.stderr,
+                )
+    report = {
+        "commit": current_commit(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {
+            "config": args.config,
+            "users": args.users,
+            "links": args.links,
+            "requests": args.requests,
+            "login_requests": args.login_requests,
+            "concurrency": args.concurrency,
+        },
+        "results": results,
+    }
+    json.dump(report, args.output, indent=2)
+    args.output.write("\n")
+
+if __name__ == "__main__":
+    main()
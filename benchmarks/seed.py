@@ -0,0 +1,82 @@
+from datetime import datetime
+
+from yocto.allocators import random_short_id
+from yocto.lib.urls import url_hash
+from yocto.lib.utils import (
+    USERNAME_IDENTIFIER,
+    PASSWORD_HASH_IDENTIFIER,
+    ACCOUNT_CREATION_DATE_IDENTIFIER,
+    LONG_URL_IDENTIFIER,
+    LONG_URL_HASH_IDENTIFIER,
+    SHORT_ID_IDENTIFIER,
+    URL_CREATION_DATE_IDENTIFIER,
+    CREATOR_ID_IDENTIFIER,
+    VISITS_COUNT_IDENTIFIER,
+)
+
+PASSWORD = "B3nchmark_password"
+
+def username(i):
+    """
+    Name of the `i`th seeded user.
+
+    :param int i: The index of the user.
+
+    :return: The username.
+    :rtype: str
+    """
+    return f"bench_user_{i}"
+
+def seed(database, users, links, password_hash, length=7, batch_size=1000):
+    """
+    Fill the users and urls collections with generated data.
+
+    Every user has the password `PASSWORD`, hashed once in advance so that
+    seeding is not dominated by Argon2. Links are spread evenly across the
+    users. The collections should be empty, with their indexes built.
+
+    :param database: The database to fill.
+    :type database: pymongo.database.Database
+    :param int users: The number of users to create.
+    :param int links: The number of links to create.
+    :param str password_hash: The stored hash of `PASSWORD`.
+    :param int length: The number of characters in a short ID.
+    :param int batch_size: The number of documents inserted at once.
+
+    :return: The short IDs of the created links.
+    :rtype: list[str]
+    """
+    now = datetime.now()
+    user_ids = []
+    for start in range(0, users, batch_size):
+        result = database.users.insert_many(
+            [
+                {
+                    USERNAME_IDENTIFIER: username(i),
+                    PASSWORD_HASH_IDENTIFIER: password_hash,
+                    ACCOUNT_CREATION_DATE_IDENTIFIER: now,
+                }
+                for i in range(start, min(start + batch_size, users))
+            ]
+        )
+        user_ids.extend(result.inserted_ids)
+    short_ids = set()
+    while len(short_ids) < links:
+        short_ids.add(random_short_id(length))
+    short_ids = list(short_ids)
+    for start in range(0, links, batch_size):
+        database.urls.insert_many(
+            [
+                {
+                    LONG_URL_IDENTIFIER: f"https://www.example.com/seed/{i}",
+                    LONG_URL_HASH_IDENTIFIER: url_hash(f"https://www.example.com/seed/{i}"),
+                    SHORT_ID_IDENTIFIER: short_ids[i],
+                    URL_CREATION_DATE_IDENTIFIER: now,
+                    CREATOR_ID_IDENTIFIER: user_ids[i % users],
+                    VISITS_COUNT_IDENTIFIER: 0,
+                }
+                for i in range(start, min(start + batch_size, links))
+            ],
+            ordered=False,
+        )
+    return short_ids
@@ -8,15 +8,21 @@ from pymongo import MongoClient
 from bson.objectid import ObjectId
 
 from yocto.address import AddressManager
+from yocto.allocators import CounterIdAllocator
 from yocto.auth import UserAuthenticator
+from yocto.cache import RedirectCache
+from yocto.indexes import ensure_indexes
 from yocto.lib.exceptions import (
     UrlNotFoundError,
     UrlInvalidError,
     UrlExistsError,
-    UserNotFoundError
+    UserNotFoundError,
+    ShortIdAllocationError,
 )
+from yocto.lib.urls import canonical_url, is_valid_url, url_hash
 from yocto.lib.utils import (
     LONG_URL_IDENTIFIER,
+    LONG_URL_HASH_IDENTIFIER,
     SHORT_ID_IDENTIFIER,
     URL_CREATION_DATE_IDENTIFIER,
     CREATOR_ID_IDENTIFIER,
@@ -25,6 +31,8 @@ from yocto.lib.utils import (
     USERNAME_IDENTIFIER,
     PASSWORD_HASH_IDENTIFIER,
     ACCOUNT_CREATION_DATE_IDENTIFIER,
+    TOMBSTONE_SHORT_ID_IDENTIFIER,
+    VISIT_SHORT_ID_IDENTIFIER,
 )
 
 @pytest.fixture()
@@ -74,6 +82,7 @@ def mongo_client_with_data(mongo_client):
     urls.insert_one(
         {
             LONG_URL_IDENTIFIER: "https://www.example.com/long/relative/path/?var=5#fragment",
+            LONG_URL_HASH_IDENTIFIER: url_hash("https://www.example.com/long/relative/path/?var=5#fragment"),
             SHORT_ID_IDENTIFIER: "abcdef1",
             URL_CREATION_DATE_IDENTIFIER: datetime(2020, 6, 1, 9, 0, 0),
             CREATOR_ID_IDENTIFIER: user_id1,
@@ -85,6 +94,7 @@ def mongo_client_with_data(mongo_client):
     urls.insert_one(
         {
             LONG_URL_IDENTIFIER: "https://www.example2.com/path",
+            LONG_URL_HASH_IDENTIFIER: url_hash("https://www.example2.com/path"),
             SHORT_ID_IDENTIFIER: "shortid",
             URL_CREATION_DATE_IDENTIFIER: datetime(2020, 1, 1, 9, 0, 0),
             CREATOR_ID_IDENTIFIER: user_id1,
@@ -96,6 +106,7 @@ def mongo_client_with_data(mongo_client):
     urls.insert_one(
         {
             LONG_URL_IDENTIFIER: "https://www.website.com/path",
+            LONG_URL_HASH_IDENTIFIER: url_hash("https://www.website.com/path"),
             SHORT_ID_IDENTIFIER: "1234567",
             URL_CREATION_DATE_IDENTIFIER: datetime(2020, 10, 1, 9, 0, 0),
             CREATOR_ID_IDENTIFIER: user_id2,
@@ -105,6 +116,37 @@ def mongo_client_with_data(mongo_client):
 
     return mongo_client
 
+def test_is_valid_url():
+    assert is_valid_url("https://www.example.com/long/relative/path/?var=5#fragment")
+    assert is_valid_url("http://www.example.com:8080")
+    # Checked by validators.url
+    assert is_valid_url("ftp://www.example.com/file")
+    assert is_valid_url("https://www.example.com/caf\u00e9")
+    assert is_valid_url("http://10.0.0.1/")
+    assert not is_valid_url("ht://wwwww.example.c5/")
+    assert not is_valid_url("https://www.example.com:08/")
+    assert not is_valid_url("https://www.example.com/a b")
+    assert not is_valid_url("https://localhost/")
+    assert not is_valid_url("")
+    assert not is_valid_url(None)
+
+
+def test_canonical_url():
+    assert canonical_url("HTTPS://WWW.Example.COM") == "https://www.example.com/"
+    assert canonical_url("https://www.example.com:443/") == "https://www.example.com/"
+    assert canonical_url("http://www.example.com:443/") == "http://www.example.com:443/"
+    assert canonical_url("https://www.example.com/%7euser/a%2fb") == "https://www.example.com/~user/a%2Fb"
+    assert canonical_url("https://www.example.com/caf\u00e9") == "https://www.example.com/caf%C3%A9"
+    assert canonical_url("https://b\u00fccher.de/") == "https://xn--bcher-kva.de/"
+    # Paths are otherwise kept, and query and fragment with them
+    assert canonical_url("https://www.example.com/Path/?b=2&a=1#Top") == "https://www.example.com/Path/?b=2&a=1#Top"
+    assert canonical_url("https://www.example.com/path") != canonical_url("https://www.example.com/path/")
+    with pytest.raises(UrlInvalidError):
+        canonical_url("ht://wwwww.example.c5/")
+    assert url_hash("HTTPS://WWW.Example.COM") == url_hash("https://www.example.com/")
+    assert len(url_hash("https://www.example.com")) == 16
+
+
 class TestAddressManager:
     def test_extract_id_from_short_url(self):
         assert AddressManager.extract_id_from_short_url("https://yoc.to/1234567") == "1234567"
@@ -166,6 +208,7 @@ class TestAddressManager:
             am.store_url_and_id(long_url, short_id, creator_id)
 
     def test_store_url_and_id_raises_if_url_exists(self, mongo_client_with_data):
+        ensure_indexes(mongo_client_with_data.tests)
         users: Collection = mongo_client_with_data.tests.users
         am = AddressManager(mongo_client_with_data.tests)
 
@@ -176,6 +219,148 @@ class TestAddressManager:
 
         with pytest.raises(UrlExistsError):
             am.store_url_and_id(long_url, short_id, user_id)
+        with pytest.raises(UrlExistsError):
+            am.store_url_and_id("HTTPS://www.example.com:443/long/relative/path/?var=5#fragment", short_id, user_id)
+
+    def test_store_url_and_id_checks_types(self, mongo_client):
+        am = AddressManager(mongo_client.tests)
+        for long_url in [None, b"https://www.example.com", 5]:
+            with pytest.raises(TypeError):
+                am.store_url_and_id(long_url, "abcdef1", ObjectId())
+
+    def test_lookup_long_url(self, mongo_client_with_data):
+        am = AddressManager(mongo_client_with_data.tests)
+        assert am.lookup_long_url("https://www.example2.com/path") == "shortid"
+        assert am.lookup_long_url("https://WWW.EXAMPLE2.COM/path") == "shortid"
+        with pytest.raises(UrlNotFoundError):
+            am.lookup_long_url("https://www.example2.com/path/")
+        with pytest.raises(UrlNotFoundError):
+            am.lookup_long_url("not a url")
+
+    def test_shorten(self, mongo_client):
+        ensure_indexes(mongo_client.tests)
+        urls: Collection = mongo_client.tests.urls
+        am = AddressManager(mongo_client.tests)
+        auth = UserAuthenticator(mongo_client.tests)
+        user_id = auth.register_user("example_user1", "S3cret_p4$$word")
+
+        long_url = "https://www.example.com/long/relative/path/?var=5#fragment"
+        short_id = am.shorten(long_url, user_id)
+        result = urls.find_one({SHORT_ID_IDENTIFIER: short_id})
+        assert len(short_id) == 7
+        assert result[LONG_URL_IDENTIFIER] == long_url
+        assert result[CREATOR_ID_IDENTIFIER] == user_id
+        assert result[VISITS_COUNT_IDENTIFIER] == 0
+
+        with pytest.raises(UrlExistsError):
+            am.shorten(long_url, user_id)
+        with pytest.raises(UrlExistsError):
+            am.shorten("https://WWW.example.com/long/relative/path/?var=5#fragment", user_id)
+        with pytest.raises(UrlInvalidError):
+            am.shorten("ht://wwwww.example.c5/", user_id)
+        with pytest.raises(UserNotFoundError):
+            am.shorten("https://www.example2.com", ObjectId(b"example_user"))
+
+    def test_shorten_retries_on_collision(self, mongo_client_with_data):
+        ensure_indexes(mongo_client_with_data.tests)
+        users: Collection = mongo_client_with_data.tests.users
+        user_id = users.find_one({USERNAME_IDENTIFIER: "example_user3"})[USER_ID_IDENTIFIER]
+
+        class FixedAllocator:
+            def __init__(self, short_ids):
+                self.short_ids = iter(short_ids)
+
+            def allocate(self):
+                return next(self.short_ids)
+
+        am = AddressManager(
+            mongo_client_with_data.tests,
+            allocator=FixedAllocator(["abcdef1", "shortid", "newid12"]),
+        )
+        assert am.shorten("https://www.example3.com", user_id, check_creator=False) == "newid12"
+
+        am = AddressManager(
+            mongo_client_with_data.tests,
+            allocator=FixedAllocator(["abcdef1"] * 3),
+        )
+        with pytest.raises(ShortIdAllocationError):
+            am.shorten("https://www.example4.com", user_id, max_attempts=3)
+
+    def test_shorten_with_counter_allocator(self, mongo_client):
+        ensure_indexes(mongo_client.tests)
+        mongo_client.tests.drop_collection("counters")
+        allocator = CounterIdAllocator(mongo_client.tests.counters, b"key", block_size=5)
+        am = AddressManager(mongo_client.tests, allocator=allocator)
+        auth = UserAuthenticator(mongo_client.tests)
+        user_id = auth.register_user("example_user1", "S3cret_p4$$word")
+        short_ids = {
+            am.shorten(f"https://www.example{i}.com", user_id, check_creator=False)
+            for i in range(12)
+        }
+        assert len(short_ids) == 12
+        for short_id in short_ids:
+            assert am.lookup_short_id(short_id).startswith("https://www.example")
+
+    def test_store_many(self, mongo_client_with_data):
+        ensure_indexes(mongo_client_with_data.tests)
+        urls: Collection = mongo_client_with_data.tests.urls
+        users: Collection = mongo_client_with_data.tests.users
+        user_id = users.find_one({USERNAME_IDENTIFIER: "example_user3"})[USER_ID_IDENTIFIER]
+        am = AddressManager(mongo_client_with_data.tests)
+        long_urls = [
+            "https://www.example3.com",
+            "https://www.example.com/long/relative/path/?var=5#fragment",  # stored
+            "ht://wwwww.example.c5/",
+            "https://www.example4.com",
+            "https://www.example3.com",  # repeated in batch
+        ]
+        results = am.store_many(long_urls, user_id)
+        assert [result[LONG_URL_IDENTIFIER] for result in results] == long_urls
+        assert [result["status"] for result in results] == [
+            "created", "exists", "invalid", "created", "exists"
+        ]
+        assert results[1][SHORT_ID_IDENTIFIER] == "abcdef1"
+        assert results[2][SHORT_ID_IDENTIFIER] is None
+        assert results[4][SHORT_ID_IDENTIFIER] == results[0][SHORT_ID_IDENTIFIER]
+        for result in (results[0], results[3]):
+            link = urls.find_one({SHORT_ID_IDENTIFIER: result[SHORT_ID_IDENTIFIER]})
+            assert link[LONG_URL_IDENTIFIER] == result[LONG_URL_IDENTIFIER]
+            assert link[CREATOR_ID_IDENTIFIER] == user_id
+        assert urls.count_documents({}) == 5
+
+        with pytest.raises(UserNotFoundError):
+            am.store_many(["https://www.example5.com"], ObjectId(b"example_user"))
+
+    def test_store_many_retries_on_collision(self, mongo_client_with_data):
+        ensure_indexes(mongo_client_with_data.tests)
+        users: Collection = mongo_client_with_data.tests.users
+        user_id = users.find_one({USERNAME_IDENTIFIER: "example_user3"})[USER_ID_IDENTIFIER]
+
+        class FixedAllocator:
+            def __init__(self, short_ids):
+                self.short_ids = iter(short_ids)
+
+            def allocate(self):
+                return next(self.short_ids)
+
+        # Second URL collides with an existing short ID, then succeeds
+        am = AddressManager(
+            mongo_client_with_data.tests,
+            allocator=FixedAllocator(["newid01", "abcdef1", "newid02"]),
+        )
+        results = am.store_many(
+            ["https://www.example3.com", "https://www.example4.com"],
+            user_id,
+        )
+        assert [result["status"] for result in results] == ["created", "created"]
+        assert [result[SHORT_ID_IDENTIFIER] for result in results] == ["newid01", "newid02"]
+
+        am = AddressManager(
+            mongo_client_with_data.tests,
+            allocator=FixedAllocator(["abcdef1"] * 2),
+        )
+        results = am.store_many(["https://www.example5.com"], user_id, max_attempts=2)
+        assert results[0]["status"] == "failed"
 
     def test_lookup_short_id(self, mongo_client_with_data):
         am = AddressManager(mongo_client_with_data.tests)
@@ -194,6 +379,76 @@ class TestAddressManager:
         assert am.lookup_short_id(short_id, count_visit=True) == long_url
         assert urls.find_one({SHORT_ID_IDENTIFIER: short_id})[VISITS_COUNT_IDENTIFIER] == visits + 1
 
+    def test_lookup_short_id_read_database(self, mongo_client_with_data):
+        # A second database stands in for a lagging secondary
+        lagging = mongo_client_with_data.tests_read
+        lagging.drop_collection("urls")
+        lagging.urls.insert_one({LONG_URL_IDENTIFIER: "https://www.example.org", SHORT_ID_IDENTIFIER: "abcdef1"})
+        am = AddressManager(mongo_client_with_data.tests, read_database=lagging)
+        assert am.lookup_short_id("abcdef1") == "https://www.example.org"
+        # Links not replicated yet are read from the primary
+        assert am.lookup_short_id("shortid") == "https://www.example2.com/path"
+        with pytest.raises(UrlNotFoundError):
+            am.lookup_short_id("xyz1234")
+        # Counting a visit without a visit counter writes, on the primary
+        long_url = "https://www.example.com/long/relative/path/?var=5#fragment"
+        assert am.lookup_short_id("abcdef1", count_visit=True) == long_url
+
+    def test_lookup_short_id_cached(self, mongo_client_with_data):
+        urls: Collection = mongo_client_with_data.tests.urls
+        cache = RedirectCache(10)
+        am = AddressManager(mongo_client_with_data.tests, cache=cache)
+        long_url = "https://www.example.com/long/relative/path/?var=5#fragment"
+
+        assert am.lookup_short_id("abcdef1") == long_url
+        assert cache.get("abcdef1") == long_url
+        # Served from the cache without reading the collection
+        urls.update_one({SHORT_ID_IDENTIFIER: "abcdef1"}, {"$set": {LONG_URL_IDENTIFIER: "https://www.example.org"}})
+        assert am.lookup_short_id("abcdef1") == long_url
+
+        # Misses are cached
+        with pytest.raises(UrlNotFoundError):
+            am.lookup_short_id("xyz1234")
+        assert cache.get("xyz1234", "absent") is None
+        with pytest.raises(UrlNotFoundError):
+            am.lookup_short_id("xyz1234")
+        assert cache.stats()["hits"] >= 2
+
+    def test_lookup_short_id_cached_count_visit(self, mongo_client_with_data):
+        urls: Collection = mongo_client_with_data.tests.urls
+        am = AddressManager(mongo_client_with_data.tests, cache=RedirectCache(10))
+        short_id = "abcdef1"
+        visits = urls.find_one({SHORT_ID_IDENTIFIER: short_id})[VISITS_COUNT_IDENTIFIER]
+        am.lookup_short_id(short_id, count_visit=True)
+        am.lookup_short_id(short_id, count_visit=True)  # cache hit
+        # Unacknowledged write may not be applied immediately
+        for _ in range(100):
+            if urls.find_one({SHORT_ID_IDENTIFIER: short_id})[VISITS_COUNT_IDENTIFIER] == visits + 2:
+                break
+        assert urls.find_one({SHORT_ID_IDENTIFIER: short_id})[VISITS_COUNT_IDENTIFIER] == visits + 2
+
+    def test_store_url_and_id_invalidates_cache(self, mongo_client):
+        cache = RedirectCache(10)
+        am = AddressManager(mongo_client.tests, cache=cache)
+        auth = UserAuthenticator(mongo_client.tests)
+        user_id = auth.register_user("example_user1", "S3cret_p4$$word")
+        with pytest.raises(UrlNotFoundError):
+            am.lookup_short_id("abcdef1")
+        am.store_url_and_id("https://www.example.com", "abcdef1", user_id)
+        assert am.lookup_short_id("abcdef1") == "https://www.example.com"
+
+    def test_delete_invalidates_cache(self, mongo_client_with_data):
+        cache = RedirectCache(10)
+        am = AddressManager(mongo_client_with_data.tests, cache=cache)
+        am.lookup_short_id("abcdef1")
+        am.lookup_short_id("shortid")
+        am.delete_short_id("abcdef1")
+        with pytest.raises(UrlNotFoundError):
+            am.lookup_short_id("abcdef1")
+        am.delete_url("https://www.example2.com/path")
+        with pytest.raises(UrlNotFoundError):
+            am.lookup_short_id("shortid")
+
     def test_delete_url(self, mongo_client_with_data):
         urls: Collection = mongo_client_with_data.tests.urls
         am = AddressManager(mongo_client_with_data.tests)
@@ -216,6 +471,51 @@ class TestAddressManager:
         am.delete_short_id(short_id)
         assert urls.find_one({SHORT_ID_IDENTIFIER: short_id}) is None
 
+    def test_delete_tombstones(self, mongo_client_with_data):
+        database = mongo_client_with_data.tests
+        database.drop_collection("tombstones")
+        AddressManager(database).delete_short_id("abcdef1")
+        assert database.tombstones.count_documents({}) == 0  # no snapshots to tell
+        AddressManager(database, tombstones=True).delete_short_id("1234567")
+        assert database.tombstones.find_one()[TOMBSTONE_SHORT_ID_IDENTIFIER] == "1234567"
+
+    def test_delete_cleanup_order(self, mongo_client_with_data, monkeypatch):
+        calls = []
+        cache = RedirectCache(10)
+        monkeypatch.setattr(cache, "invalidate_many", lambda short_ids: calls.append(("cache", short_ids)))
+        am = AddressManager(mongo_client_with_data.tests, cache=cache)
+        monkeypatch.setattr(am._visits, "delete_many", lambda query: calls.append(("visits", query)))
+        am.delete_short_id("abcdef1")
+        am.delete_url("https://www.example2.com/path")
+        assert calls == [
+            ("cache", ["abcdef1"]),
+            ("visits", {VISIT_SHORT_ID_IDENTIFIER: {"$in": ["abcdef1"]}}),
+            ("cache", ["shortid"]),
+            ("visits", {VISIT_SHORT_ID_IDENTIFIER: {"$in": ["shortid"]}}),
+        ]
+
+    def test_delete_short_id_creator(self, mongo_client_with_data):
+        urls: Collection = mongo_client_with_data.tests.urls
+        am = AddressManager(mongo_client_with_data.tests)
+        link = urls.find_one({SHORT_ID_IDENTIFIER: "abcdef1"})
+        with pytest.raises(UrlNotFoundError):
+            am.delete_short_id("abcdef1", creator_id=ObjectId())
+        assert urls.find_one({SHORT_ID_IDENTIFIER: "abcdef1"}) is not None
+        am.delete_short_id("abcdef1", creator_id=link[CREATOR_ID_IDENTIFIER])
+        assert urls.find_one({SHORT_ID_IDENTIFIER: "abcdef1"}) is None
+
+    def test_lookup_link(self, mongo_client_with_data):
+        urls: Collection = mongo_client_with_data.tests.urls
+        am = AddressManager(mongo_client_with_data.tests)
+        creator_id = urls.find_one({SHORT_ID_IDENTIFIER: "abcdef1"})[CREATOR_ID_IDENTIFIER]
+        link = am.lookup_link("abcdef1", creator_id=creator_id)
+        assert link[SHORT_ID_IDENTIFIER] == "abcdef1"
+        assert link[LONG_URL_IDENTIFIER] == am.lookup_short_id("abcdef1")
+        with pytest.raises(UrlNotFoundError):
+            am.lookup_link("abcdef1", creator_id=ObjectId())
+        with pytest.raises(UrlNotFoundError):
+            am.lookup_link("1111111")
+
     def test_compose_shortened_url(self):
         # Trailing slash
         assert AddressManager.compose_shortened_url(
@@ -239,3 +539,26 @@ class TestAddressManager:
         assert SHORT_ID_IDENTIFIER in am.lookup_user_urls(user_id1)[0]
         with pytest.raises(UserNotFoundError):
             am.lookup_user_urls(ObjectId(b"_nonexistent"))
+
+    def test_lookup_user_urls_projection(self, mongo_client_with_data):
+        am = AddressManager(mongo_client_with_data.tests)
+        user_id1 = am._users.find_one({USERNAME_IDENTIFIER: "example_user1"})[USER_ID_IDENTIFIER]
+        link = am.lookup_user_urls(user_id1)[0]
+        assert CREATOR_ID_IDENTIFIER not in link  # not needed by listings
+        link = am.lookup_user_urls(user_id1, projection={SHORT_ID_IDENTIFIER: True})[0]
+        assert LONG_URL_IDENTIFIER not in link
+        # Existence check skipped
+        assert am.lookup_user_urls(ObjectId(b"_nonexistent"), check_user=False) == []
+
+    def test_iter_user_urls_pages(self, mongo_client_with_data):
+        am = AddressManager(mongo_client_with_data.tests)
+        user_id1 = am._users.find_one({USERNAME_IDENTIFIER: "example_user1"})[USER_ID_IDENTIFIER]
+        all_links = am.lookup_user_urls(user_id1)
+        assert [link[SHORT_ID_IDENTIFIER] for link in all_links] == ["abcdef1", "shortid"]  # creation order
+        first_page = list(am.iter_user_urls(user_id1, limit=1))
+        assert [link[SHORT_ID_IDENTIFIER] for link in first_page] == ["abcdef1"]
+        second_page = list(am.iter_user_urls(user_id1, after=first_page[-1]["_id"], limit=1))
+        assert [link[SHORT_ID_IDENTIFIER] for link in second_page] == ["shortid"]
+        assert list(am.iter_user_urls(user_id1, after=second_page[-1]["_id"], limit=1)) == []
+        with pytest.raises(UserNotFoundError):
+            am.iter_user_urls(ObjectId(b"_nonexistent"))
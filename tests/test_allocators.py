@@ -0,0 +1,102 @@
+import pytest
+
+from pymongo import MongoClient
+
+from yocto import create_app
+import yocto.allocators
+from yocto.allocators import (
+    ALPHABET,
+    CounterIdAllocator,
+    RandomIdAllocator,
+    get_id_allocator,
+    keyspace_size,
+)
+from yocto.lib.exceptions import ShortIdAllocationError
+from yocto.lib.utils import (
+    COUNTER_ID_IDENTIFIER,
+    COUNTER_VALUE_IDENTIFIER,
+)
+
+@pytest.fixture()
+def mongo_client():
+    client = MongoClient(host="localhost", port=27017)
+    client.tests.drop_collection("counters")
+    client.tests.drop_collection("urls")
+    return client
+
+
+def test_alphabet():
+    assert len(ALPHABET) == 64
+    assert len(set(ALPHABET)) == 64
+    assert keyspace_size(7) == 64 ** 7
+
+
+class TestRandomIdAllocator:
+    def test_allocate(self):
+        for length in range(4, 12):
+            short_id = RandomIdAllocator(length).allocate()
+            assert len(short_id) == length
+            assert all(c in ALPHABET for c in short_id)
+
+    def test_keyspace_usage(self, mongo_client):
+        allocator = RandomIdAllocator(2)
+        assert allocator.keyspace_usage(mongo_client.tests.urls) == 0
+        mongo_client.tests.urls.insert_many([{"n": i} for i in range(64)])
+        assert allocator.keyspace_usage(mongo_client.tests.urls) == 64 / 4096
+
+
+class TestCounterIdAllocator:
+    def test_encode_is_bijective(self):
+        allocator = CounterIdAllocator(None, b"key", length=2)
+        short_ids = {allocator.encode(value) for value in range(keyspace_size(2))}
+        assert len(short_ids) == keyspace_size(2)
+        assert all(len(short_id) == 2 for short_id in short_ids)
+        assert all(c in ALPHABET for short_id in short_ids for c in short_id)
+
+    def test_encode_depends_on_key(self):
+        allocator1 = CounterIdAllocator(None, b"key1")
+        allocator2 = CounterIdAllocator(None, b"key2")
+        assert [allocator1.encode(v) for v in range(10)] != [allocator2.encode(v) for v in range(10)]
+        # Consecutive values give unrelated IDs
+        assert allocator1.encode(0)[:-1] != allocator1.encode(1)[:-1]
+
+    def test_allocate_leases_blocks(self, mongo_client):
+        counters = mongo_client.tests.counters
+        allocator = CounterIdAllocator(counters, b"key", block_size=10)
+        other = CounterIdAllocator(counters, b"key", block_size=10)
+        short_ids = [allocator.allocate() for _ in range(15)]
+        short_ids += [other.allocate() for _ in range(15)]
+        assert len(set(short_ids)) == 30
+        assert all(len(short_id) == 7 for short_id in short_ids)
+        # Two blocks leased by each allocator
+        assert counters.find_one({COUNTER_ID_IDENTIFIER: "short_id"})[COUNTER_VALUE_IDENTIFIER] == 40
+        assert allocator.keyspace_usage() == 40 / keyspace_size(7)
+
+    def test_allocate_after_fork(self, mongo_client, monkeypatch):
+        counters = mongo_client.tests.counters
+        allocator = CounterIdAllocator(counters, b"key", block_size=10)
+        allocator.allocate()
+        monkeypatch.setattr(yocto.allocators.os, "getpid", lambda: -1)
+        allocator.allocate()  # child leases its own block
+        assert counters.find_one({COUNTER_ID_IDENTIFIER: "short_id"})[COUNTER_VALUE_IDENTIFIER] == 20
+
+    def test_allocate_exhausted(self, mongo_client):
+        allocator = CounterIdAllocator(mongo_client.tests.counters, b"key", length=1, block_size=64)
+        short_ids = {allocator.allocate() for _ in range(64)}
+        assert short_ids == set(ALPHABET)
+        with pytest.raises(ShortIdAllocationError):
+            allocator.allocate()
+
+
+def test_init_app():
+    app = create_app("TestingConfig")
+    with app.app_context():
+        assert isinstance(get_id_allocator(), RandomIdAllocator)
+        assert get_id_allocator().length == app.config["SHORT_ID_LENGTH"]
+    app.config["SHORT_ID_ALLOCATOR"] = "counter"
+    yocto.allocators.init_app(app)
+    with app.app_context():
+        assert isinstance(get_id_allocator(), CounterIdAllocator)
+    app.config["SHORT_ID_ALLOCATOR"] = "sequential"
+    with pytest.raises(ValueError):
+        yocto.allocators.init_app(app)
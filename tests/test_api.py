@@ -0,0 +1,255 @@
+import pytest
+
+from yocto import create_app
+from yocto.db import init_db, get_db
+from yocto.auth import UserAuthenticator
+from yocto.address import AddressManager
+from yocto.cache import get_token_cache
+from yocto.lib.exceptions import UrlExistsError, UrlNotFoundError
+from yocto.lib.utils import (
+    USERNAME_IDENTIFIER,
+    SHORT_ID_IDENTIFIER,
+    VISITS_COUNT_IDENTIFIER,
+)
+
+@pytest.fixture()
+def app():
+    app = create_app("TestingConfig")
+    with app.app_context():
+        init_db()  # work with a fresh database
+    yield app
+
+
+@pytest.fixture()
+def token(app):
+    # Create a user with a link and an API token
+    with app.app_context():
+        db = get_db()
+        auth = UserAuthenticator(db)
+        user_id = auth.register_user("new_user", "V4l1d_password")
+        AddressManager(db).store_url_and_id("https://www.example.com", "abcdef1", user_id)
+        return auth.create_token(user_id, "test")
+
+
+@pytest.fixture()
+def client(app):
+    return app.test_client()
+
+
+def bearer(token):
+    return {"Authorization": f"Bearer {token}"}
+
+
+def test_token_required(client, token):
+    response = client.get("/api/v1/links/abcdef1")
+    assert response.status_code == 401
+    assert response.headers["WWW-Authenticate"] == "Bearer"
+    assert response.json == {"error": "An API token is required."}
+    response = client.get("/api/v1/links/abcdef1", headers=bearer("not-a-token"))
+    assert response.status_code == 401
+    assert response.json == {"error": "The API token is not valid."}
+
+
+def test_token_cached(app, client, token):
+    client.get("/api/v1/links/abcdef1", headers=bearer(token))
+    with app.app_context():
+        assert len(get_token_cache()) == 1
+        # Later requests are authenticated without the database
+        get_db().tokens.delete_many({})
+    response = client.get("/api/v1/links/abcdef1", headers=bearer(token))
+    assert response.status_code == 200
+
+
+def test_revoked_token_invalidated_in_other_workers(app, token):
+    other = create_app("TestingConfig")  # another worker process
+    other.extensions["yocto.cache_invalidator"].poll_interval = 0
+    other_client = other.test_client()
+    assert other_client.get("/api/v1/links/abcdef1", headers=bearer(token)).status_code == 200
+    result = app.test_cli_runner().invoke(args=["revoke-api-token", "new_user", "--name", "test"])
+    assert result.exit_code == 0
+    response = other_client.get("/api/v1/links/abcdef1", headers=bearer(token))
+    assert response.status_code == 401
+
+
+def test_create_link_deleted_owner(app, client, token):
+    client.get("/api/v1/links/abcdef1", headers=bearer(token))  # token cached
+    with app.app_context():
+        get_db().users.delete_many({})
+    response = client.post("/api/v1/links", json={"url": "https://www.xyz.com"}, headers=bearer(token))
+    assert response.status_code == 401
+    response = client.post("/api/v1/links/batch", json={"urls": ["https://www.xyz.com"]}, headers=bearer(token))
+    assert response.status_code == 401
+    with app.app_context():
+        assert get_db().urls.count_documents({}) == 1
+
+def test_create_link(app, client, token):
+    response = client.post(
+        "/api/v1/links",
+        json={"url": "https://www.example2.com"},
+        headers=bearer(token),
+    )
+    assert response.status_code == 201
+    short_id = response.json["short_id"]
+    assert response.json["long_url"] == "https://www.example2.com"
+    assert response.json["short_url"] == f"http://localhost/{short_id}"
+    with app.app_context():
+        assert AddressManager(get_db()).lookup_short_id(short_id) == "https://www.example2.com"
+
+
+def test_create_link_existing(client, token):
+    response = client.post(
+        "/api/v1/links",
+        json={"url": "https://www.example.com"},
+        headers=bearer(token),
+    )
+    assert response.status_code == 200
+    assert response.json["short_id"] == "abcdef1"
+
+
+def test_create_link_existing_deleted(monkeypatch, client, token):
+    # The existing link is deleted between the insert and the lookup
+    def shorten(self, *args, **kwargs):
+        raise UrlExistsError
+
+    def lookup_long_url(self, long_url):
+        raise UrlNotFoundError
+
+    monkeypatch.setattr(AddressManager, "shorten", shorten)
+    monkeypatch.setattr(AddressManager, "lookup_long_url", lookup_long_url)
+    response = client.post("/api/v1/links", json={"url": "https://www.xyz.com"}, headers=bearer(token))
+    assert response.status_code == 409
+
+def test_create_link_invalid(client, token):
+    response = client.post("/api/v1/links", json={"url": "not a url"}, headers=bearer(token))
+    assert response.status_code == 400
+    response = client.post("/api/v1/links", json=["https://www.example2.com"], headers=bearer(token))
+    assert response.status_code == 400
+    response = client.post("/api/v1/links", data="{", headers=bearer(token))
+    assert response.status_code == 400
+
+
+def test_create_links_batch(client, token):
+    response = client.post(
+        "/api/v1/links/batch",
+        json={"urls": ["https://www.example2.com", "https://www.example.com", "not a url"]},
+        headers=bearer(token),
+    )
+    assert response.status_code == 201
+    links = response.json["links"]
+    assert [link["status"] for link in links] == ["created", "exists", "invalid"]
+    assert links[1]["short_id"] == "abcdef1"
+    assert "short_id" not in links[2]
+
+
+def test_create_links_batch_too_large(app, client, token):
+    app.config["API_BATCH_MAX_SIZE"] = 2
+    response = client.post(
+        "/api/v1/links/batch",
+        json={"urls": ["https://www.example2.com"] * 3},
+        headers=bearer(token),
+    )
+    assert response.status_code == 413
+
+
+def test_resolve_link(app, client, token):
+    response = client.get("/api/v1/links/abcdef1", headers=bearer(token))
+    assert response.status_code == 200
+    assert response.json["long_url"] == "https://www.example.com"
+    etag = response.headers["ETag"]
+    response = client.get(
+        "/api/v1/links/abcdef1",
+        headers={**bearer(token), "If-None-Match": etag},
+    )
+    assert response.status_code == 304
+    with app.app_context():
+        link = get_db().urls.find_one({SHORT_ID_IDENTIFIER: "abcdef1"})
+        assert link[VISITS_COUNT_IDENTIFIER] == 0  # not counted as visits
+    response = client.get("/api/v1/links/xxxxxxx", headers=bearer(token))
+    assert response.status_code == 404
+
+
+def test_link_stats(client, token):
+    client.get("/abcdef1")  # visit
+    response = client.get("/api/v1/links/abcdef1/stats", headers=bearer(token))
+    assert response.status_code == 200
+    assert response.json["visits"] == 1
+    assert response.json["created"] is not None
+    etag = response.headers["ETag"]
+    client.get("/abcdef1")
+    response = client.get(
+        "/api/v1/links/abcdef1/stats",
+        headers={**bearer(token), "If-None-Match": etag},
+    )
+    assert response.status_code == 200  # changed
+    assert response.json["visits"] == 2
+
+
+def test_delete_link(app, client, token):
+    with app.app_context():
+        auth = UserAuthenticator(get_db())
+        other = auth.register_user("other_user", "V4l1d_password")
+        other_token = auth.create_token(other, "test")
+    # Only the creator may delete a link
+    response = client.delete("/api/v1/links/abcdef1", headers=bearer(other_token))
+    assert response.status_code == 404
+    response = client.get("/api/v1/links/abcdef1/stats", headers=bearer(other_token))
+    assert response.status_code == 404
+    response = client.delete("/api/v1/links/abcdef1", headers=bearer(token))
+    assert response.status_code == 204
+    response = client.get("/api/v1/links/abcdef1", headers=bearer(token))
+    assert response.status_code == 404
+
+
+def test_api_token_commands(app, token):
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["create-api-token", "new_user", "--name", "cli"])
+    assert result.exit_code == 0
+    new_token = result.output.strip()
+    with app.app_context():
+        user_id = get_db().users.find_one({USERNAME_IDENTIFIER: "new_user"})["_id"]
+        assert UserAuthenticator(get_db()).authenticate_token(new_token) == user_id
+    result = runner.invoke(args=["create-api-token", "new_user", "--name", "cli"])
+    assert "already has a token named 'cli'" in result.output
+    result = runner.invoke(args=["revoke-api-token", "new_user", "--name", "cli"])
+    assert "Revoked token 'cli' of user 'new_user'." in result.output
+    result = runner.invoke(args=["create-api-token", "unknown_user"])
+    assert "User 'unknown_user' not found." in result.output
+
+
+def test_link_visits(app, client, token):
+    client.get("/abcdef1")
+    client.get("/abcdef1")
+    response = client.get(
+        "/api/v1/links/abcdef1/visits",
+        query_string={"granularity": "day"},
+        headers=bearer(token),
+    )
+    assert response.status_code == 200
+    assert response.json["granularity"] == "day"
+    buckets = response.json["buckets"]
+    assert len(buckets) == 8  # the last 7 days
+    assert buckets[-1]["visits"] == 2
+    assert sum(bucket["visits"] for bucket in buckets) == 2
+    assert buckets[-1]["start"].endswith("T00:00:00Z")
+
+
+def test_link_visits_invalid(client, token):
+    url = "/api/v1/links/abcdef1/visits"
+    response = client.get(url, query_string={"granularity": "week"}, headers=bearer(token))
+    assert response.status_code == 400
+    response = client.get(url, query_string={"start": "yesterday"}, headers=bearer(token))
+    assert response.status_code == 400
+    response = client.get(
+        url,
+        query_string={"start": "2024-01-03T00:00:00", "end": "2024-01-02T00:00:00"},
+        headers=bearer(token),
+    )
+    assert response.status_code == 400
+    response = client.get(
+        url,
+        query_string={"granularity": "minute", "start": "2024-01-01", "end": "2024-02-01"},
+        headers=bearer(token),
+    )
+    assert response.status_code == 400
+    response = client.get("/api/v1/links/xxxxxxx/visits", headers=bearer(token))
+    assert response.status_code == 404
@@ -0,0 +1,116 @@
+import asyncio
+import pytest
+
+from pymongo import MongoClient
+from pymongo.collection import Collection
+
+from yocto.asgi import AsyncMongoClient, create_redirect_app
+from yocto.lib.utils import (
+    LONG_URL_IDENTIFIER,
+    SHORT_ID_IDENTIFIER,
+    VISITS_COUNT_IDENTIFIER,
+)
+
+# The locked PyMongo predates AsyncMongoClient, which arrived in 4.10
+pytestmark = pytest.mark.skipif(
+    AsyncMongoClient is None,
+    reason="The redirect service needs PyMongo 4.10 or later, or Motor",
+)
+
+@pytest.fixture()
+def urls():
+    client = MongoClient(host="localhost", port=27017)
+    client.tests.drop_collection("urls")
+    urls: Collection = client.tests.urls
+    urls.insert_many(
+        [
+            {
+                LONG_URL_IDENTIFIER: "https://www.example.com",
+                SHORT_ID_IDENTIFIER: "abcdef1",
+                VISITS_COUNT_IDENTIFIER: 0,
+            },
+            {
+                LONG_URL_IDENTIFIER: "https://www.example.com/ñ",
+                SHORT_ID_IDENTIFIER: "1234567",
+                VISITS_COUNT_IDENTIFIER: 0,
+            },
+        ]
+    )
+    return urls
+
+
+@pytest.fixture()
+def app():
+    app = create_redirect_app("TestingConfig")
+    yield app
+    asyncio.run(app.close())
+
+
+def request(app, path, method="GET"):
+    # Send one HTTP request through the ASGI app, returning the status and headers
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {"type": "http", "method": method, "path": path, "root_path": "", "headers": []}
+    asyncio.run(app(scope, receive, send))
+    return messages[0]["status"], dict(messages[0]["headers"])
+
+
+def test_redirect(app, urls):
+    status, headers = request(app, "/abcdef1")
+    assert status == 302
+    assert headers[b"location"] == b"https://www.example.com"
+    status, headers = request(app, "/abcdef1/")
+    assert status == 302
+    assert headers[b"location"] == b"https://www.example.com"
+    # Visits are counted as by the Flask app
+    assert urls.find_one({SHORT_ID_IDENTIFIER: "abcdef1"})[VISITS_COUNT_IDENTIFIER] == 2
+
+
+def test_redirect_encodes_iri(app, urls):
+    status, headers = request(app, "/1234567")
+    assert status == 302
+    assert headers[b"location"] == b"https://www.example.com/%C3%B1"
+
+
+def test_redirect_unknown(app, urls):
+    status, headers = request(app, "/xxxxxxx")
+    assert status == 302
+    assert headers[b"location"].startswith(b"/pages/error/?message=Sorry")
+    assert app.cache.get("xxxxxxx", "not cached") is None  # miss cached
+
+
+def test_redirect_cached(app, urls):
+    request(app, "/abcdef1")
+    urls.delete_many({})
+    status, headers = request(app, "/abcdef1")
+    assert headers[b"location"] == b"https://www.example.com"
+
+
+def test_root_and_other_paths(app, urls):
+    status, headers = request(app, "/")
+    assert status == 302
+    assert headers[b"location"] == b"/pages/"
+    status, headers = request(app, "/pages/login/")
+    assert status == 404
+    status, headers = request(app, "/abcdef1", method="POST")
+    assert status == 405
+
+
+def test_lifespan(app):
+    sent = []
+    received = iter([{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}])
+
+    async def receive():
+        return next(received)
+
+    async def send(message):
+        sent.append(message["type"])
+
+    asyncio.run(app({"type": "lifespan"}, receive, send))
+    assert sent == ["lifespan.startup.complete", "lifespan.shutdown.complete"]
@@ -12,8 +12,14 @@ from yocto.auth import (
     PasswordInvalidError,
     UserExistsError,
     UserNotFoundError,
-    PasswordMismatchError
+    PasswordMismatchError,
+    hash_token,
 )
+from yocto.lib.exceptions import TokenInvalidError, TokenExistsError
+from yocto.cache import RedirectCache
+from yocto.hashing import PasswordHashingPool
+from yocto.indexes import ensure_indexes
+from yocto.lib.cache import LRUCache
 from yocto.lib.utils import (
     LONG_URL_IDENTIFIER,
     SHORT_ID_IDENTIFIER,
@@ -26,6 +32,8 @@ def mongo_client():
     client = MongoClient(host="localhost", port=27017)
     client.tests.drop_collection("users")
     client.tests.drop_collection("urls")
+    client.tests.drop_collection("tokens")
+    ensure_indexes(client.tests)
     return client
 
 class TestUserAuthenticator:
@@ -84,6 +92,17 @@ class TestUserAuthenticator:
         with pytest.raises(UserExistsError):
             auth.register_user(username, "...")
 
+    def test_register_user_single_round_trip(self, mongo_client, monkeypatch):
+        auth = UserAuthenticator(mongo_client.tests)
+        auth.register_user("test_user", "Test_p4s$word")
+        monkeypatch.setattr(
+            auth._users, "find_one", lambda *args, **kwargs: pytest.fail("username looked up")
+        )
+        auth.register_user("other_user", "Test_p4s$word")
+        with pytest.raises(UserExistsError):
+            auth.register_user("test_user", "Other_p4s$word")  # rejected by the unique index
+        assert mongo_client.tests.users.count_documents({"username": "test_user"}) == 1
+
     def test_authenticate_user(self, mongo_client):
         auth = UserAuthenticator(mongo_client.tests)
         username = "test_user"
@@ -96,6 +115,30 @@ class TestUserAuthenticator:
         with pytest.raises(UserNotFoundError):
             auth.authenticate_user("unseen_user", "password")
 
+    def test_authenticate_unknown_user_verifies_dummy_hash(self, mongo_client):
+        fast = PasswordHasher(time_cost=1, memory_cost=8, parallelism=1)
+        hasher = PasswordHashingPool(fast, processes=0, dummy_hash=fast.hash("dummy"))
+        verified = []
+        hasher.verify_dummy = verified.append
+        auth = UserAuthenticator(mongo_client.tests, hasher=hasher)
+        with pytest.raises(UserNotFoundError):
+            auth.authenticate_user("unseen_user", "Passw0rd_with_\u006e\u0303")
+        assert verified == ["Passw0rd_with_\u00f1"]  # normalized like a stored password
+
+    def test_authenticate_user_rehashes_stale_hash(self, mongo_client):
+        old = PasswordHashingPool(PasswordHasher(time_cost=1, memory_cost=8, parallelism=1), processes=0)
+        new = PasswordHashingPool(PasswordHasher(time_cost=2, memory_cost=16, parallelism=1), processes=0)
+        username = "test_user"
+        password = "Test_p4s$word"
+        UserAuthenticator(mongo_client.tests, hasher=old).register_user(username, password)
+        old_hash = mongo_client.tests.users.find_one({"username": username})["password_hash"]
+        auth = UserAuthenticator(mongo_client.tests, hasher=new)
+        auth.authenticate_user(username, password)
+        new_hash = mongo_client.tests.users.find_one({"username": username})["password_hash"]
+        assert new_hash != old_hash
+        assert not new.check_needs_rehash(new_hash)
+        assert auth.authenticate_user(username, password)  # new hash verifies
+
     def test_register_authenticate_with_unicode(self, mongo_client):
         auth = UserAuthenticator(mongo_client.tests)
         username = "test_user"
@@ -165,3 +208,68 @@ class TestUserAuthenticator:
         assert urls.find_one({CREATOR_ID_IDENTIFIER: user_id}) is None
         # Other users' links remain in urls
         assert urls.find_one({CREATOR_ID_IDENTIFIER: user_id2}) is not None
+
+    def test_delete_user_invalidates_redirect_cache(self, mongo_client):
+        cache = RedirectCache(10)
+        auth = UserAuthenticator(mongo_client.tests, redirect_cache=cache)
+        user_id = auth.register_user("test_user", "Test_p4s$word")
+        mongo_client.tests.urls.insert_one(
+            {
+                LONG_URL_IDENTIFIER: "https://www.example1.com",
+                SHORT_ID_IDENTIFIER: "Xa8b29q",
+                URL_CREATION_DATE_IDENTIFIER: datetime.now(),
+                CREATOR_ID_IDENTIFIER: user_id,
+            }
+        )
+        cache.set("Xa8b29q", "https://www.example1.com")
+        cache.set("u9Ms41p", "https://www.test.org/path")
+        auth.delete_user(user_id)
+        assert cache.get("Xa8b29q") is None
+        assert cache.get("u9Ms41p") == "https://www.test.org/path"
+
+    def test_delete_user_invalidates_user_cache(self, mongo_client):
+        cache = LRUCache(10)
+        auth = UserAuthenticator(mongo_client.tests, user_cache=cache)
+        user_id = auth.register_user("test_user", "Test_p4s$word")
+        cache.set(str(user_id), {"username": "test_user"})
+        auth.delete_user(user_id)
+        assert cache.get(str(user_id)) is None
+
+    def test_create_and_authenticate_token(self, mongo_client):
+        auth = UserAuthenticator(mongo_client.tests)
+        user_id = auth.register_user("test_user", "Test_p4s$word")
+        token = auth.create_token(user_id, "test")
+        assert auth.authenticate_token(token) == user_id
+        record = mongo_client.tests.tokens.find_one({"user_id": user_id})
+        assert token not in record.values()  # only the hash is stored
+        assert record["token_hash"] == hash_token(token)
+        with pytest.raises(TokenExistsError):
+            auth.create_token(user_id, "test")
+        with pytest.raises(TokenInvalidError):
+            auth.authenticate_token("not-a-token")
+        with pytest.raises(UserNotFoundError):
+            auth.create_token(ObjectId(), "test")
+
+    def test_revoke_token(self, mongo_client):
+        cache = LRUCache(10)
+        auth = UserAuthenticator(mongo_client.tests, token_cache=cache)
+        user_id = auth.register_user("test_user", "Test_p4s$word")
+        token = auth.create_token(user_id, "test")
+        auth.authenticate_token(token)
+        assert cache.get(hash_token(token)) == user_id
+        auth.revoke_token(user_id, "test")
+        assert cache.get(hash_token(token)) is None
+        with pytest.raises(TokenInvalidError):
+            auth.authenticate_token(token)
+        with pytest.raises(TokenInvalidError):
+            auth.revoke_token(user_id, "test")
+
+    def test_delete_user_removes_tokens(self, mongo_client):
+        cache = LRUCache(10)
+        auth = UserAuthenticator(mongo_client.tests, token_cache=cache)
+        user_id = auth.register_user("test_user", "Test_p4s$word")
+        token = auth.create_token(user_id, "test")
+        auth.authenticate_token(token)
+        auth.delete_user(user_id)
+        assert mongo_client.tests.tokens.find_one({"user_id": user_id}) is None
+        assert cache.get(hash_token(token)) is None
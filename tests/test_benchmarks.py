@@ -0,0 +1,39 @@
+from benchmarks.compare import change, compare
+from benchmarks.harness import percentile, summarize
+
+def test_percentile():
+    ordered = [float(i) for i in range(1, 101)]
+    assert percentile(ordered, 50) == 50.0
+    assert percentile(ordered, 95) == 95.0
+    assert percentile(ordered, 99) == 99.0
+    assert percentile(ordered, 0) == 1.0
+    assert percentile([3.0], 99) == 3.0
+    assert percentile([], 50) is None
+
+def test_summarize():
+    summary = summarize([0.001, 0.002, 0.003, 0.004], elapsed=0.5, errors=1, commands=6)
+    assert summary["requests"] == 4
+    assert summary["errors"] == 1
+    assert summary["latency_ms"]["p50"] == 2.0
+    assert summary["latency_ms"]["p99"] == 4.0
+    assert summary["latency_ms"]["mean"] == 2.5
+    assert summary["requests_per_second"] == 8.0
+    assert summary["db_ops_per_request"] == 1.5
+
+def test_compare():
+    def report(p50):
+        return {
+            "results": [
+                {
+                    "driver": "server",
+                    "scenario": "redirect",
+                    "latency_ms": {"p50": p50, "p95": p50, "p99": p50},
+                    "requests_per_second": 100.0,
+                    "db_ops_per_request": 1.0,
+                },
+            ]
+        }
+    lines = compare(report(2.0), report(1.0))
+    assert len(lines) == 6  # header and one line per metric
+    assert "-50.0%" in lines[1]
+    assert change(None, 1.0) == "n/a"
@@ -0,0 +1,171 @@
+from datetime import datetime
+import gzip
+import io
+import json
+import pytest
+
+from yocto import create_app
+from yocto.auth import UserAuthenticator
+from yocto.address import AddressManager
+from yocto.bulk import (
+    batched,
+    encode_chunks,
+    export_rows,
+    hash_long_urls,
+    read_urls,
+    write_rows,
+)
+from yocto.db import init_db, get_db
+from yocto.lib.urls import url_hash
+from yocto.lib.utils import (
+    LONG_URL_IDENTIFIER,
+    LONG_URL_HASH_IDENTIFIER,
+    SHORT_ID_IDENTIFIER,
+    URL_CREATION_DATE_IDENTIFIER,
+    VISITS_COUNT_IDENTIFIER,
+)
+
+@pytest.fixture()
+def app():
+    app = create_app("TestingConfig")
+    with app.app_context():
+        init_db()
+        UserAuthenticator(get_db()).register_user("new_user", "V4l1d_password")
+    yield app
+
+
+@pytest.fixture()
+def runner(app):
+    return app.test_cli_runner()
+
+
+def test_read_urls_csv():
+    stream = io.StringIO("name,url\na,https://www.example.com\nb,https://www.example2.com\n")
+    assert list(read_urls(stream, "csv")) == ["https://www.example.com", "https://www.example2.com"]
+    with pytest.raises(ValueError):
+        list(read_urls(io.StringIO("name,link\na,https://www.example.com\n"), "csv"))
+    assert list(read_urls(io.StringIO(""), "csv")) == []
+
+
+def test_read_urls_jsonl():
+    stream = io.StringIO('{"url": "https://www.example.com"}\n\n"https://www.example2.com"\n')
+    assert list(read_urls(stream, "jsonl")) == ["https://www.example.com", "https://www.example2.com"]
+    with pytest.raises(ValueError):
+        list(read_urls(io.StringIO('{"link": "https://www.example.com"}\n'), "jsonl"))
+    with pytest.raises(ValueError):
+        list(read_urls(io.StringIO(""), "xml"))
+
+
+def test_batched():
+    assert list(batched(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(batched([], 2)) == []
+
+
+def test_bulk_shorten_command(app, runner, tmp_path):
+    source = tmp_path / "urls.csv"
+    source.write_text(
+        "url\nhttps://www.example.com\nhttps://www.example2.com\n"
+        "https://www.example.123\nhttps://www.example.com\n"
+    )
+    output = tmp_path / "results.jsonl"
+    result = runner.invoke(
+        args=["bulk-shorten", str(source), "--user", "new_user", "--batch-size", "3", "--output", str(output)]
+    )
+    assert result.exit_code == 0
+    assert "Processed 4 URLs" in result.output
+    assert "2 created, 1 existing, 1 invalid, 0 failed." in result.output
+    results = [json.loads(line) for line in output.read_text().splitlines()]
+    assert [r["status"] for r in results] == ["created", "created", "invalid", "exists"]
+    with app.app_context():
+        db = get_db()
+        for r in results[:2]:
+            assert db.urls.find_one({SHORT_ID_IDENTIFIER: r[SHORT_ID_IDENTIFIER]})[LONG_URL_IDENTIFIER] == r[LONG_URL_IDENTIFIER]
+
+
+def test_hash_long_urls(app, runner):
+    with app.app_context():
+        urls = get_db().urls
+        urls.insert_many(
+            [
+                {LONG_URL_IDENTIFIER: "https://www.example.com", SHORT_ID_IDENTIFIER: "abcdef1"},
+                {LONG_URL_IDENTIFIER: "https://WWW.EXAMPLE.COM/", SHORT_ID_IDENTIFIER: "abcdef2"},
+                {LONG_URL_IDENTIFIER: "https://www.example2.com", SHORT_ID_IDENTIFIER: "abcdef3"},
+                {LONG_URL_IDENTIFIER: "not a url", SHORT_ID_IDENTIFIER: "abcdef4"},
+            ]
+        )
+        assert hash_long_urls(urls, batch_size=2) == {"hashed": 2, "duplicate": 1, "invalid": 1}
+        link = urls.find_one({SHORT_ID_IDENTIFIER: "abcdef3"})
+        assert link[LONG_URL_HASH_IDENTIFIER] == url_hash("https://www.example2.com")
+        assert urls.count_documents({LONG_URL_HASH_IDENTIFIER: {"$exists": False}}) == 2
+    result = runner.invoke(args=["hash-long-urls"])
+    assert result.exit_code == 0
+    assert "Hashed 0 links; left 1 duplicate and 1 invalid long URLs unhashed." in result.output
+
+
+def test_bulk_shorten_command_unknown_user(runner, tmp_path):
+    source = tmp_path / "urls.jsonl"
+    source.write_text('"https://www.example.com"\n')
+    result = runner.invoke(args=["bulk-shorten", str(source), "--user", "other_user"])
+    assert result.exit_code != 0
+    assert "User 'other_user' not found." in result.output
+
+
+def test_write_rows():
+    links = [
+        {
+            SHORT_ID_IDENTIFIER: "abcdef1",
+            LONG_URL_IDENTIFIER: "https://www.example.com/a,b",
+            URL_CREATION_DATE_IDENTIFIER: datetime(2024, 1, 2, 3, 4, 5),
+            VISITS_COUNT_IDENTIFIER: 3,
+        },
+    ]
+    rows = list(export_rows(links, "https://yoc.to/"))
+    assert rows == [
+        {
+            "short_id": "abcdef1",
+            "short_url": "https://yoc.to/abcdef1",
+            "long_url": "https://www.example.com/a,b",
+            "created": "2024-01-02T03:04:05",
+            "visits": 3,
+        },
+    ]
+    assert "".join(write_rows(rows, "csv")) == (
+        "short_id,short_url,long_url,created,visits\r\n"
+        'abcdef1,https://yoc.to/abcdef1,"https://www.example.com/a,b",2024-01-02T03:04:05,3\r\n'
+    )
+    assert "".join(write_rows([], "csv")) == "short_id,short_url,long_url,created,visits\r\n"
+    assert [json.loads(line) for line in write_rows(rows, "jsonl")] == rows
+    with pytest.raises(ValueError):
+        list(write_rows(rows, "xml"))
+
+
+def test_encode_chunks():
+    lines = [f"line {i}\n" for i in range(1000)]
+    chunks = list(encode_chunks(lines, chunk_size=100))
+    assert len(chunks) > 1
+    assert all(len(chunk) < 200 for chunk in chunks)
+    assert b"".join(chunks).decode() == "".join(lines)
+    compressed = b"".join(encode_chunks(lines, compress=True))
+    assert gzip.decompress(compressed).decode() == "".join(lines)
+    assert gzip.decompress(b"".join(encode_chunks([], compress=True))) == b""
+
+
+def test_export_links_command(app, runner, tmp_path):
+    with app.app_context():
+        db = get_db()
+        user_id = db.users.find_one()["_id"]
+        am = AddressManager(db)
+        am.store_url_and_id("https://www.example.com", "abcdef1", user_id)
+        am.store_url_and_id("https://www.example2.com", "1234567", user_id)
+    result = runner.invoke(args=["export-links", "new_user", "--root-url", "https://yoc.to/"])
+    assert result.exit_code == 0
+    assert result.output.splitlines()[1].startswith("abcdef1,https://yoc.to/abcdef1,https://www.example.com,")
+    output = tmp_path / "links.jsonl.gz"
+    result = runner.invoke(
+        args=["export-links", "new_user", "--format", "jsonl", "--gzip", "--output", str(output)]
+    )
+    assert result.exit_code == 0
+    lines = gzip.decompress(output.read_bytes()).decode().splitlines()
+    assert [json.loads(line)["short_id"] for line in lines] == ["abcdef1", "1234567"]
+    result = runner.invoke(args=["export-links", "other_user"])
+    assert "User 'other_user' not found." in result.output
@@ -0,0 +1,429 @@
+import socketserver
+import threading
+import time
+import pytest
+
+from pymongo import MongoClient
+
+from yocto import create_app
+from yocto.address import AddressManager
+from yocto.cache import (
+    CacheInvalidator,
+    RedirectCache,
+    SharedRedirectCache,
+    TieredRedirectCache,
+    get_cache_invalidator,
+    get_redirect_cache,
+)
+from yocto.auth import UserAuthenticator
+from yocto.db import get_db, init_db
+from yocto.indexes import INVALIDATION_RETENTION
+from yocto.lib.cache import LRUCache
+from yocto.lib.exceptions import UrlNotFoundError
+from yocto.lib.resp import RespClient, RespError, _read_reply
+from yocto.lib.utils import (
+    CREATOR_ID_IDENTIFIER,
+    LONG_URL_IDENTIFIER,
+    SHORT_ID_IDENTIFIER,
+)
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture()
+def timer():
+    return FakeTimer()
+
+
+class FakeRespServer(socketserver.ThreadingTCPServer):
+    """Local stand-in for a Redis server, with GET, SET, DEL, INCR, DECR, PEXPIRE and SELECT."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeRespHandler)
+        self.data = {}
+        self.commands = []
+
+    def run(self, *args):
+        self.commands.append(args)
+        name = args[0].upper()
+        if name == b"GET":
+            value, expiry = self.data.get(args[1], (None, None))
+            if expiry is not None and expiry <= time.monotonic():
+                return None
+            return value
+        if name == b"SET":
+            expiry = None
+            if len(args) == 5 and args[3].upper() == b"PX":
+                expiry = time.monotonic() + int(args[4]) / 1000
+            self.data[args[1]] = (args[2], expiry)
+            return "OK"
+        if name == b"DEL":
+            return sum(self.data.pop(key, None) is not None for key in args[1:])
+        if name in (b"INCR", b"DECR"):
+            value, expiry = self.data.get(args[1], (b"0", None))
+            value = int(value) + (1 if name == b"INCR" else -1)
+            self.data[args[1]] = (str(value).encode(), expiry)
+            return value
+        if name == b"PEXPIRE":
+            if args[1] not in self.data:
+                return 0
+            self.data[args[1]] = (self.data[args[1]][0], time.monotonic() + int(args[2]) / 1000)
+            return 1
+        if name == b"SELECT":
+            return "OK"
+        return RespError(f"ERR unknown command '{args[0].decode()}'")
+
+
+class FakeRespHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                args = _read_reply(self.rfile)
+            except ConnectionError:
+                return
+            reply = self.server.run(*args)
+            if reply is None:
+                self.wfile.write(b"$-1\r\n")
+            elif isinstance(reply, RespError):
+                self.wfile.write(b"-%s\r\n" % str(reply).encode())
+            elif isinstance(reply, int):
+                self.wfile.write(b":%d\r\n" % reply)
+            elif isinstance(reply, str):
+                self.wfile.write(b"+%s\r\n" % reply.encode())
+            else:
+                self.wfile.write(b"$%d\r\n%s\r\n" % (len(reply), reply))
+
+
+@pytest.fixture()
+def resp_server():
+    server = FakeRespServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture()
+def resp_client(resp_server):
+    host, port = resp_server.server_address
+    client = RespClient(host, port, timeout=1.0)
+    yield client
+    client.close()
+
+
+class TestLRUCache:
+    def test_get_set(self):
+        cache = LRUCache(10)
+        assert cache.get("abcdef1") is None
+        assert cache.get("abcdef1", "default") == "default"
+        cache.set("abcdef1", "https://www.example.com")
+        assert cache.get("abcdef1") == "https://www.example.com"
+        assert len(cache) == 1
+
+    def test_maxsize(self):
+        with pytest.raises(ValueError):
+            LRUCache(0)
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")  # "b" is now least recently used
+        cache.set("c", 3)
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert cache.get("c") == 3
+        assert cache.evictions == 1
+
+    def test_ttl(self, timer):
+        cache = LRUCache(10, ttl=5, timer=timer)
+        cache.set("a", 1)
+        cache.set("b", 2, ttl=20)
+        timer.now = 10
+        assert cache.get("a") is None
+        assert cache.get("b") == 2
+        assert cache.expirations == 1
+
+    def test_invalidate(self):
+        cache = LRUCache(10)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.set("c", 3)
+        cache.invalidate("a")
+        cache.invalidate("x")  # absent keys ignored
+        assert cache.get("a") is None
+        cache.invalidate_many(["b", "y"])
+        assert cache.get("b") is None
+        assert cache.get("c") == 3
+        cache.clear()
+        assert len(cache) == 0
+
+    def test_stats(self):
+        cache = LRUCache(1)
+        cache.set("a", 1)
+        cache.get("a")
+        cache.get("b")
+        cache.set("b", 2)
+        assert cache.stats() == {
+            "size": 1,
+            "hits": 1,
+            "misses": 1,
+            "evictions": 1,
+            "expirations": 0,
+        }
+
+
+class TestRedirectCache:
+    def test_set_missing(self, timer):
+        cache = RedirectCache(10, ttl=300, negative_ttl=10, timer=timer)
+        cache.set_missing("notreal")
+        assert cache.get("notreal", "absent") is None
+        timer.now = 11
+        assert cache.get("notreal", "absent") == "absent"
+
+    def test_negative_ttl_default(self):
+        cache = RedirectCache(10, ttl=300)
+        assert cache.negative_ttl == 300
+
+
+def test_init_app():
+    app = create_app("TestingConfig")
+    with app.app_context():
+        cache = get_redirect_cache()
+        assert isinstance(cache, RedirectCache)
+        assert cache.maxsize == app.config["REDIRECT_CACHE_SIZE"]
+    app = create_app("TestingConfig")
+    with app.app_context():
+        assert get_redirect_cache() is not cache  # one cache per app
+
+
+def test_init_app_disabled():
+    from yocto import cache
+    app = create_app("TestingConfig")
+    app.config["REDIRECT_CACHE_SIZE"] = 0
+    cache.init_app(app)
+    with app.app_context():
+        assert get_redirect_cache() is None
+
+
+class TestCacheInvalidator:
+    @pytest.fixture()
+    def collection(self):
+        client = MongoClient(host="localhost", port=27017)
+        client.tests.drop_collection("invalidations")
+        return client.tests.invalidations
+
+    def test_publish_poll(self, collection, timer):
+        timer.now = 1700000000.0
+        publisher = CacheInvalidator(collection, {"redirect": RedirectCache(10)}, synchronous=True, timer=timer)
+        cache = RedirectCache(10)
+        other = CacheInvalidator(collection, {"redirect": cache, "user": None}, synchronous=True, timer=timer)
+        assert set(other.caches) == {"redirect"}
+        cache.set("abcdef1", "https://www.example.com")
+        cache.set("abcdef2", "https://www.example.org")
+        publisher.publish("redirect", ["abcdef1"])
+        publisher.publish("user", ["abcdef2"])  # not a cache of this process
+        other.ensure_started()  # not due yet
+        assert cache.get("abcdef1") == "https://www.example.com"
+        timer.now += 1.0
+        other.ensure_started()
+        assert cache.get("abcdef1") is None
+        assert cache.get("abcdef2") == "https://www.example.org"
+        assert collection.count_documents({}) == 2
+
+    def test_poll_after_retention(self, collection, timer):
+        timer.now = 1700000000.0
+        cache = RedirectCache(10)
+        invalidator = CacheInvalidator(collection, {"redirect": cache}, synchronous=True, timer=timer)
+        cache.set("abcdef1", "https://www.example.com")
+        timer.now += INVALIDATION_RETENTION
+        # Invalidations may have expired unread, so everything is dropped
+        assert invalidator.poll() == 0
+        assert len(cache) == 0
+
+    def test_deletion_reaches_other_workers(self):
+        app = create_app("TestingConfig")
+        other = create_app("TestingConfig")  # another worker process
+        with app.app_context():
+            init_db()
+            user_id = UserAuthenticator(get_db()).register_user("new_user", "V4l1d_password")
+            get_db().urls.insert_one({
+                LONG_URL_IDENTIFIER: "https://www.example.com",
+                SHORT_ID_IDENTIFIER: "abcdef1",
+                CREATOR_ID_IDENTIFIER: user_id,
+            })
+        other.extensions["yocto.cache_invalidator"].poll_interval = 0
+        other_client = other.test_client()
+        assert other_client.get("/abcdef1").location == "https://www.example.com"
+        client = app.test_client()
+        client.post("/pages/login/", data={"uname": "new_user", "pw": "V4l1d_password"})
+        client.get("/pages/delete/confirmed/")
+        assert other_client.get("/abcdef1").location.startswith("/pages/error/")
+
+def test_init_app_invalidator():
+    app = create_app("TestingConfig")
+    with app.app_context():
+        invalidator = get_cache_invalidator()
+        assert set(invalidator.caches) == {"redirect", "user", "token"}
+        assert invalidator.synchronous
+    app.config["REDIRECT_CACHE_SIZE"] = 0
+    app.config["USER_CACHE_SIZE"] = 0
+    app.config["TOKEN_CACHE_SIZE"] = 0
+    from yocto import cache
+    cache.init_app(app)
+    with app.app_context():
+        assert get_cache_invalidator() is None
+
+
+class TestRespClient:
+    def test_commands(self, resp_client):
+        assert resp_client.execute("SET", "key", "value") == "OK"
+        assert resp_client.execute("GET", "key") == b"value"
+        assert resp_client.execute("GET", "other") is None
+        assert resp_client.execute("DEL", "key", "other") == 1
+        with pytest.raises(RespError):
+            resp_client.execute("NOTACOMMAND")
+        # The connection is still usable after an error reply
+        assert resp_client.execute("GET", "key") is None
+
+    def test_from_url(self):
+        client = RespClient.from_url("redis://:p%40ss@cache.local:6380/2", timeout=0.5)
+        assert (client.host, client.port, client.db, client.password, client.timeout) == (
+            "cache.local", 6380, 2, "p@ss", 0.5
+        )
+        with pytest.raises(ValueError):
+            RespClient.from_url("http://cache.local")
+
+    def test_select(self, resp_server):
+        host, port = resp_server.server_address
+        client = RespClient.from_url(f"redis://{host}:{port}/3")
+        client.execute("GET", "key")
+        assert resp_server.commands[0] == (b"SELECT", b"3")
+        client.close()
+
+
+class TestSharedRedirectCache:
+    def test_get_set(self, resp_client):
+        cache = SharedRedirectCache(resp_client, ttl=60, negative_ttl=5)
+        assert cache.get("abcdef1", "default") == "default"
+        cache.set("abcdef1", "https://www.example.com/é")
+        assert cache.get("abcdef1") == "https://www.example.com/é"
+        cache.set_missing("xxxxxxx")
+        assert cache.get("xxxxxxx", "default") is None
+        cache.invalidate_many(["abcdef1", "xxxxxxx"])
+        assert cache.get("abcdef1", "default") == "default"
+        stats = cache.stats()
+        assert (stats["hits"], stats["misses"], stats["errors"]) == (2, 2, 0)
+
+    def test_ttl(self, resp_server, resp_client):
+        cache = SharedRedirectCache(resp_client, ttl=60, negative_ttl=5, prefix="p:")
+        cache.set("abcdef1", "https://www.example.com")
+        cache.set_missing("xxxxxxx")
+        assert resp_server.commands[0] == (b"SET", b"p:abcdef1", b"https://www.example.com", b"PX", b"60000")
+        assert resp_server.commands[1] == (b"SET", b"p:xxxxxxx", b"", b"PX", b"5000")
+
+    def test_unavailable(self, timer):
+        # Nothing listens on port 9 of localhost
+        cache = SharedRedirectCache(RespClient("127.0.0.1", 9, timeout=0.1), retry_interval=5, timer=timer)
+        assert cache.get("abcdef1", "default") == "default"
+        cache.set("abcdef1", "https://www.example.com")
+        # Not tried again until the retry interval has passed
+        assert cache.stats()["errors"] == 1
+        timer.now += 5
+        cache.invalidate("abcdef1")
+        assert cache.stats()["errors"] == 2
+
+
+class TestTieredRedirectCache:
+    def test_read_through(self, resp_client):
+        shared = SharedRedirectCache(resp_client, ttl=60)
+        first = TieredRedirectCache(RedirectCache(10), shared)
+        second = TieredRedirectCache(RedirectCache(10), shared)
+        first.set("abcdef1", "https://www.example.com")
+        first.set_missing("xxxxxxx")
+        # Found by another worker in the shared tier, then kept locally
+        assert second.get("abcdef1") == "https://www.example.com"
+        assert second.get("xxxxxxx", "default") is None
+        assert second.local.get("abcdef1") == "https://www.example.com"
+        assert second.get("abcdef1") == "https://www.example.com"
+        assert shared.stats()["hits"] == 2
+        assert second.get("abcdef2", "default") == "default"
+
+    def test_address_manager_invalidates(self, resp_client):
+        client = MongoClient(host="localhost", port=27017)
+        client.tests.drop_collection("urls")
+        client.tests.urls.insert_one({LONG_URL_IDENTIFIER: "https://www.example.com", SHORT_ID_IDENTIFIER: "abcdef1"})
+        shared = SharedRedirectCache(resp_client, ttl=60)
+        am = AddressManager(client.tests, cache=TieredRedirectCache(RedirectCache(10), shared))
+        other = TieredRedirectCache(RedirectCache(10), shared)
+        assert am.lookup_short_id("abcdef1") == "https://www.example.com"
+        assert other.get("abcdef1") == "https://www.example.com"
+        am.delete_short_id("abcdef1")
+        assert shared.get("abcdef1", "default") == "default"
+        with pytest.raises(UrlNotFoundError):
+            am.lookup_short_id("abcdef1")
+
+
+    def test_invalidates_other_workers(self, resp_client):
+        client = MongoClient(host="localhost", port=27017)
+        client.tests.drop_collection("urls")
+        client.tests.drop_collection("invalidations")
+        client.tests.urls.insert_one({LONG_URL_IDENTIFIER: "https://www.example.com", SHORT_ID_IDENTIFIER: "abcdef1"})
+        shared = SharedRedirectCache(resp_client, ttl=60)
+        cache = TieredRedirectCache(RedirectCache(10), shared)
+        other = TieredRedirectCache(RedirectCache(10), shared)
+        invalidator = CacheInvalidator(client.tests.invalidations, {"redirect": cache})
+        other_invalidator = CacheInvalidator(client.tests.invalidations, {"redirect": other})
+        am = AddressManager(client.tests, cache=cache, invalidator=invalidator)
+        assert am.lookup_short_id("abcdef1") == "https://www.example.com"
+        assert other.get("abcdef1") == "https://www.example.com"
+        am.delete_short_id("abcdef1")
+        # A lookup racing the deletion stores the link in the shared tier again
+        shared.set("abcdef1", "https://www.example.com")
+        assert other.get("abcdef1") == "https://www.example.com"  # first tier
+        other_invalidator.poll()
+        assert other.get("abcdef1", "default") == "default"
+        assert shared.get("abcdef1", "default") == "default"
+
+def test_init_app_shared(resp_server):
+    from yocto import cache
+    host, port = resp_server.server_address
+    app = create_app("TestingConfig")
+    app.config["REDIRECT_SHARED_CACHE_URL"] = f"redis://{host}:{port}"
+    cache.init_app(app)
+    with app.app_context():
+        redirect_cache = get_redirect_cache()
+        assert isinstance(redirect_cache, TieredRedirectCache)
+        assert redirect_cache.shared.client.port == port
+    app.config["REDIRECT_CACHE_SIZE"] = 0
+    cache.init_app(app)
+    with app.app_context():
+        assert isinstance(get_redirect_cache(), SharedRedirectCache)
+
+
+def test_tiered_cache_metrics(resp_server):
+    from yocto import cache
+    from yocto.metrics import REGISTRY
+    host, port = resp_server.server_address
+    app = create_app("TestingConfig")
+    app.config["REDIRECT_SHARED_CACHE_URL"] = f"redis://{host}:{port}"
+    cache.init_app(app)
+    REGISTRY.reset()
+    client = app.test_client()
+    client.get("/xxxxxxx")  # missed by both tiers, then cached as missing
+    app.extensions[cache.REDIRECT_CACHE_EXTENSION].local.clear()
+    client.get("/xxxxxxx")  # missed by the first tier, found in the second
+    response = client.get("/metrics")
+    assert 'yocto_cache_misses_total{cache="redirect"} 2' in response.text
+    assert 'yocto_cache_hits_total{cache="redirect_shared"} 1' in response.text
+    assert 'yocto_cache_misses_total{cache="redirect_shared"} 1' in response.text
+    assert 'yocto_cache_errors_total{cache="redirect_shared"} 0' in response.text
@@ -1,12 +1,18 @@
 import pytest
 
 from flask import g
+from pymongo import MongoClient
 from pymongo.database import Database
-from pymongo.errors import InvalidOperation
+from pymongo.read_preferences import Nearest, Primary, SecondaryPreferred
 
 from yocto import create_app
+import yocto.db
 from yocto.db import (
+    _client_settings,
+    get_client,
     get_db,
+    get_read_db,
+    read_preference,
     init_db,
     close_db,
     init_app,
@@ -41,31 +47,67 @@ def test_get_db(app):
 def test_init_db(app):
     with app.app_context():
         db = get_db()
-        db.create_collection("users")
-        db.create_collection("urls")
+        db.users.insert_one({"username": "example_user"})
+        db.urls.insert_one({"short_id": "abcdef1"})
         g.db = db
 
-        assert "users" in g.db.list_collection_names()
-        assert "urls" in g.db.list_collection_names()
-        init_db()  # should drop users and urls collections
-        assert "users" not in g.db.list_collection_names()
-        assert "urls" not in g.db.list_collection_names()
+        assert g.db.users.count_documents({}) == 1
+        assert g.db.urls.count_documents({}) == 1
+        report = init_db()  # should drop users and urls collections
+        assert g.db.users.count_documents({}) == 0
+        assert g.db.urls.count_documents({}) == 0
+        # Indexes rebuilt on the empty collections
+        assert "urls.short_id_unique" in report["created"]
+        assert "short_id_unique" in g.db.urls.index_information()
+        assert "username_unique" in g.db.users.index_information()
 
 
 def test_init_db_command(app, runner):
     with app.app_context():
         db = get_db()
-        db.create_collection("users")
-        db.create_collection("urls")
+        db.users.insert_one({"username": "example_user"})
+        db.urls.insert_one({"short_id": "abcdef1"})
         g.db = db
 
-        assert "users" in g.db.list_collection_names()
-        assert "urls" in g.db.list_collection_names()
         result = runner.invoke(args="init-db")  # should drop users and urls collections
-        assert "users" not in g.db.list_collection_names()
-        assert "urls" not in g.db.list_collection_names()
+        assert g.db.users.count_documents({}) == 0
+        assert g.db.urls.count_documents({}) == 0
         
         assert "Initialized the database." in result.output
+        assert "Created index urls.short_id_unique." in result.output
+
+
+def test_ensure_indexes_command(app, runner):
+    result = runner.invoke(args="ensure-indexes")
+    assert "Index urls.short_id_unique already in place." in result.output
+    assert "Created index" not in result.output
+
+
+def test_get_client(app):
+    with app.app_context():
+        client = get_client()
+        assert isinstance(client, MongoClient)
+        assert get_db().client is client
+    with app.app_context():
+        assert get_client() is client  # shared between app contexts
+    other_app = create_app("TestingConfig")
+    with other_app.app_context():
+        assert get_client() is client  # shared between apps with same settings
+
+
+def test_get_client_settings(app):
+    app.config["MONGO_MAX_POOL_SIZE"] = 7
+    with app.app_context():
+        client = get_client()
+        assert client.options.pool_options.max_pool_size == 7
+
+
+def test_get_client_after_fork(app, monkeypatch):
+    with app.app_context():
+        client = get_client()
+        # Simulate running in a forked child process
+        monkeypatch.setattr(yocto.db, "_clients_pid", -1)
+        assert get_client() is not client
 
 
 def test_close_db(app):
@@ -74,12 +116,57 @@ def test_close_db(app):
         g.db = db
         close_db()
         assert "db" not in g
-        # Raises InvalidOperation if connection closed
-        with pytest.raises(InvalidOperation):
-            db.list_collection_names()
+        # Client remains open for the next request
+        db.list_collection_names()
 
 
 def test_init_app(app):
     init_app(app)
     assert "init-db" in app.cli.commands
+    assert "ensure-indexes" in app.cli.commands
     assert close_db in app.teardown_appcontext_funcs
+
+
+def test_init_app_ensures_indexes(app):
+    with app.app_context():
+        get_db().drop_collection("users")
+    app.config["ENSURE_INDEXES_ON_STARTUP"] = True
+    init_app(app)
+    with app.app_context():
+        assert "username_unique" in get_db().users.index_information()
+
+def test_client_settings_replica_set(app):
+    app.config["MONGO_REPLICA_SET"] = "rs0"
+    app.config["MONGO_WRITE_CONCERN"] = "majority"
+    app.config["MONGO_WRITE_CONCERN_TIMEOUT_MS"] = 2000
+    app.config["MONGO_JOURNAL"] = True
+    settings = dict(_client_settings(app.config))
+    assert settings["replicaSet"] == "rs0"
+    assert settings["w"] == "majority"
+    assert settings["wTimeoutMS"] == 2000
+    assert settings["journal"] is True
+
+
+def test_read_preference(app):
+    assert read_preference(app.config) == Primary()
+    app.config["MONGO_READ_PREFERENCE"] = "nearest"
+    app.config["MONGO_MAX_STALENESS_SECONDS"] = 120
+    assert read_preference(app.config) == Nearest(max_staleness=120)
+    app.config["MONGO_READ_PREFERENCE"] = "closest"
+    with pytest.raises(ValueError):
+        read_preference(app.config)
+
+
+def test_get_read_db(app):
+    with app.app_context():
+        # Reads are not routed by default
+        assert get_read_db() is get_db()
+    app.config["MONGO_READ_PREFERENCE"] = "secondaryPreferred"
+    with app.app_context():
+        read_db = get_read_db()
+        assert read_db is not get_db()
+        assert read_db.name == "tests"
+        assert read_db.read_preference == SecondaryPreferred()
+        assert get_read_db() is read_db
+        close_db()
+        assert "read_db" not in g
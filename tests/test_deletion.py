@@ -0,0 +1,193 @@
+from datetime import datetime
+import time
+import pytest
+
+from pymongo import MongoClient
+
+from yocto import config, create_app
+from yocto.address import AddressManager
+from yocto.auth import UserAuthenticator
+from yocto.cache import RedirectCache
+from yocto.deletion import DeletionWorker, get_deletion_worker, queue_deletion
+from yocto.indexes import ensure_indexes
+from yocto.visits import VisitCounter, VisitHistory
+from yocto.lib.background import BackgroundLoop
+from yocto.lib.exceptions import UserNotFoundError
+from yocto.lib.utils import (
+    LONG_URL_IDENTIFIER,
+    SHORT_ID_IDENTIFIER,
+    CREATOR_ID_IDENTIFIER,
+    VISITS_COUNT_IDENTIFIER,
+    DELETION_USER_ID_IDENTIFIER,
+    DELETION_LEASE_OWNER_IDENTIFIER,
+    DELETION_LEASE_EXPIRY_IDENTIFIER,
+    DELETION_LINKS_DELETED_IDENTIFIER,
+)
+
+@pytest.fixture()
+def database():
+    client = MongoClient(host="localhost", port=27017)
+    for name in ("users", "urls", "tokens", "visits", "deletions"):
+        client.tests.drop_collection(name)
+    ensure_indexes(client.tests)
+    return client.tests
+
+
+@pytest.fixture()
+def user_id(database):
+    # A user with 5 links, and another user with one
+    auth = UserAuthenticator(database)
+    user_id = auth.register_user("test_user", "Test_p4s$word")
+    other_id = auth.register_user("other_user", "Test_p4s$word")
+    database.urls.insert_many(
+        [
+            {
+                LONG_URL_IDENTIFIER: f"https://www.example.com/{i}",
+                SHORT_ID_IDENTIFIER: f"abcdef{i}",
+                CREATOR_ID_IDENTIFIER: user_id,
+                VISITS_COUNT_IDENTIFIER: 0,
+            }
+            for i in range(5)
+        ]
+        + [
+            {
+                LONG_URL_IDENTIFIER: "https://www.example2.com",
+                SHORT_ID_IDENTIFIER: "1234567",
+                CREATOR_ID_IDENTIFIER: other_id,
+                VISITS_COUNT_IDENTIFIER: 0,
+            }
+        ]
+    )
+    return user_id
+
+
+def test_request_deletion(database, user_id):
+    auth = UserAuthenticator(database)
+    auth.create_token(user_id, "test")
+    auth.request_deletion(user_id)
+    # The account goes at once, the links are left to the worker
+    assert database.users.find_one({"_id": user_id}) is None
+    assert database.tokens.count_documents({}) == 0
+    assert database.urls.count_documents({CREATOR_ID_IDENTIFIER: user_id}) == 5
+    job = database.deletions.find_one({DELETION_USER_ID_IDENTIFIER: user_id})
+    assert job[DELETION_LEASE_OWNER_IDENTIFIER] is None
+    with pytest.raises(UserNotFoundError):
+        auth.authenticate_user("test_user", "Test_p4s$word")
+    with pytest.raises(UserNotFoundError):
+        auth.request_deletion(user_id)
+    assert database.deletions.count_documents({}) == 1
+
+
+def test_worker_deletes_in_batches(database, user_id, monkeypatch):
+    cache = RedirectCache(10)
+    cache.set("abcdef0", "https://www.example.com/0")
+    VisitCounter(
+        database.urls,
+        synchronous=True,
+        history=VisitHistory(database.visits, config.Config.VISIT_HISTORY_RETENTION),
+    ).record("abcdef0")
+    UserAuthenticator(database).request_deletion(user_id)
+    batches = []
+    delete_creator_links = AddressManager.delete_creator_links
+
+    def counting(self, creator_id, limit):
+        deleted = delete_creator_links(self, creator_id, limit)
+        batches.append(deleted)
+        return deleted
+
+    monkeypatch.setattr(AddressManager, "delete_creator_links", counting)
+    worker = DeletionWorker(database, redirect_cache=cache, batch_size=2, batch_pause=0)
+    assert worker.run_pending() == 5
+    assert batches == [2, 2, 1, 0]
+    assert database.urls.count_documents({CREATOR_ID_IDENTIFIER: user_id}) == 0
+    assert database.urls.count_documents({}) == 1  # other user's link kept
+    assert database.visits.count_documents({}) == 0
+    assert database.deletions.count_documents({}) == 0
+    assert cache.get("abcdef0", "not cached") == "not cached"
+
+
+def test_worker_respects_lease(database, user_id):
+    queue_deletion(database.deletions, user_id)
+    other = DeletionWorker(database, lease_time=60)
+    assert other.claim()[DELETION_LEASE_OWNER_IDENTIFIER] == other.owner
+    # Held by another worker
+    worker = DeletionWorker(database, batch_pause=0)
+    assert worker.claim() is None
+    # Resumed once the lease has expired, e.g. after a crash
+    database.deletions.update_one(
+        {DELETION_USER_ID_IDENTIFIER: user_id},
+        {"$set": {DELETION_LEASE_EXPIRY_IDENTIFIER: datetime(2000, 1, 1)}},
+    )
+    assert worker.run_pending() == 5
+    assert database.deletions.count_documents({}) == 0
+
+
+def test_worker_stops_on_lost_lease(database, user_id):
+    queue_deletion(database.deletions, user_id)
+    worker = DeletionWorker(database, batch_size=2, batch_pause=0)
+    job = worker.claim()
+    # Taken over by another worker
+    database.deletions.update_one(
+        {DELETION_USER_ID_IDENTIFIER: user_id},
+        {"$set": {DELETION_LEASE_OWNER_IDENTIFIER: "other"}},
+    )
+    assert worker.run_job(job) == 2
+    job = database.deletions.find_one({DELETION_USER_ID_IDENTIFIER: user_id})
+    assert job[DELETION_LEASE_OWNER_IDENTIFIER] == "other"
+    assert job[DELETION_LINKS_DELETED_IDENTIFIER] == 0
+
+
+def test_background_thread(database, user_id):
+    UserAuthenticator(database).request_deletion(user_id)
+    worker = DeletionWorker(database, batch_pause=0, poll_interval=60)
+    worker.notify()
+    for _ in range(50):
+        if database.deletions.count_documents({}) == 0:
+            break
+        time.sleep(0.1)
+    worker.close()
+    assert database.urls.count_documents({CREATOR_ID_IDENTIFIER: user_id}) == 0
+
+
+def test_background_loop_logs_errors(caplog):
+    calls = []
+
+    def function():
+        calls.append(len(calls))
+        if len(calls) == 1:
+            raise ValueError("first call fails")
+
+    loop = BackgroundLoop(function, 0.01, "test-loop", errors=ValueError, message="Failed: %s")
+    loop.ensure_started()
+    loop.ensure_started()  # one thread per process
+    for _ in range(50):
+        if len(calls) >= 2:
+            break
+        time.sleep(0.01)
+    loop.stop()
+    loop.thread.join(timeout=1)
+    assert len(calls) >= 2  # the loop carried on
+    assert "Failed: first call fails" in caplog.text
+
+
+def test_background_loop_after_fork():
+    forked = []
+    loop = BackgroundLoop(lambda: None, 60, "test-loop", after_fork=lambda: forked.append(True))
+    loop.ensure_started()
+    thread = loop.thread
+    loop._reset_after_fork()  # as in a forked child
+    assert loop.thread is None and forked == [True]
+    loop.ensure_started()
+    assert loop.thread is not thread
+    loop.stop()
+
+
+def test_run_deletions_command(user_id):
+    app = create_app("TestingConfig")
+    database = MongoClient(host="localhost", port=27017).tests
+    queue_deletion(database.deletions, user_id)
+    result = app.test_cli_runner().invoke(args=["run-deletions"])
+    assert "Deleted 5 links." in result.output
+    with app.app_context():
+        worker = get_deletion_worker()
+        assert worker.synchronous
@@ -0,0 +1,98 @@
+import pytest
+
+from flask import Flask, url_for
+
+from yocto import create_app, fastpath
+from yocto.db import init_db, get_db
+from yocto.auth import UserAuthenticator
+from yocto.address import AddressManager
+from yocto.fastpath import RedirectFastPath
+from yocto.metrics import REGISTRY
+from yocto.visits import get_visit_counter
+from yocto.lib.utils import (
+    SHORT_ID_IDENTIFIER,
+    VISITS_COUNT_IDENTIFIER,
+)
+
+
+@pytest.fixture()
+def app():
+    app = create_app("TestingConfig")
+    with app.app_context():
+        init_db()
+        user_id = UserAuthenticator(get_db()).register_user("new_user", "V4l1d_password")
+        AddressManager(get_db()).store_url_and_id("https://www.example.com/café", "abcdef1", user_id)
+    yield app
+
+
+@pytest.fixture()
+def client(app):
+    return app.test_client()
+
+
+def test_mounted(app):
+    assert isinstance(app.wsgi_app, RedirectFastPath)
+
+
+def test_redirect(client, app):
+    response = client.get("/abcdef1")
+    assert response.status_code == 302
+    assert response.location == "https://www.example.com/caf%C3%A9"
+    assert response.headers["Cache-Control"] == "private, max-age=0"
+    assert "Set-Cookie" not in response.headers
+    assert response.data == b""
+    response = client.head("/abcdef1/")
+    assert response.status_code == 302
+    assert response.location == "https://www.example.com/caf%C3%A9"
+    with app.app_context():
+        get_visit_counter().flush()
+        link = get_db().urls.find_one({SHORT_ID_IDENTIFIER: "abcdef1"})
+        assert link[VISITS_COUNT_IDENTIFIER] == 2
+
+
+def test_redirect_not_found(client):
+    response = client.get("/notreal", follow_redirects=True)
+    assert len(response.history) == 1
+    assert response.history[0].headers["Cache-Control"] == "no-store"
+    assert response.request.path == "/pages/error/"
+    assert b"shortened address is not valid" in response.data
+
+
+def test_redirect_not_found_script_name(client, app):
+    response = client.get("/notreal", base_url="http://localhost/yocto")
+    with app.test_request_context(base_url="http://localhost/yocto"):
+        expected = url_for("pages.error", message=fastpath.NOT_FOUND_MESSAGE)
+    assert expected.startswith("/yocto/pages/error/?")
+    assert response.headers["Location"] == expected
+
+
+def test_passes_through(client):
+    # Routes of the app
+    assert client.get("/pages/").status_code == 200
+    response = client.get("/pages")
+    assert response.status_code == 308
+    assert response.location.endswith("/pages/")
+    assert client.get("/").status_code == 302
+    # Other methods and paths
+    assert client.post("/abcdef1").status_code == 405
+    response = client.get("/abc.def")
+    assert response.status_code == 302
+    assert "Cache-Control" not in response.headers
+
+
+def test_metrics(client):
+    def count():
+        samples = REGISTRY.snapshot()["yocto_http_requests_total"]["samples"]
+        return sum(value for labels, value in samples if labels == ["short.index", "GET", "302"])
+
+    before = count()
+    client.get("/abcdef1")
+    assert count() == before + 1
+
+
+def test_disabled():
+    app = Flask(__name__)
+    app.config["REDIRECT_FAST_PATH"] = False
+    wsgi_app = app.wsgi_app
+    fastpath.init_app(app)
+    assert app.wsgi_app == wsgi_app
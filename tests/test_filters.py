@@ -0,0 +1,151 @@
+from datetime import datetime, timedelta, timezone
+import pytest
+
+from bson.objectid import ObjectId
+from pymongo import MongoClient
+
+from yocto import create_app
+from yocto.address import AddressManager
+from yocto.filters import ShortIdFilter, get_short_id_filter
+from yocto.lib.bloom import BloomFilter
+from yocto.lib.exceptions import UrlNotFoundError
+from yocto.lib.utils import (
+    LONG_URL_IDENTIFIER,
+    SHORT_ID_IDENTIFIER,
+    URL_ID_IDENTIFIER,
+)
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture()
+def timer():
+    return FakeTimer()
+
+
+@pytest.fixture()
+def urls():
+    client = MongoClient(host="localhost", port=27017)
+    client.tests.drop_collection("urls")
+    client.tests.urls.insert_many(
+        [
+            {LONG_URL_IDENTIFIER: f"https://www.example.com/{i}", SHORT_ID_IDENTIFIER: f"abcdef{i}"}
+            for i in range(10)
+        ]
+    )
+    return client.tests.urls
+
+
+class TestBloomFilter:
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000)
+        items = [f"item{i}" for i in range(1000)]
+        bloom.update(items)
+        assert all(item in bloom for item in items)
+        assert len(bloom) == 1000
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(1000, error_rate=0.01)
+        bloom.update(f"item{i}" for i in range(1000))
+        false_positives = sum(f"other{i}" in bloom for i in range(10000))
+        assert false_positives < 300  # about 100 expected
+
+    def test_sizing(self):
+        bloom = BloomFilter(1000, error_rate=0.01)
+        assert 9000 < bloom.size < 10000  # about 9.6 bits per item
+        assert bloom.hashes == 7
+        with pytest.raises(ValueError):
+            BloomFilter(0)
+        with pytest.raises(ValueError):
+            BloomFilter(10, error_rate=1)
+
+
+class TestShortIdFilter:
+    def test_build(self, urls, timer):
+        id_filter = ShortIdFilter(urls, capacity=100, synchronous=True, timer=timer)
+        assert not id_filter.ready
+        assert id_filter.might_exist("abcdef1")
+        assert id_filter.ready
+        assert not id_filter.might_exist("zzzzzzz")
+
+    def test_not_ready_until_built(self, urls, timer):
+        id_filter = ShortIdFilter(urls, capacity=100, timer=timer)
+        id_filter.close()  # no thread
+        assert id_filter.might_exist("zzzzzzz")
+        id_filter.build()
+        assert not id_filter.might_exist("zzzzzzz")
+        # Not trusted once refreshes stop
+        timer.now += 10
+        assert id_filter.might_exist("zzzzzzz")
+
+    def test_refresh(self, urls, timer):
+        id_filter = ShortIdFilter(urls, capacity=100, synchronous=True, timer=timer)
+        assert not id_filter.might_exist("1234567")
+        # Stored by another process
+        urls.insert_one({LONG_URL_IDENTIFIER: "https://www.example2.com", SHORT_ID_IDENTIFIER: "1234567"})
+        assert not id_filter.might_exist("1234567")
+        timer.now += 1
+        assert id_filter.might_exist("1234567")
+
+    def test_refresh_overlap(self, urls, timer):
+        id_filter = ShortIdFilter(urls, capacity=100, synchronous=True, timer=timer)
+        id_filter.build()
+        # Inserted late with an ObjectId from before the last refresh
+        urls.insert_one(
+            {
+                URL_ID_IDENTIFIER: ObjectId.from_datetime(datetime.now(timezone.utc) - timedelta(seconds=2)),
+                LONG_URL_IDENTIFIER: "https://www.example2.com",
+                SHORT_ID_IDENTIFIER: "1234567",
+            }
+        )
+        timer.now += 1
+        assert id_filter.might_exist("1234567")
+
+    def test_rebuild_after_deletions(self, urls, timer):
+        id_filter = ShortIdFilter(urls, capacity=100, synchronous=True, timer=timer)
+        am = AddressManager(urls.database, short_id_filter=id_filter)
+        assert id_filter.might_exist("abcdef1")
+        am.delete_short_id("abcdef1")
+        # Still present, as one deletion is under a tenth of the IDs
+        assert id_filter.might_exist("abcdef1")
+        am.delete_short_id("abcdef2")
+        assert not id_filter.might_exist("abcdef1")
+        assert not id_filter.might_exist("abcdef2")
+
+    def test_address_manager(self, urls, timer):
+        id_filter = ShortIdFilter(urls, capacity=100, synchronous=True, timer=timer)
+        am = AddressManager(urls.database, short_id_filter=id_filter)
+        assert am.lookup_short_id("abcdef1") == "https://www.example.com/1"
+        id_filter._collection = None  # lookups of ruled-out IDs do not query
+        with pytest.raises(UrlNotFoundError):
+            am.lookup_short_id("zzzzzzz")
+        id_filter._collection = urls
+        # Links stored through the manager are added at once
+        users = urls.database.users
+        users.drop()
+        user_id = users.insert_one({"username": "test_user"}).inserted_id
+        am.store_url_and_id("https://www.example2.com", "1234567", user_id)
+        assert am.lookup_short_id("1234567") == "https://www.example2.com"
+
+    def test_generate_short_id(self, urls, timer):
+        id_filter = ShortIdFilter(urls, capacity=100, synchronous=True, timer=timer)
+        am = AddressManager(urls.database, short_id_filter=id_filter)
+        id_filter.might_exist("abcdef1")  # build
+        id_filter._collection = None
+        am._urls = None  # free candidates are not looked up
+        assert len(am.generate_short_id()) == 7
+
+
+def test_init_app():
+    app = create_app("TestingConfig")
+    with app.app_context():
+        assert get_short_id_filter() is None
+    app = create_app("BenchmarkConfig")
+    with app.app_context():
+        assert isinstance(get_short_id_filter(), ShortIdFilter)
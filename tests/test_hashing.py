@@ -0,0 +1,107 @@
+import time
+import pytest
+
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError
+
+from yocto import create_app
+from yocto.hashing import PasswordHashingPool, get_password_hasher
+from yocto.lib.exceptions import HashingBusyError
+
+# Cheap parameters, so the tests do not spend their time hashing
+FAST_HASHER = PasswordHasher(time_cost=1, memory_cost=8, parallelism=1)
+
+def test_hash_and_verify_inline():
+    pool = PasswordHashingPool(FAST_HASHER, processes=0)
+    password_hash = pool.hash("Test_p4s$word")
+    assert password_hash.startswith("$argon2id$")
+    assert pool.verify(password_hash, "Test_p4s$word")
+    with pytest.raises(VerifyMismatchError):
+        pool.verify(password_hash, "wrong_password")
+
+def test_hash_and_verify_in_pool():
+    pool = PasswordHashingPool(FAST_HASHER, processes=1)
+    try:
+        password_hash = pool.hash("Test_p4s$word")
+        assert FAST_HASHER.verify(password_hash, "Test_p4s$word")
+        assert pool.verify(password_hash, "Test_p4s$word")
+        with pytest.raises(VerifyMismatchError):
+            pool.verify(password_hash, "wrong_password")
+    finally:
+        pool.close()
+
+def test_busy_when_all_slots_taken():
+    pool = PasswordHashingPool(FAST_HASHER, processes=1, max_pending=1)
+    assert pool._slots.acquire(blocking=False)  # an operation in progress
+    try:
+        with pytest.raises(HashingBusyError):
+            pool.hash("Test_p4s$word")
+    finally:
+        pool._slots.release()
+        pool.close()
+
+def test_timed_out_operation_keeps_slot():
+    slow = PasswordHasher(time_cost=10, memory_cost=65536, parallelism=1)
+    pool = PasswordHashingPool(slow, processes=1, max_pending=1, timeout=0.01)
+    try:
+        with pytest.raises(HashingBusyError):
+            pool.hash("Test_p4s$word")
+        # The timed out hash is still running, so it holds the only slot
+        assert not pool._slots.acquire(blocking=False)
+        deadline = time.monotonic() + 30
+        while not pool._slots.acquire(blocking=False):
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        pool._slots.release()
+    finally:
+        pool.close()
+
+def test_inline_never_busy():
+    pool = PasswordHashingPool(FAST_HASHER, processes=0, max_pending=0)
+    assert pool.hash("Test_p4s$word")
+
+def test_check_needs_rehash():
+    old = PasswordHasher(time_cost=1, memory_cost=8, parallelism=1)
+    new = PasswordHasher(time_cost=2, memory_cost=16, parallelism=1)
+    password_hash = old.hash("Test_p4s$word")
+    assert not PasswordHashingPool(old, processes=0).check_needs_rehash(password_hash)
+    assert PasswordHashingPool(new, processes=0).check_needs_rehash(password_hash)
+
+def test_init_app():
+    app = create_app("TestingConfig")
+    app.config.update(ARGON2_TIME_COST=2, ARGON2_MEMORY_COST=16, ARGON2_PARALLELISM=1)
+    from yocto import hashing
+    hashing.init_app(app)
+    with app.app_context():
+        pool = get_password_hasher()
+    assert pool.processes == 0
+    assert pool.hasher.time_cost == 2
+    assert pool.hasher.memory_cost == 16
+    assert pool.hasher.parallelism == 1
+
+def test_verify_dummy():
+    PasswordHashingPool(FAST_HASHER, processes=0).verify_dummy("Test_p4s$word")  # no dummy hash
+    calls = []
+    pool = PasswordHashingPool(FAST_HASHER, processes=0, dummy_hash=FAST_HASHER.hash("other"))
+    pool._submit = lambda function, *args: calls.append(args) or function(pool.hasher, *args)
+    pool.verify_dummy("Test_p4s$word")  # mismatch not raised
+    assert calls == [(pool.dummy_hash, "Test_p4s$word")]
+
+def test_init_app_unknown_user_hash_policy():
+    app = create_app("TestingConfig")
+    from yocto import hashing
+    app.config.update(ARGON2_DUMMY_TIME_COST=1, ARGON2_DUMMY_MEMORY_COST=16, ARGON2_DUMMY_PARALLELISM=1)
+    hashing.init_app(app)
+    with app.app_context():
+        assert get_password_hasher().dummy_hash.startswith("$argon2id$v=19$m=16,t=1,p=1$")
+    app.config.update(UNKNOWN_USER_HASH_POLICY="full", ARGON2_TIME_COST=2, ARGON2_MEMORY_COST=16, ARGON2_PARALLELISM=1)
+    hashing.init_app(app)
+    with app.app_context():
+        assert get_password_hasher().dummy_hash.startswith("$argon2id$v=19$m=16,t=2,p=1$")
+    app.config.update(UNKNOWN_USER_HASH_POLICY="none")
+    hashing.init_app(app)
+    with app.app_context():
+        assert get_password_hasher().dummy_hash is None
+    app.config.update(UNKNOWN_USER_HASH_POLICY="unknown")
+    with pytest.raises(ValueError):
+        hashing.init_app(app)
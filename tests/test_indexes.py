@@ -0,0 +1,62 @@
+import pytest
+
+from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError
+
+from yocto.indexes import INDEXES, ensure_indexes
+from yocto.lib.utils import (
+    LONG_URL_IDENTIFIER,
+    SHORT_ID_IDENTIFIER,
+    USERNAME_IDENTIFIER,
+)
+
+@pytest.fixture()
+def mongo_client():
+    client = MongoClient(host="localhost", port=27017)
+    client.tests.drop_collection("users")
+    client.tests.drop_collection("urls")
+    client.tests.drop_collection("tokens")
+    client.tests.drop_collection("visits")
+    client.tests.drop_collection("tombstones")
+    client.tests.drop_collection("invalidations")
+    return client
+
+
+def test_ensure_indexes(mongo_client):
+    report = ensure_indexes(mongo_client.tests)
+    expected = [
+        f"{collection}.{model.document['name']}"
+        for collection, models in INDEXES.items()
+        for model in models
+    ]
+    assert sorted(report["created"]) == sorted(expected)
+    assert report["existing"] == []
+    assert "short_id_unique" in mongo_client.tests.urls.index_information()
+    assert "creator_id" in mongo_client.tests.urls.index_information()
+    ttl = mongo_client.tests.visits.index_information()["expires_ttl"]
+    assert ttl["expireAfterSeconds"] == 0
+
+
+def test_ensure_indexes_drops_obsolete(mongo_client):
+    mongo_client.tests.urls.create_index(LONG_URL_IDENTIFIER, name="long_url_unique", unique=True)
+    report = ensure_indexes(mongo_client.tests)
+    assert report["dropped"] == ["urls.long_url_unique"]
+    assert "long_url_unique" not in mongo_client.tests.urls.index_information()
+    assert ensure_indexes(mongo_client.tests)["dropped"] == []
+
+
+def test_ensure_indexes_idempotent(mongo_client):
+    ensure_indexes(mongo_client.tests)
+    report = ensure_indexes(mongo_client.tests)
+    assert report["created"] == []
+    assert "users.username_unique" in report["existing"]
+
+
+def test_ensure_indexes_unique(mongo_client):
+    ensure_indexes(mongo_client.tests)
+    mongo_client.tests.urls.insert_one({SHORT_ID_IDENTIFIER: "abcdef1"})
+    with pytest.raises(DuplicateKeyError):
+        mongo_client.tests.urls.insert_one({SHORT_ID_IDENTIFIER: "abcdef1"})
+    mongo_client.tests.users.insert_one({USERNAME_IDENTIFIER: "example_user"})
+    with pytest.raises(DuplicateKeyError):
+        mongo_client.tests.users.insert_one({USERNAME_IDENTIFIER: "example_user"})
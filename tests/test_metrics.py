@@ -0,0 +1,227 @@
+import json
+import os
+import time
+import pytest
+
+from types import SimpleNamespace
+
+from yocto import config, create_app
+from yocto.db import close_clients
+from yocto.hashing import PasswordHashingPool
+from yocto.lib.exceptions import HashingBusyError
+from yocto.lib.metrics import Counter, Gauge, Histogram, Registry, merge, render
+from yocto.metrics import (
+    REGISTRY,
+    CommandTimer,
+    DB_COMMAND_DURATION,
+    DB_COMMAND_FAILURES,
+    METRICS_FILE_EXTENSION,
+    MetricsFile,
+    PASSWORD_HASHING_DURATION,
+    PASSWORD_HASHING_REJECTED,
+)
+
+@pytest.fixture()
+def app():
+    app = create_app("TestingConfig")
+    REGISTRY.reset()
+    yield app
+
+
+def sample(snapshot, name, **labels):
+    # Value of the sample of a metric with the given labels
+    metric = snapshot[name]
+    key = [str(labels[label]) for label in metric["labelnames"]]
+    for sample_labels, value in metric["samples"]:
+        if sample_labels == key:
+            return value
+    return None
+
+
+def test_counter_gauge_histogram():
+    registry = Registry()
+    counter = Counter(registry, "test_total", "Test counter.", ["kind"])
+    gauge = Gauge(registry, "test_size", "Test gauge.")
+    histogram = Histogram(registry, "test_seconds", "Test histogram.", buckets=(0.1, 1.0))
+    counter.inc(kind="a")
+    counter.inc(2, kind="a")
+    gauge.set(5)
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+    snapshot = registry.snapshot()
+    assert sample(snapshot, "test_total", kind="a") == 3
+    assert sample(snapshot, "test_size") == 5
+    assert sample(snapshot, "test_seconds") == {"counts": [1, 1, 1], "sum": 5.55}
+    with pytest.raises(ValueError):
+        counter.inc(other="a")  # wrong labels
+    with pytest.raises(ValueError):
+        Counter(registry, "test_total", "Duplicate.")
+
+
+def test_merge_and_render():
+    registry = Registry()
+    counter = Counter(registry, "test_total", "Test counter.", ["kind"])
+    histogram = Histogram(registry, "test_seconds", "Test histogram.", buckets=(0.1, 1.0))
+    counter.inc(kind="a")
+    histogram.observe(0.05)
+    snapshot = json.loads(json.dumps(registry.snapshot()))  # as read from a file
+    merged = merge([snapshot, snapshot])
+    assert sample(merged, "test_total", kind="a") == 2
+    text = render(merged)
+    assert "# TYPE test_total counter" in text
+    assert 'test_total{kind="a"} 2' in text
+    assert "# TYPE test_seconds histogram" in text
+    assert 'test_seconds_bucket{le="0.1"} 2' in text
+    assert 'test_seconds_bucket{le="1"} 2' in text
+    assert 'test_seconds_bucket{le="+Inf"} 2' in text
+    assert "test_seconds_count 2" in text
+    assert "test_seconds_sum 0.1" in text
+
+
+def test_render_escapes_labels():
+    registry = Registry()
+    counter = Counter(registry, "test_total", "Test counter.", ["kind"])
+    counter.inc(kind='a"b\\c\nd')
+    assert 'test_total{kind="a\\"b\\\\c\\nd"} 1' in render(registry.snapshot())
+
+
+def test_request_metrics(app):
+    client = app.test_client()
+    client.get("/pages/")
+    client.get("/pages/")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    assert 'yocto_http_requests_total{endpoint="pages.index",method="GET",status="200"} 2' in response.text
+    assert 'yocto_http_request_duration_seconds_count{endpoint="pages.index",method="GET"} 2' in response.text
+
+
+def test_database_metrics(app):
+    # Clients created before the listener was registered are not timed
+    close_clients()
+    client = app.test_client()
+    client.get("/zzzzzzz")  # looks up the short ID
+    response = client.get("/metrics")
+    assert 'yocto_mongodb_command_duration_seconds_count{collection="urls",command="find"' in response.text
+
+
+def test_command_timer():
+    REGISTRY.reset()
+    timer = CommandTimer()
+
+    def event(command_name, command=None, duration_micros=None, request_id=1):
+        return SimpleNamespace(
+            command_name=command_name,
+            command=command,
+            duration_micros=duration_micros,
+            connection_id=("localhost", 27017),
+            request_id=request_id,
+        )
+
+    timer.started(event("find", {"find": "urls", "filter": {}}))
+    timer.succeeded(event("find", duration_micros=1500))
+    timer.started(event("getMore", {"getMore": 123, "collection": "urls"}, request_id=2))
+    timer.failed(event("getMore", duration_micros=100, request_id=2))
+    snapshot = REGISTRY.snapshot()
+    find = sample(snapshot, DB_COMMAND_DURATION.name, collection="urls", command="find")
+    assert sum(find["counts"]) == 1
+    assert find["sum"] == 0.0015
+    assert sample(snapshot, DB_COMMAND_FAILURES.name, collection="urls", command="getMore") == 1
+
+
+def test_cache_metrics(app):
+    client = app.test_client()
+    client.get("/xxxxxxx")  # miss, then cached as missing
+    client.get("/xxxxxxx")  # hit
+    response = client.get("/metrics")
+    assert 'yocto_cache_hits_total{cache="redirect"} 1' in response.text
+    assert 'yocto_cache_misses_total{cache="redirect"} 1' in response.text
+    assert 'yocto_cache_entries{cache="redirect"} 1' in response.text
+
+
+def test_password_hashing_metrics():
+    REGISTRY.reset()
+    pool = PasswordHashingPool(processes=0)
+    pool.hash("Test_p4s$word")
+    snapshot = REGISTRY.snapshot()
+    assert sum(sample(snapshot, PASSWORD_HASHING_DURATION.name, operation="hash")["counts"]) == 1
+    pool = PasswordHashingPool(processes=1, max_pending=1)
+    pool._slots.acquire()
+    try:
+        with pytest.raises(HashingBusyError):
+            pool.hash("Test_p4s$word")
+    finally:
+        pool._slots.release()
+    assert sample(REGISTRY.snapshot(), PASSWORD_HASHING_REJECTED.name, operation="hash") == 1
+
+
+def test_metrics_file_aggregates_processes(app, tmp_path):
+    metrics_file = MetricsFile(str(tmp_path))
+    app.test_client().get("/pages/")
+    metrics_file.write()
+    # Metrics of another worker, which has exited
+    other = REGISTRY.snapshot()
+    with open(tmp_path / "1-0.json", "w") as f:
+        json.dump({"pid": 2 ** 22 + 1, "metrics": other}, f)
+    merged = metrics_file.collect()
+    assert sample(merged, "yocto_http_requests_total", endpoint="pages.index", method="GET", status=200) == 2
+    # Gauges of exited workers are left out
+    assert sample(merged, "yocto_cache_entries", cache="user") == 0
+    assert len(os.listdir(tmp_path)) == 2
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_metrics_file_written_without_scrape(monkeypatch, tmp_path):
+    monkeypatch.setattr(config.TestingConfig, "METRICS_DIR", str(tmp_path))
+    monkeypatch.setattr(config.TestingConfig, "METRICS_WRITE_INTERVAL", 0.05)
+    worker = create_app("TestingConfig")
+    REGISTRY.reset()
+    # The worker handles a request but is never scraped
+    worker.test_client().get("/pages/")
+    metrics_file = worker.extensions[METRICS_FILE_EXTENSION]
+    assert wait_for(lambda: any(name.endswith(".json") for name in os.listdir(tmp_path)))
+    metrics_file.close()
+    metrics_file._loop.thread.join(timeout=1)
+    # Another process, which has handled no requests, serves the scrape
+    REGISTRY.reset()
+    merged = MetricsFile(str(tmp_path)).collect()
+    assert sample(merged, "yocto_http_requests_total", endpoint="pages.index", method="GET", status=200) == 1
+
+
+def test_metrics_file_writer_survives_errors(tmp_path, caplog):
+    metrics_file = MetricsFile(str(tmp_path), interval=0.01)
+    failures = []
+
+    def failing():
+        if len(failures) < 2:
+            failures.append(True)
+            raise RuntimeError("collector failed")
+
+    REGISTRY.set_collector("failing", failing)
+    try:
+        metrics_file.ensure_started()
+        assert wait_for(lambda: any(name.endswith(".json") for name in os.listdir(tmp_path)))
+    finally:
+        metrics_file.close()
+        REGISTRY.remove_collector("failing")
+    assert "Could not write metrics: collector failed" in caplog.text
+
+
+def test_metrics_disabled():
+    assert not config.Config.METRICS_ENABLED  # not served unless asked for
+    app = create_app("TestingConfig")
+    assert "metrics" in app.view_functions
+    app.config["METRICS_ENABLED"] = False
+    from flask import Flask
+    from yocto import metrics
+    other = Flask(__name__)
+    other.config.from_mapping(METRICS_ENABLED=False)
+    metrics.init_app(other)
+    assert "metrics" not in other.view_functions
@@ -1,3 +1,7 @@
+import csv
+import gzip
+import io
+import json
 import pytest
 
 import regex
@@ -8,6 +12,9 @@ from yocto import create_app
 from yocto.db import init_db, get_db
 from yocto.auth import UserAuthenticator
 from yocto.address import AddressManager
+from yocto.cache import get_cache_invalidator, get_user_cache
+from yocto.hashing import get_password_hasher
+from yocto.lib.exceptions import HashingBusyError, UrlExistsError, UrlNotFoundError
 from yocto.lib.utils import (
     USER_ID_IDENTIFIER,
     USERNAME_IDENTIFIER, 
@@ -160,6 +167,16 @@ def test_login_post_valid_credentials(client_with_data, app):
     assert response.request.path == "/pages/login_success/new_user/"  # correct destination
 
 
+def test_login_post_hashing_busy(client_with_data, app, monkeypatch):
+    def busy(*args):
+        raise HashingBusyError
+    with app.app_context():
+        monkeypatch.setattr(get_password_hasher(), "verify", busy)
+    response = client_with_data.post("/pages/login/", data={"uname": "new_user", "pw": "V4l1d_password"})
+    assert response.status_code == 503
+    assert b"The server is busy, please try again." in response.data
+
+
 def test_login_success(client):
     response = client.get("/pages/login_success/test_name", follow_redirects=True)
     assert b'Login successful. Welcome test_name.' in response.data
@@ -284,3 +301,138 @@ def test_my_links(client_with_data, app):
             assert AddressManager.compose_shortened_url(pages_root_url, "abcdef1") not in response.text
             assert AddressManager.compose_shortened_url(root_url, "abcdef1") in response.text
 
+
+
+def test_my_links_pages(client_with_data, app):
+    with client_with_data as client:
+        client.post(
+            "/pages/login/", 
+            data={"uname": "new_user", "pw": "V4l1d_password"}, 
+            follow_redirects=True
+        )
+        response = client.get("/pages/my-links/?limit=1")
+        assert b"abcdef1" in response.data
+        assert b"1234567" not in response.data
+        assert b"First page" not in response.data
+        next_page = regex.search(r'<a href="([^"]*)">Next page</a>', response.text)
+        assert next_page is not None
+
+        response = client.get(next_page.group(1).replace("&amp;", "&"))
+        assert b"abcdef1" not in response.data
+        assert b"1234567" in response.data
+        assert b"First page" in response.data
+        assert b"Next page" not in response.data
+
+        # Page size limited by configuration
+        app.config["MY_LINKS_MAX_PAGE_SIZE"] = 1
+        response = client.get("/pages/my-links/?limit=5")
+        assert b"1234567" not in response.data
+
+
+def test_export_links(client_with_data):
+    with client_with_data as client:
+        response = client.get("/pages/my-links/export")
+        assert response.status_code == 302  # login required
+        client.post(
+            "/pages/login/",
+            data={"uname": "new_user", "pw": "V4l1d_password"},
+            follow_redirects=True
+        )
+        response = client.get("/pages/my-links/export")
+        assert response.status_code == 200
+        assert response.is_streamed
+        assert response.mimetype == "text/csv"
+        assert 'filename="yocto-links.csv"' in response.headers["Content-Disposition"]
+        rows = list(csv.DictReader(io.StringIO(response.text)))
+        assert [row["short_id"] for row in rows] == ["abcdef1", "1234567"]
+        assert rows[0]["short_url"] == "http://localhost/abcdef1"
+        assert rows[0]["visits"] == "0"
+
+        response = client.get("/pages/my-links/export?format=jsonl&gzip=1")
+        assert response.mimetype == "application/gzip"
+        assert 'filename="yocto-links.jsonl.gz"' in response.headers["Content-Disposition"]
+        lines = gzip.decompress(response.data).decode().splitlines()
+        assert [json.loads(line)["long_url"] for line in lines] == [
+            "https://www.example.com",
+            "https://www.example2.com",
+        ]
+
+        response = client.get("/pages/my-links/export?format=xml")
+        assert response.status_code == 302
+        assert "/pages/error/" in response.location
+
+
+def test_logged_in_user_cached(client_with_data, app):
+    with client_with_data as client:
+        client.post("/pages/login/", data={"uname": "new_user", "pw": "V4l1d_password"}, follow_redirects=True)
+        response = client.get("/pages/account/")
+        assert regex.search(r"<p>\s+new_user\s+</p>", response.text)
+        user_id = session["user"]
+        with app.app_context():
+            assert get_user_cache().get(user_id)[USERNAME_IDENTIFIER] == "new_user"
+            # Record served from the cache rather than the database
+            get_db().users.update_one({USER_ID_IDENTIFIER: ObjectId(user_id)}, {"$set": {USERNAME_IDENTIFIER: "renamed_user"}})
+        response = client.get("/pages/account/")
+        assert regex.search(r"<p>\s+new_user\s+</p>", response.text)
+
+
+def test_logged_in_user_loaded_lazily(client_with_data, app):
+    # Through the blueprint route rather than the redirect fast path, which
+    # pushes no context at all
+    app.wsgi_app = app.wsgi_app.wsgi_app
+    with client_with_data as client:
+        client.post("/pages/login/", data={"uname": "new_user", "pw": "V4l1d_password"}, follow_redirects=True)
+        client.get("/abcdef1")
+        assert "user" not in vars(g._get_current_object())  # redirect did not load user
+        client.get("/pages/account/")
+        assert g.user[USERNAME_IDENTIFIER] == "new_user"
+
+
+def test_delete_confirmed_invalidates_user_cache(client_with_data, app):
+    with client_with_data as client:
+        client.post("/pages/login/", data={"uname": "new_user", "pw": "V4l1d_password"}, follow_redirects=True)
+        client.get("/pages/account/")
+        user_id = session["user"]
+        client.get("/pages/delete/confirmed/")
+        with app.app_context():
+            assert get_user_cache().get(user_id) is None
+
+
+def test_delete_invalidates_user_in_other_workers(client_with_data, app):
+    other = create_app("TestingConfig")  # another worker process
+    other.extensions["yocto.cache_invalidator"].poll_interval = 0
+    with other.test_client() as client:
+        client.post("/pages/login/", data={"uname": "new_user", "pw": "V4l1d_password"})
+        assert client.get("/pages/account/").status_code == 200  # user cached
+        user_id = session["user"]
+        with app.app_context():
+            UserAuthenticator(get_db(), invalidator=get_cache_invalidator()).request_deletion(ObjectId(user_id))
+        response = client.get("/pages/account/")
+        assert response.location == "/pages/login/"
+
+
+def test_create_post_deleted_user(client_with_data, app):
+    with client_with_data as client:
+        client.post("/pages/login/", data={"uname": "new_user", "pw": "V4l1d_password"})
+        client.get("/pages/account/")  # user cached
+        get_db().users.delete_many({})  # deleted without invalidating the cache
+        response = client.post("/pages/create/", data={"url": "https://www.xyz.com"})
+        assert response.location == "/pages/login/"
+        assert "user" not in session
+        assert get_db().urls.find_one({LONG_URL_IDENTIFIER: "https://www.xyz.com"}) is None
+
+
+def test_create_post_existing_deleted(monkeypatch, client_with_data):
+    # The existing link is deleted between the insert and the lookup
+    def shorten(self, *args, **kwargs):
+        raise UrlExistsError
+
+    def lookup_long_url(self, long_url):
+        raise UrlNotFoundError
+
+    monkeypatch.setattr(AddressManager, "shorten", shorten)
+    monkeypatch.setattr(AddressManager, "lookup_long_url", lookup_long_url)
+    client_with_data.post("/pages/login/", data={"uname": "new_user", "pw": "V4l1d_password"})
+    response = client_with_data.post("/pages/create/", data={"url": "https://www.xyz.com"})
+    assert response.status_code == 200
+    assert b"The link was being deleted, please try again." in response.data
@@ -0,0 +1,247 @@
+import threading
+import pytest
+
+from yocto import config, create_app
+from yocto.auth import UserAuthenticator
+from yocto.db import get_db, init_db
+from yocto.lib.ratelimit import SlidingWindowLimiter
+from yocto.lib.resp import RespClient
+from yocto.metrics import LOGIN_REJECTED
+from yocto.ratelimit import (
+    LoginThrottle,
+    SharedSlidingWindowLimiter,
+    get_login_throttle,
+)
+from tests.test_cache import FakeTimer, resp_server, resp_client
+
+
+@pytest.fixture()
+def timer():
+    return FakeTimer()
+
+
+class TestSlidingWindowLimiter:
+    def test_limit(self, timer):
+        limiter = SlidingWindowLimiter(3, 60, timer=timer)
+        assert [limiter.hit("a") for _ in range(4)] == [True, True, True, False]
+        assert limiter.hit("b")  # keys are counted separately
+
+    def test_sliding_window(self, timer):
+        limiter = SlidingWindowLimiter(4, 60, timer=timer)
+        for _ in range(4):
+            assert limiter.hit("a")
+        # Half of the previous window is still covered: 4 * 0.5 + 1 allowed
+        timer.now = 90
+        assert limiter.hit("a")
+        assert limiter.hit("a")
+        assert not limiter.hit("a")
+        # Two windows later everything has been forgotten
+        timer.now = 240
+        assert [limiter.hit("a") for _ in range(5)] == [True, True, True, True, False]
+
+    def test_rejected_not_counted(self, timer):
+        limiter = SlidingWindowLimiter(2, 60, timer=timer)
+        for _ in range(10):
+            limiter.hit("a")
+        timer.now = 60
+        # Only the 2 allowed events are carried into the next window
+        assert limiter.hit("a") is False
+        timer.now = 90
+        assert limiter.hit("a") is True
+
+    def test_reset(self, timer):
+        limiter = SlidingWindowLimiter(1, 60, timer=timer)
+        assert limiter.hit("a")
+        assert not limiter.hit("a")
+        limiter.reset("a")
+        assert limiter.hit("a")
+
+    def test_refund(self, timer):
+        limiter = SlidingWindowLimiter(2, 60, timer=timer)
+        limiter.refund("a")  # nothing recorded
+        assert limiter.hit("a")
+        assert limiter.hit("a")
+        limiter.refund("a")
+        assert limiter.hit("a")
+        assert not limiter.hit("a")
+
+    def test_maxsize(self, timer):
+        with pytest.raises(ValueError):
+            SlidingWindowLimiter(1, 60, maxsize=0)
+        limiter = SlidingWindowLimiter(1, 60, maxsize=2, timer=timer)
+        limiter.hit("a")
+        limiter.hit("b")
+        limiter.hit("c")  # "a" is forgotten
+        assert len(limiter) == 2
+        assert limiter.hit("a")
+        assert not limiter.hit("c")
+
+
+class TestSharedSlidingWindowLimiter:
+    def test_limit(self, resp_client, resp_server, timer):
+        timer.now = 600
+        limiter = SharedSlidingWindowLimiter(resp_client, 2, 60, prefix="test:", timer=timer)
+        other = SharedSlidingWindowLimiter(resp_client, 2, 60, prefix="test:", timer=timer)
+        assert limiter.hit("a")
+        assert other.hit("a")  # counts are shared
+        assert not limiter.hit("a")
+        assert resp_server.data[b"test:a:10"][0] == b"2"
+        assert resp_server.data[b"test:a:10"][1] is not None  # expires
+        limiter.reset("a")
+        assert b"test:a:10" not in resp_server.data
+        assert other.hit("a")
+
+    def test_refund(self, resp_client, resp_server, timer):
+        limiter = SharedSlidingWindowLimiter(resp_client, 1, 60, prefix="test:", timer=timer)
+        assert limiter.hit("a")
+        limiter.refund("a")
+        assert resp_server.data[b"test:a:0"][0] == b"0"
+        assert limiter.hit("a")
+        assert not limiter.hit("a")
+        timer.now = 60
+        limiter.refund("a")  # taken from the previous window
+        assert resp_server.data[b"test:a:0"][0] == b"0"
+
+    def test_sliding_window(self, resp_client, timer):
+        limiter = SharedSlidingWindowLimiter(resp_client, 4, 60, timer=timer)
+        for _ in range(4):
+            assert limiter.hit("a")
+        timer.now = 90
+        assert limiter.hit("a")
+        assert limiter.hit("a")
+        assert not limiter.hit("a")
+
+    def test_server_unavailable(self, timer):
+        client = RespClient("127.0.0.1", 1, timeout=0.1)
+        limiter = SharedSlidingWindowLimiter(client, 1, 60, retry_interval=5.0, timer=timer)
+        # The limit still applies in the process
+        assert limiter.hit("a")
+        assert not limiter.hit("a")
+        assert limiter._retry_at == 5.0
+
+
+class TestLoginThrottle:
+    def test_attempt(self, timer):
+        username_limiter = SlidingWindowLimiter(2, 60, timer=timer)
+        address_limiter = SlidingWindowLimiter(3, 120, timer=timer)
+        throttle = LoginThrottle(username_limiter, address_limiter)
+        LOGIN_REJECTED.reset()
+        for _ in range(2):
+            assert throttle.attempt("user", "10.0.0.1") is None
+        assert throttle.attempt("user", "10.0.0.1") == 60
+        assert LOGIN_REJECTED.snapshot()["samples"] == [[["username"], 1]]
+        # The rejected attempt was not charged to the address
+        assert throttle.attempt("other", "10.0.0.1") is None
+        assert throttle.attempt("other", "10.0.0.1") == 120
+        # nor was the attempt rejected by the address to its username
+        assert username_limiter.hit("10.0.0.1/other")
+        assert not username_limiter.hit("10.0.0.1/other")
+        # Failures from one address do not lock the username out elsewhere
+        assert throttle.attempt("user", "10.0.0.2") is None
+
+    def test_succeeded(self, timer):
+        throttle = LoginThrottle(SlidingWindowLimiter(1, 60, timer=timer))
+        assert throttle.attempt("user", None) is None
+        throttle.succeeded("user", None)
+        assert throttle.attempt("user", None) is None
+        assert throttle.attempt("user", None) == 60
+
+    def test_distributed(self, timer):
+        throttle = LoginThrottle(
+            SlidingWindowLimiter(2, 60, timer=timer),
+            account_limiter=SlidingWindowLimiter(5, 600, timer=timer),
+        )
+        LOGIN_REJECTED.reset()
+        # One guess from each of many addresses
+        results = [throttle.attempt("user", f"10.0.0.{i}") for i in range(10)]
+        assert results == [None] * 5 + [600] * 5
+        assert LOGIN_REJECTED.snapshot()["samples"] == [[["account"], 5]]
+        # Rejected attempts were not charged to their address
+        assert throttle.attempt("user", "10.0.0.9") == 600
+        assert throttle.attempt("other", "10.0.0.9") is None
+        assert throttle.attempt("other", "10.0.0.9") is None
+
+    def test_succeeded_refunds_account(self, timer):
+        account_limiter = SlidingWindowLimiter(3, 600, timer=timer)
+        throttle = LoginThrottle(SlidingWindowLimiter(3, 60, timer=timer), account_limiter=account_limiter)
+        assert throttle.attempt("user", "10.0.0.1") is None
+        assert throttle.attempt("user", "10.0.0.2") is None
+        assert throttle.attempt("user", "10.0.0.3") is None  # the owner, who logs in
+        throttle.succeeded("user", "10.0.0.3")
+        # Only the owner's attempt is taken back from the account limit
+        assert throttle.attempt("user", "10.0.0.1") is None
+        assert throttle.attempt("user", "10.0.0.2") == 600
+
+    def test_concurrent(self, timer):
+        throttle = LoginThrottle(
+            SlidingWindowLimiter(3, 60, timer=timer),
+            account_limiter=SlidingWindowLimiter(5, 600, timer=timer),
+        )
+        barrier = threading.Barrier(8)
+        results = []
+
+        def attempt(address):
+            barrier.wait()
+            results.append(throttle.attempt("user", address))
+
+        # Attempts whose passwords are still being verified are counted
+        threads = [
+            threading.Thread(target=attempt, args=(f"10.0.0.{i % 2}",)) for i in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results.count(None) == 5
+
+
+def test_login_throttled(monkeypatch):
+    monkeypatch.setattr(config.TestingConfig, "LOGIN_USERNAME_LIMIT", 2)
+    app = create_app("TestingConfig")
+    with app.app_context():
+        init_db()
+        UserAuthenticator(get_db()).register_user("new_user", "V4l1d_password")
+    client = app.test_client()
+    verify = app.extensions["yocto.password_hasher"].verify
+    calls = []
+    monkeypatch.setattr(
+        app.extensions["yocto.password_hasher"],
+        "verify",
+        lambda *args: calls.append(args) or verify(*args),
+    )
+    for _ in range(2):
+        response = client.post("/pages/login/", data={"uname": "new_user", "pw": "Wr0ng_password"})
+        assert response.status_code == 200
+    response = client.post("/pages/login/", data={"uname": "new_user", "pw": "V4l1d_password"})
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "300"
+    assert b"Too many login attempts" in response.data
+    assert len(calls) == 2  # the rejected attempt was not verified
+    # The owner can still log in from another address
+    response = client.post(
+        "/pages/login/",
+        data={"uname": "new_user", "pw": "V4l1d_password"},
+        environ_base={"REMOTE_ADDR": "10.0.0.2"},
+    )
+    assert response.status_code == 302
+
+
+def test_init_app(monkeypatch):
+    app = create_app("TestingConfig")
+    with app.app_context():
+        throttle = get_login_throttle()
+        assert set(throttle.limiters) == {"username", "account", "address"}
+        assert isinstance(throttle.limiters["username"], SlidingWindowLimiter)
+    monkeypatch.setattr(config.TestingConfig, "LOGIN_ADDRESS_LIMIT", 0)
+    monkeypatch.setattr(config.TestingConfig, "LOGIN_RATE_LIMIT_URL", "redis://localhost:6379/1")
+    app = create_app("TestingConfig")
+    with app.app_context():
+        throttle = get_login_throttle()
+        assert list(throttle.limiters) == ["username", "account"]
+        assert isinstance(throttle.limiters["username"], SharedSlidingWindowLimiter)
+        assert throttle.limiters["username"].prefix == "yocto:login:username:"
+        assert throttle.limiters["account"].prefix == "yocto:login:account:"
+    monkeypatch.setattr(config.TestingConfig, "LOGIN_RATE_LIMIT_ENABLED", False)
+    app = create_app("TestingConfig")
+    with app.app_context():
+        assert get_login_throttle() is None
@@ -6,6 +6,7 @@ from yocto import create_app
 from yocto.db import init_db, get_db
 from yocto.auth import UserAuthenticator
 from yocto.address import AddressManager
+from yocto.cache import get_redirect_cache
 from yocto.lib.utils import (
     SHORT_ID_IDENTIFIER, 
     VISITS_COUNT_IDENTIFIER
@@ -70,3 +71,14 @@ def test_index_redirect_count_visits(client_with_data, app):
         visits = db.urls.find_one({SHORT_ID_IDENTIFIER: "abcdef1"})[VISITS_COUNT_IDENTIFIER]
         client_with_data.get("/abcdef1")
         assert db.urls.find_one({SHORT_ID_IDENTIFIER: "abcdef1"})[VISITS_COUNT_IDENTIFIER] == visits + 1
+
+
+def test_index_redirect_cached(client_with_data, app):
+    client_with_data.get("/abcdef1")
+    with app.app_context():
+        assert get_redirect_cache().get("abcdef1") == "https://www.example.com"
+        # Deleting the link stops it resolving
+        AddressManager(get_db(), cache=get_redirect_cache()).delete_short_id("abcdef1")
+    response = client_with_data.get("/abcdef1")
+    assert response.status_code == 302
+    assert response.location != "https://www.example.com"
@@ -0,0 +1,185 @@
+import os
+import time
+import pytest
+
+from pymongo import MongoClient
+
+from yocto import create_app
+from yocto.address import AddressManager
+from yocto.db import init_db, get_db
+from yocto.indexes import TOMBSTONE_RETENTION
+from yocto.lib.exceptions import UrlNotFoundError
+from yocto.lib.snapshot import SnapshotFile, SnapshotFormatError, write_snapshot
+from yocto.snapshots import (
+    RedirectSnapshot,
+    build_redirect_snapshot,
+    get_redirect_snapshot,
+)
+from yocto.lib.utils import (
+    LONG_URL_IDENTIFIER,
+    SHORT_ID_IDENTIFIER,
+    VISITS_COUNT_IDENTIFIER,
+)
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture()
+def timer():
+    return FakeTimer()
+
+
+@pytest.fixture()
+def database():
+    client = MongoClient(host="localhost", port=27017)
+    client.tests.drop_collection("urls")
+    client.tests.drop_collection("tombstones")
+    client.tests.urls.insert_many(
+        [
+            {
+                LONG_URL_IDENTIFIER: f"https://www.example.com/{i}",
+                SHORT_ID_IDENTIFIER: f"abcdef{i}",
+                VISITS_COUNT_IDENTIFIER: i,
+            }
+            for i in range(10)
+        ]
+    )
+    return client.tests
+
+
+class TestSnapshotFile:
+    def test_write_and_read(self, tmp_path):
+        path = str(tmp_path / "redirects.snapshot")
+        items = [("abc", "https://www.example.com/1"), ("abd", "https://www.example.com/é")]
+        assert write_snapshot(path, items, 1234.5) == 2
+        snapshot = SnapshotFile(path)
+        assert len(snapshot) == 2
+        assert snapshot.created_at == 1234.5
+        assert snapshot.get("abc") == "https://www.example.com/1"
+        assert snapshot.get("abd") == "https://www.example.com/é"
+        assert snapshot.get("abe") is None
+        assert snapshot.get("ab", "missing") == "missing"
+
+    def test_empty(self, tmp_path):
+        path = str(tmp_path / "redirects.snapshot")
+        assert write_snapshot(path, [], 0.0) == 0
+        assert SnapshotFile(path).get("abc") is None
+
+    def test_unsorted(self, tmp_path):
+        path = str(tmp_path / "redirects.snapshot")
+        with pytest.raises(ValueError):
+            write_snapshot(path, [("b", "1"), ("a", "2")], 0.0)
+        with pytest.raises(ValueError):
+            write_snapshot(path, [("a", "1"), ("a", "2")], 0.0)
+        assert not os.path.exists(path)
+        assert os.listdir(tmp_path) == []
+
+    def test_not_a_snapshot(self, tmp_path):
+        path = tmp_path / "redirects.snapshot"
+        path.write_bytes(b"not a snapshot, but long enough to have a header")
+        with pytest.raises(SnapshotFormatError):
+            SnapshotFile(str(path))
+
+
+class TestRedirectSnapshot:
+    def test_build_all(self, database, tmp_path):
+        path = str(tmp_path / "redirects.snapshot")
+        assert build_redirect_snapshot(database.urls, path) == 10
+        snapshot = SnapshotFile(path)
+        assert snapshot.get("abcdef3") == "https://www.example.com/3"
+
+    def test_build_top(self, database, tmp_path):
+        path = str(tmp_path / "redirects.snapshot")
+        assert build_redirect_snapshot(database.urls, path, top=3) == 3
+        snapshot = SnapshotFile(path)
+        assert snapshot.get("abcdef9") == "https://www.example.com/9"
+        assert snapshot.get("abcdef7") == "https://www.example.com/7"
+        assert snapshot.get("abcdef6") is None
+
+    def test_lookup(self, database, tmp_path, timer):
+        path = str(tmp_path / "redirects.snapshot")
+        redirects = RedirectSnapshot(path, database.tombstones, synchronous=True, timer=timer)
+        # No file yet
+        assert redirects.get("abcdef1") is None
+        build_redirect_snapshot(database.urls, path)
+        timer.now += 5
+        assert redirects.get("abcdef1") == "https://www.example.com/1"
+        assert redirects.get("zzzzzzz") is None
+
+    def test_not_ready(self, database, tmp_path, timer):
+        path = str(tmp_path / "redirects.snapshot")
+        build_redirect_snapshot(database.urls, path)
+        redirects = RedirectSnapshot(path, database.tombstones, timer=timer)
+        redirects.close()  # no thread
+        assert redirects.get("abcdef1") is None
+        redirects.refresh()
+        assert redirects.get("abcdef1") == "https://www.example.com/1"
+        # Not trusted once refreshes stop
+        timer.now += 30
+        assert redirects.get("abcdef1") is None
+
+    def test_too_old(self, database, tmp_path, timer):
+        path = str(tmp_path / "redirects.snapshot")
+        write_snapshot(path, [("abcdef1", "https://www.example.com/1")], time.time() - TOMBSTONE_RETENTION - 1)
+        redirects = RedirectSnapshot(path, database.tombstones, synchronous=True, timer=timer)
+        assert redirects.get("abcdef1") is None
+
+    def test_replaced(self, database, tmp_path, timer):
+        path = str(tmp_path / "redirects.snapshot")
+        write_snapshot(path, [("abcdef1", "https://www.example.com/old")], time.time())
+        redirects = RedirectSnapshot(path, database.tombstones, synchronous=True, timer=timer)
+        assert redirects.get("abcdef1") == "https://www.example.com/old"
+        build_redirect_snapshot(database.urls, path)
+        timer.now += 5
+        assert redirects.get("abcdef1") == "https://www.example.com/1"
+
+    def test_address_manager(self, database, tmp_path, timer):
+        path = str(tmp_path / "redirects.snapshot")
+        build_redirect_snapshot(database.urls, path)
+        redirects = RedirectSnapshot(path, database.tombstones, synchronous=True, timer=timer)
+        am = AddressManager(database, snapshot=redirects, tombstones=True)
+        assert am.lookup_short_id("abcdef1", count_visit=True) == "https://www.example.com/1"
+        assert database.urls.find_one({SHORT_ID_IDENTIFIER: "abcdef1"})[VISITS_COUNT_IDENTIFIER] == 2
+        # Links created since the snapshot are read from the database
+        database.urls.insert_one({LONG_URL_IDENTIFIER: "https://www.example2.com", SHORT_ID_IDENTIFIER: "1234567"})
+        assert am.lookup_short_id("1234567") == "https://www.example2.com"
+        # Links deleted since the snapshot are not answered from it
+        am.delete_short_id("abcdef2")
+        timer.now += 5
+        with pytest.raises(UrlNotFoundError):
+            am.lookup_short_id("abcdef2")
+        assert am.lookup_short_id("abcdef3") == "https://www.example.com/3"
+
+
+def test_build_command(tmp_path):
+    app = create_app("TestingConfig")
+    with app.app_context():
+        init_db()
+        get_db().urls.insert_one({LONG_URL_IDENTIFIER: "https://www.example.com", SHORT_ID_IDENTIFIER: "abcdefg"})
+    path = str(tmp_path / "redirects.snapshot")
+    result = app.test_cli_runner().invoke(args=["build-redirect-snapshot", "--output", path])
+    assert result.exit_code == 0
+    assert "Wrote 1 links" in result.output
+    assert SnapshotFile(path).get("abcdefg") == "https://www.example.com"
+
+
+def test_init_app(tmp_path):
+    app = create_app("TestingConfig")
+    with app.app_context():
+        assert get_redirect_snapshot() is None
+    app = create_app("TestingConfig")
+    app.config["REDIRECT_SNAPSHOT_ENABLED"] = True
+    app.config["REDIRECT_SNAPSHOT_PATH"] = str(tmp_path / "redirects.snapshot")
+    from yocto import snapshots
+    snapshots.init_app(app)
+    with app.app_context():
+        snapshot = get_redirect_snapshot()
+        assert isinstance(snapshot, RedirectSnapshot)
+        assert snapshot.path == str(tmp_path / "redirects.snapshot")
+        snapshot.close()
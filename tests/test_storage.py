@@ -0,0 +1,185 @@
+from datetime import datetime, timedelta, timezone
+import pytest
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel, InsertOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from yocto import config, create_app
+from yocto.address import AddressManager
+from yocto.auth import UserAuthenticator, UserExistsError, PasswordMismatchError
+from yocto.db import get_database, get_db, init_db
+from yocto.indexes import ensure_indexes
+from yocto.lib.exceptions import UrlExistsError, UrlNotFoundError
+from yocto.storage import sqlite
+from yocto.storage.sqlite import SQLiteDatabase
+from yocto.lib.utils import (
+    LONG_URL_IDENTIFIER,
+    SHORT_ID_IDENTIFIER,
+    CREATOR_ID_IDENTIFIER,
+    VISITS_COUNT_IDENTIFIER,
+)
+
+
+@pytest.fixture()
+def database(tmp_path):
+    database = SQLiteDatabase(str(tmp_path / "tests.sqlite3"))
+    ensure_indexes(database)
+    yield database
+    database.close()
+
+
+class TestSQLiteDatabase:
+    def test_values(self, database):
+        document = {
+            "id": ObjectId(),
+            "date": datetime(2024, 5, 1, 12, 30, 15, 250000),
+            "aware": datetime(2024, 5, 1, 14, 30, tzinfo=timezone(timedelta(hours=2))),
+            "bytes": b"\x00\x01",
+            "tagged": "\x01o not an ObjectId",
+            "nested": {"list": [1, 2.5, None, True, "text"]},
+        }
+        inserted_id = database.things.insert_one(document).inserted_id
+        assert document["_id"] == inserted_id
+        found = database.things.find_one({"_id": inserted_id})
+        assert found["id"] == document["id"]
+        assert found["date"] == document["date"]
+        assert found["aware"] == datetime(2024, 5, 1, 12, 30)
+        assert found["bytes"] == b"\x00\x01"
+        assert found["tagged"] == "\x01o not an ObjectId"
+        assert found["nested"] == document["nested"]
+        assert database.things.find_one({"tagged": "\x01o not an ObjectId"})["_id"] == inserted_id
+
+    def test_queries(self, database):
+        database.things.insert_many([{"n": i, "even": i % 2 == 0} for i in range(10)])
+        database.things.insert_one({"other": True})
+        things = database.things
+        assert [t["n"] for t in things.find({"n": {"$gte": 3, "$lt": 6}})] == [3, 4, 5]
+        assert [t["n"] for t in things.find({"n": {"$in": [1, 8, 20]}})] == [1, 8]
+        assert things.count_documents({"even": True}) == 5
+        assert things.count_documents({"n": {"$exists": False}}) == 1
+        assert things.count_documents({"n": {"$ne": 3}}) == 10
+        assert things.count_documents({"$or": [{"n": 1}, {"other": True}]}) == 2
+        assert [t["n"] for t in things.find({"even": False}).sort("n", DESCENDING).skip(1).limit(2)] == [7, 5]
+        assert things.find_one({"n": 4}, {"n": True, "_id": False}) == {"n": 4}
+        assert "n" not in things.find_one({"n": 4}, projection={"n": False})
+        assert things.estimated_document_count() == 11
+
+    def test_updates(self, database):
+        things = database.things
+        things.insert_one({"name": "a", "count": 1})
+        result = things.update_one({"name": "a"}, {"$inc": {"count": 2}, "$set": {"flag": True}})
+        assert result.matched_count == 1 and result.modified_count == 1
+        assert things.find_one({"name": "a"})["count"] == 3
+        result = things.update_one({"name": "b"}, {"$setOnInsert": {"count": 0}}, upsert=True)
+        assert result.upserted_id is not None
+        assert things.find_one({"name": "b"})["count"] == 0
+        after = things.find_one_and_update(
+            {"count": {"$lt": 10}},
+            {"$inc": {"count": 10}},
+            sort=[("count", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+        assert after["name"] == "b" and after["count"] == 10
+        assert things.find_one_and_delete({"name": "a"})["count"] == 3
+        assert things.find_one({"name": "a"}) is None
+        assert things.delete_many({}).deleted_count == 1
+
+    def test_unique_index(self, database):
+        database.urls.insert_one({SHORT_ID_IDENTIFIER: "abcdefg"})
+        with pytest.raises(DuplicateKeyError) as excinfo:
+            database.urls.insert_one({SHORT_ID_IDENTIFIER: "abcdefg"})
+        assert excinfo.value.details["keyPattern"] == {SHORT_ID_IDENTIFIER: 1}
+        # Sparse indexes leave out documents without the field
+        database.urls.insert_many([{SHORT_ID_IDENTIFIER: "1"}, {SHORT_ID_IDENTIFIER: "2"}])
+        assert set(database.urls.index_information()) >= {"_id_", "short_id_unique", "long_url_hash_unique"}
+
+    def test_bulk_write(self, database):
+        database.urls.insert_one({SHORT_ID_IDENTIFIER: "abcdefg"})
+        with pytest.raises(BulkWriteError) as excinfo:
+            database.urls.bulk_write(
+                [
+                    InsertOne({SHORT_ID_IDENTIFIER: "abcdefg"}),
+                    UpdateOne({SHORT_ID_IDENTIFIER: "abcdefg"}, {"$inc": {VISITS_COUNT_IDENTIFIER: 1}}),
+                    UpdateOne({SHORT_ID_IDENTIFIER: "1234567"}, {"$inc": {VISITS_COUNT_IDENTIFIER: 1}}, upsert=True),
+                ],
+                ordered=False,
+            )
+        details = excinfo.value.details
+        assert [error["index"] for error in details["writeErrors"]] == [0]
+        assert details["nModified"] == 1 and details["nUpserted"] == 1
+        assert database.urls.find_one({SHORT_ID_IDENTIFIER: "1234567"})[VISITS_COUNT_IDENTIFIER] == 1
+
+    def test_ttl_index(self, database, monkeypatch):
+        monkeypatch.setattr(sqlite, "TTL_INTERVAL", 0)
+        things = database.things
+        things.create_indexes([IndexModel([("expires", ASCENDING)], name="expires_ttl", expireAfterSeconds=0)])
+        now = datetime.now(timezone.utc)
+        things.insert_many([
+            {"name": "old", "expires": now - timedelta(minutes=1)},
+            {"name": "new", "expires": now + timedelta(minutes=1)},
+            {"name": "none", "expires": "not a date"},
+        ])
+        things._next_expiry = 0.0
+        assert sorted(thing["name"] for thing in things.find()) == ["new", "none"]
+
+    def test_drop_collection(self, database):
+        database.urls.insert_one({SHORT_ID_IDENTIFIER: "abcdefg"})
+        database.drop_collection("urls")
+        assert database.urls.find_one({}) is None
+        assert list(database.urls.index_information()) == ["_id_"]
+
+
+class TestManagers:
+    def test_address_manager(self, database):
+        user_id = UserAuthenticator(database).register_user("new_user", "V4l1d_password")
+        am = AddressManager(database)
+        short_id = am.shorten("https://www.example.com", user_id)
+        with pytest.raises(UrlExistsError):
+            am.shorten("HTTPS://WWW.EXAMPLE.COM/", user_id)
+        with pytest.raises(UrlExistsError):
+            am.store_url_and_id("https://www.example.com", "abcdef1", user_id)
+        with pytest.raises(DuplicateKeyError):
+            am.store_url_and_id("https://www.example3.com", short_id, user_id)
+        assert am.lookup_short_id(short_id, count_visit=True) == "https://www.example.com"
+        assert database.urls.find_one({SHORT_ID_IDENTIFIER: short_id})[VISITS_COUNT_IDENTIFIER] == 1
+        assert am.lookup_long_url("https://www.example.com/") == short_id
+        results = am.store_many(["https://www.example.com", "https://www.example2.com", "invalid"], user_id)
+        assert [result["status"] for result in results] == ["exists", "created", "invalid"]
+        links = list(am.iter_user_urls(user_id))
+        assert [link[LONG_URL_IDENTIFIER] for link in links] == ["https://www.example.com", "https://www.example2.com"]
+        am.delete_short_id(short_id, creator_id=user_id)
+        with pytest.raises(UrlNotFoundError):
+            am.lookup_short_id(short_id)
+
+    def test_user_authenticator(self, database):
+        auth = UserAuthenticator(database)
+        user_id = auth.register_user("new_user", "V4l1d_password")
+        with pytest.raises(UserExistsError):
+            auth.register_user("new_user", "V4l1d_password")
+        assert auth.authenticate_user("new_user", "V4l1d_password") == user_id
+        with pytest.raises(PasswordMismatchError):
+            auth.authenticate_user("new_user", "Wr0ng_password")
+        AddressManager(database).shorten("https://www.example.com", user_id)
+        auth.delete_user(user_id)
+        assert database.users.find_one({}) is None
+        assert database.urls.count_documents({CREATOR_ID_IDENTIFIER: user_id}) == 0
+
+
+def test_app(tmp_path, monkeypatch):
+    monkeypatch.setattr(config.TestingConfig, "STORAGE_BACKEND", "sqlite")
+    monkeypatch.setattr(config.TestingConfig, "SQLITE_PATH", str(tmp_path / "tests.sqlite3"))
+    app = create_app("TestingConfig")
+    with app.app_context():
+        init_db()
+        assert isinstance(get_db(), SQLiteDatabase)
+        user_id = UserAuthenticator(get_db()).register_user("new_user", "V4l1d_password")
+        AddressManager(get_db()).store_url_and_id("https://www.example.com", "abcdef1", user_id)
+    response = app.test_client().get("/abcdef1")
+    assert response.status_code == 302
+    assert response.location == "https://www.example.com"
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        get_database({"STORAGE_BACKEND": "unknown", "DATABASE": "tests"})
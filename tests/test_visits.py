@@ -0,0 +1,254 @@
+from datetime import datetime, timezone
+import gc
+import time
+import weakref
+import pytest
+
+from pymongo import MongoClient
+from pymongo.collection import Collection
+
+from yocto import config, create_app
+from yocto.address import AddressManager
+from yocto.visits import (
+    VISIT_COUNTER_EXTENSION,
+    VisitCounter,
+    VisitHistory,
+    bucket_start,
+    get_visit_counter,
+)
+from yocto.lib.urls import url_hash
+from yocto.lib.utils import (
+    LONG_URL_IDENTIFIER,
+    LONG_URL_HASH_IDENTIFIER,
+    SHORT_ID_IDENTIFIER,
+    VISITS_COUNT_IDENTIFIER,
+    VISIT_SHORT_ID_IDENTIFIER,
+    VISIT_GRANULARITY_IDENTIFIER,
+    VISIT_START_IDENTIFIER,
+    VISIT_COUNT_IDENTIFIER,
+    VISIT_EXPIRY_IDENTIFIER,
+)
+
+TIMESTAMP = datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc).timestamp()
+RETENTION = config.Config.VISIT_HISTORY_RETENTION
+
+@pytest.fixture()
+def urls():
+    client = MongoClient(host="localhost", port=27017)
+    client.tests.drop_collection("urls")
+    client.tests.drop_collection("visits")
+    urls: Collection = client.tests.urls
+    urls.insert_many(
+        [
+            {
+                LONG_URL_IDENTIFIER: "https://www.example.com",
+                LONG_URL_HASH_IDENTIFIER: url_hash("https://www.example.com"),
+                SHORT_ID_IDENTIFIER: "abcdef1",
+                VISITS_COUNT_IDENTIFIER: 0,
+            },
+            {
+                LONG_URL_IDENTIFIER: "https://www.example2.com",
+                LONG_URL_HASH_IDENTIFIER: url_hash("https://www.example2.com"),
+                SHORT_ID_IDENTIFIER: "1234567",
+                VISITS_COUNT_IDENTIFIER: 5,
+            },
+        ]
+    )
+    return urls
+
+
+def visits(urls, short_id):
+    return urls.find_one({SHORT_ID_IDENTIFIER: short_id})[VISITS_COUNT_IDENTIFIER]
+
+
+class TestVisitCounter:
+    def test_record_buffers(self, urls):
+        counter = VisitCounter(urls, flush_size=100, flush_interval=60)
+        counter.record("abcdef1")
+        counter.record("abcdef1")
+        counter.record("1234567", count=3)
+        assert counter.pending() == {"abcdef1": 2, "1234567": 3}
+        assert visits(urls, "abcdef1") == 0
+        assert counter.flush() == 2
+        assert counter.pending() == {}
+        assert visits(urls, "abcdef1") == 2
+        assert visits(urls, "1234567") == 8
+        assert counter.flush() == 0  # nothing pending
+        counter.close()
+
+    def test_synchronous(self, urls):
+        counter = VisitCounter(urls, synchronous=True)
+        counter.record("abcdef1")
+        assert counter.pending() == {}
+        assert visits(urls, "abcdef1") == 1
+
+    def test_flush_on_size(self, urls):
+        counter = VisitCounter(urls, flush_size=3, flush_interval=60)
+        for _ in range(3):
+            counter.record("abcdef1")
+        for _ in range(50):
+            if visits(urls, "abcdef1") == 3:
+                break
+            time.sleep(0.1)
+        assert visits(urls, "abcdef1") == 3
+        counter.close()
+
+    def test_flush_on_interval(self, urls):
+        counter = VisitCounter(urls, flush_size=100, flush_interval=0.1)
+        counter.record("abcdef1")
+        for _ in range(50):
+            if visits(urls, "abcdef1") == 1:
+                break
+            time.sleep(0.1)
+        assert visits(urls, "abcdef1") == 1
+        counter.close()
+
+    def test_close_flushes(self, urls):
+        counter = VisitCounter(urls, flush_size=100, flush_interval=60)
+        counter.record("abcdef1")
+        counter.close()
+        assert visits(urls, "abcdef1") == 1
+
+    def test_unknown_short_id_ignored(self, urls):
+        counter = VisitCounter(urls, synchronous=True)
+        counter.record("notreal")
+        assert urls.find_one({SHORT_ID_IDENTIFIER: "notreal"}) is None
+
+    def test_address_manager_uses_counter(self, urls):
+        counter = VisitCounter(urls, flush_size=100, flush_interval=60)
+        am = AddressManager(urls.database, visit_counter=counter)
+        assert am.lookup_short_id("abcdef1", count_visit=True) == "https://www.example.com"
+        assert am.lookup_short_id("abcdef1") == "https://www.example.com"
+        assert counter.pending() == {"abcdef1": 1}
+        assert visits(urls, "abcdef1") == 0
+        counter.close()
+        assert visits(urls, "abcdef1") == 1
+
+
+def buckets(database, short_id, granularity):
+    return {
+        bucket[VISIT_START_IDENTIFIER]: bucket[VISIT_COUNT_IDENTIFIER]
+        for bucket in database.visits.find(
+            {VISIT_SHORT_ID_IDENTIFIER: short_id, VISIT_GRANULARITY_IDENTIFIER: granularity}
+        )
+    }
+
+
+def test_bucket_start():
+    moment = datetime(2024, 1, 2, 3, 4, 5)
+    assert bucket_start(moment, "minute") == datetime(2024, 1, 2, 3, 4)
+    assert bucket_start(moment, "hour") == datetime(2024, 1, 2, 3)
+    assert bucket_start(moment, "day") == datetime(2024, 1, 2)
+    assert bucket_start(TIMESTAMP, "hour") == datetime(2024, 1, 2, 3)
+    with pytest.raises(ValueError):
+        bucket_start(moment, "week")
+
+
+class TestVisitHistory:
+    def test_counter_writes_buckets(self, urls):
+        history = VisitHistory(urls.database.visits, RETENTION)
+        counter = VisitCounter(urls, flush_size=100, flush_interval=60, history=history)
+        counter.record("abcdef1", timestamp=TIMESTAMP)
+        counter.record("abcdef1", timestamp=TIMESTAMP + 60)
+        counter.record("abcdef1", count=2, timestamp=TIMESTAMP + 3600)
+        counter.record("1234567", timestamp=TIMESTAMP)
+        assert counter.pending() == {"abcdef1": 4, "1234567": 1}
+        assert counter.flush() == 2
+        assert visits(urls, "abcdef1") == 4
+        assert buckets(urls.database, "abcdef1", "minute") == {
+            datetime(2024, 1, 2, 3, 4): 1,
+            datetime(2024, 1, 2, 3, 5): 1,
+            datetime(2024, 1, 2, 4, 4): 2,
+        }
+        assert buckets(urls.database, "abcdef1", "hour") == {
+            datetime(2024, 1, 2, 3): 2,
+            datetime(2024, 1, 2, 4): 2,
+        }
+        assert buckets(urls.database, "abcdef1", "day") == {datetime(2024, 1, 2): 4}
+        # Later visits are added to the same buckets
+        counter.record("abcdef1", timestamp=TIMESTAMP)
+        counter.close()
+        assert buckets(urls.database, "abcdef1", "day") == {datetime(2024, 1, 2): 5}
+
+    def test_deleted_link_not_written(self, urls):
+        history = VisitHistory(urls.database.visits, RETENTION)
+        counter = VisitCounter(urls, flush_size=100, flush_interval=60, history=history)
+        counter.record("abcdef1", timestamp=TIMESTAMP)
+        counter.record("1234567", timestamp=TIMESTAMP)
+        # Deleted between the visit and the flush
+        urls.delete_one({SHORT_ID_IDENTIFIER: "abcdef1"})
+        counter.flush()
+        assert buckets(urls.database, "abcdef1", "day") == {}
+        assert buckets(urls.database, "1234567", "day") == {datetime(2024, 1, 2): 1}
+
+    def test_retention(self, urls):
+        history = VisitHistory(urls.database.visits, {"hour": 3600, "day": None})
+        history.write({("abcdef1", int(TIMESTAMP // 60)): 1})
+        bucket = urls.database.visits.find_one({VISIT_SHORT_ID_IDENTIFIER: "abcdef1"})
+        assert bucket[VISIT_GRANULARITY_IDENTIFIER] == "hour"
+        # Kept for an hour after the end of the bucket
+        assert bucket[VISIT_EXPIRY_IDENTIFIER] == datetime(2024, 1, 2, 5)
+        assert urls.database.visits.count_documents({}) == 1
+        with pytest.raises(ValueError):
+            VisitHistory(urls.database.visits, {"week": 3600})
+
+    def test_visit_history(self, urls):
+        history = VisitHistory(urls.database.visits, RETENTION)
+        counter = VisitCounter(urls, synchronous=True, history=history)
+        counter.record("abcdef1", timestamp=TIMESTAMP)
+        counter.record("abcdef1", count=3, timestamp=TIMESTAMP + 2 * 3600)
+        am = AddressManager(urls.database)
+        result = am.visit_history(
+            "abcdef1",
+            "hour",
+            start=datetime(2024, 1, 2, 2, 30),
+            end=datetime(2024, 1, 2, 5, 30),
+        )
+        assert result == [
+            (datetime(2024, 1, 2, 2), 0),
+            (datetime(2024, 1, 2, 3), 1),
+            (datetime(2024, 1, 2, 4), 0),
+            (datetime(2024, 1, 2, 5), 3),
+        ]
+        # The last 7 days by default
+        assert len(am.visit_history("abcdef1", "day")) == 8
+        with pytest.raises(ValueError):
+            am.visit_history("abcdef1", "week")
+        with pytest.raises(ValueError):
+            am.visit_history("abcdef1", start=datetime(2024, 1, 3), end=datetime(2024, 1, 2))
+
+    def test_deleted_with_link(self, urls):
+        counter = VisitCounter(urls, synchronous=True, history=VisitHistory(urls.database.visits, RETENTION))
+        counter.record("abcdef1")
+        counter.record("1234567")
+        am = AddressManager(urls.database)
+        am.delete_short_id("abcdef1")
+        assert urls.database.visits.count_documents({VISIT_SHORT_ID_IDENTIFIER: "abcdef1"}) == 0
+        am.delete_url("https://www.example2.com")
+        assert urls.database.visits.count_documents({}) == 0
+
+
+def test_init_app():
+    app = create_app("TestingConfig")
+    with app.app_context():
+        counter = get_visit_counter()
+        assert isinstance(counter, VisitCounter)
+        assert counter.synchronous
+        assert isinstance(counter.history, VisitHistory)
+        assert counter.history.retention == config.TestingConfig.VISIT_HISTORY_RETENTION
+    app.config["VISIT_COUNTER_ENABLED"] = False
+    from yocto import visits
+    visits.init_app(app)
+    with app.app_context():
+        assert get_visit_counter() is None
+
+
+def test_counters_not_kept_after_apps():
+    counters = []
+    for _ in range(3):
+        app = create_app("TestingConfig")
+        counters.append(weakref.ref(app.extensions[VISIT_COUNTER_EXTENSION]))
+    del app
+    gc.collect()
+    # Counters of discarded apps are not held by exit hooks
+    assert counters[0]() is None and counters[1]() is None
@@ -20,14 +20,63 @@ def create_app(configType=None):
         pass
 
     # Import pages blueprint
-    from yocto import pages, short
+    from yocto import api, pages, short
     app.register_blueprint(short.bp)
     app.register_blueprint(pages.bp)
+    app.register_blueprint(api.bp)
+
+    # Set up metrics before the database client is created, so that its
+    # commands are timed
+    from yocto import metrics
+    metrics.init_app(app)
 
     # Import database functions and initialize
     from yocto import db
     db.init_app(app)
 
+    # Set up in-process caches
+    from yocto import cache
+    cache.init_app(app)
+
+    # Set up the filter of existing short IDs
+    from yocto import filters
+    filters.init_app(app)
+
+    # Set up the shared snapshot of redirects
+    from yocto import snapshots
+    snapshots.init_app(app)
+
+    # Set up buffered visit counting
+    from yocto import visits
+    visits.init_app(app)
+
+    # Set up background deletion of deleted accounts' links
+    from yocto import deletion
+    deletion.init_app(app)
+
+    # Set up short ID allocation
+    from yocto import allocators
+    allocators.init_app(app)
+
+    # Set up the password hashing pool
+    from yocto import hashing
+    hashing.init_app(app)
+
+    # Set up login rate limits
+    from yocto import ratelimit
+    ratelimit.init_app(app)
+
+    # Import API token commands
+    api.init_app(app)
+
+    # Import bulk link creation command
+    from yocto import bulk
+    bulk.init_app(app)
+
+    # Answer redirects ahead of Flask, once every route is registered
+    from yocto import fastpath
+    fastpath.init_app(app)
+
     # Set up reverse proxy if using nginx
     if os.getenv("NGINX_CONF"):
         app.wsgi_app = ProxyFix(
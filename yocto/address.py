@@ -1,30 +1,84 @@
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from urllib.parse import urlsplit
-import secrets
-import math
 
+from pymongo import ASCENDING
 from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.write_concern import WriteConcern
 from bson.objectid import ObjectId
-from validators import url
 
+from yocto.allocators import RandomIdAllocator, random_short_id
 from yocto.lib.exceptions import (
     UrlInvalidError,
     UrlExistsError,
     UrlNotFoundError,
-    UserNotFoundError
+    UserNotFoundError,
+    ShortIdAllocationError,
 )
+from yocto.lib.urls import is_valid_url, url_hash
 from yocto.lib.utils import (
     _verify_type,
     LONG_URL_IDENTIFIER,
+    LONG_URL_HASH_IDENTIFIER,
     SHORT_ID_IDENTIFIER,
     URL_CREATION_DATE_IDENTIFIER,
     CREATOR_ID_IDENTIFIER,
     VISITS_COUNT_IDENTIFIER,
+    URL_ID_IDENTIFIER,
     USER_ID_IDENTIFIER,
+    VISIT_SHORT_ID_IDENTIFIER,
+    VISIT_GRANULARITY_IDENTIFIER,
+    VISIT_START_IDENTIFIER,
+    VISIT_COUNT_IDENTIFIER,
+    TOMBSTONE_SHORT_ID_IDENTIFIER,
+    TOMBSTONE_DELETION_DATE_IDENTIFIER,
 )
+from yocto.visits import GRANULARITIES, bucket_start
+
+# Status of each long URL in the result of `AddressManager.store_many`
+STORE_CREATED = "created"
+STORE_EXISTS = "exists"
+STORE_INVALID = "invalid"
+STORE_FAILED = "failed"
+
+# Fields of a link returned when listing a user's links
+LISTING_PROJECTION = {
+    URL_ID_IDENTIFIER: True,
+    LONG_URL_IDENTIFIER: True,
+    SHORT_ID_IDENTIFIER: True,
+    URL_CREATION_DATE_IDENTIFIER: True,
+    VISITS_COUNT_IDENTIFIER: True,
+}
+
+def _duplicate_key_field(details):
+    # Name the field whose unique index rejected an insert, from the details
+    # of a DuplicateKeyError or a write error in a BulkWriteError
+    key_pattern = details.get("keyPattern")
+    if key_pattern:
+        return next(iter(key_pattern))
+    message = details.get("errmsg", "")
+    for field in (SHORT_ID_IDENTIFIER, LONG_URL_HASH_IDENTIFIER):
+        if field in message:
+            return field
+    return None
+
+# Returned by cache lookups for short IDs not in the cache, since a cached
+# `None` records a short ID known not to exist.
+_NOT_CACHED = object()
 
 class AddressManager:
-    def __init__(self, database):
+    def __init__(
+            self,
+            database,
+            cache=None,
+            visit_counter=None,
+            allocator=None,
+            short_id_filter=None,
+            snapshot=None,
+            read_database=None,
+            invalidator=None,
+            tombstones=False,
+        ):
         """
         Class to manage URLs and their corresponding shortened versions.
 
@@ -36,11 +90,92 @@ class AddressManager:
         is the ID which will be stored in the database, as the rest of the URL
         can be constructed outside the database.
 
-        :param database: The database containing the users and urls collections.
-        :type database: pymongo.database.Database
+        If a cache is provided, short ID lookups are answered from it where
+        possible, and entries are invalidated when links are created or
+        deleted through this class. If a visit counter is provided, visits
+        are buffered by it rather than written by each lookup. If a short ID
+        filter is provided, lookups of short IDs it rules out do not query
+        the database, and it is told of the links created and deleted
+        through this class. If a redirect snapshot is provided, lookups of
+        short IDs in it do not query the database. If a read database is
+        provided, e.g. one reading from secondaries of a replica set, short
+        ID lookups which do not write are made through it, and those it
+        does not answer, such as links not yet replicated, are made again
+        through `database`. If an invalidator is provided, deleted short IDs
+        are also invalidated in the redirect caches of the other processes.
+        If `tombstones` is set, deletions leave tombstones, from which
+        redirect snapshots taken before learn of them; they are only needed
+        while snapshots are enabled.
+
+        :param database: The database containing the users and urls
+            collections, of any of the backends in `yocto.storage`.
+        :type database: pymongo.database.Database | yocto.storage.sqlite.SQLiteDatabase
+        :param cache: Cache of short IDs to long URLs (default no caching).
+        :type cache: yocto.cache.RedirectCache
+        :param visit_counter: Buffer for visit counts (default write each
+            visit to the database).
+        :type visit_counter: yocto.visits.VisitCounter
+        :param allocator: Source of new short IDs for `shorten` (default
+            random 7-character IDs).
+        :type allocator: yocto.allocators.RandomIdAllocator
+        :param short_id_filter: Filter of the short IDs in the database
+            (default none).
+        :type short_id_filter: yocto.filters.ShortIdFilter
+        :param snapshot: Snapshot of short IDs to long URLs (default none).
+        :type snapshot: yocto.snapshots.RedirectSnapshot
+        :param read_database: The database for short ID lookups (default
+            `database`).
+        :type read_database: pymongo.database.Database
+        :param invalidator: Invalidator of the caches of every process
+            (default this process's cache only).
+        :type invalidator: yocto.cache.CacheInvalidator
+        :param bool tombstones: Whether deletions leave tombstones.
         """
         self._urls: Collection = database.urls
+        self._read_urls: Collection = (
+            self._urls if read_database is None or read_database is database else read_database.urls
+        )
         self._users: Collection = database.users
+        self._visits: Collection = database.visits
+        self._tombstones: Collection = database.tombstones
+        self._cache = cache
+        self._visit_counter = visit_counter
+        self._allocator = RandomIdAllocator() if allocator is None else allocator
+        self._filter = short_id_filter
+        self._snapshot = snapshot
+        self._invalidator = invalidator
+        self._write_tombstones = tombstones
+
+    def _stored(self, short_id):
+        if self._cache is not None:
+            # Drop any cached miss for the new short ID
+            self._cache.invalidate(short_id)
+        if self._filter is not None:
+            self._filter.add(short_id)
+
+    def _deleted(self, short_ids):
+        # Clean up after deleting links: the caches and tombstones first, so
+        # that no worker keeps redirecting, then the visit history
+        if self._write_tombstones:
+            # Tombstones tell redirect snapshots taken before the deletion
+            now = datetime.now(timezone.utc)
+            self._tombstones.insert_many(
+                [
+                    {
+                        TOMBSTONE_SHORT_ID_IDENTIFIER: short_id,
+                        TOMBSTONE_DELETION_DATE_IDENTIFIER: now,
+                    }
+                    for short_id in short_ids
+                ],
+                ordered=False,
+            )
+        if self._cache is not None:
+            self._cache.invalidate_many(short_ids)
+        if self._invalidator is not None:
+            self._invalidator.publish("redirect", short_ids)
+        if self._filter is not None:
+            self._filter.discard(short_ids)
+        self._visits.delete_many({VISIT_SHORT_ID_IDENTIFIER: {"$in": short_ids}})
 
     @staticmethod
     def extract_id_from_short_url(short_url):
@@ -65,7 +200,7 @@ class AddressManager:
         >>> extract_id_from_short_url("https://yoc.to/1234567")
         "1234567"
         """
-        if not url(short_url):
+        if not is_valid_url(short_url):
             raise UrlInvalidError
         split_url = urlsplit(short_url)
         return split_url.path.removeprefix("/")
@@ -81,7 +216,8 @@ class AddressManager:
         cryptographic randomness is used. Short IDs generated are `length`
         characters long, comprising numbers, uppercase and lowercase
         letters, "-" and "_" (a 64-character encoding). The returned value 
-        is ensured to be unique in the database.
+        is ensured to be unique in the database. Candidates ruled out by the
+        short ID filter, if any, are not looked up.
 
         :param int length: The number of characters in the returned ID 
         (default 7).
@@ -90,10 +226,9 @@ class AddressManager:
         :rtype: str
         """
         while True:
-            # Bit encoding of string may be non-integer number of bytes.
-            # To ensure all `length`-character strings possible, round up
-            # bytes then truncate result to correct length
-            short_id = secrets.token_urlsafe(math.ceil(6 * length / 8))[:length]
+            short_id = random_short_id(length)
+            if self._filter is not None and not self._filter.might_exist(short_id):
+                break
             if self._urls.find_one({SHORT_ID_IDENTIFIER: short_id}) is None:
                 break
         return short_id
@@ -102,6 +237,10 @@ class AddressManager:
         """
         Store a long URL with its associated shortened ID in the collection.
 
+        Long URLs are compared in their canonical form (see
+        `yocto.lib.urls.canonical_url`), so that another spelling of a stored
+        URL is found to exist. The URL is stored as given.
+
         :param str long_url: The long URL to which the shortened address points.
         :param str short_id: The ID part of the shortened URL.
         :param bson.objectid.ObjectId creator_id: The user ID of the account creating the 
@@ -111,27 +250,199 @@ class AddressManager:
         :raises UserNotFoundError: If `creator_id` is not registered in
         the users collection of the database.
         :raises UrlExistsError: If `long_url` is already in the urls collection.
+        :raises pymongo.errors.DuplicateKeyError: If `short_id` is already
+        in use.
         """
-        if not url(long_url):
-            raise UrlInvalidError
         for var in [long_url, short_id]:
             _verify_type(var, str)
         _verify_type(creator_id, ObjectId)
+        long_url_hash = url_hash(long_url)
         user_record = self._users.find_one({USER_ID_IDENTIFIER: creator_id})
         if user_record is None:
             raise UserNotFoundError
-        if self._urls.find_one({LONG_URL_IDENTIFIER: long_url}) is not None:
-            raise UrlExistsError
-        self._urls.insert_one(
-            {
-                LONG_URL_IDENTIFIER: long_url,
-                SHORT_ID_IDENTIFIER: short_id,
-                URL_CREATION_DATE_IDENTIFIER: datetime.now(),
-                CREATOR_ID_IDENTIFIER: user_record[USER_ID_IDENTIFIER],
-                VISITS_COUNT_IDENTIFIER: 0,
-            }
-        )
-        
+        try:
+            self._urls.insert_one(
+                self._new_link(long_url, short_id, user_record[USER_ID_IDENTIFIER], long_url_hash)
+            )
+        except DuplicateKeyError as e:
+            if _duplicate_key_field(e.details or {"errmsg": str(e)}) == LONG_URL_HASH_IDENTIFIER:
+                raise UrlExistsError
+            raise
+        self._stored(short_id)
+
+    def shorten(self, long_url, creator_id, check_creator=True, max_attempts=10):
+        """
+        Store a long URL under a newly allocated short ID.
+
+        Short IDs come from the allocator given to this instance and are not
+        checked before inserting. Instead, the unique indexes on the urls
+        collection (see `yocto.indexes`) reject a short ID already in use,
+        upon which another is allocated, and a long URL already stored in any
+        spelling.
+        Creating a link therefore takes a single insert in the usual case.
+
+        :param str long_url: The long URL to which the shortened address points.
+        :param bson.objectid.ObjectId creator_id: The user ID of the account creating the
+        database entry.
+        :param bool check_creator: If `False`, the caller guarantees that
+        `creator_id` is registered and it is not looked up.
+        :param int max_attempts: The number of short IDs to try before
+        giving up (default 10).
+
+        :raises UrlInvalidError: If `long_url` is not a valid URL.
+        :raises UserNotFoundError: If `creator_id` is not registered in
+        the users collection of the database.
+        :raises UrlExistsError: If `long_url` is already in the urls collection.
+        :raises ShortIdAllocationError: If no unused short ID was found.
+
+        :return: The short ID of the new link.
+        :rtype: str
+        """
+        _verify_type(long_url, str)
+        _verify_type(creator_id, ObjectId)
+        long_url_hash = url_hash(long_url)
+        if check_creator and self._users.find_one({USER_ID_IDENTIFIER: creator_id}) is None:
+            raise UserNotFoundError
+        for _ in range(max_attempts):
+            short_id = self._allocator.allocate()
+            try:
+                self._urls.insert_one(
+                    self._new_link(long_url, short_id, creator_id, long_url_hash)
+                )
+            except DuplicateKeyError as e:
+                if _duplicate_key_field(e.details or {"errmsg": str(e)}) == LONG_URL_HASH_IDENTIFIER:
+                    raise UrlExistsError
+                continue
+            self._stored(short_id)
+            return short_id
+        raise ShortIdAllocationError(f"No unused short ID in {max_attempts} attempts")
+
+    def store_many(self, long_urls, creator_id, check_creator=True, max_attempts=10):
+        """
+        Store a batch of long URLs, each under a newly allocated short ID.
+
+        All URLs are validated first, then the long URLs already stored are
+        found with a single query, comparing canonical forms as for
+        `store_url_and_id`. Short IDs are allocated for the rest,
+        which are written with one unordered `insert_many`. Inserts rejected
+        because their short ID is in use are retried with new short IDs, and
+        those rejected because another process stored the same long URL in
+        the meantime are reported as existing. As for `shorten`, the unique
+        indexes of `yocto.indexes` are required.
+
+        :param long_urls: The long URLs to store.
+        :type long_urls: list[str]
+        :param bson.objectid.ObjectId creator_id: The user ID of the account creating the
+        database entries.
+        :param bool check_creator: If `False`, the caller guarantees that
+        `creator_id` is registered and it is not looked up.
+        :param int max_attempts: The number of times to try inserting each
+        long URL (default 10).
+
+        :raises UserNotFoundError: If `creator_id` is not registered in
+        the users collection of the database.
+
+        :return: One result for each long URL, in order, with its "long_url",
+        "short_id" (`None` if not stored) and "status", which is one of
+        "created", "exists" (stored previously or earlier in the batch, in
+        any spelling),
+        "invalid" or "failed" (no unused short ID found).
+        :rtype: list[dict]
+        """
+        _verify_type(creator_id, ObjectId)
+        if check_creator and self._users.find_one({USER_ID_IDENTIFIER: creator_id}) is None:
+            raise UserNotFoundError
+        hashes = {}  # long URL -> hash of its canonical form, or None if invalid
+        statuses = {}  # hash -> (status, short ID)
+        pending = []  # first spelling in the batch of each canonical URL
+        for long_url in long_urls:
+            if not isinstance(long_url, str) or long_url in hashes:
+                continue
+            try:
+                long_url_hash = url_hash(long_url)
+            except UrlInvalidError:
+                hashes[long_url] = None
+                continue
+            hashes[long_url] = long_url_hash
+            if long_url_hash not in statuses:
+                statuses[long_url_hash] = None
+                pending.append(long_url)
+        if statuses:
+            for link in self._urls.find(
+                {LONG_URL_HASH_IDENTIFIER: {"$in": list(statuses)}},
+                projection={LONG_URL_HASH_IDENTIFIER: True, SHORT_ID_IDENTIFIER: True},
+            ):
+                statuses[link[LONG_URL_HASH_IDENTIFIER]] = (STORE_EXISTS, link[SHORT_ID_IDENTIFIER])
+        pending = [long_url for long_url in pending if statuses[hashes[long_url]] is None]
+        raced = []
+        for _ in range(max_attempts):
+            if not pending:
+                break
+            links = [
+                self._new_link(long_url, self._allocator.allocate(), creator_id, hashes[long_url])
+                for long_url in pending
+            ]
+            try:
+                self._urls.insert_many(links, ordered=False)
+                errors = []
+            except BulkWriteError as e:
+                errors = e.details["writeErrors"]
+                if any(error["code"] != 11000 for error in errors):
+                    raise
+            retry = set()
+            for error in errors:
+                long_url = links[error["index"]][LONG_URL_IDENTIFIER]
+                if _duplicate_key_field(error) == LONG_URL_HASH_IDENTIFIER:
+                    raced.append(long_url)
+                else:
+                    retry.add(long_url)
+            for link in links:
+                long_url = link[LONG_URL_IDENTIFIER]
+                if long_url not in retry and long_url not in raced:
+                    statuses[hashes[long_url]] = (STORE_CREATED, link[SHORT_ID_IDENTIFIER])
+                    self._stored(link[SHORT_ID_IDENTIFIER])
+            pending = [long_url for long_url in pending if long_url in retry]
+        for long_url in pending:
+            statuses[hashes[long_url]] = (STORE_FAILED, None)
+        if raced:
+            for long_url in raced:
+                statuses[hashes[long_url]] = (STORE_FAILED, None)
+            for link in self._urls.find(
+                {LONG_URL_HASH_IDENTIFIER: {"$in": [hashes[long_url] for long_url in raced]}},
+                projection={LONG_URL_HASH_IDENTIFIER: True, SHORT_ID_IDENTIFIER: True},
+            ):
+                statuses[link[LONG_URL_HASH_IDENTIFIER]] = (STORE_EXISTS, link[SHORT_ID_IDENTIFIER])
+        results = []
+        seen = set()
+        for long_url in long_urls:
+            long_url_hash = hashes.get(long_url) if isinstance(long_url, str) else None
+            if long_url_hash is None:
+                status, short_id = STORE_INVALID, None
+            else:
+                status, short_id = statuses[long_url_hash]
+                if status == STORE_CREATED and long_url_hash in seen:
+                    status = STORE_EXISTS
+                seen.add(long_url_hash)
+            results.append(
+                {
+                    LONG_URL_IDENTIFIER: long_url,
+                    SHORT_ID_IDENTIFIER: short_id,
+                    "status": status,
+                }
+            )
+        return results
+
+    @staticmethod
+    def _new_link(long_url, short_id, creator_id, long_url_hash):
+        return {
+            LONG_URL_IDENTIFIER: long_url,
+            LONG_URL_HASH_IDENTIFIER: long_url_hash,
+            SHORT_ID_IDENTIFIER: short_id,
+            URL_CREATION_DATE_IDENTIFIER: datetime.now(),
+            CREATOR_ID_IDENTIFIER: creator_id,
+            VISITS_COUNT_IDENTIFIER: 0,
+        }
+
     def lookup_short_id(self, short_id, count_visit=False):
         """
         Retrieve the long URL corresponding to the provided short ID.
@@ -146,41 +457,229 @@ class AddressManager:
         :rtype: str
         """
         _verify_type(short_id, str)
-        if count_visit:
+        if self._cache is not None:
+            long_url = self._cache.get(short_id, _NOT_CACHED)
+            if long_url is None:
+                raise UrlNotFoundError
+            if long_url is not _NOT_CACHED:
+                if count_visit:
+                    self._record_visit(short_id)
+                return long_url
+        if self._snapshot is not None:
+            long_url = self._snapshot.get(short_id)
+            if long_url is not None:
+                if count_visit:
+                    self._record_visit(short_id)
+                return long_url
+        if self._filter is not None and not self._filter.might_exist(short_id):
+            raise UrlNotFoundError
+        if count_visit and self._visit_counter is None:
             result = self._urls.find_one_and_update({SHORT_ID_IDENTIFIER: short_id}, {"$inc": {VISITS_COUNT_IDENTIFIER: 1}})
         else:
-            result = self._urls.find_one({SHORT_ID_IDENTIFIER: short_id})
+            result = self._read_urls.find_one({SHORT_ID_IDENTIFIER: short_id})
+            if result is None and self._read_urls is not self._urls:
+                # The link may not have reached the member read from yet
+                result = self._urls.find_one({SHORT_ID_IDENTIFIER: short_id})
         if result is None:
+            if self._cache is not None:
+                self._cache.set_missing(short_id)
             raise UrlNotFoundError
+        if self._cache is not None:
+            self._cache.set(short_id, result[LONG_URL_IDENTIFIER])
+        if count_visit and self._visit_counter is not None:
+            self._visit_counter.record(short_id)
         return result[LONG_URL_IDENTIFIER]
 
+    def _record_visit(self, short_id):
+        if self._visit_counter is not None:
+            self._visit_counter.record(short_id)
+            return
+        # Unacknowledged write, so a redirect answered from the cache does
+        # not wait for the database
+        self._urls.with_options(write_concern=WriteConcern(w=0)).update_one(
+            {SHORT_ID_IDENTIFIER: short_id},
+            {"$inc": {VISITS_COUNT_IDENTIFIER: 1}},
+        )
+
+    def lookup_long_url(self, long_url):
+        """
+        Find the short ID under which a long URL is stored.
+
+        :param str long_url: The long URL, in any spelling.
+
+        :raises UrlNotFoundError: If the long URL is not in the database.
+
+        :return: The short ID.
+        :rtype: str
+        """
+        _verify_type(long_url, str)
+        try:
+            long_url_hash = url_hash(long_url)
+        except UrlInvalidError:
+            raise UrlNotFoundError
+        result = self._urls.find_one(
+            {LONG_URL_HASH_IDENTIFIER: long_url_hash},
+            projection={SHORT_ID_IDENTIFIER: True},
+        )
+        if result is None:
+            raise UrlNotFoundError
+        return result[SHORT_ID_IDENTIFIER]
+
     def delete_url(self, long_url):
         """
         Delete an entry from the database based on its long URL.
 
-        :param str long_url: The long URL to remove.
+        :param str long_url: The long URL to remove, in any spelling.
 
         :raises UrlNotFoundError: If the long URL specified is not present
             in the database.
         """
         _verify_type(long_url, str)
-        result = self._urls.delete_one({LONG_URL_IDENTIFIER: long_url})
-        if result.deleted_count == 0:
+        try:
+            long_url_hash = url_hash(long_url)
+        except UrlInvalidError:
             raise UrlNotFoundError
+        result = self._urls.find_one_and_delete(
+            {LONG_URL_HASH_IDENTIFIER: long_url_hash},
+            projection={SHORT_ID_IDENTIFIER: True},
+        )
+        if result is None:
+            raise UrlNotFoundError
+        self._deleted([result[SHORT_ID_IDENTIFIER]])
 
-    def delete_short_id(self, short_id):
+    def lookup_link(self, short_id, creator_id=None, projection=LISTING_PROJECTION):
+        """
+        Retrieve the stored record of a link, without counting a visit.
+
+        :param str short_id: The short ID of the link.
+        :param bson.objectid.ObjectId creator_id: If given, only a link
+            created by this user is returned.
+        :param projection: The fields to return (default those listed on
+            the My Links page).
+        :type projection: dict
+
+        :raises UrlNotFoundError: If no such link is in the database.
+
+        :return: The link record.
+        :rtype: dict
+        """
+        _verify_type(short_id, str)
+        query = {SHORT_ID_IDENTIFIER: short_id}
+        if creator_id is not None:
+            _verify_type(creator_id, ObjectId)
+            query[CREATOR_ID_IDENTIFIER] = creator_id
+        result = self._urls.find_one(query, projection=projection)
+        if result is None:
+            raise UrlNotFoundError
+        return result
+
+    def delete_short_id(self, short_id, creator_id=None):
         """
         Delete an entry from the database based on its short ID.
 
         :param str short_id: The short ID to remove.
+        :param bson.objectid.ObjectId creator_id: If given, the entry is only
+            deleted if it was created by this user.
 
         :raises UrlNotFoundError: If the short ID specified is not present
-            in the database.
+            in the database (or was not created by `creator_id`).
         """
         _verify_type(short_id, str)
-        result = self._urls.delete_one({SHORT_ID_IDENTIFIER: short_id})
+        query = {SHORT_ID_IDENTIFIER: short_id}
+        if creator_id is not None:
+            _verify_type(creator_id, ObjectId)
+            query[CREATOR_ID_IDENTIFIER] = creator_id
+        result = self._urls.delete_one(query)
         if result.deleted_count == 0:
+            if self._cache is not None:
+                self._cache.invalidate(short_id)
             raise UrlNotFoundError
+        self._deleted([short_id])
+
+    def delete_creator_links(self, creator_id, limit=1000):
+        """
+        Delete a bounded batch of the links created by a user, with their
+        visit history.
+
+        Links are removed in creation order, and deleted short IDs are
+        invalidated in the cache. Call repeatedly until it returns 0 to
+        remove every link of the user.
+
+        :param bson.objectid.ObjectId creator_id: The user whose links are
+            deleted.
+        :param int limit: The most links deleted.
+
+        :return: The number of links deleted.
+        :rtype: int
+        """
+        _verify_type(creator_id, ObjectId)
+        links = list(
+            self._urls.find(
+                {CREATOR_ID_IDENTIFIER: creator_id},
+                projection={URL_ID_IDENTIFIER: True, SHORT_ID_IDENTIFIER: True},
+            ).sort(URL_ID_IDENTIFIER, ASCENDING).limit(limit)
+        )
+        if not links:
+            return 0
+        short_ids = [link[SHORT_ID_IDENTIFIER] for link in links]
+        result = self._urls.delete_many(
+            {URL_ID_IDENTIFIER: {"$in": [link[URL_ID_IDENTIFIER] for link in links]}}
+        )
+        self._deleted(short_ids)
+        return result.deleted_count
+
+    def visit_history(self, short_id, granularity="hour", start=None, end=None):
+        """
+        Count the visits to a short ID in each minute, hour or day of a
+        period, e.g. the visits per hour over the last 7 days.
+
+        The counts are read from the buckets written by the visit counter
+        (see `yocto.visits.VisitHistory`), with one index range scan. Visits
+        still buffered by the workers are not included, nor are visits to
+        buckets past their retention.
+
+        :param str short_id: The short ID of the link.
+        :param str granularity: "minute", "hour" or "day".
+        :param datetime.datetime start: The start of the period (default 7
+            days before its end). Naive datetimes are taken to be UTC.
+        :param datetime.datetime end: The end of the period (default now).
+
+        :raises ValueError: If `granularity` is not known, or `start` is
+            after `end`.
+
+        :return: The start of each bucket in the period, as a naive UTC
+            datetime, with its visit count (0 for buckets without visits).
+        :rtype: list[tuple[datetime.datetime, int]]
+        """
+        _verify_type(short_id, str)
+        if granularity not in GRANULARITIES:
+            raise ValueError(f"Unknown granularity {granularity!r}")
+        if end is None:
+            end = datetime.now(timezone.utc)
+        if start is None:
+            start = end - timedelta(days=7)
+        first = bucket_start(start, granularity)
+        last = bucket_start(end, granularity)
+        if first > last:
+            raise ValueError("The start of the period is after its end")
+        counts = {
+            bucket[VISIT_START_IDENTIFIER]: bucket[VISIT_COUNT_IDENTIFIER]
+            for bucket in self._visits.find(
+                {
+                    VISIT_SHORT_ID_IDENTIFIER: short_id,
+                    VISIT_GRANULARITY_IDENTIFIER: granularity,
+                    VISIT_START_IDENTIFIER: {"$gte": first, "$lte": last},
+                },
+                projection={VISIT_START_IDENTIFIER: True, VISIT_COUNT_IDENTIFIER: True, "_id": False},
+            )
+        }
+        size = timedelta(seconds=GRANULARITIES[granularity])
+        history = []
+        bucket = first
+        while bucket <= last:
+            history.append((bucket, counts.get(bucket, 0)))
+            bucket += size
+        return history
         
     @staticmethod
     def compose_shortened_url(domain, short_id):
@@ -199,22 +698,75 @@ class AddressManager:
         else:
             return "/".join([domain, short_id])
         
-    def lookup_user_urls(self, user_id):
+    def iter_user_urls(
+            self,
+            user_id,
+            after=None,
+            limit=None,
+            projection=LISTING_PROJECTION,
+            check_user=True,
+            batch_size=None,
+        ):
         """
-        Find all URLs belonging to a specific user.
+        Iterate over the URLs belonging to a specific user, in the order
+        they were created.
 
-        :param str user_id: The user ID associated with the returned link
+        Links are read from a cursor as they are consumed rather than
+        collected in memory. To read them a page at a time, pass the ID of
+        the last link on the previous page as `after`; the next page then
+        starts with an index seek instead of skipping over earlier links.
+
+        :param bson.objectid.ObjectId user_id: The user ID associated with the returned link
         information.
+        :param bson.objectid.ObjectId after: Only links with an ID greater than this are
+        returned (default from the first link).
+        :param int limit: The maximum number of links returned (default
+        no limit).
+        :param dict projection: The fields of each link returned (default
+        `LISTING_PROJECTION`).
+        :param bool check_user: If `False`, the caller guarantees that
+        `user_id` is registered and it is not looked up.
+        :param int batch_size: The number of links fetched from the server
+        at a time (default chosen by the server).
 
         :raises UserNotFoundError: If the user is not present in the users
         collection.
 
-        :return: All URLs created by the specified user, as a sequence of 
+        :return: Cursor over the links, as dictionaries.
+        :rtype: pymongo.cursor.Cursor
+        """
+        if check_user and self._users.find_one({USER_ID_IDENTIFIER: user_id}) is None:
+            raise UserNotFoundError
+        query = {CREATOR_ID_IDENTIFIER: user_id}
+        if after is not None:
+            query[URL_ID_IDENTIFIER] = {"$gt": after}
+        cursor = self._urls.find(query, projection=projection).sort(URL_ID_IDENTIFIER, ASCENDING)
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        if batch_size is not None:
+            cursor = cursor.batch_size(batch_size)
+        return cursor
+
+    def lookup_user_urls(
+            self,
+            user_id,
+            after=None,
+            limit=None,
+            projection=LISTING_PROJECTION,
+            check_user=True,
+        ):
+        """
+        Find the URLs belonging to a specific user.
+
+        See `iter_user_urls` for the parameters.
+
+        :raises UserNotFoundError: If the user is not present in the users
+        collection.
+
+        :return: URLs created by the specified user, as a sequence of 
         dictionaries.
         :rtype: list[dict]
         """
-        if self._users.find_one({USER_ID_IDENTIFIER: user_id}) is None:
-            raise UserNotFoundError
-        cursor = self._urls.find({CREATOR_ID_IDENTIFIER: user_id})
+        cursor = self.iter_user_urls(user_id, after, limit, projection, check_user)
         return [link for link in cursor]
 
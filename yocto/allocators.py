@@ -0,0 +1,249 @@
+import hashlib
+import math
+import os
+import secrets
+import string
+import threading
+
+from flask import current_app
+import click
+from flask.cli import with_appcontext
+from pymongo import ReturnDocument
+
+from yocto.db import get_database
+from yocto.lib.exceptions import ShortIdAllocationError
+from yocto.lib.utils import (
+    COUNTER_ID_IDENTIFIER,
+    COUNTER_VALUE_IDENTIFIER,
+)
+
+ID_ALLOCATOR_EXTENSION = "yocto.id_allocator"
+
+# The characters of the 64-character encoding used for short IDs, the same
+# set as produced by `secrets.token_urlsafe`
+ALPHABET = string.ascii_uppercase + string.ascii_lowercase + string.digits + "-_"
+
+def random_short_id(length):
+    """
+    Generate a random `length`-character short ID.
+
+    To ensure the output is unpredictable, the system's source of
+    cryptographic randomness is used.
+
+    :param int length: The number of characters in the returned ID.
+
+    :return: The generated short ID.
+    :rtype: str
+    """
+    # Bit encoding of string may be non-integer number of bytes.
+    # To ensure all `length`-character strings possible, round up
+    # bytes then truncate result to correct length
+    return secrets.token_urlsafe(math.ceil(6 * length / 8))[:length]
+
+def keyspace_size(length):
+    """
+    Count the short IDs of `length` characters.
+
+    :param int length: The number of characters in a short ID.
+
+    :return: The number of distinct short IDs.
+    :rtype: int
+    """
+    return len(ALPHABET) ** length
+
+class RandomIdAllocator:
+    def __init__(self, length=7):
+        """
+        Allocator of random short IDs.
+
+        Candidates are not checked against the database. Instead, they are
+        inserted directly and the unique index on the short ID rejects the
+        rare collision, upon which the caller asks for another candidate (see
+        `AddressManager.shorten`). Collisions become more likely as the
+        keyspace fills.
+
+        :param int length: The number of characters in a short ID
+            (default 7).
+        """
+        self.length = length
+
+    def allocate(self):
+        """
+        Generate a short ID candidate.
+
+        :return: The short ID.
+        :rtype: str
+        """
+        return random_short_id(self.length)
+
+    def keyspace_usage(self, urls):
+        """
+        Estimate the fraction of the keyspace already used.
+
+        :param urls: The urls collection.
+        :type urls: pymongo.collection.Collection
+
+        :return: The number of stored links as a fraction of the number of
+            short IDs of the configured length.
+        :rtype: float
+        """
+        return urls.estimated_document_count() / keyspace_size(self.length)
+
+class CounterIdAllocator:
+    def __init__(self, counters, key, length=7, block_size=100, name="short_id"):
+        """
+        Allocator of short IDs from an atomic counter in the database.
+
+        Each allocator leases a block of `block_size` consecutive counter
+        values with one atomic `$inc` on the counter document, then hands
+        them out from memory, so the database is only contacted once per
+        block. Counter values are mapped to short IDs by a keyed Feistel
+        permutation of the `6 * length`-bit values, so consecutive values
+        give unrelated IDs and IDs cannot be predicted without the key. As
+        the permutation is a bijection, IDs cannot collide unless the key or
+        length changes. A forked process discards the block leased by its
+        parent.
+
+        :param counters: The collection holding counter documents.
+        :type counters: pymongo.collection.Collection
+        :param bytes key: Secret key for the permutation.
+        :param int length: The number of characters in a short ID
+            (default 7).
+        :param int block_size: The number of counter values leased at once
+            (default 100).
+        :param str name: The ID of the counter document (default
+            "short_id").
+        """
+        self._counters = counters
+        self._key = hashlib.blake2b(key, digest_size=32).digest()
+        self.length = length
+        self.block_size = block_size
+        self.name = name
+        self._half_bits = 3 * length
+        self._half_mask = (1 << self._half_bits) - 1
+        self._next = 0
+        self._end = 0
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def allocate(self):
+        """
+        Take the next counter value and encode it as a short ID.
+
+        :raises ShortIdAllocationError: If every short ID of the configured
+            length has been allocated.
+
+        :return: The short ID.
+        :rtype: str
+        """
+        with self._lock:
+            if self._pid != os.getpid() or self._next >= self._end:
+                self._lease()
+            value = self._next
+            self._next += 1
+        if value >= keyspace_size(self.length):
+            raise ShortIdAllocationError("Short ID keyspace exhausted")
+        return self.encode(value)
+
+    def _lease(self):
+        result = self._counters.find_one_and_update(
+            {COUNTER_ID_IDENTIFIER: self.name},
+            {"$inc": {COUNTER_VALUE_IDENTIFIER: self.block_size}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        self._end = result[COUNTER_VALUE_IDENTIFIER]
+        self._next = self._end - self.block_size
+        self._pid = os.getpid()
+
+    def _round(self, i, half):
+        digest = hashlib.blake2b(
+            half.to_bytes(8, "big"),
+            key=self._key,
+            salt=i.to_bytes(16, "big"),
+            digest_size=8,
+        ).digest()
+        return int.from_bytes(digest, "big") & self._half_mask
+
+    def encode(self, value):
+        """
+        Map a counter value to its short ID.
+
+        :param int value: The counter value, less than the keyspace size.
+
+        :return: The short ID.
+        :rtype: str
+        """
+        left = value >> self._half_bits
+        right = value & self._half_mask
+        for i in range(4):
+            left, right = right, left ^ self._round(i, right)
+        permuted = (left << self._half_bits) | right
+        chars = []
+        for _ in range(self.length):
+            chars.append(ALPHABET[permuted & 63])
+            permuted >>= 6
+        return "".join(chars)
+
+    def keyspace_usage(self, urls=None):
+        """
+        Report the fraction of the keyspace already leased.
+
+        :param urls: Unused, for compatibility with `RandomIdAllocator`.
+
+        :return: The counter value as a fraction of the number of short IDs
+            of the configured length.
+        :rtype: float
+        """
+        result = self._counters.find_one({COUNTER_ID_IDENTIFIER: self.name})
+        value = 0 if result is None else result[COUNTER_VALUE_IDENTIFIER]
+        return value / keyspace_size(self.length)
+
+def get_id_allocator():
+    """
+    Obtain the short ID allocator of the current application.
+
+    :return: The allocator.
+    :rtype: RandomIdAllocator | CounterIdAllocator
+    """
+    return current_app.extensions[ID_ALLOCATOR_EXTENSION]
+
+@click.command("short-id-usage")
+@with_appcontext
+def short_id_usage_command():
+    """Report how much of the short ID keyspace is in use."""
+    allocator = get_id_allocator()
+    database = get_database()
+    usage = allocator.keyspace_usage(database.urls)
+    click.echo(
+        f"{usage:.6%} of {keyspace_size(allocator.length)} "
+        f"{allocator.length}-character short IDs in use."
+    )
+
+def init_app(app):
+    """
+    Initialize the Flask app with a short ID allocator.
+
+    The `SHORT_ID_ALLOCATOR` option selects "random" or "counter" allocation
+    of `SHORT_ID_LENGTH`-character IDs. Counter blocks hold
+    `SHORT_ID_BLOCK_SIZE` values, and the permutation key is taken from
+    `SHORT_ID_KEY`, falling back to `SECRET_KEY`. Also makes the
+    `short-id-usage` command available.
+    """
+    length = app.config.get("SHORT_ID_LENGTH", 7)
+    kind = app.config.get("SHORT_ID_ALLOCATOR", "random")
+    if kind == "random":
+        allocator = RandomIdAllocator(length)
+    elif kind == "counter":
+        database = get_database(app.config)
+        key = app.config.get("SHORT_ID_KEY") or app.config["SECRET_KEY"]
+        allocator = CounterIdAllocator(
+            database.counters,
+            key.encode() if isinstance(key, str) else key,
+            length=length,
+            block_size=app.config.get("SHORT_ID_BLOCK_SIZE", 100),
+        )
+    else:
+        raise ValueError(f"Unknown short ID allocator '{kind}'")
+    app.extensions[ID_ALLOCATOR_EXTENSION] = allocator
+    app.cli.add_command(short_id_usage_command)
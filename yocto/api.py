@@ -0,0 +1,312 @@
+from datetime import datetime, timedelta, timezone
+import functools
+
+import click
+from flask import (
+    Blueprint,
+    current_app,
+    g,
+    jsonify,
+    request,
+    url_for,
+)
+from flask.cli import with_appcontext
+from werkzeug.exceptions import HTTPException
+
+from yocto.auth import UserAuthenticator
+from yocto.address import AddressManager, STORE_CREATED
+from yocto.allocators import get_id_allocator
+from yocto.cache import get_cache_invalidator, get_redirect_cache, get_token_cache
+from yocto.db import get_db, get_read_db
+from yocto.filters import get_short_id_filter
+from yocto.snapshots import get_redirect_snapshot
+from yocto.visits import GRANULARITIES, bucket_start
+from yocto.lib.exceptions import (
+    TokenInvalidError,
+    TokenExistsError,
+    UrlInvalidError,
+    UrlExistsError,
+    UrlNotFoundError,
+    UserNotFoundError,
+    ShortIdAllocationError,
+)
+from yocto.lib.utils import (
+    USER_ID_IDENTIFIER,
+    USERNAME_IDENTIFIER,
+    LONG_URL_IDENTIFIER,
+    SHORT_ID_IDENTIFIER,
+    URL_CREATION_DATE_IDENTIFIER,
+    VISITS_COUNT_IDENTIFIER,
+)
+
+bp = Blueprint("api", __name__, url_prefix="/api/v1")
+
+# Most buckets returned by one visit history request (a week of minutes)
+MAX_HISTORY_BUCKETS = 7 * 24 * 60
+
+def error(status, message):
+    """
+    Build a JSON error response.
+
+    :param int status: The HTTP status code.
+    :param str message: Description of the error.
+
+    :return: The response body and status.
+    :rtype: tuple
+    """
+    return jsonify({"error": message}), status
+
+@bp.errorhandler(HTTPException)
+def handle_http_exception(e):
+    return error(e.code, e.description)
+
+def token_required(view):
+    """
+    Authenticate the request with the API token in its `Authorization`
+    header, as `Bearer <token>`, storing the owner's user ID in
+    `g.api_user_id`.
+    """
+    @functools.wraps(view)
+    def wrapped_view(**kwargs):
+        scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() != "bearer" or not token:
+            response, status = error(401, "An API token is required.")
+            response.headers["WWW-Authenticate"] = "Bearer"
+            return response, status
+        auth = UserAuthenticator(get_db(), token_cache=get_token_cache())
+        try:
+            g.api_user_id = auth.authenticate_token(token.strip())
+        except TokenInvalidError:
+            response, status = error(401, "The API token is not valid.")
+            response.headers["WWW-Authenticate"] = 'Bearer error="invalid_token"'
+            return response, status
+        return view(**kwargs)
+
+    return wrapped_view
+
+def get_address_manager():
+    return AddressManager(
+        get_db(),
+        cache=get_redirect_cache(),
+        allocator=get_id_allocator(),
+        short_id_filter=get_short_id_filter(),
+    )
+
+def link_body(short_id, long_url):
+    return {
+        "short_id": short_id,
+        "short_url": AddressManager.compose_shortened_url(
+            url_for("short.index", _external=True),
+            short_id,
+        ),
+        "long_url": long_url,
+    }
+
+def conditional(body):
+    """
+    Build a JSON response to a read, answered with 304 Not Modified if the
+    client's `If-None-Match` header holds its ETag.
+    """
+    response = jsonify(body)
+    response.add_etag()
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+def json_body():
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return None
+    return body
+
+@bp.post("/links")
+@token_required
+def create_link():
+    body = json_body()
+    if body is None or not isinstance(body.get("url"), str):
+        return error(400, 'Expected a JSON object with a "url" string.')
+    long_url = body["url"]
+    am = get_address_manager()
+    try:
+        short_id = am.shorten(long_url, g.api_user_id)
+    except UserNotFoundError:
+        # The owner was deleted since the token was cached
+        return error(401, "The API token is not valid.")
+    except UrlInvalidError:
+        return error(400, "Input is not a valid web address.")
+    except UrlExistsError:
+        try:
+            return jsonify(link_body(am.lookup_long_url(long_url), long_url)), 200
+        except UrlNotFoundError:
+            # The existing link was deleted since
+            return error(409, "The link was being deleted, please try again.")
+    except ShortIdAllocationError:
+        return error(503, "No short ID could be allocated, please try again.")
+    return jsonify(link_body(short_id, long_url)), 201
+
+@bp.post("/links/batch")
+@token_required
+def create_links():
+    body = json_body()
+    if body is None or not isinstance(body.get("urls"), list):
+        return error(400, 'Expected a JSON object with a "urls" list.')
+    long_urls = body["urls"]
+    max_size = current_app.config["API_BATCH_MAX_SIZE"]
+    if len(long_urls) > max_size:
+        return error(413, f"At most {max_size} URLs can be shortened at once.")
+    am = get_address_manager()
+    try:
+        results = am.store_many(long_urls, g.api_user_id)
+    except UserNotFoundError:
+        return error(401, "The API token is not valid.")
+    links = []
+    for result in results:
+        if result[SHORT_ID_IDENTIFIER] is None:
+            link = {"long_url": result[LONG_URL_IDENTIFIER]}
+        else:
+            link = link_body(result[SHORT_ID_IDENTIFIER], result[LONG_URL_IDENTIFIER])
+        link["status"] = result["status"]
+        links.append(link)
+    created = any(result["status"] == STORE_CREATED for result in results)
+    return jsonify({"links": links}), 201 if created else 200
+
+@bp.get("/links/<short_id>")
+@token_required
+def resolve_link(short_id):
+    # Resolving through the API is not a visit
+    am = AddressManager(
+        get_db(),
+        cache=get_redirect_cache(),
+        short_id_filter=get_short_id_filter(),
+        snapshot=get_redirect_snapshot(),
+        read_database=get_read_db(),
+    )
+    try:
+        long_url = am.lookup_short_id(short_id)
+    except UrlNotFoundError:
+        return error(404, "No link has this short ID.")
+    return conditional(link_body(short_id, long_url))
+
+@bp.delete("/links/<short_id>")
+@token_required
+def delete_link(short_id):
+    am = AddressManager(
+        get_db(),
+        cache=get_redirect_cache(),
+        short_id_filter=get_short_id_filter(),
+        invalidator=get_cache_invalidator(),
+        tombstones=current_app.config.get("REDIRECT_SNAPSHOT_ENABLED", False),
+    )
+    try:
+        am.delete_short_id(short_id, creator_id=g.api_user_id)
+    except UrlNotFoundError:
+        return error(404, "You have no link with this short ID.")
+    return "", 204
+
+@bp.get("/links/<short_id>/stats")
+@token_required
+def link_stats(short_id):
+    am = AddressManager(get_db())
+    try:
+        link = am.lookup_link(short_id, creator_id=g.api_user_id)
+    except UrlNotFoundError:
+        return error(404, "You have no link with this short ID.")
+    body = link_body(short_id, link[LONG_URL_IDENTIFIER])
+    created = link.get(URL_CREATION_DATE_IDENTIFIER)
+    body["created"] = created.isoformat() if created is not None else None
+    # Visits still buffered by the workers' visit counters are not included
+    body["visits"] = link.get(VISITS_COUNT_IDENTIFIER, 0)
+    return conditional(body)
+
+def _parse_time(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+@bp.get("/links/<short_id>/visits")
+@token_required
+def link_visits(short_id):
+    granularity = request.args.get("granularity", "hour")
+    if granularity not in GRANULARITIES:
+        return error(400, f"Granularity must be one of {', '.join(GRANULARITIES)}.")
+    start, end = _parse_time("start"), _parse_time("end")
+    if (start is None and "start" in request.args) or (end is None and "end" in request.args):
+        return error(400, "Times must be in ISO 8601 format.")
+    if end is None:
+        end = datetime.now(timezone.utc)
+    if start is None:
+        start = end - timedelta(days=7)
+    # Times without a time zone are taken to be UTC
+    first, last = bucket_start(start, granularity), bucket_start(end, granularity)
+    buckets = (last - first) // timedelta(seconds=GRANULARITIES[granularity]) + 1
+    if buckets < 1:
+        return error(400, "The start must not be after the end.")
+    if buckets > MAX_HISTORY_BUCKETS:
+        return error(400, f"At most {MAX_HISTORY_BUCKETS} buckets can be requested at once.")
+    am = AddressManager(get_db())
+    try:
+        am.lookup_link(short_id, creator_id=g.api_user_id, projection={SHORT_ID_IDENTIFIER: True})
+    except UrlNotFoundError:
+        return error(404, "You have no link with this short ID.")
+    history = am.visit_history(short_id, granularity, start, end)
+    return conditional({
+        "short_id": short_id,
+        "granularity": granularity,
+        # Bucket starts are in UTC
+        "buckets": [
+            {"start": bucket.isoformat() + "Z", "visits": count}
+            for bucket, count in history
+        ],
+    })
+
+def _find_user(username):
+    user = get_db().users.find_one({USERNAME_IDENTIFIER: username})
+    if user is None:
+        raise click.ClickException(f"User '{username}' not found.")
+    return user
+
+@click.command("create-api-token")
+@with_appcontext
+@click.argument("username")
+@click.option("--name", default="default", show_default=True, help="Name of the token.")
+def create_api_token_command(username, name):
+    """Issue an API token for USERNAME and print it."""
+    user = _find_user(username)
+    auth = UserAuthenticator(get_db())
+    try:
+        token = auth.create_token(user[USER_ID_IDENTIFIER], name)
+    except TokenExistsError:
+        raise click.ClickException(f"User '{username}' already has a token named '{name}'.")
+    click.echo(token)
+
+@click.command("revoke-api-token")
+@with_appcontext
+@click.argument("username")
+@click.option("--name", default="default", show_default=True, help="Name of the token.")
+def revoke_api_token_command(username, name):
+    """Revoke an API token of USERNAME."""
+    user = _find_user(username)
+    auth = UserAuthenticator(
+        get_db(),
+        token_cache=get_token_cache(),
+        invalidator=get_cache_invalidator(),
+    )
+    try:
+        auth.revoke_token(user[USER_ID_IDENTIFIER], name)
+    except TokenInvalidError:
+        raise click.ClickException(f"User '{username}' has no token named '{name}'.")
+    click.echo(f"Revoked token '{name}' of user '{username}'.")
+
+def init_app(app):
+    """
+    Initialize the Flask app for the JSON API.
+
+    Makes the `create-api-token` and `revoke-api-token` commands available
+    to run with e.g. `flask --app yocto create-api-token <username>`.
+    """
+    app.cli.add_command(create_api_token_command)
+    app.cli.add_command(revoke_api_token_command)
@@ -0,0 +1,292 @@
+"""
+ASGI service for the short link redirects.
+
+Redirects only look up a short ID and answer with a 302, so they spend most
+of their time waiting for the database. This module serves the same
+`/<short_id>` routes as the `short` blueprint from an asyncio event loop, so
+that one process can have thousands of redirects in flight at once, e.g.::
+
+    YOCTO_CONFIG=ProductionConfig uvicorn --factory "yocto.asgi:create_redirect_app" --workers 4
+
+The Flask application is still needed for the account pages under `/pages/`,
+to which the root and unknown short IDs are redirected. The async MongoDB
+client is `pymongo.AsyncMongoClient` (PyMongo 4.10 or later), or Motor's
+`AsyncIOMotorClient` if only Motor is installed.
+"""
+import inspect
+import os
+from urllib.parse import urlencode
+
+from flask import Config
+from pymongo.read_preferences import Primary
+from pymongo.write_concern import WriteConcern
+from werkzeug.urls import iri_to_uri
+
+try:
+    from pymongo import AsyncMongoClient
+except ImportError:
+    try:
+        from motor.motor_asyncio import AsyncIOMotorClient as AsyncMongoClient
+    except ImportError:
+        AsyncMongoClient = None
+
+import yocto.config as config
+from yocto.address import _NOT_CACHED
+from yocto.cache import (
+    SharedRedirectCache,
+    TieredRedirectCache,
+    create_cache_invalidator,
+    create_redirect_cache,
+)
+from yocto.db import _client_settings, read_preference
+from yocto.fastpath import NOT_FOUND_MESSAGE
+from yocto.visits import create_visit_counter
+from yocto.lib.exceptions import UrlNotFoundError
+from yocto.lib.utils import (
+    _verify_type,
+    LONG_URL_IDENTIFIER,
+    SHORT_ID_IDENTIFIER,
+    VISITS_COUNT_IDENTIFIER,
+)
+
+class AsyncAddressManager:
+    def __init__(self, database, cache=None, visit_counter=None, read_database=None):
+        """
+        Counterpart of `AddressManager` for an async MongoDB client.
+
+        Only the lookup of short IDs is provided, with the same caching and
+        visit counting as `AddressManager.lookup_short_id`. Neither the cache
+        nor the visit counter blocks the event loop: the cache is in memory
+        and the counter writes from its own thread. Lookups which do not
+        write are made through the read database, if provided, as described
+        for `AddressManager`.
+
+        :param database: The database containing the urls collection.
+        :type database: pymongo.asynchronous.database.AsyncDatabase
+        :param cache: Cache of short IDs to long URLs (default no caching).
+        :type cache: yocto.cache.RedirectCache
+        :param visit_counter: Buffer of visit counts (default each visit is
+            written by its lookup).
+        :type visit_counter: yocto.visits.VisitCounter
+        :param read_database: The database for short ID lookups (default
+            `database`).
+        :type read_database: pymongo.asynchronous.database.AsyncDatabase
+        """
+        self._urls = database.urls
+        self._read_urls = (
+            self._urls if read_database is None or read_database is database else read_database.urls
+        )
+        self._cache = cache
+        self._visit_counter = visit_counter
+
+    async def lookup_short_id(self, short_id, count_visit=False):
+        """
+        Retrieve the long URL corresponding to the provided short ID.
+
+        :param str short_id: The shortened URL to look up in the database.
+        :param bool count_visit: If `True`, the visit count for the ID provided is
+        incremented.
+
+        :raises UrlNotFoundError: If the URL to look up is not in the database.
+
+        :return: The long URL to which the shortened URL should redirect.
+        :rtype: str
+        """
+        _verify_type(short_id, str)
+        if self._cache is not None:
+            long_url = self._cache.get(short_id, _NOT_CACHED)
+            if long_url is None:
+                raise UrlNotFoundError
+            if long_url is not _NOT_CACHED:
+                if count_visit:
+                    await self._record_visit(short_id)
+                return long_url
+        if count_visit and self._visit_counter is None:
+            result = await self._urls.find_one_and_update(
+                {SHORT_ID_IDENTIFIER: short_id},
+                {"$inc": {VISITS_COUNT_IDENTIFIER: 1}},
+            )
+        else:
+            result = await self._read_urls.find_one({SHORT_ID_IDENTIFIER: short_id})
+            if result is None and self._read_urls is not self._urls:
+                # The link may not have reached the member read from yet
+                result = await self._urls.find_one({SHORT_ID_IDENTIFIER: short_id})
+        if result is None:
+            if self._cache is not None:
+                self._cache.set_missing(short_id)
+            raise UrlNotFoundError
+        if self._cache is not None:
+            self._cache.set(short_id, result[LONG_URL_IDENTIFIER])
+        if count_visit and self._visit_counter is not None:
+            self._visit_counter.record(short_id)
+        return result[LONG_URL_IDENTIFIER]
+
+    async def _record_visit(self, short_id):
+        if self._visit_counter is not None:
+            self._visit_counter.record(short_id)
+            return
+        # Unacknowledged write, so a redirect answered from the cache does
+        # not wait for the database
+        await self._urls.with_options(write_concern=WriteConcern(w=0)).update_one(
+            {SHORT_ID_IDENTIFIER: short_id},
+            {"$inc": {VISITS_COUNT_IDENTIFIER: 1}},
+        )
+
+class RedirectApp:
+    def __init__(self, app_config, client_factory=None):
+        """
+        ASGI application serving the short link redirects.
+
+        `GET` (or `HEAD`) of `/<short_id>` or `/<short_id>/` redirects to the
+        long URL, or to the error page if the short ID is unknown, and `/`
+        redirects to the home page, as in the `short` blueprint. Other paths
+        are not found. The MongoDB client is created on the first request,
+        in the event loop serving the application, and closed on lifespan
+        shutdown along with a flush of the visit counter. Cached redirects
+        are invalidated by the other processes as in the Flask application.
+
+        :param app_config: The configuration, as for the Flask application.
+        :type app_config: flask.Config
+        :param client_factory: Function of the client keyword arguments
+            returning an async MongoDB client (default `AsyncMongoClient`).
+        """
+        if client_factory is None:
+            if AsyncMongoClient is None:
+                raise RuntimeError(
+                    "The redirect service needs PyMongo 4.10 or later, or Motor"
+                )
+            client_factory = AsyncMongoClient
+        self.config = app_config
+        self._client_factory = client_factory
+        self._client = None
+        self._client_pid = None
+        # The shared tier of the redirect cache is not used, as its commands
+        # would block the event loop
+        cache = create_redirect_cache(app_config)
+        if isinstance(cache, TieredRedirectCache):
+            cache = cache.local
+        elif isinstance(cache, SharedRedirectCache):
+            cache = None
+        self.cache = cache
+        # Invalidations are read with the synchronous client, on a thread
+        self.invalidator = create_cache_invalidator(app_config, {"redirect": cache})
+        self.visit_counter = create_visit_counter(app_config)
+        self.read_preference = read_preference(app_config)
+
+    def get_database(self):
+        """
+        Obtain the database, creating the async client on first use.
+
+        As with `yocto.db.get_client`, a forked process creates its own
+        client.
+
+        :return: The database named by the `DATABASE` option.
+        :rtype: pymongo.asynchronous.database.AsyncDatabase
+        """
+        if self._client_pid != os.getpid():
+            settings = dict(_client_settings(self.config))
+            max_pool_size = self.config.get("ASYNC_MONGO_MAX_POOL_SIZE")
+            if max_pool_size is not None:
+                settings["maxPoolSize"] = max_pool_size
+            self._client = self._client_factory(**settings)
+            self._client_pid = os.getpid()
+        return self._client.get_database(self.config["DATABASE"])
+
+    async def close(self):
+        """Flush pending visits and close the database client."""
+        if self.invalidator is not None:
+            self.invalidator.close()
+        if self.visit_counter is not None:
+            self.visit_counter.close()
+        if self._client is not None and self._client_pid == os.getpid():
+            result = self._client.close()
+            if inspect.isawaitable(result):  # PyMongo, but not Motor
+                await result
+        self._client = None
+        self._client_pid = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            await self._handle(scope, send)
+        elif scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _handle(self, scope, send):
+        if scope["method"] not in ("GET", "HEAD"):
+            await self._respond(send, 405, [(b"allow", b"GET, HEAD")])
+            return
+        root_path = scope.get("root_path", "")
+        path = scope["path"]
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        short_id = path[1:-1] if path.endswith("/") else path[1:]
+        if path == "/":
+            location = f"{root_path}/pages/"
+        elif not path.startswith("/") or not short_id or "/" in short_id:
+            await self._respond(send, 404)
+            return
+        else:
+            if self.invalidator is not None:
+                self.invalidator.ensure_started()
+            database = self.get_database()
+            read_database = None
+            if self.read_preference != Primary():
+                read_database = database.with_options(read_preference=self.read_preference)
+            am = AsyncAddressManager(
+                database,
+                cache=self.cache,
+                visit_counter=self.visit_counter,
+                read_database=read_database,
+            )
+            try:
+                location = await am.lookup_short_id(short_id, count_visit=True)
+            except UrlNotFoundError:
+                query = urlencode({"message": NOT_FOUND_MESSAGE})
+                location = f"{root_path}/pages/error/?{query}"
+        await self._respond(send, 302, [(b"location", iri_to_uri(location).encode("latin-1"))])
+
+    @staticmethod
+    async def _respond(send, status, headers=()):
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-length", b"0"), *headers],
+        })
+        await send({"type": "http.response.body", "body": b""})
+
+def create_redirect_app(configType=None):
+    """
+    Create the ASGI redirect service.
+
+    The configuration classes are those of `yocto.create_app`; the secret key
+    is not needed, as the service has no sessions. Only the "mongodb" storage
+    backend has an async client; an embedded database is served by the
+    Flask app's redirect fast path instead.
+
+    :param str configType: The name of a configuration class in
+        `yocto.config` (default from the `YOCTO_CONFIG` environment
+        variable, else "DevelopmentConfig").
+
+    :raises RuntimeError: If the configured storage backend is not
+        "mongodb".
+
+    :return: The ASGI application.
+    :rtype: RedirectApp
+    """
+    if configType is None:
+        configType = os.getenv("YOCTO_CONFIG", "DevelopmentConfig")
+    app_config = Config(os.path.dirname(__file__))
+    app_config.from_object(getattr(config, configType, config.DevelopmentConfig))
+    if app_config.get("STORAGE_BACKEND", "mongodb") != "mongodb":
+        raise RuntimeError("The ASGI redirect service needs the mongodb storage backend")
+    return RedirectApp(app_config)
@@ -1,8 +1,11 @@
 from datetime import datetime
+import hashlib
 import regex
+import secrets
 import unicodedata
 
 from pymongo.collection import Collection
+from pymongo.errors import DuplicateKeyError
 from bson.objectid import ObjectId
 from argon2 import PasswordHasher
 from argon2.exceptions import VerifyMismatchError
@@ -12,8 +15,13 @@ from yocto.lib.exceptions import (
     UserExistsError,
     UserNotFoundError,
     PasswordInvalidError,
-    PasswordMismatchError
+    PasswordMismatchError,
+    TokenInvalidError,
+    TokenExistsError,
 )
+from yocto.address import AddressManager
+from yocto.deletion import queue_deletion
+from yocto.hashing import PasswordHashingPool
 from yocto.lib.utils import (
     _verify_type,
     USER_ID_IDENTIFIER,
@@ -21,6 +29,12 @@ from yocto.lib.utils import (
     PASSWORD_HASH_IDENTIFIER,
     ACCOUNT_CREATION_DATE_IDENTIFIER,
     CREATOR_ID_IDENTIFIER,
+    SHORT_ID_IDENTIFIER,
+    TOKEN_HASH_IDENTIFIER,
+    TOKEN_USER_ID_IDENTIFIER,
+    TOKEN_NAME_IDENTIFIER,
+    TOKEN_CREATION_DATE_IDENTIFIER,
+    DELETION_USER_ID_IDENTIFIER,
 )
 
 ph = PasswordHasher()
@@ -29,22 +43,76 @@ USERNAME_MIN_LENGTH = 1
 USERNAME_MAX_LENGTH = 100
 PASSWORD_MIN_LENGTH = 8
 PASSWORD_MAX_LENGTH = 100
+TOKEN_BYTES = 32
+
+def hash_token(token):
+    """
+    Hash an API token for storage and lookup.
+
+    Tokens are long random strings rather than chosen passwords, so a single
+    SHA-256 hash is enough to keep them secret in the database, and can be
+    computed on every request.
+
+    :param str token: The API token.
+
+    :return: The hex digest of the token.
+    :rtype: str
+    """
+    return hashlib.sha256(token.encode()).hexdigest()
 
 class UserAuthenticator:
-    def __init__(self, database):
+    def __init__(
+            self,
+            database,
+            redirect_cache=None,
+            user_cache=None,
+            hasher=None,
+            token_cache=None,
+            invalidator=None,
+            tombstones=False,
+        ):
         """
         Class for managing user authentication and credential storage in database.
 
         Methods in this class allow registration of new users in the database
         and authentication of existing users with credentials. Passwords are
         securely hashed and salted using Argon2id. When a user is deleted, it is
-        ensured that all links created by the user are also removed.
+        ensured that all links and API tokens created by the user are also removed.
 
-        :param database: Database containing the users and urls collections.
-        :type database: pymongo.database.Database
+        :param database: Database containing the users and urls collections,
+            of any of the backends in `yocto.storage`.
+        :type database: pymongo.database.Database | yocto.storage.sqlite.SQLiteDatabase
+        :param redirect_cache: Cache of short IDs to long URLs from which a
+            deleted user's links are removed (default no caching).
+        :type redirect_cache: yocto.cache.RedirectCache
+        :param user_cache: Cache of user records, keyed by user ID string,
+            from which a deleted user is removed (default no caching).
+        :type user_cache: yocto.lib.cache.LRUCache
+        :param hasher: Pool in which passwords are hashed and verified
+            (default hashing on the calling thread with `auth.ph`).
+        :type hasher: yocto.hashing.PasswordHashingPool
+        :param token_cache: Cache of API token owners, keyed by token hash
+            (default no caching).
+        :type token_cache: yocto.lib.cache.LRUCache
+        :param invalidator: Invalidator of the caches of every process, in
+            which revoked tokens, and a deleted user with their links and
+            tokens, are also invalidated (default this process's caches
+            only).
+        :type invalidator: yocto.cache.CacheInvalidator
+        :param bool tombstones: Whether deleting a user's links leaves
+            tombstones for redirect snapshots.
         """
+        self._database = database
         self._users: Collection = database.users
         self._urls: Collection = database.urls
+        self._tokens: Collection = database.tokens
+        self._deletions: Collection = database.deletions
+        self._token_cache = token_cache
+        self._redirect_cache = redirect_cache
+        self._user_cache = user_cache
+        self._invalidator = invalidator
+        self._write_tombstones = tombstones
+        self._hasher = PasswordHashingPool(ph, processes=0) if hasher is None else hasher
 
     @staticmethod
     def validate_username(username):
@@ -108,38 +176,62 @@ class UserAuthenticator:
         """
         Register a new user in the users database.
 
+        The user is inserted without first looking up the username, and the
+        unique index on usernames (see `yocto.indexes`), which must be in
+        place, rejects one already taken, so that registration takes a
+        single round trip and two registrations of the same username cannot
+        both succeed.
+
         :param str username: The username of the new user.
         :param str password: The password of the new user.
 
         :raises UserExistsError: If the username already exists in the database.
         :raises UsernameInvalidError: If `username` is not a valid username.
         :raises PasswordInvalidError: If `password` is not a valid password.
+        :raises HashingBusyError: If the password cannot be hashed now.
 
         :return: The immutable ID of the created user
         :rtype: bson.objectid.ObjectId
         """
         self.validate_username(username)
-        if self._users.find_one({USERNAME_IDENTIFIER: username}) is not None:
+        try:
+            self.validate_password(password)
+        except PasswordInvalidError:
+            # A taken username is reported ahead of an invalid password
+            if self._users.find_one({USERNAME_IDENTIFIER: username}, projection={"_id": True}) is not None:
+                raise UserExistsError
+            raise
+        try:
+            result = self._users.insert_one(
+                {
+                    USERNAME_IDENTIFIER: username,
+                    PASSWORD_HASH_IDENTIFIER: self._hasher.hash(
+                        unicodedata.normalize("NFKC", password)
+                    ),
+                    ACCOUNT_CREATION_DATE_IDENTIFIER: datetime.now(),
+                }
+            )
+        except DuplicateKeyError:
             raise UserExistsError
-        self.validate_password(password)
-        result = self._users.insert_one(
-            {
-                USERNAME_IDENTIFIER: username,
-                PASSWORD_HASH_IDENTIFIER: ph.hash(unicodedata.normalize("NFKC", password)),
-                ACCOUNT_CREATION_DATE_IDENTIFIER: datetime.now(),
-            }
-        )
         return result.inserted_id
 
     def authenticate_user(self, username, password):
         """
         Authenticate a user's credentials against the database.
 
+        If the stored hash was made with Argon2 parameters other than the
+        configured ones, it is replaced by a new hash of the password. If the
+        username is not found, the password is verified against the hasher's
+        dummy hash before raising, so that unknown usernames are not
+        revealed by a quicker answer (see
+        `yocto.hashing.PasswordHashingPool.verify_dummy`).
+
         :param str username: The user's username.
         :param str password: The user's password.
 
         :raises UserNotFoundError: If the username is not in the database.
         :raises PasswordMismatchError: If the user's password is not correct.
+        :raises HashingBusyError: If the password cannot be verified now.
 
         :return: User ID if password is correct, otherwise raises.
         :rtype: bson.objectid.ObjectId
@@ -147,20 +239,36 @@ class UserAuthenticator:
         _verify_type(username, str)
         _verify_type(password, str)
         user_record = self._users.find_one({USERNAME_IDENTIFIER: username})
+        password = unicodedata.normalize("NFKC", password)
         if user_record is None:
+            self._hasher.verify_dummy(password)
             raise UserNotFoundError
+        password_hash = user_record[PASSWORD_HASH_IDENTIFIER]
         try:
-            ph.verify(
-                user_record[PASSWORD_HASH_IDENTIFIER],
-                unicodedata.normalize("NFKC", password)
-            )
-            return user_record[USER_ID_IDENTIFIER]
+            self._hasher.verify(password_hash, password)
         except VerifyMismatchError:
             raise PasswordMismatchError
+        if self._hasher.check_needs_rehash(password_hash):
+            self._users.update_one(
+                {
+                    USER_ID_IDENTIFIER: user_record[USER_ID_IDENTIFIER],
+                    PASSWORD_HASH_IDENTIFIER: password_hash,
+                },
+                {"$set": {PASSWORD_HASH_IDENTIFIER: self._hasher.hash(password)}},
+            )
+        return user_record[USER_ID_IDENTIFIER]
 
-    def delete_user(self, user_id):
+    def request_deletion(self, user_id):
         """
-        Delete a user account from the database.
+        Delete a user account, leaving its links to be deleted in the
+        background.
+
+        The account and its API tokens are removed at once, so the user can
+        no longer log in, and a job to delete the user's links is queued for
+        a `yocto.deletion.DeletionWorker`. The job is queued first, so that
+        links are never left behind by an interrupted deletion. The user is
+        invalidated in the user cache of this process, and through the
+        invalidator in those of the others.
 
         :param bson.objectid.ObjectId user_id: The user ID of the account to delete.
 
@@ -168,10 +276,144 @@ class UserAuthenticator:
         users database collection.
         """
         _verify_type(user_id, ObjectId)
-        # Delete user's URLs
-        self._urls.delete_many({CREATOR_ID_IDENTIFIER: user_id})
+        queue_deletion(self._deletions, user_id)
+        # Delete user's API tokens
+        token_hashes = [
+            token[TOKEN_HASH_IDENTIFIER] for token in self._tokens.find(
+                {TOKEN_USER_ID_IDENTIFIER: user_id},
+                projection={TOKEN_HASH_IDENTIFIER: True, "_id": False},
+            )
+        ]
+        self._tokens.delete_many({TOKEN_USER_ID_IDENTIFIER: user_id})
+        if self._token_cache is not None:
+            self._token_cache.invalidate_many(token_hashes)
+        if self._invalidator is not None:
+            self._invalidator.publish("token", token_hashes)
         # Delete user account
         result = self._users.delete_one({USER_ID_IDENTIFIER: user_id})
+        if self._user_cache is not None:
+            self._user_cache.invalidate(str(user_id))
+        if self._invalidator is not None:
+            self._invalidator.publish("user", [str(user_id)])
         # Raise exception if no account deleted
         if result.deleted_count == 0:
             raise UserNotFoundError
+
+    def delete_user(self, user_id, batch_size=1000):
+        """
+        Delete a user account from the database, with all of its links.
+
+        Links are deleted in batches of `batch_size` before this returns.
+        Use `request_deletion` to delete them in the background instead.
+
+        :param bson.objectid.ObjectId user_id: The user ID of the account to delete.
+        :param int batch_size: The most links deleted by one write.
+
+        :raises UserNotFoundError: If `user_id` is not the ID of a user in the
+        users database collection.
+        """
+        try:
+            self.request_deletion(user_id)
+        finally:
+            # Delete user's URLs and their visit history
+            am = AddressManager(
+                self._database,
+                cache=self._redirect_cache,
+                invalidator=self._invalidator,
+                tombstones=self._write_tombstones,
+            )
+            while am.delete_creator_links(user_id, batch_size):
+                pass
+            self._deletions.delete_one({DELETION_USER_ID_IDENTIFIER: user_id})
+
+    def create_token(self, user_id, name):
+        """
+        Issue a new API token for a user.
+
+        Only the hash of the token is stored, so the token itself cannot be
+        shown again.
+
+        :param bson.objectid.ObjectId user_id: The user ID of the owner.
+        :param str name: A name for the token, unique among the user's tokens.
+
+        :raises UserNotFoundError: If `user_id` is not a registered user.
+        :raises TokenExistsError: If the user has a token named `name`.
+
+        :return: The token.
+        :rtype: str
+        """
+        _verify_type(user_id, ObjectId)
+        _verify_type(name, str)
+        if self._users.find_one({USER_ID_IDENTIFIER: user_id}) is None:
+            raise UserNotFoundError
+        token = secrets.token_urlsafe(TOKEN_BYTES)
+        try:
+            self._tokens.insert_one(
+                {
+                    TOKEN_HASH_IDENTIFIER: hash_token(token),
+                    TOKEN_USER_ID_IDENTIFIER: user_id,
+                    TOKEN_NAME_IDENTIFIER: name,
+                    TOKEN_CREATION_DATE_IDENTIFIER: datetime.now(),
+                }
+            )
+        except DuplicateKeyError:
+            raise TokenExistsError
+        return token
+
+    def authenticate_token(self, token):
+        """
+        Find the owner of an API token.
+
+        Owners are taken from the token cache where possible, so most
+        requests neither hash a password nor query the database. A token
+        revoked by another process, or whose owner was deleted there, is
+        still accepted from this process's cache until the invalidation is
+        read by its `yocto.cache.CacheInvalidator`, i.e. for up to about
+        `CACHE_INVALIDATION_INTERVAL` seconds, or until the entry expires
+        if the invalidation could not be published.
+
+        :param str token: The API token.
+
+        :raises TokenInvalidError: If the token was not issued, or its
+            revocation is known to this process.
+
+        :return: The user ID of the owner.
+        :rtype: bson.objectid.ObjectId
+        """
+        _verify_type(token, str)
+        token_hash = hash_token(token)
+        if self._token_cache is not None:
+            user_id = self._token_cache.get(token_hash)
+            if user_id is not None:
+                return user_id
+        record = self._tokens.find_one(
+            {TOKEN_HASH_IDENTIFIER: token_hash},
+            projection={TOKEN_USER_ID_IDENTIFIER: True, "_id": False},
+        )
+        if record is None:
+            raise TokenInvalidError
+        if self._token_cache is not None:
+            self._token_cache.set(token_hash, record[TOKEN_USER_ID_IDENTIFIER])
+        return record[TOKEN_USER_ID_IDENTIFIER]
+
+    def revoke_token(self, user_id, name):
+        """
+        Revoke one of a user's API tokens.
+
+        :param bson.objectid.ObjectId user_id: The user ID of the owner.
+        :param str name: The name of the token.
+
+        :raises TokenInvalidError: If the user has no token named `name`.
+        """
+        _verify_type(user_id, ObjectId)
+        _verify_type(name, str)
+        record = self._tokens.find_one_and_delete(
+            {TOKEN_USER_ID_IDENTIFIER: user_id, TOKEN_NAME_IDENTIFIER: name},
+            projection={TOKEN_HASH_IDENTIFIER: True},
+        )
+        if record is None:
+            raise TokenInvalidError
+        if self._token_cache is not None:
+            self._token_cache.invalidate(record[TOKEN_HASH_IDENTIFIER])
+        if self._invalidator is not None:
+            self._invalidator.publish("token", [record[TOKEN_HASH_IDENTIFIER]])
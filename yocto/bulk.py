@@ -0,0 +1,399 @@
+import csv
+import io
+import itertools
+import json
+import time
+import zlib
+
+import click
+from flask.cli import with_appcontext
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from yocto.address import (
+    AddressManager,
+    STORE_CREATED,
+    STORE_EXISTS,
+    STORE_INVALID,
+    STORE_FAILED,
+)
+from yocto.allocators import get_id_allocator
+from yocto.cache import get_redirect_cache
+from yocto.db import get_db
+from yocto.lib.exceptions import UrlInvalidError
+from yocto.lib.urls import url_hash
+from yocto.lib.utils import (
+    USER_ID_IDENTIFIER,
+    USERNAME_IDENTIFIER,
+    URL_ID_IDENTIFIER,
+    LONG_URL_IDENTIFIER,
+    LONG_URL_HASH_IDENTIFIER,
+    SHORT_ID_IDENTIFIER,
+    URL_CREATION_DATE_IDENTIFIER,
+    VISITS_COUNT_IDENTIFIER,
+)
+
+EXPORT_FORMATS = ("csv", "jsonl")
+
+# Fields of each exported link, in column order
+EXPORT_FIELDS = ("short_id", "short_url", "long_url", "created", "visits")
+
+# Fields read from the database for an export
+EXPORT_PROJECTION = {
+    "_id": False,
+    SHORT_ID_IDENTIFIER: True,
+    LONG_URL_IDENTIFIER: True,
+    URL_CREATION_DATE_IDENTIFIER: True,
+    VISITS_COUNT_IDENTIFIER: True,
+}
+
+EXPORT_MIMETYPES = {
+    "csv": "text/csv",
+    "jsonl": "application/jsonl",
+}
+
+def read_urls(stream, fmt, field="url"):
+    """
+    Read long URLs one at a time from a CSV or JSON Lines file.
+
+    A CSV file must have a header row, and URLs are read from the column
+    named `field`. Each line of a JSON Lines file is either a string or an
+    object holding the URL under the key `field`. Blank lines are skipped.
+
+    :param stream: The open text file to read.
+    :param str fmt: The file format, "csv" or "jsonl".
+    :param str field: The column or key holding the URL (default "url").
+
+    :raises ValueError: If the format is unknown or a URL cannot be found.
+
+    :return: Iterator over the long URLs.
+    :rtype: collections.abc.Iterator[str]
+    """
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        if reader.fieldnames is None:
+            return
+        if field not in reader.fieldnames:
+            raise ValueError(f"No column '{field}' in CSV header")
+        for row in reader:
+            yield row[field]
+    elif fmt == "jsonl":
+        for line_number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if isinstance(item, dict):
+                if field not in item:
+                    raise ValueError(f"No key '{field}' on line {line_number}")
+                item = item[field]
+            yield item
+    else:
+        raise ValueError(f"Unknown format '{fmt}'")
+
+def batched(iterable, size):
+    """
+    Split an iterable into lists of at most `size` items.
+
+    :param iterable: The items to split.
+    :param int size: The maximum number of items in a batch.
+
+    :return: Iterator over the batches.
+    :rtype: collections.abc.Iterator[list]
+    """
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+def export_rows(links, root_url):
+    """
+    Convert link documents to the rows of an export.
+
+    :param links: The link documents, with the fields of
+        `EXPORT_PROJECTION`.
+    :type links: collections.abc.Iterable[dict]
+    :param str root_url: The URL prefix of shortened addresses.
+
+    :return: Iterator over the rows, with the keys of `EXPORT_FIELDS`.
+    :rtype: collections.abc.Iterator[dict]
+    """
+    for link in links:
+        created = link.get(URL_CREATION_DATE_IDENTIFIER)
+        yield {
+            "short_id": link[SHORT_ID_IDENTIFIER],
+            "short_url": AddressManager.compose_shortened_url(root_url, link[SHORT_ID_IDENTIFIER]),
+            "long_url": link[LONG_URL_IDENTIFIER],
+            "created": created.isoformat() if created is not None else None,
+            "visits": link.get(VISITS_COUNT_IDENTIFIER, 0),
+        }
+
+def write_rows(rows, fmt):
+    """
+    Format export rows as CSV (with a header row) or JSON Lines.
+
+    :param rows: The rows (see `export_rows`).
+    :type rows: collections.abc.Iterable[dict]
+    :param str fmt: The file format, "csv" or "jsonl".
+
+    :raises ValueError: If the format is unknown.
+
+    :return: Iterator over the text of each line.
+    :rtype: collections.abc.Iterator[str]
+    """
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, EXPORT_FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        # The header of an empty export
+        if buffer.tell():
+            yield buffer.getvalue()
+    elif fmt == "jsonl":
+        for row in rows:
+            yield json.dumps(row) + "\n"
+    else:
+        raise ValueError(f"Unknown format '{fmt}'")
+
+def encode_chunks(lines, compress=False, chunk_size=65536):
+    """
+    Encode lines of text as UTF-8 chunks of about `chunk_size` bytes,
+    optionally compressed with gzip as they are produced.
+
+    :param lines: The text to encode.
+    :type lines: collections.abc.Iterable[str]
+    :param bool compress: If `True`, the chunks form a gzip file.
+    :param int chunk_size: The number of bytes gathered before a chunk is
+        produced.
+
+    :return: Iterator over the chunks.
+    :rtype: collections.abc.Iterator[bytes]
+    """
+    compressor = zlib.compressobj(wbits=31) if compress else None  # 31: gzip header
+    pending = []
+    pending_size = 0
+    for line in lines:
+        data = line.encode("utf-8")
+        if compressor is not None:
+            data = compressor.compress(data)
+        pending.append(data)
+        pending_size += len(data)
+        if pending_size >= chunk_size:
+            yield b"".join(pending)
+            pending = []
+            pending_size = 0
+    if compressor is not None:
+        pending.append(compressor.flush())
+    if pending:
+        yield b"".join(pending)
+
+def export_user_links(database, user_id, fmt, root_url, compress=False, batch_size=1000):
+    """
+    Export a user's links and their visit counts, in creation order.
+
+    Links are read from a cursor `batch_size` at a time and encoded as they
+    arrive, so memory use does not grow with the number of links.
+
+    :param database: The database containing the urls collection.
+    :type database: pymongo.database.Database
+    :param bson.objectid.ObjectId user_id: The user whose links are exported.
+    :param str fmt: The file format, "csv" or "jsonl".
+    :param str root_url: The URL prefix of shortened addresses.
+    :param bool compress: If `True`, the export is compressed with gzip.
+    :param int batch_size: The number of links fetched at a time.
+
+    :raises ValueError: If the format is unknown.
+
+    :return: Iterator over chunks of the exported file.
+    :rtype: collections.abc.Iterator[bytes]
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown format '{fmt}'")
+    links = AddressManager(database).iter_user_urls(
+        user_id,
+        projection=EXPORT_PROJECTION,
+        check_user=False,
+        batch_size=batch_size,
+    )
+    return encode_chunks(write_rows(export_rows(links, root_url), fmt), compress)
+
+def export_filename(fmt, compress=False):
+    """
+    Name a downloaded export file.
+
+    :param str fmt: The file format, "csv" or "jsonl".
+    :param bool compress: If `True`, the file is compressed with gzip.
+
+    :return: The file name.
+    :rtype: str
+    """
+    return f"yocto-links.{fmt}" + (".gz" if compress else "")
+
+def hash_long_urls(collection, batch_size=1000):
+    """
+    Store the hash of the canonical long URL of links stored without one.
+
+    Links are updated in batches of `batch_size`, each with one bulk write.
+    A link whose long URL is another spelling of one already hashed is
+    rejected by the unique index on the hashes, and left without a hash to
+    be resolved by hand, as is a link whose long URL is no longer valid.
+
+    :param collection: The urls collection.
+    :type collection: pymongo.collection.Collection
+    :param int batch_size: The number of links updated per write
+        (default 1000).
+
+    :return: The number of links "hashed", and of those left as
+        "duplicate" or "invalid".
+    :rtype: dict[str, int]
+    """
+    counts = {"hashed": 0, "duplicate": 0, "invalid": 0}
+    links = collection.find(
+        {LONG_URL_HASH_IDENTIFIER: {"$exists": False}},
+        projection={LONG_URL_IDENTIFIER: True},
+        batch_size=batch_size,
+    )
+    for batch in batched(links, batch_size):
+        updates = []
+        for link in batch:
+            try:
+                long_url_hash = url_hash(link[LONG_URL_IDENTIFIER])
+            except UrlInvalidError:
+                counts["invalid"] += 1
+                continue
+            updates.append(
+                UpdateOne(
+                    {
+                        URL_ID_IDENTIFIER: link[URL_ID_IDENTIFIER],
+                        LONG_URL_HASH_IDENTIFIER: {"$exists": False},
+                    },
+                    {"$set": {LONG_URL_HASH_IDENTIFIER: long_url_hash}},
+                )
+            )
+        if not updates:
+            continue
+        try:
+            result = collection.bulk_write(updates, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details["writeErrors"]
+            if any(error["code"] != 11000 for error in errors):
+                raise
+            counts["hashed"] += e.details["nModified"]
+            counts["duplicate"] += len(errors)
+        else:
+            counts["hashed"] += result.modified_count
+    return counts
+
+@click.command("bulk-shorten")
+@with_appcontext
+@click.argument("file", type=click.File("r"))
+@click.option("--user", "username", required=True, help="Username of the creator of the links.")
+@click.option(
+    "--format", "fmt",
+    type=click.Choice(["csv", "jsonl"]),
+    help="File format (default from the file extension).",
+)
+@click.option("--field", default="url", show_default=True, help="CSV column or JSON key holding the URL.")
+@click.option("--batch-size", default=1000, show_default=True, help="Number of URLs stored per batch.")
+@click.option(
+    "--output",
+    type=click.File("w"),
+    help="File to write the result for each URL to, as JSON Lines.",
+)
+def bulk_shorten_command(file, username, fmt, field, batch_size, output):
+    """Shorten every URL in FILE (a CSV or JSON Lines file, or - for stdin)."""
+    if fmt is None:
+        fmt = "csv" if file.name.endswith(".csv") else "jsonl"
+    db = get_db()
+    user = db.users.find_one({USERNAME_IDENTIFIER: username})
+    if user is None:
+        raise click.ClickException(f"User '{username}' not found.")
+    am = AddressManager(
+        db,
+        cache=get_redirect_cache(),
+        allocator=get_id_allocator(),
+    )
+    counts = {STORE_CREATED: 0, STORE_EXISTS: 0, STORE_INVALID: 0, STORE_FAILED: 0}
+    start = time.perf_counter()
+    try:
+        for batch in batched(read_urls(file, fmt, field), batch_size):
+            results = am.store_many(batch, user[USER_ID_IDENTIFIER], check_creator=False)
+            for result in results:
+                counts[result["status"]] += 1
+                if output is not None:
+                    output.write(json.dumps(result) + "\n")
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    elapsed = time.perf_counter() - start
+    total = sum(counts.values())
+    rate = total / elapsed if elapsed > 0 else 0
+    click.echo(
+        f"Processed {total} URLs in {elapsed:.2f}s ({rate:.0f} URLs/s): "
+        f"{counts[STORE_CREATED]} created, {counts[STORE_EXISTS]} existing, "
+        f"{counts[STORE_INVALID]} invalid, {counts[STORE_FAILED]} failed."
+    )
+
+@click.command("export-links")
+@with_appcontext
+@click.argument("username")
+@click.option(
+    "--format", "fmt",
+    type=click.Choice(EXPORT_FORMATS),
+    default="csv",
+    show_default=True,
+    help="File format.",
+)
+@click.option("--gzip", "compress", is_flag=True, help="Compress the output with gzip.")
+@click.option(
+    "--root-url",
+    default="http://localhost/",
+    show_default=True,
+    help="URL prefix of the shortened addresses.",
+)
+@click.option("--batch-size", default=1000, show_default=True, help="Number of links read per batch.")
+@click.option(
+    "--output",
+    type=click.File("wb"),
+    default="-",
+    help="File to write the links to (default stdout).",
+)
+def export_links_command(username, fmt, compress, root_url, batch_size, output):
+    """Export the links of USERNAME with their visit counts."""
+    db = get_db()
+    user = db.users.find_one({USERNAME_IDENTIFIER: username})
+    if user is None:
+        raise click.ClickException(f"User '{username}' not found.")
+    chunks = export_user_links(
+        db,
+        user[USER_ID_IDENTIFIER],
+        fmt,
+        root_url,
+        compress=compress,
+        batch_size=batch_size,
+    )
+    for chunk in chunks:
+        output.write(chunk)
+
+@click.command("hash-long-urls")
+@with_appcontext
+@click.option("--batch-size", default=1000, show_default=True, help="Number of links updated per batch.")
+def hash_long_urls_command(batch_size):
+    """Add the hashes used to find long URLs to links stored without one."""
+    counts = hash_long_urls(get_db().urls, batch_size=batch_size)
+    click.echo(
+        f"Hashed {counts['hashed']} links; left {counts['duplicate']} duplicate "
+        f"and {counts['invalid']} invalid long URLs unhashed."
+    )
+
+def init_app(app):
+    """
+    Initialize the Flask app for bulk link creation and export.
+
+    Makes the `bulk-shorten`, `export-links` and `hash-long-urls` commands
+    available to run with e.g. `flask --app yocto bulk-shorten`.
+    """
+    app.cli.add_command(bulk_shorten_command)
+    app.cli.add_command(export_links_command)
+    app.cli.add_command(hash_long_urls_command)
@@ -0,0 +1,522 @@
+from collections import defaultdict
+from datetime import datetime, timezone
+import logging
+import threading
+import time
+
+from flask import current_app
+from pymongo.errors import PyMongoError
+
+from yocto.db import get_database
+from yocto.indexes import INVALIDATION_RETENTION
+from yocto.lib.background import BackgroundLoop
+from yocto.lib.cache import LRUCache
+from yocto.lib.resp import RespClient, RespError
+from yocto.lib.utils import (
+    INVALIDATION_CACHE_IDENTIFIER,
+    INVALIDATION_KEY_IDENTIFIER,
+    INVALIDATION_DATE_IDENTIFIER,
+)
+
+REDIRECT_CACHE_EXTENSION = "yocto.redirect_cache"
+USER_CACHE_EXTENSION = "yocto.user_cache"
+TOKEN_CACHE_EXTENSION = "yocto.token_cache"
+CACHE_INVALIDATOR_EXTENSION = "yocto.cache_invalidator"
+
+# Invalidations are read from this long before the previous read, to allow
+# for clocks differing between hosts and writes committed out of order
+INVALIDATION_MARGIN = 5
+
+class RedirectCache(LRUCache):
+    def __init__(self, maxsize, ttl=None, negative_ttl=None, timer=time.monotonic):
+        """
+        Cache of short IDs to the long URLs they redirect to.
+
+        A short ID which is not in the database can be cached as missing, so
+        that repeated requests for it are also answered from memory. Misses
+        use their own, usually shorter, lifetime, because a short ID created
+        by another worker process is only seen here once the entry expires.
+
+        :param int maxsize: The maximum number of entries held.
+        :param float ttl: The lifetime of a cached long URL in seconds.
+        :param float negative_ttl: The lifetime of a cached miss in seconds
+            (default `ttl`).
+        :param timer: Function returning the current time in seconds.
+        """
+        super().__init__(maxsize, ttl, timer)
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+
+    def set_missing(self, short_id):
+        """
+        Record that `short_id` is not in the database.
+
+        A subsequent `get` for the short ID returns `None` until the entry
+        expires or is invalidated.
+
+        :param str short_id: The short ID which was not found.
+        """
+        self.set(short_id, None, ttl=self.negative_ttl)
+
+logger = logging.getLogger(__name__)
+
+# Value stored in the shared cache for a short ID which is not in the
+# database; long URLs are never empty
+_MISSING = b""
+_ABSENT = object()
+
+class SharedRedirectCache:
+    def __init__(
+            self,
+            client,
+            ttl=300,
+            negative_ttl=None,
+            prefix="yocto:redirect:",
+            retry_interval=5.0,
+            timer=time.monotonic,
+        ):
+        """
+        Cache of short IDs to long URLs held by a server speaking the Redis
+        protocol, shared by every worker process using it.
+
+        It has the methods of `RedirectCache`, so that it can be used on its
+        own or as the second tier of a `TieredRedirectCache`. The cache is
+        an optimization only: if the server cannot be reached, lookups are
+        reported as misses and writes are dropped, and the server is not
+        tried again for `retry_interval` seconds so that redirects do not
+        wait for it. Invalidations dropped meanwhile leave entries to expire
+        with their lifetime.
+
+        :param client: The client of the cache server.
+        :type client: yocto.lib.resp.RespClient
+        :param float ttl: The lifetime of a cached long URL in seconds.
+        :param float negative_ttl: The lifetime of a cached miss in seconds
+            (default `ttl`).
+        :param str prefix: Prefix of the keys, so that the server can be
+            shared with other data.
+        :param float retry_interval: Seconds for which the server is not
+            used after a failure.
+        :param timer: Function returning the current time in seconds.
+        """
+        self.client = client
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.prefix = prefix
+        self.retry_interval = retry_interval
+        self._timer = timer
+        self._lock = threading.Lock()
+        self._retry_at = None
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def _execute(self, *args):
+        # Run a command, returning `None` if the server is unavailable
+        if self._retry_at is not None and self._timer() < self._retry_at:
+            return None
+        try:
+            reply = self.client.execute(*args)
+        except (OSError, RespError) as e:
+            with self._lock:
+                self.errors += 1
+                self._retry_at = self._timer() + self.retry_interval
+            logger.warning("Shared redirect cache unavailable: %s", e)
+            return None
+        self._retry_at = None
+        return reply
+
+    def get(self, key, default=None):
+        value = self._execute("GET", self.prefix + key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+        return None if value == _MISSING else value.decode("utf-8")
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        value = _MISSING if value is None else value
+        if ttl is None:
+            self._execute("SET", self.prefix + key, value)
+        else:
+            self._execute("SET", self.prefix + key, value, "PX", max(1, int(ttl * 1000)))
+
+    def set_missing(self, short_id):
+        self.set(short_id, None, ttl=self.negative_ttl)
+
+    def invalidate(self, key):
+        self._execute("DEL", self.prefix + key)
+
+    def invalidate_many(self, keys):
+        keys = [self.prefix + key for key in keys]
+        if keys:
+            self._execute("DEL", *keys)
+
+    def stats(self):
+        """
+        Report the counters of this process's lookups.
+
+        :return: The counts of hits, misses and failed commands. The number
+            of entries held by the server is not known, and reported as 0.
+        :rtype: dict[str, int]
+        """
+        with self._lock:
+            return {
+                "size": 0,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": 0,
+                "errors": self.errors,
+            }
+
+class TieredRedirectCache:
+    def __init__(self, local, shared):
+        """
+        Redirect cache in two tiers: the worker's own `RedirectCache`,
+        backed by a `SharedRedirectCache` of every worker on the host.
+
+        Lookups missing the first tier are read from the second, and what is
+        found there is kept in the first, so a link resolved by one worker
+        is then answered by the others without a database query. Entries
+        are set and invalidated in both tiers. The first tiers of the other
+        workers only learn of an invalidation from a `CacheInvalidator`,
+        which invalidates both tiers again in each worker, so that an entry
+        set in the second tier by a lookup racing the invalidation is also
+        removed. Each tier keeps its own counters, so that their hit ratios
+        are reported apart.
+
+        :param local: The first tier.
+        :type local: RedirectCache
+        :param shared: The second tier.
+        :type shared: SharedRedirectCache
+        """
+        self.local = local
+        self.shared = shared
+
+    def get(self, key, default=None):
+        value = self.local.get(key, _ABSENT)
+        if value is not _ABSENT:
+            return value
+        value = self.shared.get(key, _ABSENT)
+        if value is _ABSENT:
+            return default
+        if value is None:
+            self.local.set_missing(key)
+        else:
+            self.local.set(key, value)
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.local.set(key, value, ttl=ttl)
+        self.shared.set(key, value, ttl=ttl)
+
+    def set_missing(self, short_id):
+        self.local.set_missing(short_id)
+        self.shared.set_missing(short_id)
+
+    def invalidate(self, key):
+        self.local.invalidate(key)
+        self.shared.invalidate(key)
+
+    def invalidate_many(self, keys):
+        keys = list(keys)
+        self.local.invalidate_many(keys)
+        self.shared.invalidate_many(keys)
+
+    def clear(self):
+        """Remove all entries of the first tier."""
+        self.local.clear()
+
+    def stats(self):
+        """
+        Report the size and counters of the first tier.
+
+        :rtype: dict[str, int]
+        """
+        return self.local.stats()
+
+    def __len__(self):
+        return len(self.local)
+
+class CacheInvalidator:
+    def __init__(
+            self,
+            collection,
+            caches,
+            poll_interval=1.0,
+            synchronous=False,
+            timer=time.time,
+        ):
+        """
+        Invalidation of the in-process caches of every worker process.
+
+        Each process holds its own caches, so an entry invalidated by one
+        process, e.g. the short ID of a deleted link, would otherwise still
+        be served by the others until it expires. Invalidations are written
+        to the invalidations collection by `publish`, and read every
+        `poll_interval` seconds by a background thread in each process,
+        started by `ensure_started`, which removes the keys from its own
+        caches. Other processes therefore stop serving an invalidated entry
+        within about `poll_interval` seconds. Invalidations are kept for
+        `yocto.indexes.INVALIDATION_RETENTION` seconds; a process which has
+        not read them for that long, e.g. because the database was
+        unavailable, clears its caches instead.
+
+        :param collection: The invalidations collection.
+        :type collection: pymongo.collection.Collection
+        :param caches: The caches of this process by name, e.g. "redirect".
+            Caches which are `None` are left out.
+        :type caches: dict[str, yocto.lib.cache.LRUCache]
+        :param float poll_interval: Seconds between reads of the
+            invalidations.
+        :param bool synchronous: If `True`, no thread is started, and
+            `ensure_started` reads the invalidations when they are due.
+        :param timer: Function returning the current POSIX time, which must
+            roughly agree between the processes sharing the collection.
+        """
+        self._collection = collection
+        self.caches = {name: cache for name, cache in caches.items() if cache is not None}
+        self.poll_interval = poll_interval
+        self.synchronous = synchronous
+        self._timer = timer
+        self._polled_at = timer()
+        self._poll_lock = threading.Lock()
+        self._loop = BackgroundLoop(
+            self.poll,
+            poll_interval,
+            "yocto-cache-invalidator",
+            errors=PyMongoError,
+            message="Could not read cache invalidations: %s",
+            logger=logger,
+            wait_first=True,
+            after_fork=self._reset_after_fork,
+        )
+
+    def publish(self, name, keys):
+        """
+        Invalidate keys of a cache in every process.
+
+        The caller still invalidates its own cache, which is not waited for
+        here. If the invalidations cannot be written, they are logged, and
+        the other processes keep the entries until they expire.
+
+        :param str name: The name of the cache, e.g. "redirect".
+        :param keys: The keys to invalidate.
+        :type keys: list
+        """
+        now = datetime.fromtimestamp(self._timer(), timezone.utc)
+        records = [
+            {
+                INVALIDATION_CACHE_IDENTIFIER: name,
+                INVALIDATION_KEY_IDENTIFIER: key,
+                INVALIDATION_DATE_IDENTIFIER: now,
+            }
+            for key in keys
+        ]
+        if not records:
+            return
+        try:
+            self._collection.insert_many(records, ordered=False)
+        except PyMongoError as e:
+            logger.warning("Could not publish cache invalidations: %s", e)
+
+    def poll(self):
+        """
+        Remove the keys invalidated since the previous read from the caches
+        of this process.
+
+        :raises pymongo.errors.PyMongoError: If the invalidations cannot be
+            read.
+
+        :return: The number of keys invalidated.
+        :rtype: int
+        """
+        with self._poll_lock:
+            now = self._timer()
+            if now - self._polled_at > INVALIDATION_RETENTION - INVALIDATION_MARGIN:
+                # Invalidations may have expired unread
+                for cache in self.caches.values():
+                    cache.clear()
+                self._polled_at = now
+                return 0
+            since = datetime.fromtimestamp(self._polled_at - INVALIDATION_MARGIN, timezone.utc)
+            keys = defaultdict(list)
+            for record in self._collection.find(
+                {INVALIDATION_DATE_IDENTIFIER: {"$gte": since}},
+                projection={
+                    INVALIDATION_CACHE_IDENTIFIER: True,
+                    INVALIDATION_KEY_IDENTIFIER: True,
+                    "_id": False,
+                },
+            ):
+                if record[INVALIDATION_CACHE_IDENTIFIER] in self.caches:
+                    keys[record[INVALIDATION_CACHE_IDENTIFIER]].append(record[INVALIDATION_KEY_IDENTIFIER])
+            for name, cache_keys in keys.items():
+                self.caches[name].invalidate_many(cache_keys)
+            self._polled_at = now
+            return sum(len(cache_keys) for cache_keys in keys.values())
+
+    def ensure_started(self):
+        """
+        Start the background thread of this process, if not running, or in
+        synchronous mode read the invalidations if they are due.
+        """
+        if not self.synchronous:
+            self._loop.ensure_started()
+        elif self._timer() - self._polled_at >= self.poll_interval:
+            self.poll()
+
+    def close(self):
+        """Stop the background thread."""
+        self._loop.stop()
+
+    def _reset_after_fork(self):
+        self._poll_lock = threading.Lock()
+
+def get_redirect_cache():
+    """
+    Obtain the redirect cache of the current application.
+
+    Each worker process holds its own cache, created by `init_app`.
+
+    :return: The redirect cache, or `None` if caching is disabled.
+    :rtype: RedirectCache
+    """
+    return current_app.extensions.get(REDIRECT_CACHE_EXTENSION)
+
+def get_user_cache():
+    """
+    Obtain the cache of logged-in user records of the current application.
+
+    Records are keyed by the user ID as stored in the session. Each worker
+    process holds its own cache, created by `init_app`.
+
+    :return: The user cache, or `None` if caching is disabled.
+    :rtype: yocto.lib.cache.LRUCache
+    """
+    return current_app.extensions.get(USER_CACHE_EXTENSION)
+
+def get_token_cache():
+    """
+    Obtain the cache of API token owners of the current application.
+
+    User IDs are keyed by the hash of the token. Each worker process holds
+    its own cache, created by `init_app`.
+
+    :return: The token cache, or `None` if caching is disabled.
+    :rtype: yocto.lib.cache.LRUCache
+    """
+    return current_app.extensions.get(TOKEN_CACHE_EXTENSION)
+
+def get_cache_invalidator():
+    """
+    Obtain the cache invalidator of the current application.
+
+    :return: The cache invalidator, or `None` if caching is disabled.
+    :rtype: CacheInvalidator
+    """
+    return current_app.extensions.get(CACHE_INVALIDATOR_EXTENSION)
+
+def create_cache_invalidator(config, caches):
+    """
+    Build a cache invalidator as configured.
+
+    The invalidations are read every `CACHE_INVALIDATION_INTERVAL` seconds,
+    by a background thread unless `CACHE_INVALIDATION_SYNCHRONOUS` is set.
+
+    :param config: The application configuration.
+    :type config: flask.Config
+    :param caches: The caches of this process by name.
+    :type caches: dict[str, yocto.lib.cache.LRUCache]
+
+    :return: The cache invalidator, or `None` if no cache is given.
+    :rtype: CacheInvalidator
+    """
+    if all(cache is None for cache in caches.values()):
+        return None
+    return CacheInvalidator(
+        get_database(config).invalidations,
+        caches,
+        poll_interval=config.get("CACHE_INVALIDATION_INTERVAL", 1.0),
+        synchronous=config.get("CACHE_INVALIDATION_SYNCHRONOUS", False),
+    )
+
+def create_redirect_cache(config):
+    """
+    Build a redirect cache as configured.
+
+    The cache is sized from the `REDIRECT_CACHE_SIZE`, `REDIRECT_CACHE_TTL`
+    and `REDIRECT_CACHE_NEGATIVE_TTL` options. A size of zero disables it.
+    If `REDIRECT_SHARED_CACHE_URL` is set, a `SharedRedirectCache` on that
+    server is added as a second tier (or used alone if the first is
+    disabled), with the `REDIRECT_SHARED_CACHE_*` options.
+
+    :param config: The application configuration.
+    :type config: flask.Config
+
+    :return: The redirect cache, or `None` if caching is disabled.
+    :rtype: RedirectCache | SharedRedirectCache | TieredRedirectCache
+    """
+    size = config.get("REDIRECT_CACHE_SIZE", 0)
+    local = None
+    if size > 0:
+        local = RedirectCache(
+            size,
+            ttl=config.get("REDIRECT_CACHE_TTL"),
+            negative_ttl=config.get("REDIRECT_CACHE_NEGATIVE_TTL"),
+        )
+    url = config.get("REDIRECT_SHARED_CACHE_URL")
+    if not url:
+        return local
+    shared = SharedRedirectCache(
+        RespClient.from_url(url, timeout=config.get("REDIRECT_SHARED_CACHE_TIMEOUT")),
+        ttl=config.get("REDIRECT_SHARED_CACHE_TTL"),
+        negative_ttl=config.get("REDIRECT_SHARED_CACHE_NEGATIVE_TTL"),
+        prefix=config.get("REDIRECT_SHARED_CACHE_PREFIX", "yocto:redirect:"),
+        retry_interval=config.get("REDIRECT_SHARED_CACHE_RETRY_INTERVAL", 5.0),
+    )
+    if local is None:
+        return shared
+    return TieredRedirectCache(local, shared)
+
+def init_app(app):
+    """
+    Initialize the Flask app with its in-process caches.
+
+    The redirect cache is configured as described in `create_redirect_cache`,
+    the user cache is sized from `USER_CACHE_SIZE` and `USER_CACHE_TTL`, and
+    the token cache from `TOKEN_CACHE_SIZE` and `TOKEN_CACHE_TTL`. A size of
+    zero disables a cache. If any cache is enabled, a `CacheInvalidator`,
+    configured as described in `create_cache_invalidator`, carries
+    invalidations between processes, with its thread started by the first
+    request handled by each process.
+    """
+    app.extensions[REDIRECT_CACHE_EXTENSION] = create_redirect_cache(app.config)
+    for extension, prefix in (
+        (USER_CACHE_EXTENSION, "USER_CACHE"),
+        (TOKEN_CACHE_EXTENSION, "TOKEN_CACHE"),
+    ):
+        size = app.config.get(f"{prefix}_SIZE", 0)
+        if size > 0:
+            app.extensions[extension] = LRUCache(
+                size,
+                ttl=app.config.get(f"{prefix}_TTL"),
+            )
+        else:
+            app.extensions[extension] = None
+    redirect_cache = app.extensions[REDIRECT_CACHE_EXTENSION]
+    if isinstance(redirect_cache, SharedRedirectCache):
+        # Held by the server, so invalidated there by the publisher alone
+        redirect_cache = None
+    invalidator = create_cache_invalidator(
+        app.config,
+        {
+            "redirect": redirect_cache,
+            "user": app.extensions[USER_CACHE_EXTENSION],
+            "token": app.extensions[TOKEN_CACHE_EXTENSION],
+        },
+    )
+    app.extensions[CACHE_INVALIDATOR_EXTENSION] = invalidator
+    if invalidator is not None:
+        app.before_request(invalidator.ensure_started)
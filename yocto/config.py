@@ -1,7 +1,217 @@
+import os
+
 class Config:
     SECRET_KEY = "dev"  # default if not overwritten from file in __init__
     DEBUG = False
 
+    # Storage backend: "mongodb", or "sqlite" for a database embedded in the
+    # process, in the file at SQLITE_PATH (default "<DATABASE>.sqlite3" in the
+    # instance folder), shared by the workers of one host
+    STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "mongodb")
+    SQLITE_PATH = os.getenv("SQLITE_PATH")
+
+    # MongoDB client settings. One client (and its connection pool) is shared
+    # by all requests handled in a worker process. If in docker, the hostname
+    # is taken from the environment, else look on localhost.
+    MONGO_HOST = os.getenv("DATABASE_HOST", "localhost")
+    MONGO_PORT = 27017
+    MONGO_MAX_POOL_SIZE = 100
+    MONGO_MIN_POOL_SIZE = 0
+    MONGO_MAX_IDLE_TIME_MS = None
+    MONGO_CONNECT_TIMEOUT_MS = 5000
+    MONGO_SOCKET_TIMEOUT_MS = None
+    MONGO_SERVER_SELECTION_TIMEOUT_MS = 5000
+    MONGO_WAIT_QUEUE_TIMEOUT_MS = None
+    # Replica set routing. Redirect lookups and the logged-in user lookup
+    # read with MONGO_READ_PREFERENCE ("primary", "primaryPreferred",
+    # "secondary", "secondaryPreferred" or "nearest") from members at most
+    # MONGO_MAX_STALENESS_SECONDS behind (-1 for no limit, else at least 90);
+    # links and users not found there are read again from the primary.
+    # Other reads and all writes go to the primary, writes acknowledged with
+    # MONGO_WRITE_CONCERN ("majority" or a number of members, default the
+    # server's), waiting at most MONGO_WRITE_CONCERN_TIMEOUT_MS, and
+    # journaled if MONGO_JOURNAL is set. A single-node replica set
+    # (`mongod --replSet rs0`, then `rs.initiate()`) is enough to try them.
+    MONGO_REPLICA_SET = os.getenv("MONGO_REPLICA_SET")
+    MONGO_READ_PREFERENCE = os.getenv("MONGO_READ_PREFERENCE", "primary")
+    MONGO_MAX_STALENESS_SECONDS = -1
+    MONGO_WRITE_CONCERN = None
+    MONGO_WRITE_CONCERN_TIMEOUT_MS = None
+    MONGO_JOURNAL = None
+    # Pool size of the async client of the ASGI redirect service, which has
+    # many requests in flight at once
+    ASYNC_MONGO_MAX_POOL_SIZE = 100
+    # Build missing indexes when the app is created. Registration relies on
+    # the unique index on usernames to reject concurrent duplicates.
+    ENSURE_INDEXES_ON_STARTUP = True
+
+    # Per-worker cache of short IDs to long URLs (size 0 disables). Misses
+    # are cached for a shorter time, as IDs created by other workers are only
+    # seen once the entry expires. Deleted links are invalidated in every
+    # worker within CACHE_INVALIDATION_INTERVAL.
+    REDIRECT_CACHE_SIZE = 10000
+    REDIRECT_CACHE_TTL = 300
+    REDIRECT_CACHE_NEGATIVE_TTL = 10
+
+    # Second tier of the redirect cache, shared by the workers of a host, on
+    # a server speaking the Redis protocol (e.g. Redis or Valkey) at
+    # REDIRECT_SHARED_CACHE_URL ("redis://[:password@]host[:port][/db]").
+    # Commands taking longer than TIMEOUT seconds fail, after which the
+    # server is not used for RETRY_INTERVAL seconds. Each worker still keeps
+    # its own first tier, invalidated within CACHE_INVALIDATION_INTERVAL.
+    REDIRECT_SHARED_CACHE_URL = os.getenv("REDIRECT_SHARED_CACHE_URL")
+    REDIRECT_SHARED_CACHE_TTL = 300
+    REDIRECT_SHARED_CACHE_NEGATIVE_TTL = 10
+    REDIRECT_SHARED_CACHE_PREFIX = "yocto:redirect:"
+    REDIRECT_SHARED_CACHE_TIMEOUT = 0.1
+    REDIRECT_SHARED_CACHE_RETRY_INTERVAL = 5.0
+
+    # Per-worker cache of logged-in user records (size 0 disables). Deleted
+    # users are invalidated in every worker within CACHE_INVALIDATION_INTERVAL.
+    USER_CACHE_SIZE = 1000
+    USER_CACHE_TTL = 30
+
+    # Per-worker cache of API token owners (size 0 disables). A revoked token
+    # is accepted by other workers until they read its invalidation, within
+    # CACHE_INVALIDATION_INTERVAL.
+    TOKEN_CACHE_SIZE = 10000
+    TOKEN_CACHE_TTL = 60
+
+    # Workers read the cache entries invalidated by the others, e.g. the
+    # short IDs of deleted links, every CACHE_INVALIDATION_INTERVAL seconds,
+    # which bounds how long they keep serving them
+    CACHE_INVALIDATION_INTERVAL = 1.0
+    CACHE_INVALIDATION_SYNCHRONOUS = False
+
+    # Most URLs accepted by one batch request to the JSON API
+    API_BATCH_MAX_SIZE = 1000
+
+    # Per-worker Bloom filter of the short IDs in the database, so that
+    # redirects from unknown IDs need no query. It is built in the background
+    # by each worker, reads links created by other workers every
+    # REFRESH_INTERVAL seconds (for which time they can be reported missing)
+    # and is rebuilt every REBUILD_INTERVAL seconds.
+    SHORT_ID_FILTER_ENABLED = False
+    SHORT_ID_FILTER_CAPACITY = 1000000
+    SHORT_ID_FILTER_ERROR_RATE = 0.01
+    SHORT_ID_FILTER_REFRESH_INTERVAL = 1.0
+    SHORT_ID_FILTER_REBUILD_INTERVAL = 3600
+
+    # Answer redirects in a WSGI middleware ahead of Flask, without loading
+    # the session or user. Browsers may reuse a redirect for REDIRECT_MAX_AGE
+    # seconds, during which their visits are not counted.
+    REDIRECT_FAST_PATH = True
+    REDIRECT_MAX_AGE = 0
+
+    # Redirects answered from a snapshot file memory-mapped by every worker
+    # on the host, written by `flask build-redirect-snapshot` (default path
+    # "redirects.snapshot" in the instance folder). Workers read the short
+    # IDs deleted since the snapshot, and check for a new file, every
+    # REFRESH_INTERVAL seconds. Snapshots older than the tombstones of
+    # deleted links (yocto.indexes.TOMBSTONE_RETENTION) are not used.
+    # Deletions only leave tombstones while this is enabled, so it must be
+    # set for every process deleting links, including the flask commands.
+    REDIRECT_SNAPSHOT_ENABLED = False
+    REDIRECT_SNAPSHOT_PATH = None
+    REDIRECT_SNAPSHOT_REFRESH_INTERVAL = 5.0
+
+    # Buffer visit counts in each worker and write them in batches, when
+    # FLUSH_SIZE visits are pending or every FLUSH_INTERVAL seconds
+    VISIT_COUNTER_ENABLED = True
+    VISIT_COUNTER_FLUSH_SIZE = 1000
+    VISIT_COUNTER_FLUSH_INTERVAL = 5.0
+    VISIT_COUNTER_SYNCHRONOUS = False
+    # Also count visits by minute, hour and day, keeping the buckets of each
+    # granularity for the given number of seconds (None does not record that
+    # granularity). Recorded by the visit counter only.
+    VISIT_HISTORY_ENABLED = True
+    VISIT_HISTORY_RETENTION = {
+        "minute": 2 * 86400,
+        "hour": 90 * 86400,
+        "day": 2 * 365 * 86400,
+    }
+
+    # Deleting an account removes its links afterwards, in the background:
+    # BATCH_SIZE links at a time with BATCH_PAUSE seconds between batches.
+    # A deletion interrupted by a crash is resumed by another worker once its
+    # LEASE_TIME has passed; workers look for them every POLL_INTERVAL.
+    DELETION_BATCH_SIZE = 1000
+    DELETION_BATCH_PAUSE = 0.05
+    DELETION_LEASE_TIME = 60
+    DELETION_POLL_INTERVAL = 60
+    DELETION_SYNCHRONOUS = False
+
+    # Short ID allocation: "random" IDs retried on collision, or "counter"
+    # values leased in blocks and permuted with SHORT_ID_KEY (default
+    # SECRET_KEY)
+    SHORT_ID_ALLOCATOR = "random"
+    SHORT_ID_LENGTH = 7
+    SHORT_ID_BLOCK_SIZE = 100
+    SHORT_ID_KEY = None
+
+    # Number of links on a page of My Links, and the most a request can ask for
+    MY_LINKS_PAGE_SIZE = 100
+    MY_LINKS_MAX_PAGE_SIZE = 1000
+
+    # Argon2 parameters for new password hashes. Stored hashes made with
+    # other parameters are replaced when the user next logs in.
+    ARGON2_TIME_COST = 3
+    ARGON2_MEMORY_COST = 65536  # KiB
+    ARGON2_PARALLELISM = 4
+
+    # Passwords are hashed in a pool of PROCESSES worker processes (default
+    # one per CPU, 0 hashes on the request thread). Logins beyond MAX_PENDING
+    # (default twice the pool size), or taking longer than TIMEOUT seconds,
+    # are asked to try again.
+    PASSWORD_HASHING_PROCESSES = None
+    PASSWORD_HASHING_MAX_PENDING = None
+    PASSWORD_HASHING_TIMEOUT = 10
+
+    # Logins with unknown usernames verify the password against a dummy hash
+    # made at startup, so that they cost a bounded amount of hashing and do
+    # not reveal which usernames exist by answering sooner. The policy is
+    # "cheap" for a hash with the ARGON2_DUMMY_* parameters, "full" for one
+    # with the ARGON2_* parameters (equal timing, at full cost), or "none"
+    # to answer at once.
+    UNKNOWN_USER_HASH_POLICY = "cheap"
+    ARGON2_DUMMY_TIME_COST = 1
+    ARGON2_DUMMY_MEMORY_COST = 8192  # KiB
+    ARGON2_DUMMY_PARALLELISM = 1
+
+    # Login attempts are limited per client address (X-Forwarded-For behind
+    # nginx), per username from each address and per username from every
+    # address, in sliding windows of WINDOW seconds, counted before the
+    # password is verified; a limit of 0 disables it. A successful login
+    # clears the attempts of its username from its address, so failures from
+    # one address do not lock out the owner of the username at another until
+    # the higher ACCOUNT limit, which bounds guessing from many addresses, is
+    # reached. Each worker counts at most MAX_KEYS usernames and addresses
+    # per limit, unless the counts are shared on a server speaking the Redis
+    # protocol at LOGIN_RATE_LIMIT_URL ("redis://[:password@]host[:port][/db]").
+    LOGIN_RATE_LIMIT_ENABLED = True
+    LOGIN_USERNAME_LIMIT = 5
+    LOGIN_USERNAME_WINDOW = 300
+    LOGIN_ACCOUNT_LIMIT = 50
+    LOGIN_ACCOUNT_WINDOW = 3600
+    LOGIN_ADDRESS_LIMIT = 30
+    LOGIN_ADDRESS_WINDOW = 300
+    LOGIN_RATE_LIMIT_MAX_KEYS = 100000
+    LOGIN_RATE_LIMIT_URL = os.getenv("LOGIN_RATE_LIMIT_URL")
+    LOGIN_RATE_LIMIT_PREFIX = "yocto:login:"
+    LOGIN_RATE_LIMIT_TIMEOUT = 0.1
+    LOGIN_RATE_LIMIT_RETRY_INTERVAL = 5.0
+
+    # Request, database, cache and password hashing metrics, served in the
+    # Prometheus text format at METRICS_PATH. Worker processes sharing
+    # METRICS_DIR write their metrics there every METRICS_WRITE_INTERVAL
+    # seconds, so that a scrape of any worker reports all of them. Disabled by
+    # default, as the endpoint is not authenticated: enable it only where
+    # METRICS_PATH cannot be reached from outside, e.g. blocked by the proxy.
+    METRICS_ENABLED = False
+    METRICS_PATH = "/metrics"
+    METRICS_DIR = os.getenv("METRICS_DIR")
+    METRICS_WRITE_INTERVAL = 5.0
+
 class DevelopmentConfig(Config):
     DEBUG = True
     DATABASE = "dev"
@@ -9,8 +219,34 @@ class DevelopmentConfig(Config):
 class ProductionConfig(Config):
     DEBUG = False
     DATABASE = "yocto"
+    # Sync gunicorn workers serve one request at a time, so a small pool per
+    # worker is enough; keep one connection warm for the redirect path.
+    MONGO_MAX_POOL_SIZE = 10
+    MONGO_MIN_POOL_SIZE = 1
+    MONGO_MAX_IDLE_TIME_MS = 300000
+    MONGO_SOCKET_TIMEOUT_MS = 10000
+    MONGO_WAIT_QUEUE_TIMEOUT_MS = 2000
+    SHORT_ID_FILTER_ENABLED = True
+
+class BenchmarkConfig(ProductionConfig):
+    # Production settings against a separate database, for the benchmarks
+    # suite, without needing a secret key file
+    SECRET_KEY = "benchmark"
+    DATABASE = "benchmarks"
 
 class TestingConfig(Config):
     DEBUG = True
     TESTING = True
     DATABASE = "tests"
+    # Indexes are built by init_db
+    ENSURE_INDEXES_ON_STARTUP = False
+    # Write visits before the redirect returns
+    VISIT_COUNTER_SYNCHRONOUS = True
+    # Hash passwords on the request thread
+    PASSWORD_HASHING_PROCESSES = 0
+    # Delete accounts' links before the request returns
+    DELETION_SYNCHRONOUS = True
+    # Read cache invalidations on the request thread
+    CACHE_INVALIDATION_SYNCHRONOUS = True
+    # Record and serve metrics, to test them
+    METRICS_ENABLED = True
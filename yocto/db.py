@@ -1,58 +1,299 @@
+import atexit
 import os
+import threading
 
 from flask import g, current_app
 import click
+from flask.cli import with_appcontext
 from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+from pymongo.read_preferences import (
+    Nearest,
+    Primary,
+    PrimaryPreferred,
+    Secondary,
+    SecondaryPreferred,
+)
+
+from yocto.indexes import ensure_indexes
+from yocto.storage import STORAGE_BACKENDS
+
+# Map of client settings to the MongoClient built from them. Clients are
+# shared by every request in the process and rebuilt after a fork.
+_clients = {}
+# Read preferences by the name used in `MONGO_READ_PREFERENCE`
+READ_PREFERENCES = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+
+# Map of SQLite file paths to the database opened on them, for the
+# "sqlite" storage backend. Each opens its own connections after a fork.
+_sqlite_databases = {}
+_clients_pid = os.getpid()
+_clients_lock = threading.Lock()
+
+def _client_settings(config):
+    """
+    Collect the MongoClient keyword arguments from the app configuration.
+
+    :param config: The application configuration.
+    :type config: flask.Config
+
+    :return: The client settings, as a hashable sequence of pairs.
+    :rtype: tuple
+    """
+    settings = {
+        "host": config.get("MONGO_HOST", "localhost"),
+        "port": config.get("MONGO_PORT", 27017),
+        "maxPoolSize": config.get("MONGO_MAX_POOL_SIZE"),
+        "minPoolSize": config.get("MONGO_MIN_POOL_SIZE"),
+        "maxIdleTimeMS": config.get("MONGO_MAX_IDLE_TIME_MS"),
+        "connectTimeoutMS": config.get("MONGO_CONNECT_TIMEOUT_MS"),
+        "socketTimeoutMS": config.get("MONGO_SOCKET_TIMEOUT_MS"),
+        "serverSelectionTimeoutMS": config.get("MONGO_SERVER_SELECTION_TIMEOUT_MS"),
+        "waitQueueTimeoutMS": config.get("MONGO_WAIT_QUEUE_TIMEOUT_MS"),
+        "replicaSet": config.get("MONGO_REPLICA_SET"),
+        # Write concern of every write not setting its own
+        "w": config.get("MONGO_WRITE_CONCERN"),
+        "wTimeoutMS": config.get("MONGO_WRITE_CONCERN_TIMEOUT_MS"),
+        "journal": config.get("MONGO_JOURNAL"),
+    }
+    return tuple(
+        (key, value) for key, value in settings.items() if value is not None
+    )
+
+def get_client(config=None):
+    """
+    Obtain the MongoClient shared by the current process.
+
+    The client is created on first use and kept for the lifetime of the
+    process, so requests reuse pooled connections instead of connecting,
+    handshaking and discovering the server topology every time. A process
+    forked from one holding clients (e.g. a gunicorn worker) builds its own.
+
+    :param config: The configuration to read client settings from (default
+        `current_app.config`).
+    :type config: flask.Config
+
+    :return: The process-wide client.
+    :rtype: pymongo.MongoClient
+    """
+    global _clients_pid
+    if config is None:
+        config = current_app.config
+    settings = _client_settings(config)
+    with _clients_lock:
+        if _clients_pid != os.getpid():
+            # Connections inherited from the parent must not be used
+            _clients.clear()
+            _clients_pid = os.getpid()
+        client = _clients.get(settings)
+        if client is None:
+            client = MongoClient(connect=False, **dict(settings))
+            _clients[settings] = client
+    return client
+
+def get_database(config=None):
+    """
+    Obtain the database of the configured storage backend.
+
+    With the "mongodb" backend (the default), this is the `DATABASE`
+    database of the client returned by `get_client`. With the "sqlite"
+    backend, it is the embedded database in the file at `SQLITE_PATH`,
+    shared by every thread of the process.
+
+    :param config: The configuration to read the settings from (default
+        `current_app.config`).
+    :type config: flask.Config
+
+    :raises ValueError: If `STORAGE_BACKEND` is not a known backend.
+
+    :return: The database.
+    :rtype: pymongo.database.Database | yocto.storage.sqlite.SQLiteDatabase
+    """
+    if config is None:
+        config = current_app.config
+    backend = config.get("STORAGE_BACKEND", "mongodb")
+    if backend == "mongodb":
+        return get_client(config).get_database(config["DATABASE"])
+    if backend == "sqlite":
+        path = config.get("SQLITE_PATH") or f"{config['DATABASE']}.sqlite3"
+        with _clients_lock:
+            database = _sqlite_databases.get(path)
+            if database is None:
+                from yocto.storage.sqlite import SQLiteDatabase
+                database = SQLiteDatabase(path, name=config["DATABASE"])
+                _sqlite_databases[path] = database
+        return database
+    raise ValueError(
+        f"Unknown storage backend {backend!r}, expected one of {', '.join(STORAGE_BACKENDS)}"
+    )
+
+def read_preference(config):
+    """
+    Build the read preference of lookups which tolerate replication lag.
+
+    :param config: The application configuration, with the
+        `MONGO_READ_PREFERENCE` and `MONGO_MAX_STALENESS_SECONDS` options.
+    :type config: flask.Config
+
+    :raises ValueError: If `MONGO_READ_PREFERENCE` is not a known mode.
+
+    :return: The read preference.
+    :rtype: pymongo.read_preferences.ServerMode
+    """
+    mode = config.get("MONGO_READ_PREFERENCE", "primary")
+    if mode not in READ_PREFERENCES:
+        raise ValueError(
+            f"Unknown read preference {mode!r}, expected one of {', '.join(READ_PREFERENCES)}"
+        )
+    if mode == "primary":
+        return Primary()
+    return READ_PREFERENCES[mode](max_staleness=config.get("MONGO_MAX_STALENESS_SECONDS", -1))
+
+def with_read_preference(database, config=None):
+    """
+    Obtain a handle on a database for lookups which tolerate replication
+    lag, such as redirects.
+
+    With the "mongodb" backend, reads through the handle follow the
+    `MONGO_READ_PREFERENCE` option, so that they can be answered by
+    secondaries or the nearest member of a replica set. If the preference
+    is "primary", or the backend has no replicas, `database` itself is
+    returned. Writes should go through `database`.
+
+    :param database: The database, as returned by `get_database`.
+    :type database: pymongo.database.Database
+    :param config: The configuration to read the settings from (default
+        `current_app.config`).
+    :type config: flask.Config
+
+    :return: The database for lag-tolerant reads.
+    :rtype: pymongo.database.Database | yocto.storage.sqlite.SQLiteDatabase
+    """
+    if config is None:
+        config = current_app.config
+    if config.get("STORAGE_BACKEND", "mongodb") != "mongodb":
+        return database
+    preference = read_preference(config)
+    if preference == Primary():
+        return database
+    return database.with_options(read_preference=preference)
+
+def close_clients():
+    """
+    Close every client created by this process.
+
+    Registered to run at interpreter exit; a later call to `get_client` will
+    create a new client.
+    """
+    with _clients_lock:
+        if _clients_pid == os.getpid():
+            for client in _clients.values():
+                client.close()
+        _clients.clear()
+
+def _reset_after_fork():
+    global _clients_pid
+    # Drop the parent's clients without closing them; their sockets belong
+    # to the parent process.
+    _clients.clear()
+    _clients_pid = os.getpid()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+atexit.register(close_clients)
 
 def get_db():
     """
     Obtain a reference to the database.
 
-    Using this function to get a reference to the database ensures that only
-    one client is initialized which can be cleaned up after a request is made.
-    After this function is called, the database is available via the global
+    The database handle is taken from `get_database`, which shares one
+    client per process, so no connection is set up for the request. After
+    this function is called, the database is available via the global
     reference in `g`.
 
     :return: The global reference to the database.
-    :rtype: pymongo.database.Database
+    :rtype: pymongo.database.Database | yocto.storage.sqlite.SQLiteDatabase
     """
     if "db" not in g:
-        # If in docker, get hostname from env, else look on localhost
-        client = MongoClient(host=os.getenv("DATABASE_HOST", "localhost"), port=27017)  
-        g.db = client.get_database(current_app.config['DATABASE'])
-    print(g.db.name)
+        g.db = get_database()
     return g.db
 
+def get_read_db():
+    """
+    Obtain a reference to the database for lookups which tolerate
+    replication lag, as returned by `with_read_preference`.
+
+    This is the database returned by `get_db` unless reads are routed to
+    other members. After this function is called, the database is available
+    via the global reference in `g`.
+
+    :return: The global reference to the database.
+    :rtype: pymongo.database.Database | yocto.storage.sqlite.SQLiteDatabase
+    """
+    if "read_db" not in g:
+        g.read_db = with_read_preference(get_db())
+    return g.read_db
+
 def init_db():
     """
     Initialize the database for use with the application.
 
-    The collections "users" and "urls" will be dropped if they exist,
-    providing a blank database into which the new data can be stored.
+    The collections "users", "urls", "tokens", "visits", "deletions",
+    "tombstones", "invalidations" and "counters" will be dropped if they
+    exist, providing a blank database into which the new data can be stored.
     As the NoSQL database does not use a schema, it is not necessary to
-    create the new tables as they will be generated lazily when needed.
+    create the new tables, but the indexes used by the application are
+    built on the empty collections.
+
+    :return: The index report from `yocto.indexes.ensure_indexes`.
+    :rtype: dict[str, list[str]]
     """
     db = get_db()
     db.drop_collection("users")
     db.drop_collection("urls")
+    db.drop_collection("tokens")
+    db.drop_collection("visits")
+    db.drop_collection("deletions")
+    db.drop_collection("tombstones")
+    db.drop_collection("invalidations")
+    db.drop_collection("counters")
+    return ensure_indexes(db)
+
+def _echo_index_report(report):
+    for name in report["created"]:
+        click.echo(f"Created index {name}.")
+    for name in report["existing"]:
+        click.echo(f"Index {name} already in place.")
+    for name in report["dropped"]:
+        click.echo(f"Dropped obsolete index {name}.")
 
 @click.command("init-db")
 def init_db_command():
     """Clear existing data in the database and initialize collections."""
-    init_db()
+    report = init_db()
     click.echo("Initialized the database.")
+    _echo_index_report(report)
+
+@click.command("ensure-indexes")
+@with_appcontext
+def ensure_indexes_command():
+    """Create any missing indexes on the users and urls collections."""
+    _echo_index_report(ensure_indexes(get_db()))
 
 def close_db(e=None):
     """
-    Clean up the database if a connection exists.
+    Release the database reference held for the current app context.
 
-    If a database connection exists, the reference to the database in `g` will
-    be removed and the client connection will be closed. If there is no 
-    database connection, no action is taken.
+    The references in `g` are removed. The underlying client is left open,
+    and its connections return to the pool for the next request.
     """
-    db = g.pop("db", None)
-    if db is not None:
-        db.client.close()
+    g.pop("db", None)
+    g.pop("read_db", None)
 
 def init_app(app):
     """
@@ -60,7 +301,27 @@ def init_app(app):
 
     This function should be called by the application factory to register
     the database cleanup function to run after a request and to make the
-    `init-db` command available to run with `flask --app yocto init-db`.
+    `init-db` and `ensure-indexes` commands available to run with e.g.
+    `flask --app yocto init-db`. If the `ENSURE_INDEXES_ON_STARTUP` option is
+    set (the default), missing indexes are built now; failure to reach the
+    database or to build an index is logged as an error rather than raised,
+    so that the application can still start.
+    With the "sqlite" storage backend, the database file defaults to
+    "<DATABASE>.sqlite3" in the instance folder.
     """
+    if app.config.get("STORAGE_BACKEND") == "sqlite" and not app.config.get("SQLITE_PATH"):
+        app.config["SQLITE_PATH"] = os.path.join(app.instance_path, f"{app.config['DATABASE']}.sqlite3")
     app.teardown_appcontext(close_db)
     app.cli.add_command(init_db_command)
+    app.cli.add_command(ensure_indexes_command)
+    if app.config.get("ENSURE_INDEXES_ON_STARTUP", False):
+        with app.app_context():
+            try:
+                report = ensure_indexes(get_db())
+            except PyMongoError as e:
+                app.logger.error(
+                    "Could not ensure indexes, so that e.g. usernames may not be unique: %s", e
+                )
+            else:
+                if report["created"]:
+                    app.logger.info("Created indexes: %s", ", ".join(report["created"]))
@@ -0,0 +1,282 @@
+from datetime import datetime, timedelta, timezone
+import logging
+import os
+import secrets
+import socket
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import PyMongoError
+
+from yocto.address import AddressManager
+from yocto.cache import CACHE_INVALIDATOR_EXTENSION, REDIRECT_CACHE_EXTENSION, get_cache_invalidator
+from yocto.db import get_database, get_db
+from yocto.lib.background import BackgroundLoop
+from yocto.lib.utils import (
+    DELETION_USER_ID_IDENTIFIER,
+    DELETION_REQUEST_DATE_IDENTIFIER,
+    DELETION_LEASE_OWNER_IDENTIFIER,
+    DELETION_LEASE_EXPIRY_IDENTIFIER,
+    DELETION_LINKS_DELETED_IDENTIFIER,
+)
+
+DELETION_WORKER_EXTENSION = "yocto.deletion_worker"
+
+logger = logging.getLogger(__name__)
+
+# Lease expiry of a job no worker has claimed
+_UNCLAIMED = datetime(1970, 1, 1)
+
+def _utcnow():
+    # Naive UTC, as returned by PyMongo, so leases compare across hosts
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def queue_deletion(deletions, user_id):
+    """
+    Record that the links of a user are to be deleted.
+
+    Queuing the same user again has no effect.
+
+    :param deletions: The deletions collection.
+    :type deletions: pymongo.collection.Collection
+    :param bson.objectid.ObjectId user_id: The user whose links are deleted.
+    """
+    deletions.update_one(
+        {DELETION_USER_ID_IDENTIFIER: user_id},
+        {
+            "$setOnInsert": {
+                DELETION_REQUEST_DATE_IDENTIFIER: _utcnow(),
+                DELETION_LEASE_OWNER_IDENTIFIER: None,
+                DELETION_LEASE_EXPIRY_IDENTIFIER: _UNCLAIMED,
+                DELETION_LINKS_DELETED_IDENTIFIER: 0,
+            },
+        },
+        upsert=True,
+    )
+
+class DeletionWorker:
+    def __init__(
+            self,
+            database,
+            redirect_cache=None,
+            batch_size=1000,
+            batch_pause=0.05,
+            lease_time=60,
+            poll_interval=60,
+            synchronous=False,
+            invalidator=None,
+            tombstones=False,
+        ):
+        """
+        Background deletion of the links of deleted accounts.
+
+        Deleting an account removes the user at once and queues a job in the
+        deletions collection (see `UserAuthenticator.request_deletion`).
+        Jobs are run by a thread, woken by `notify` and otherwise checking
+        for jobs every `poll_interval` seconds. Links are removed
+        `batch_size` at a time, pausing `batch_pause` seconds between
+        batches so the database is not kept busy by one deletion.
+
+        A worker claims a job with a lease of `lease_time` seconds, renewed
+        after every batch, so that one job is only run by one worker at a
+        time across processes. The job stays queued until all its links are
+        gone, so a job interrupted by a crash is resumed by any worker once
+        its lease has expired. Deleted short IDs are invalidated in this
+        process's redirect cache, and through `invalidator` in those of the
+        other processes.
+
+        :param database: The database holding the urls and deletions
+            collections.
+        :type database: pymongo.database.Database
+        :param redirect_cache: Cache of short IDs to long URLs of this process
+            (default none).
+        :type redirect_cache: yocto.cache.RedirectCache
+        :param int batch_size: The most links deleted by one write.
+        :param float batch_pause: Seconds to wait between batches.
+        :param float lease_time: Seconds for which a claimed job is reserved
+            to this worker.
+        :param float poll_interval: Seconds between checks for jobs.
+        :param bool synchronous: If `True`, `notify` runs the queued jobs
+            before returning and no thread is started.
+        :param invalidator: Invalidator of the caches of every process
+            (default none).
+        :type invalidator: yocto.cache.CacheInvalidator
+        :param bool tombstones: Whether deletions leave tombstones for
+            redirect snapshots.
+        """
+        self._database = database
+        self._deletions = database.deletions
+        self._redirect_cache = redirect_cache
+        self._invalidator = invalidator
+        self._write_tombstones = tombstones
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.lease_time = lease_time
+        self.poll_interval = poll_interval
+        self.synchronous = synchronous
+        self._owner = None
+        self._loop = BackgroundLoop(
+            self.run_pending,
+            poll_interval,
+            "yocto-deletion-worker",
+            errors=PyMongoError,
+            message="Could not run account deletions: %s",
+            logger=logger,
+        )
+
+    @property
+    def owner(self):
+        """Identifier of this worker in job leases, unique to the process."""
+        if self._owner is None or self._owner[1] != os.getpid():
+            self._owner = (f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}", os.getpid())
+        return self._owner[0]
+
+    def claim(self):
+        """
+        Lease the oldest queued job which no worker holds.
+
+        :return: The job, or `None` if there is none to run.
+        :rtype: dict
+        """
+        now = _utcnow()
+        return self._deletions.find_one_and_update(
+            {DELETION_LEASE_EXPIRY_IDENTIFIER: {"$lt": now}},
+            {
+                "$set": {
+                    DELETION_LEASE_OWNER_IDENTIFIER: self.owner,
+                    DELETION_LEASE_EXPIRY_IDENTIFIER: now + timedelta(seconds=self.lease_time),
+                },
+            },
+            sort=[(DELETION_REQUEST_DATE_IDENTIFIER, ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def run_job(self, job):
+        """
+        Delete the links of a claimed job in batches, then remove the job.
+
+        Stops early if the lease is lost, e.g. because a batch took longer
+        than the lease, leaving the job to the worker now holding it.
+
+        :param dict job: The job, as returned by `claim`.
+
+        :return: The number of links deleted.
+        :rtype: int
+        """
+        user_id = job[DELETION_USER_ID_IDENTIFIER]
+        lease = {
+            DELETION_USER_ID_IDENTIFIER: user_id,
+            DELETION_LEASE_OWNER_IDENTIFIER: self.owner,
+        }
+        am = AddressManager(
+            self._database,
+            cache=self._redirect_cache,
+            invalidator=self._invalidator,
+            tombstones=self._write_tombstones,
+        )
+        total = 0
+        while True:
+            deleted = am.delete_creator_links(user_id, self.batch_size)
+            if deleted == 0:
+                self._deletions.delete_one(lease)
+                return total
+            total += deleted
+            result = self._deletions.update_one(
+                lease,
+                {
+                    "$set": {
+                        DELETION_LEASE_EXPIRY_IDENTIFIER: _utcnow() + timedelta(seconds=self.lease_time),
+                    },
+                    "$inc": {DELETION_LINKS_DELETED_IDENTIFIER: deleted},
+                },
+            )
+            if result.matched_count == 0:
+                logger.warning("Lost the lease on the deletion of user %s", user_id)
+                return total
+            if self.batch_pause > 0:
+                time.sleep(self.batch_pause)
+
+    def run_pending(self):
+        """
+        Run queued jobs until none is left unclaimed.
+
+        :raises pymongo.errors.PyMongoError: If the database cannot be used.
+
+        :return: The number of links deleted.
+        :rtype: int
+        """
+        total = 0
+        while not self._loop.stopped:
+            job = self.claim()
+            if job is None:
+                break
+            total += self.run_job(job)
+        return total
+
+    def notify(self):
+        """Start running queued jobs, e.g. after queuing a deletion."""
+        if self.synchronous:
+            self.run_pending()
+            return
+        self.ensure_started()
+        self._loop.wake()
+
+    def ensure_started(self):
+        """Start the background thread of this process, if not running."""
+        if not self.synchronous:
+            self._loop.ensure_started()
+
+    def close(self):
+        """Stop the background thread after the current batch."""
+        self._loop.stop()
+
+def get_deletion_worker():
+    """
+    Obtain the deletion worker of the current application.
+
+    :return: The deletion worker.
+    :rtype: DeletionWorker
+    """
+    return current_app.extensions[DELETION_WORKER_EXTENSION]
+
+@click.command("run-deletions")
+@with_appcontext
+def run_deletions_command():
+    """Delete the links of deleted accounts which are still queued."""
+    worker = DeletionWorker(
+        get_db(),
+        batch_size=current_app.config.get("DELETION_BATCH_SIZE", 1000),
+        batch_pause=current_app.config.get("DELETION_BATCH_PAUSE", 0.05),
+        lease_time=current_app.config.get("DELETION_LEASE_TIME", 60),
+        invalidator=get_cache_invalidator(),
+        tombstones=current_app.config.get("REDIRECT_SNAPSHOT_ENABLED", False),
+    )
+    click.echo(f"Deleted {worker.run_pending()} links.")
+
+def init_app(app):
+    """
+    Initialize the Flask app with a deletion worker.
+
+    The worker is configured by the `DELETION_*` options, and its thread is
+    started by the first request handled by each process, so that jobs left
+    by a crashed process are resumed. The `run-deletions` command runs the
+    queued jobs from the command line.
+    """
+    database = get_database(app.config)
+    worker = DeletionWorker(
+        database,
+        redirect_cache=app.extensions.get(REDIRECT_CACHE_EXTENSION),
+        batch_size=app.config.get("DELETION_BATCH_SIZE", 1000),
+        batch_pause=app.config.get("DELETION_BATCH_PAUSE", 0.05),
+        lease_time=app.config.get("DELETION_LEASE_TIME", 60),
+        poll_interval=app.config.get("DELETION_POLL_INTERVAL", 60),
+        synchronous=app.config.get("DELETION_SYNCHRONOUS", False),
+        invalidator=app.extensions.get(CACHE_INVALIDATOR_EXTENSION),
+        tombstones=app.config.get("REDIRECT_SNAPSHOT_ENABLED", False),
+    )
+    app.extensions[DELETION_WORKER_EXTENSION] = worker
+    app.before_request(worker.ensure_started)
+    app.cli.add_command(run_deletions_command)
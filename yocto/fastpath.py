@@ -0,0 +1,124 @@
+import re
+import time
+
+from werkzeug.urls import iri_to_uri
+
+from yocto.address import AddressManager
+from yocto.cache import CACHE_INVALIDATOR_EXTENSION, REDIRECT_CACHE_EXTENSION
+from yocto.db import get_database, with_read_preference
+from yocto.filters import SHORT_ID_FILTER_EXTENSION
+from yocto.metrics import METRICS_FILE_EXTENSION, REQUEST_DURATION, REQUESTS
+from yocto.snapshots import REDIRECT_SNAPSHOT_EXTENSION
+from yocto.visits import VISIT_COUNTER_EXTENSION
+from yocto.lib.exceptions import UrlNotFoundError
+
+NOT_FOUND_MESSAGE = "Sorry, this shortened address is not valid."
+
+# Paths answered by the fast path, with an optional trailing slash
+_SHORT_ID_PATH = re.compile(r"/([0-9A-Za-z_-]+)/?")
+
+class RedirectFastPath:
+    def __init__(self, app, wsgi_app):
+        """
+        WSGI middleware answering short link redirects before Flask.
+
+        `GET` and `HEAD` requests for `/<short_id>` or `/<short_id>/` are
+        resolved with `AddressManager.lookup_short_id`, using the app's
+        redirect cache, kept up to date by its cache invalidator, visit
+        counter, short ID filter and snapshot, and
+        answered with a bare 302. No request context is pushed, so the
+        session cookie is not decoded, the logged in user is not loaded and
+        no URLs are built, none of which affects a redirect. Other requests,
+        and paths whose first segment is that of a route of the app (e.g.
+        "/pages"), are passed to `wsgi_app`. Requests answered here are
+        included in the request metrics under the "short.index" endpoint,
+        and start the process's metrics file writer like other requests.
+
+        :param flask.Flask app: The application, for its configuration and
+            extensions.
+        :param wsgi_app: The WSGI application handling other requests,
+            usually `app.wsgi_app`.
+        """
+        self.app = app
+        self.wsgi_app = wsgi_app
+        self.max_age = app.config.get("REDIRECT_MAX_AGE", 0)
+        self._reserved = None
+        self._error_path = None
+
+    def _reserved_segments(self):
+        # First path segments of the app's routes which are not variables,
+        # read once the routes are all registered
+        if self._reserved is None:
+            self._reserved = frozenset(
+                segment
+                for rule in self.app.url_map.iter_rules()
+                if (segment := rule.rule.split("/")[1]) and "<" not in segment
+            )
+        return self._reserved
+
+    def _not_found_path(self):
+        # Path of the error page for an unknown short ID, relative to the
+        # script root, built once the routes are all registered
+        if self._error_path is None:
+            adapter = self.app.url_map.bind("", script_name="/")
+            self._error_path = adapter.build("pages.error", {"message": NOT_FOUND_MESSAGE})
+        return self._error_path
+
+    def __call__(self, environ, start_response):
+        if environ["REQUEST_METHOD"] not in ("GET", "HEAD"):
+            return self.wsgi_app(environ, start_response)
+        match = _SHORT_ID_PATH.fullmatch(environ.get("PATH_INFO", ""))
+        if match is None or match.group(1) in self._reserved_segments():
+            return self.wsgi_app(environ, start_response)
+        start = time.perf_counter()
+        extensions = self.app.extensions
+        config = self.app.config
+        invalidator = extensions.get(CACHE_INVALIDATOR_EXTENSION)
+        if invalidator is not None:
+            invalidator.ensure_started()
+        database = get_database(config)
+        am = AddressManager(
+            database,
+            cache=extensions.get(REDIRECT_CACHE_EXTENSION),
+            visit_counter=extensions.get(VISIT_COUNTER_EXTENSION),
+            short_id_filter=extensions.get(SHORT_ID_FILTER_EXTENSION),
+            snapshot=extensions.get(REDIRECT_SNAPSHOT_EXTENSION),
+            read_database=with_read_preference(database, config),
+        )
+        try:
+            location = am.lookup_short_id(match.group(1), count_visit=True)
+            cache_control = f"private, max-age={self.max_age}"
+        except UrlNotFoundError:
+            # The short ID may be created later, so this is not cached
+            location = f"{environ.get('SCRIPT_NAME', '')}{self._not_found_path()}"
+            cache_control = "no-store"
+        start_response(
+            "302 FOUND",
+            [
+                ("Location", iri_to_uri(location)),
+                ("Cache-Control", cache_control),
+                ("Content-Length", "0"),
+            ],
+        )
+        if config.get("METRICS_ENABLED", False):
+            metrics_file = extensions.get(METRICS_FILE_EXTENSION)
+            if metrics_file is not None:
+                metrics_file.ensure_started()
+            REQUEST_DURATION.observe(
+                time.perf_counter() - start,
+                endpoint="short.index",
+                method=environ["REQUEST_METHOD"],
+            )
+            REQUESTS.inc(endpoint="short.index", method=environ["REQUEST_METHOD"], status=302)
+        return [b""]
+
+def init_app(app):
+    """
+    Mount the redirect fast path ahead of the Flask app.
+
+    Should be called once every route is registered, and before any other
+    middleware which must see the requests first, such as `ProxyFix`, is
+    applied. Nothing is mounted unless `REDIRECT_FAST_PATH` is set.
+    """
+    if app.config.get("REDIRECT_FAST_PATH", False):
+        app.wsgi_app = RedirectFastPath(app, app.wsgi_app)
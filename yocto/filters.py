@@ -0,0 +1,256 @@
+from datetime import datetime, timedelta, timezone
+import logging
+import threading
+import time
+
+from bson.objectid import ObjectId
+from flask import current_app
+from pymongo.errors import PyMongoError
+
+from yocto.db import get_database
+from yocto.lib.background import BackgroundLoop
+from yocto.lib.bloom import BloomFilter
+from yocto.lib.utils import (
+    URL_ID_IDENTIFIER,
+    SHORT_ID_IDENTIFIER,
+)
+
+SHORT_ID_FILTER_EXTENSION = "yocto.short_id_filter"
+
+logger = logging.getLogger(__name__)
+
+class ShortIdFilter:
+    def __init__(
+            self,
+            collection,
+            capacity=1000000,
+            error_rate=0.01,
+            refresh_interval=1.0,
+            rebuild_interval=3600,
+            refresh_overlap=5.0,
+            synchronous=False,
+            timer=time.monotonic,
+        ):
+        """
+        Bloom filter of the short IDs in the database, so that lookups of
+        short IDs which do not exist can be answered without a query.
+
+        The filter is built from a scan of the short IDs, by a background
+        thread started on first use in each process. Until it is built,
+        every short ID is reported as possibly existing. Links created
+        through this process are added at once. Links created by other
+        processes are added by a refresh every `refresh_interval` seconds,
+        reading the links with an ObjectId from `refresh_overlap` seconds
+        before the previous refresh, to allow for clocks differing between
+        hosts and inserts completing out of order. A link created by another
+        process can therefore be reported missing for about
+        `refresh_interval` seconds. If refreshes stop, e.g. because the
+        database cannot be reached, the filter is no longer trusted.
+
+        Deleted short IDs cannot be removed from a Bloom filter, so they are
+        only dropped when the filter is rebuilt, every `rebuild_interval`
+        seconds or sooner if a tenth of the IDs added have been deleted or
+        the filter is over capacity. Until then they are false positives,
+        which only cost the query the filter would otherwise save.
+
+        :param collection: The urls collection.
+        :type collection: pymongo.collection.Collection
+        :param int capacity: The least number of short IDs the filter is
+            sized for. Rebuilt filters are sized for twice the number of
+            links, if larger.
+        :param float error_rate: The false positive rate at capacity.
+        :param float refresh_interval: Seconds between reads of links created
+            elsewhere.
+        :param float rebuild_interval: Seconds between full rebuilds.
+        :param float refresh_overlap: Seconds by which each refresh reads
+            back before the previous one.
+        :param bool synchronous: If `True`, no thread is started, and the
+            filter is built or refreshed by the lookup which finds it
+            missing or stale.
+        :param timer: Function returning the current time in seconds.
+        """
+        self._collection = collection
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.refresh_interval = refresh_interval
+        self.rebuild_interval = rebuild_interval
+        self.refresh_overlap = refresh_overlap
+        self.synchronous = synchronous
+        self._timer = timer
+        # A lookup trusts the filter only if it was refreshed this recently
+        self.max_staleness = 5 * refresh_interval
+        self._filter = None
+        self._built_at = None
+        self._refreshed_at = None
+        self._since = None  # wall-clock time from which to refresh
+        self._deleted = 0
+        self._lock = threading.Lock()
+        self._loop = BackgroundLoop(
+            self._maintain,
+            refresh_interval,
+            "yocto-short-id-filter",
+            errors=PyMongoError,
+            message="Could not update the short ID filter: %s",
+            logger=logger,
+            after_fork=self._reset_after_fork,
+        )
+
+    @property
+    def ready(self):
+        """Whether lookups are answered by the filter."""
+        return (
+            self._filter is not None
+            and self._timer() - self._refreshed_at <= self.max_staleness
+        )
+
+    def might_exist(self, short_id):
+        """
+        Test whether a short ID may be in the database.
+
+        :param str short_id: The short ID.
+
+        :return: `False` if the short ID is certainly not in the database,
+            otherwise `True`.
+        :rtype: bool
+        """
+        if self.synchronous:
+            self._maintain()
+        else:
+            self._loop.ensure_started()
+        if not self.ready:
+            return True
+        return short_id in self._filter
+
+    def add(self, short_id):
+        """
+        Add a short ID stored by this process.
+
+        :param str short_id: The new short ID.
+        """
+        current = self._filter
+        if current is not None:
+            current.add(short_id)
+
+    def discard(self, short_ids):
+        """
+        Note short IDs deleted by this process, which stay in the filter
+        until it is rebuilt.
+
+        :param short_ids: The deleted short IDs.
+        :type short_ids: list[str]
+        """
+        with self._lock:
+            self._deleted += len(short_ids)
+            current = self._filter
+            if current is not None and self._deleted * 10 > len(current):
+                self._built_at = None  # rebuild soon
+                self._loop.wake()
+
+    def build(self):
+        """
+        Replace the filter by one built from a scan of the short IDs.
+
+        :raises pymongo.errors.PyMongoError: If the scan fails.
+        """
+        since = datetime.now(timezone.utc)
+        links = self._collection.estimated_document_count()
+        new_filter = BloomFilter(max(self.capacity, 2 * links), self.error_rate)
+        cursor = self._collection.find(
+            {},
+            projection={SHORT_ID_IDENTIFIER: True, URL_ID_IDENTIFIER: False},
+            batch_size=10000,
+        )
+        for link in cursor:
+            new_filter.add(link[SHORT_ID_IDENTIFIER])
+        with self._lock:
+            self._filter = new_filter
+            self._deleted = 0
+            self._since = since
+            self._built_at = self._refreshed_at = self._timer()
+        # Links stored by this process during the scan are read back
+        self.refresh()
+
+    def refresh(self):
+        """
+        Add the short IDs created since the previous build or refresh.
+
+        :raises pymongo.errors.PyMongoError: If the query fails.
+        """
+        current = self._filter
+        if current is None:
+            return
+        since = datetime.now(timezone.utc)
+        start = ObjectId.from_datetime(self._since - timedelta(seconds=self.refresh_overlap))
+        cursor = self._collection.find(
+            {URL_ID_IDENTIFIER: {"$gte": start}},
+            projection={SHORT_ID_IDENTIFIER: True, URL_ID_IDENTIFIER: False},
+        )
+        for link in cursor:
+            # Links read by an earlier refresh are not counted again
+            if link[SHORT_ID_IDENTIFIER] not in current:
+                current.add(link[SHORT_ID_IDENTIFIER])
+        with self._lock:
+            if self._filter is current:
+                self._since = since
+                self._refreshed_at = self._timer()
+                if len(current) > current.capacity:
+                    self._built_at = None  # rebuild soon
+
+    def _maintain(self):
+        now = self._timer()
+        if self._built_at is None or now - self._built_at >= self.rebuild_interval:
+            self.build()
+        elif now - self._refreshed_at >= self.refresh_interval:
+            self.refresh()
+
+    def close(self):
+        """Stop the background thread."""
+        self._loop.stop()
+
+    def _reset_after_fork(self):
+        # The filter itself is still valid, and refreshed by the child's
+        # own thread
+        self._lock = threading.Lock()
+
+def get_short_id_filter():
+    """
+    Obtain the short ID filter of the current application.
+
+    :return: The filter, or `None` if disabled.
+    :rtype: ShortIdFilter
+    """
+    return current_app.extensions.get(SHORT_ID_FILTER_EXTENSION)
+
+def create_short_id_filter(config):
+    """
+    Build a short ID filter as configured.
+
+    The filter is configured by the `SHORT_ID_FILTER_CAPACITY`,
+    `SHORT_ID_FILTER_ERROR_RATE`, `SHORT_ID_FILTER_REFRESH_INTERVAL` and
+    `SHORT_ID_FILTER_REBUILD_INTERVAL` options. If
+    `SHORT_ID_FILTER_ENABLED` is not set, no filter is built.
+
+    :param config: The application configuration.
+    :type config: flask.Config
+
+    :return: The filter, or `None` if disabled.
+    :rtype: ShortIdFilter
+    """
+    if not config.get("SHORT_ID_FILTER_ENABLED", False):
+        return None
+    database = get_database(config)
+    return ShortIdFilter(
+        database.urls,
+        capacity=config.get("SHORT_ID_FILTER_CAPACITY", 1000000),
+        error_rate=config.get("SHORT_ID_FILTER_ERROR_RATE", 0.01),
+        refresh_interval=config.get("SHORT_ID_FILTER_REFRESH_INTERVAL", 1.0),
+        rebuild_interval=config.get("SHORT_ID_FILTER_REBUILD_INTERVAL", 3600),
+    )
+
+def init_app(app):
+    """
+    Initialize the Flask app with a short ID filter.
+
+    The filter is configured as described in `create_short_id_filter`.
+    """
+    app.extensions[SHORT_ID_FILTER_EXTENSION] = create_short_id_filter(app.config)
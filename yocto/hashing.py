@@ -0,0 +1,231 @@
+import atexit
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+import multiprocessing
+import os
+import secrets
+import threading
+import time
+
+from flask import current_app
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError
+
+from yocto.lib.exceptions import HashingBusyError
+from yocto.metrics import PASSWORD_HASHING_DURATION, PASSWORD_HASHING_REJECTED
+
+PASSWORD_HASHER_EXTENSION = "yocto.password_hasher"
+# Values of `UNKNOWN_USER_HASH_POLICY`
+UNKNOWN_USER_HASH_POLICIES = ("cheap", "full", "none")
+
+def _hash(hasher, password):
+    return hasher.hash(password)
+
+def _verify(hasher, password_hash, password):
+    return hasher.verify(password_hash, password)
+
+class PasswordHashingPool:
+    def __init__(self, hasher=None, processes=None, max_pending=None, timeout=None, dummy_hash=None):
+        """
+        Argon2 hashing and verification run in a pool of worker processes.
+
+        Hashing is CPU- and memory-intensive, so it is taken off the request
+        thread and bounded by the pool size. At most `max_pending` operations
+        may be running or queued at once; beyond that, `HashingBusyError` is
+        raised immediately so that the caller can ask the client to try
+        again instead of queueing behind a burst of logins. The pool is
+        started on first use, and again in a forked child process.
+
+        :param hasher: The hasher holding the Argon2 parameters (default
+            `argon2.PasswordHasher()`).
+        :type hasher: argon2.PasswordHasher
+        :param int processes: The number of worker processes (default the
+            number of CPUs). With 0, operations run on the calling thread
+            and are not limited.
+        :param int max_pending: The most operations running or queued at
+            once (default twice the number of processes).
+        :param float timeout: Seconds to wait for an operation before
+            raising `HashingBusyError` (default no limit). The operation
+            still counts towards `max_pending` until it finishes.
+        :param str dummy_hash: The hash checked by `verify_dummy` (default
+            none, so that it does nothing).
+        """
+        self.hasher = PasswordHasher() if hasher is None else hasher
+        self.processes = (os.cpu_count() or 1) if processes is None else processes
+        self.max_pending = 2 * self.processes if max_pending is None else max_pending
+        self.timeout = timeout
+        self.dummy_hash = dummy_hash
+        self._slots = threading.BoundedSemaphore(max(self.max_pending, 1))
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+
+    def hash(self, password):
+        """
+        Hash a password.
+
+        :param str password: The password to hash.
+
+        :raises HashingBusyError: If too many operations are pending or the
+            operation timed out.
+
+        :return: The encoded Argon2 hash.
+        :rtype: str
+        """
+        return self._run("hash", _hash, password)
+
+    def verify(self, password_hash, password):
+        """
+        Verify a password against a hash.
+
+        :param str password_hash: The encoded Argon2 hash.
+        :param str password: The password to check.
+
+        :raises argon2.exceptions.VerifyMismatchError: If the password does
+            not match.
+        :raises HashingBusyError: If too many operations are pending or the
+            operation timed out.
+
+        :return: `True` if the password matches, otherwise raises.
+        :rtype: bool
+        """
+        return self._run("verify", _verify, password_hash, password)
+
+    def verify_dummy(self, password):
+        """
+        Verify a password against `dummy_hash`, in place of the hash of a
+        user who does not exist, so that a login with an unknown username
+        costs some hashing and is limited by the pool in the same way as one
+        with a wrong password. It only takes as long if `dummy_hash` was
+        made with the parameters of `hasher` (the "full" policy of
+        `init_app`); a cheaper dummy hash (the "cheap" policy) bounds the
+        cost of unknown usernames but answers them measurably sooner.
+
+        :param str password: The password given.
+
+        :raises HashingBusyError: If too many operations are pending or the
+            operation timed out.
+        """
+        if self.dummy_hash is None:
+            return
+        try:
+            self._run("verify", _verify, self.dummy_hash, password)
+        except VerifyMismatchError:
+            pass
+
+    def check_needs_rehash(self, password_hash):
+        """
+        Check whether a hash was made with parameters other than the
+        configured ones.
+
+        :param str password_hash: The encoded Argon2 hash.
+
+        :return: `True` if the password should be hashed again.
+        :rtype: bool
+        """
+        return self.hasher.check_needs_rehash(password_hash)
+
+    def _run(self, operation, function, *args):
+        start = time.perf_counter()
+        try:
+            return self._submit(function, *args)
+        except HashingBusyError:
+            PASSWORD_HASHING_REJECTED.inc(operation=operation)
+            raise
+        finally:
+            PASSWORD_HASHING_DURATION.observe(
+                time.perf_counter() - start, operation=operation
+            )
+
+    def _submit(self, function, *args):
+        if self.processes == 0:
+            return function(self.hasher, *args)
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusyError
+        try:
+            future = self._get_executor().submit(function, self.hasher, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        # A running operation cannot be cancelled, so the slot is held until
+        # it finishes rather than until it is no longer waited for
+        future.add_done_callback(lambda future: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise HashingBusyError
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor_pid != os.getpid():
+                # Worker processes are spawned rather than forked, so they
+                # inherit no locks or sockets from the application
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def close(self):
+        """Shut down the worker processes, if started by this process."""
+        with self._lock:
+            if self._executor is not None and self._executor_pid == os.getpid():
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            self._executor_pid = None
+
+def get_password_hasher():
+    """
+    Obtain the password hashing pool of the current application.
+
+    :return: The hashing pool.
+    :rtype: PasswordHashingPool
+    """
+    return current_app.extensions[PASSWORD_HASHER_EXTENSION]
+
+def init_app(app):
+    """
+    Initialize the Flask app with a password hashing pool.
+
+    The Argon2 parameters are read from the `ARGON2_TIME_COST`,
+    `ARGON2_MEMORY_COST` and `ARGON2_PARALLELISM` options, and the pool is
+    sized by `PASSWORD_HASHING_PROCESSES`, `PASSWORD_HASHING_MAX_PENDING` and
+    `PASSWORD_HASHING_TIMEOUT`. The dummy hash verified for logins with
+    unknown usernames is made once, of a random password, as set by
+    `UNKNOWN_USER_HASH_POLICY`: with the `ARGON2_DUMMY_*` parameters for
+    "cheap", with the configured parameters for "full", or not at all for
+    "none".
+
+    :raises ValueError: If `UNKNOWN_USER_HASH_POLICY` is not one of
+        `UNKNOWN_USER_HASH_POLICIES`.
+    """
+    hasher = PasswordHasher(
+        time_cost=app.config.get("ARGON2_TIME_COST", 3),
+        memory_cost=app.config.get("ARGON2_MEMORY_COST", 65536),
+        parallelism=app.config.get("ARGON2_PARALLELISM", 4),
+    )
+    policy = app.config.get("UNKNOWN_USER_HASH_POLICY", "cheap")
+    if policy not in UNKNOWN_USER_HASH_POLICIES:
+        raise ValueError(
+            f"Unknown UNKNOWN_USER_HASH_POLICY {policy!r}, "
+            f"expected one of {UNKNOWN_USER_HASH_POLICIES}"
+        )
+    dummy_hash = None
+    if policy == "full":
+        dummy_hash = hasher.hash(secrets.token_urlsafe())
+    elif policy == "cheap":
+        dummy_hash = PasswordHasher(
+            time_cost=app.config.get("ARGON2_DUMMY_TIME_COST", 1),
+            memory_cost=app.config.get("ARGON2_DUMMY_MEMORY_COST", 8192),
+            parallelism=app.config.get("ARGON2_DUMMY_PARALLELISM", 1),
+        ).hash(secrets.token_urlsafe())
+    pool = PasswordHashingPool(
+        hasher,
+        processes=app.config.get("PASSWORD_HASHING_PROCESSES"),
+        max_pending=app.config.get("PASSWORD_HASHING_MAX_PENDING"),
+        timeout=app.config.get("PASSWORD_HASHING_TIMEOUT"),
+        dummy_hash=dummy_hash,
+    )
+    app.extensions[PASSWORD_HASHER_EXTENSION] = pool
+    atexit.register(pool.close)
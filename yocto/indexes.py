@@ -0,0 +1,156 @@
+from pymongo import ASCENDING, IndexModel
+
+from yocto.lib.utils import (
+    LONG_URL_HASH_IDENTIFIER,
+    SHORT_ID_IDENTIFIER,
+    CREATOR_ID_IDENTIFIER,
+    URL_ID_IDENTIFIER,
+    USERNAME_IDENTIFIER,
+    TOKEN_HASH_IDENTIFIER,
+    TOKEN_USER_ID_IDENTIFIER,
+    TOKEN_NAME_IDENTIFIER,
+    VISIT_SHORT_ID_IDENTIFIER,
+    VISIT_GRANULARITY_IDENTIFIER,
+    VISIT_START_IDENTIFIER,
+    VISIT_EXPIRY_IDENTIFIER,
+    TOMBSTONE_DELETION_DATE_IDENTIFIER,
+    INVALIDATION_DATE_IDENTIFIER,
+)
+
+# Seconds for which deleted short IDs are remembered, so that redirect
+# snapshots older than this are not used
+TOMBSTONE_RETENTION = 7 * 86400
+
+# Seconds for which cache invalidations are kept for the other workers, so
+# that a worker which has not read them for longer clears its caches
+INVALIDATION_RETENTION = 3600
+
+# Indexes required by the queries in AddressManager and UserAuthenticator,
+# by collection. Each index is named so that its presence can be checked
+# without comparing key specifications.
+INDEXES = {
+    "urls": [
+        # Redirect lookups and the uniqueness of generated IDs
+        IndexModel(
+            [(SHORT_ID_IDENTIFIER, ASCENDING)],
+            name="short_id_unique",
+            unique=True,
+        ),
+        # Duplicate check when storing a long URL, by the hash of its
+        # canonical form. Links stored before hashes were added have none
+        # until `flask hash-long-urls` is run, and are left out.
+        IndexModel(
+            [(LONG_URL_HASH_IDENTIFIER, ASCENDING)],
+            name="long_url_hash_unique",
+            unique=True,
+            sparse=True,
+        ),
+        # Listing a creator's links in insertion order, a page at a time
+        IndexModel(
+            [(CREATOR_ID_IDENTIFIER, ASCENDING), (URL_ID_IDENTIFIER, ASCENDING)],
+            name="creator_id",
+        ),
+    ],
+    "users": [
+        # Login and registration
+        IndexModel(
+            [(USERNAME_IDENTIFIER, ASCENDING)],
+            name="username_unique",
+            unique=True,
+        ),
+    ],
+    "tokens": [
+        # API token authentication
+        IndexModel(
+            [(TOKEN_HASH_IDENTIFIER, ASCENDING)],
+            name="token_hash_unique",
+            unique=True,
+        ),
+        # Token names are unique per user, and a user's tokens are found
+        # when revoking them or deleting the user
+        IndexModel(
+            [(TOKEN_USER_ID_IDENTIFIER, ASCENDING), (TOKEN_NAME_IDENTIFIER, ASCENDING)],
+            name="user_id_name_unique",
+            unique=True,
+        ),
+    ],
+    "visits": [
+        # Bucket upserts and range queries over a link's visit history
+        IndexModel(
+            [
+                (VISIT_SHORT_ID_IDENTIFIER, ASCENDING),
+                (VISIT_GRANULARITY_IDENTIFIER, ASCENDING),
+                (VISIT_START_IDENTIFIER, ASCENDING),
+            ],
+            name="short_id_granularity_start_unique",
+            unique=True,
+        ),
+        # Removal of buckets past their retention
+        IndexModel(
+            [(VISIT_EXPIRY_IDENTIFIER, ASCENDING)],
+            name="expires_ttl",
+            expireAfterSeconds=0,
+        ),
+    ],
+    "tombstones": [
+        # Deletions since a redirect snapshot, and their expiry
+        IndexModel(
+            [(TOMBSTONE_DELETION_DATE_IDENTIFIER, ASCENDING)],
+            name="deletion_date_ttl",
+            expireAfterSeconds=TOMBSTONE_RETENTION,
+        ),
+    ],
+    "invalidations": [
+        # Invalidations since a worker last read them, and their expiry
+        IndexModel(
+            [(INVALIDATION_DATE_IDENTIFIER, ASCENDING)],
+            name="date_ttl",
+            expireAfterSeconds=INVALIDATION_RETENTION,
+        ),
+    ],
+}
+
+# Indexes no longer used, by collection, which are dropped if present
+OBSOLETE_INDEXES = {
+    # Replaced by long_url_hash_unique
+    "urls": ["long_url_unique"],
+}
+
+def ensure_indexes(database):
+    """
+    Create any declared indexes which are missing from the database, and
+    drop obsolete ones.
+
+    Indexes are matched by name, so calling this function again on the same
+    database has no effect. Collections are created if they do not exist.
+
+    :param database: The database containing the users and urls collections.
+    :type database: pymongo.database.Database
+
+    :raises pymongo.errors.OperationFailure: If an index cannot be built,
+        e.g. because existing documents violate a unique constraint.
+
+    :return: The names of indexes built, of indexes already in place and of
+        indexes dropped, in the form "<collection>.<index>", under the keys
+        "created", "existing" and "dropped".
+    :rtype: dict[str, list[str]]
+    """
+    report = {"created": [], "existing": [], "dropped": []}
+    for collection_name, models in INDEXES.items():
+        collection = database.get_collection(collection_name)
+        present = collection.index_information()
+        missing = []
+        for model in models:
+            name = model.document["name"]
+            if name in present:
+                report["existing"].append(f"{collection_name}.{name}")
+            else:
+                missing.append(model)
+        if missing:
+            for name in collection.create_indexes(missing):
+                report["created"].append(f"{collection_name}.{name}")
+        for name in OBSOLETE_INDEXES.get(collection_name, []):
+            if name in present:
+                collection.drop_index(name)
+                report["dropped"].append(f"{collection_name}.{name}")
+    return report
@@ -0,0 +1,114 @@
+import logging
+import os
+import threading
+import weakref
+
+logger = logging.getLogger(__name__)
+
+# Loops in this process, so that a forked child starts its own threads
+_loops = weakref.WeakSet()
+
+class BackgroundLoop:
+    def __init__(
+            self,
+            function,
+            interval,
+            name,
+            errors=Exception,
+            message="Background task failed: %s",
+            logger=logger,
+            wait_first=False,
+            after_fork=None,
+        ):
+        """
+        Daemon thread calling `function` every `interval` seconds, or sooner
+        when woken.
+
+        The thread is started by `ensure_started`, e.g. on first use, once in
+        each process: threads do not survive a fork, so a child process
+        starts its own, and `after_fork` is called in the child so that the
+        owner can reset its own locks and state. Errors of the types in
+        `errors` raised by `function` are logged and the loop carries on.
+
+        :param function: The function called, without arguments.
+        :param float interval: Seconds between calls.
+        :param str name: The name of the thread.
+        :param errors: The exception types logged rather than ending the
+            loop.
+        :type errors: type | tuple[type]
+        :param str message: The warning logged for an error, formatted with
+            the error.
+        :param logging.Logger logger: The logger of the warnings.
+        :param bool wait_first: If `True`, the thread waits for `interval`
+            seconds, or to be woken, before each call rather than after.
+        :param after_fork: Function called without arguments in a forked
+            child (default none).
+        """
+        self.function = function
+        self.interval = interval
+        self.name = name
+        self.errors = errors
+        self.message = message
+        self.logger = logger
+        self.wait_first = wait_first
+        self.after_fork = after_fork
+        self.stopped = False
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._thread_pid = None
+        _loops.add(self)
+
+    @property
+    def thread(self):
+        """The thread of this process, or `None` if not started."""
+        return self._thread if self._thread_pid == os.getpid() else None
+
+    def ensure_started(self):
+        """Start the thread of this process, if not running or stopped."""
+        if self._thread_pid == os.getpid() or self.stopped:
+            return
+        with self._lock:
+            if self._thread_pid == os.getpid():
+                return
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread_pid = os.getpid()
+            self._thread.start()
+
+    def wake(self):
+        """Make the thread call the function now rather than when due."""
+        self._wakeup.set()
+
+    def stop(self):
+        """Stop the thread after its current call."""
+        self.stopped = True
+        self._wakeup.set()
+
+    def _wait(self):
+        self._wakeup.wait(self.interval)
+        self._wakeup.clear()
+
+    def _run(self):
+        while not self.stopped:
+            if self.wait_first:
+                self._wait()
+            try:
+                self.function()
+            except self.errors as e:
+                self.logger.warning(self.message, e)
+            if not self.wait_first:
+                self._wait()
+
+    def _reset_after_fork(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._thread_pid = None
+        if self.after_fork is not None:
+            self.after_fork()
+
+def _reset_loops_after_fork():
+    for loop in _loops:
+        loop._reset_after_fork()
+
+os.register_at_fork(after_in_child=_reset_loops_after_fork)
@@ -0,0 +1,72 @@
+import hashlib
+import math
+import threading
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.01):
+        """
+        Compact set of strings answering membership with no false negatives.
+
+        A string which was added is always reported present. A string which
+        was not added is reported present with a probability of about
+        `error_rate` while no more than `capacity` strings have been added,
+        rising as more are added. Strings cannot be removed.
+
+        Adding is thread-safe, and lookups need no lock.
+
+        :param int capacity: The number of strings the filter is sized for.
+        :param float error_rate: The false positive rate at capacity.
+        """
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        if not 0 < error_rate < 1:
+            raise ValueError("error_rate must be between 0 and 1")
+        self.capacity = capacity
+        self.error_rate = error_rate
+        # Optimal number of bits and of hash functions for the capacity and
+        # error rate
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def _positions(self, item):
+        # Double hashing: the positions are h1 + i * h2 for i < hashes
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        """
+        Add a string to the filter.
+
+        :param str item: The string to add.
+        """
+        positions = self._positions(item)
+        with self._lock:
+            for position in positions:
+                self._bits[position >> 3] |= 1 << (position & 7)
+            self._count += 1
+
+    def update(self, items):
+        """
+        Add several strings to the filter.
+
+        :param items: The strings to add.
+        :type items: collections.abc.Iterable[str]
+        """
+        for item in items:
+            self.add(item)
+
+    def __contains__(self, item):
+        bits = self._bits
+        return all(
+            bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
+    def __len__(self):
+        """The number of strings added, counting repeats."""
+        return self._count
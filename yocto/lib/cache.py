@@ -0,0 +1,118 @@
+from collections import OrderedDict
+import threading
+import time
+
+class LRUCache:
+    def __init__(self, maxsize, ttl=None, timer=time.monotonic):
+        """
+        Bounded, thread-safe mapping with least-recently-used eviction.
+
+        Entries expire `ttl` seconds after they are set. When the cache is
+        full, setting a new key evicts the entry which was least recently
+        read or written. Counters of hits, misses, evictions and expirations
+        are kept for monitoring.
+
+        :param int maxsize: The maximum number of entries held.
+        :param float ttl: The default lifetime of an entry in seconds, or
+            `None` for entries which only leave the cache by eviction.
+        :param timer: Function returning the current time in seconds.
+        """
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._timer = timer
+        self._entries = OrderedDict()  # key -> (expiry time, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        """
+        Retrieve the value stored for `key`.
+
+        :param key: The key to look up.
+        :param default: The value returned if `key` is absent or expired.
+
+        :return: The cached value, or `default`.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expiry, value = entry
+            if expiry is not None and expiry <= self._timer():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Store `value` for `key`, evicting the least recently used entry if
+        the cache is full.
+
+        :param key: The key to store.
+        :param value: The value to store.
+        :param float ttl: The lifetime of this entry in seconds (default
+            the lifetime given when creating the cache).
+        """
+        if ttl is None:
+            ttl = self.ttl
+        expiry = None if ttl is None else self._timer() + ttl
+        with self._lock:
+            self._entries[key] = (expiry, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """
+        Remove `key` from the cache, if present.
+
+        :param key: The key to remove.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate_many(self, keys):
+        """
+        Remove each of `keys` from the cache, if present.
+
+        :param keys: Iterable of the keys to remove.
+        """
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove all entries. Counters are not reset."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Report the size of the cache and its counters.
+
+        :return: The current number of entries and the counts of hits,
+            misses, evictions and expirations.
+        :rtype: dict[str, int]
+        """
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+    def __len__(self):
+        return len(self._entries)
@@ -28,3 +28,19 @@ class UrlNotFoundError(Exception):
 
 class UrlExistsError(Exception):
     pass
+
+
+class ShortIdAllocationError(Exception):
+    pass
+
+
+class HashingBusyError(Exception):
+    pass
+
+
+class TokenInvalidError(Exception):
+    pass
+
+
+class TokenExistsError(Exception):
+    pass
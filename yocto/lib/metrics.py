@@ -0,0 +1,295 @@
+import math
+import threading
+
+# Default histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class _Metric:
+    type = None
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # tuple of label values -> value
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"Metric {self.name} takes labels {self.labelnames}, not {tuple(labels)}"
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def snapshot(self):
+        """
+        Copy the current values of the metric.
+
+        :return: The metric description and its samples, as JSON-compatible
+            data.
+        :rtype: dict
+        """
+        with self._lock:
+            samples = [[list(key), self._copy(value)] for key, value in self._values.items()]
+        return {
+            "type": self.type,
+            "help": self.documentation,
+            "labelnames": list(self.labelnames),
+            "samples": samples,
+        }
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+    def reset(self):
+        """Discard all values."""
+        with self._lock:
+            self._values = {}
+
+    def _reset_after_fork(self):
+        # The lock may have been held by another thread of the parent
+        self._lock = threading.Lock()
+        self._values = {}
+
+class Counter(_Metric):
+    """Count of events, which only increases."""
+
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        """
+        Add to the count.
+
+        :param float amount: The amount added (default 1).
+        :param labels: The value of each label of the metric.
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_total(self, value, **labels):
+        """
+        Replace the count by a total kept elsewhere, e.g. by a cache.
+
+        :param float value: The total.
+        :param labels: The value of each label of the metric.
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+class Gauge(_Metric):
+    """Value which can go up and down. Values of several processes are summed."""
+
+    type = "gauge"
+
+    def set(self, value, **labels):
+        """
+        Set the value.
+
+        :param float value: The new value.
+        :param labels: The value of each label of the metric.
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+class Histogram(_Metric):
+    """Distribution of observed values, counted in buckets."""
+
+    type = "histogram"
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(registry, name, documentation, labelnames)
+
+    def observe(self, value, **labels):
+        """
+        Record an observation.
+
+        :param float value: The observed value, e.g. a duration in seconds.
+        :param labels: The value of each label of the metric.
+        """
+        key = self._key(labels)
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Counts per bucket, with the last for values above every bound
+                state = self._values[key] = {
+                    "counts": [0] * (len(self.buckets) + 1),
+                    "sum": 0.0,
+                }
+            state["counts"][index] += 1
+            state["sum"] += value
+
+    @staticmethod
+    def _copy(value):
+        return {"counts": list(value["counts"]), "sum": value["sum"]}
+
+    def snapshot(self):
+        result = super().snapshot()
+        result["buckets"] = list(self.buckets)
+        return result
+
+class Registry:
+    def __init__(self):
+        """
+        Collection of the metrics of a process.
+
+        Metrics register themselves when created. Collectors are functions
+        run before each snapshot, to update metrics from values kept
+        elsewhere.
+        """
+        self._metrics = {}
+        self._collectors = {}  # name -> function
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        Add a metric.
+
+        :param metric: The metric.
+
+        :raises ValueError: If a metric of the same name is registered.
+        """
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} already registered")
+            self._metrics[metric.name] = metric
+
+    def set_collector(self, name, collector):
+        """
+        Set a function to run before each snapshot, replacing any of the
+        same name.
+
+        :param str name: The name of the collector.
+        :param collector: Function taking no arguments.
+        """
+        with self._lock:
+            self._collectors[name] = collector
+
+    def remove_collector(self, name):
+        """
+        Remove a function set by `set_collector`, if present.
+
+        :param str name: The name of the collector.
+        """
+        with self._lock:
+            self._collectors.pop(name, None)
+
+    def snapshot(self):
+        """
+        Copy the current values of every metric.
+
+        :return: Each metric by name (see `_Metric.snapshot`).
+        :rtype: dict[str, dict]
+        """
+        with self._lock:
+            collectors = list(self._collectors.values())
+            metrics = list(self._metrics.values())
+        for collector in collectors:
+            collector()
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+    def reset(self):
+        """Discard the values of every metric."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            metric.reset()
+
+    def reset_after_fork(self):
+        """
+        Discard the values of every metric in a forked child process, whose
+        values belong to the parent.
+
+        Must only be called while no other thread is running, e.g. from an
+        `os.register_at_fork` hook.
+        """
+        self._lock = threading.Lock()
+        for metric in self._metrics.values():
+            metric._reset_after_fork()
+
+def merge(snapshots):
+    """
+    Combine the snapshots of several processes.
+
+    Counters, gauges, and histogram buckets, sums and counts are added up
+    sample by sample.
+
+    :param snapshots: The registry snapshots.
+    :type snapshots: collections.abc.Iterable[dict]
+
+    :return: The combined snapshot.
+    :rtype: dict[str, dict]
+    """
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            target = merged.setdefault(name, {**metric, "samples": {}})
+            for labels, value in metric["samples"]:
+                key = tuple(labels)
+                if metric["type"] == "histogram":
+                    current = target["samples"].get(key)
+                    if current is None:
+                        target["samples"][key] = {"counts": list(value["counts"]), "sum": value["sum"]}
+                    else:
+                        current["counts"] = [a + b for a, b in zip(current["counts"], value["counts"])]
+                        current["sum"] += value["sum"]
+                else:
+                    target["samples"][key] = target["samples"].get(key, 0) + value
+    for metric in merged.values():
+        metric["samples"] = [[list(key), value] for key, value in metric["samples"].items()]
+    return merged
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+def render(snapshot):
+    """
+    Format a snapshot in the Prometheus text exposition format.
+
+    :param dict snapshot: The snapshot (see `Registry.snapshot` and `merge`).
+
+    :return: The exposition text.
+    :rtype: str
+    """
+    lines = []
+    for name in sorted(snapshot):
+        metric = snapshot[name]
+        lines.append(f"# HELP {name} {_escape(metric['help'])}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        names = metric["labelnames"]
+        for labels, value in sorted(metric["samples"], key=lambda sample: sample[0]):
+            if metric["type"] == "histogram":
+                cumulative = 0
+                bounds = [*metric["buckets"], math.inf]
+                for bound, count in zip(bounds, value["counts"]):
+                    cumulative += count
+                    le = (("le", _format_value(float(bound))),)
+                    lines.append(f"{name}_bucket{_format_labels(names, labels, le)} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(names, labels)} {_format_value(value['sum'])}")
+                lines.append(f"{name}_count{_format_labels(names, labels)} {cumulative}")
+            else:
+                lines.append(f"{name}{_format_labels(names, labels)} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
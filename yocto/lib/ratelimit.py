@@ -0,0 +1,89 @@
+from collections import OrderedDict
+import threading
+import time
+
+class SlidingWindowLimiter:
+    def __init__(self, limit, window, maxsize=100000, timer=time.monotonic):
+        """
+        Thread-safe limit on the number of events per key in a sliding time
+        window.
+
+        Each key keeps the counts of the current and previous fixed windows
+        only, and the number of events in the sliding window ending now is
+        estimated by weighting the previous count by the part of it still
+        covered. This takes three numbers per key, whatever the limit. Keys
+        are held in least-recently-used order, and the oldest is dropped
+        when `maxsize` keys are held, which can only forget the events of a
+        key not seen for the longest time.
+
+        :param int limit: The most events allowed per key in a window.
+        :param float window: The length of the window in seconds.
+        :param int maxsize: The most keys held.
+        :param timer: Function returning the current time in seconds.
+        """
+        if limit < 1:
+            raise ValueError("limit must be at least 1")
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        self.limit = limit
+        self.window = window
+        self.maxsize = maxsize
+        self._timer = timer
+        self._counts = OrderedDict()  # key -> (window number, count, previous count)
+        self._lock = threading.Lock()
+
+    def _estimate(self, now, number, count, previous):
+        if number == now // self.window - 1:
+            # The current window has not been counted yet
+            count, previous = 0, count
+        elif number != now // self.window:
+            return 0, 0, 0.0
+        covered = 1.0 - (now % self.window) / self.window
+        return count, previous, count + previous * covered
+
+    def hit(self, key):
+        """
+        Record an event for `key`, unless its limit is reached.
+
+        :param key: The key, e.g. a username.
+
+        :return: Whether the event is allowed. Events which are not allowed
+            are not counted.
+        :rtype: bool
+        """
+        now = self._timer()
+        number = now // self.window
+        with self._lock:
+            count, previous, estimate = self._estimate(now, *self._counts.get(key, (number, 0, 0)))
+            if estimate + 1 > self.limit:
+                self._counts.move_to_end(key)
+                return False
+            self._counts[key] = (number, count + 1, previous)
+            self._counts.move_to_end(key)
+            while len(self._counts) > self.maxsize:
+                self._counts.popitem(last=False)
+        return True
+
+    def refund(self, key):
+        """
+        Take back one event recorded for `key`, e.g. an attempt counted
+        before its outcome was known which turned out not to count.
+
+        :param key: The key.
+        """
+        with self._lock:
+            entry = self._counts.get(key)
+            if entry is not None and entry[1] > 0:
+                self._counts[key] = (entry[0], entry[1] - 1, entry[2])
+
+    def reset(self, key):
+        """
+        Forget the events of `key`.
+
+        :param key: The key.
+        """
+        with self._lock:
+            self._counts.pop(key, None)
+
+    def __len__(self):
+        return len(self._counts)
@@ -0,0 +1,151 @@
+import os
+import socket
+import threading
+from urllib.parse import unquote, urlsplit
+
+class RespError(Exception):
+    """An error reply from the server."""
+
+class RespProtocolError(ConnectionError):
+    """The server's reply could not be read."""
+
+def _encode_command(args):
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode("utf-8")
+        elif isinstance(arg, (int, float)):
+            arg = str(arg).encode("ascii")
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+def _read_reply(stream):
+    line = stream.readline()
+    if not line.endswith(b"\r\n"):
+        raise RespProtocolError("Connection closed by the server")
+    kind, body = line[:1], line[1:-2]
+    if kind == b"+":
+        return body.decode("utf-8")
+    if kind == b"-":
+        return RespError(body.decode("utf-8"))
+    if kind == b":":
+        return int(body)
+    if kind == b"$":
+        length = int(body)
+        if length < 0:
+            return None
+        data = stream.read(length + 2)
+        if len(data) != length + 2:
+            raise RespProtocolError("Connection closed by the server")
+        return data[:-2]
+    if kind == b"*":
+        length = int(body)
+        if length < 0:
+            return None
+        return [_read_reply(stream) for _ in range(length)]
+    raise RespProtocolError(f"Unexpected reply {line!r}")
+
+class RespClient:
+    def __init__(self, host="localhost", port=6379, db=0, password=None, timeout=None):
+        """
+        Minimal client for servers speaking the Redis protocol (RESP2), such
+        as Redis, Valkey or KeyDB.
+
+        Each thread holds one connection, opened on first use and reopened
+        after an error or a fork. Commands are sent as given and their
+        replies returned as `bytes`, `str` (status replies), `int`, `None`
+        or lists of these.
+
+        :param str host: The server host name.
+        :param int port: The server port.
+        :param int db: The number of the database selected on connection.
+        :param str password: The password sent with `AUTH`, if any.
+        :param float timeout: Seconds to wait to connect and for each reply
+            (default no limit).
+        """
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._local = threading.local()
+        self._pid = os.getpid()
+
+    @classmethod
+    def from_url(cls, url, timeout=None):
+        """
+        Build a client from a "redis://[:password@]host[:port][/db]" URL.
+
+        :param str url: The server URL.
+        :param float timeout: See `RespClient`.
+
+        :raises ValueError: If `url` is not a redis URL.
+
+        :return: The client.
+        :rtype: RespClient
+        """
+        parts = urlsplit(url)
+        if parts.scheme != "redis" or not parts.hostname:
+            raise ValueError(f"Not a redis URL: {url!r}")
+        path = parts.path.strip("/")
+        return cls(
+            host=parts.hostname,
+            port=parts.port or 6379,
+            db=int(path) if path else 0,
+            password=unquote(parts.password) if parts.password else None,
+            timeout=timeout,
+        )
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._local.socket = sock
+        self._local.stream = sock.makefile("rb")
+        try:
+            if self.password is not None:
+                self._call("AUTH", self.password)
+            if self.db:
+                self._call("SELECT", self.db)
+        except RespError:
+            self.close()
+            raise
+
+    def _call(self, *args):
+        self._local.socket.sendall(_encode_command(args))
+        reply = _read_reply(self._local.stream)
+        if isinstance(reply, RespError):
+            raise reply
+        return reply
+
+    def execute(self, *args):
+        """
+        Send a command and read its reply.
+
+        :param args: The command name and arguments.
+
+        :raises RespError: If the server replies with an error.
+        :raises OSError: If the server cannot be reached or the connection
+            fails; the connection is closed and reopened by the next command.
+
+        :return: The reply.
+        """
+        if self._pid != os.getpid():
+            # The parent's connection must not be used
+            self._local = threading.local()
+            self._pid = os.getpid()
+        try:
+            if getattr(self._local, "socket", None) is None:
+                self._connect()
+            return self._call(*args)
+        except OSError:
+            self.close()
+            raise
+
+    def close(self):
+        """Close this thread's connection."""
+        sock = getattr(self._local, "socket", None)
+        if sock is not None:
+            self._local.stream.close()
+            sock.close()
+        self._local.socket = None
+        self._local.stream = None
@@ -0,0 +1,130 @@
+import mmap
+import os
+import struct
+import tempfile
+
+# File layout: a header, then one index record per entry in short ID order,
+# then the keys and values. Offsets in index records are from the start of
+# the data.
+MAGIC = b"YOCTOSN1"
+_HEADER = struct.Struct("<8sIQd")  # magic, reserved, entry count, creation time
+_RECORD = struct.Struct("<QHI")  # data offset, key length, value length
+
+class SnapshotFormatError(ValueError):
+    """The file is not a snapshot."""
+
+def write_snapshot(path, items, created_at):
+    """
+    Write a snapshot file of string keys to string values.
+
+    The file is written next to `path` and moved into place with
+    `os.replace`, so processes reading the previous file keep a consistent
+    view of it. Only the index records are buffered, in a temporary file,
+    so memory use does not depend on the number of entries.
+
+    :param str path: The path of the snapshot.
+    :param items: The (key, value) pairs, in increasing order of the UTF-8
+        encoding of the keys, with no repeated keys.
+    :type items: collections.abc.Iterable[tuple[str, str]]
+    :param float created_at: The POSIX time the data was read from.
+
+    :raises ValueError: If the keys are not in increasing order.
+
+    :return: The number of entries written.
+    :rtype: int
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    count = 0
+    previous = None
+    offset = 0
+    with tempfile.TemporaryFile(dir=directory) as data, \
+            tempfile.TemporaryFile(dir=directory) as index:
+        for key, value in items:
+            key = key.encode("utf-8")
+            value = value.encode("utf-8")
+            if previous is not None and key <= previous:
+                raise ValueError("Snapshot keys must be unique and in increasing order")
+            index.write(_RECORD.pack(offset, len(key), len(value)))
+            data.write(key)
+            data.write(value)
+            offset += len(key) + len(value)
+            previous = key
+            count += 1
+        fd, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(_HEADER.pack(MAGIC, 0, count, created_at))
+                for part in (index, data):
+                    part.seek(0)
+                    while chunk := part.read(1 << 20):
+                        f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(temporary, 0o644)
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+    return count
+
+class SnapshotFile:
+    def __init__(self, path):
+        """
+        Read-only memory map of a snapshot file.
+
+        Lookups binary search the index in the map, so the file is shared
+        through the page cache by every process mapping it and nothing is
+        loaded up front. The map is kept if the file is replaced.
+
+        :param str path: The path of the snapshot.
+
+        :raises OSError: If the file cannot be opened.
+        :raises SnapshotFormatError: If the file is not a snapshot.
+        """
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            if stat.st_size < _HEADER.size:
+                raise SnapshotFormatError(f"{path} is too short to be a snapshot")
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, _, self.count, self.created_at = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise SnapshotFormatError(f"{path} is not a snapshot")
+        self._data_start = _HEADER.size + self.count * _RECORD.size
+        if self._data_start > len(self._map):
+            raise SnapshotFormatError(f"{path} is truncated")
+        # Identifies the file, to notice when it is replaced
+        self.file_id = (stat.st_dev, stat.st_ino, stat.st_mtime_ns)
+
+    def _record(self, i):
+        offset, key_length, value_length = _RECORD.unpack_from(
+            self._map, _HEADER.size + i * _RECORD.size
+        )
+        start = self._data_start + offset
+        return start, key_length, value_length
+
+    def get(self, key, default=None):
+        """
+        Look up the value of a key.
+
+        :param str key: The key.
+        :param default: The value returned if the key is absent.
+
+        :return: The value, or `default`.
+        """
+        target = key.encode("utf-8")
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            start, key_length, value_length = self._record(middle)
+            candidate = self._map[start:start + key_length]
+            if candidate < target:
+                low = middle + 1
+            elif candidate > target:
+                high = middle
+            else:
+                value_start = start + key_length
+                return self._map[value_start:value_start + value_length].decode("utf-8")
+        return default
+
+    def __len__(self):
+        return self.count
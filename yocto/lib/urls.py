@@ -0,0 +1,173 @@
+import hashlib
+import re
+from urllib.parse import quote, urlsplit, urlunsplit
+
+from validators import url as _full_url_check
+
+from yocto.lib.exceptions import UrlInvalidError
+
+# Bytes in the hash of a canonical URL
+URL_HASH_SIZE = 16
+
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+_UNRESERVED = frozenset(
+    "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~"
+)
+# Characters left as they are when escaping a path, query or fragment
+_SAFE = "-._~!$&'()*+,;=:@/?%"
+
+# The fast path accepts only the common shape of web address, and every
+# address it accepts is also accepted by `validators.url`. Anything else is
+# left to `validators.url`.
+_FAST_HOST = re.compile(
+    r"(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)+[a-z][a-z0-9-]{0,61}[a-z]"
+)
+_FAST_PATH = re.compile(r"[A-Za-z0-9/\-._~!$&'()*+,;=:@%]*")
+_FAST_QUERY = re.compile(
+    r"[A-Za-z0-9\-._~!$'()*+,:@%/?]+=[A-Za-z0-9\-._~!$'()*+,:@%/?=]*"
+    r"(?:&[A-Za-z0-9\-._~!$'()*+,:@%/?]+=[A-Za-z0-9\-._~!$'()*+,:@%/?=]*)*"
+)
+_FAST_FRAGMENT = re.compile(r"[0-9A-Za-z?/:@\-._~%!$&'()*+,;=#]*")
+_FAST_PORT = re.compile(r"[1-9][0-9]{0,4}")
+_ESCAPE = re.compile(r"%([0-9A-Fa-f]{2})")
+
+def _fast_check(parts):
+    # Whether the split URL is valid by the fast path; `False` means
+    # undecided rather than invalid
+    if parts.scheme not in _DEFAULT_PORTS:
+        return False
+    host, colon, port = parts.netloc.partition(":")
+    if colon and not (_FAST_PORT.fullmatch(port) and 0 < int(port) <= 65535):
+        return False
+    return (
+        len(host) <= 253
+        and _FAST_HOST.fullmatch(host.lower()) is not None
+        and _FAST_PATH.fullmatch(parts.path) is not None
+        and (not parts.query or _FAST_QUERY.fullmatch(parts.query) is not None)
+        and _FAST_FRAGMENT.fullmatch(parts.fragment) is not None
+    )
+
+def _split(value):
+    # Split a URL, or return `None` if it is not valid
+    if not isinstance(value, str) or not value:
+        return None
+    try:
+        parts = urlsplit(value)
+    except ValueError:
+        return None
+    if _fast_check(parts):
+        return parts
+    if not _full_url_check(value):
+        return None
+    return parts
+
+def is_valid_url(value):
+    """
+    Check that a value is a valid web address.
+
+    Addresses of the usual form, an http or https URL with a domain name
+    and plain ASCII path, query and fragment, are checked with a few small
+    regular expressions. Others are checked by `validators.url`, which
+    decides the same for every address.
+
+    :param value: The value to check.
+
+    :return: Whether `value` is a valid URL.
+    :rtype: bool
+    """
+    return _split(value) is not None
+
+def _normalize_escapes(component):
+    # Escape characters which must be escaped, such as non-ASCII ones, then
+    # decode escaped unreserved characters and write other escapes in upper
+    # case
+    component = quote(component, safe=_SAFE)
+
+    def replace(match):
+        character = chr(int(match.group(1), 16))
+        if character in _UNRESERVED:
+            return character
+        return "%" + match.group(1).upper()
+
+    return _ESCAPE.sub(replace, component)
+
+def canonical_url(value):
+    """
+    Normalize a web address, so that different spellings of the same address
+    are equal.
+
+    The scheme and host are put in lower case, with international domain
+    names in their ASCII form, the port is dropped if it is the default for
+    the scheme, an empty path becomes "/", and percent-encoding is
+    normalized: characters which need not be escaped are decoded, other
+    escapes are in upper case, and non-ASCII characters are escaped as
+    UTF-8. Paths are otherwise kept as they are, so "/a" and "/a/" remain
+    distinct.
+
+    :param str value: The URL.
+
+    :raises UrlInvalidError: If `value` is not a valid URL.
+
+    :return: The canonical form of the URL.
+    :rtype: str
+
+    *Examples*
+    >>> canonical_url("HTTPS://Example.COM:443")
+    "https://example.com/"
+    >>> canonical_url("https://example.com/%7euser/caf%c3%a9")
+    "https://example.com/~user/caf%C3%A9"
+    """
+    parts = _split(value)
+    if parts is None:
+        raise UrlInvalidError
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc
+    if netloc:
+        host = parts.hostname or ""
+        if ":" in host:
+            host = f"[{host}]"
+        else:
+            try:
+                host = host.encode("idna").decode("ascii")
+            except UnicodeError:
+                pass
+        try:
+            port = parts.port
+        except ValueError:
+            raise UrlInvalidError
+        if port is not None and port != _DEFAULT_PORTS.get(scheme):
+            host = f"{host}:{port}"
+        userinfo, at, _ = netloc.rpartition("@")
+        netloc = f"{userinfo}@{host}" if at else host
+    path = _normalize_escapes(parts.path)
+    if netloc and not path:
+        path = "/"
+    return urlunsplit(
+        (
+            scheme,
+            netloc,
+            path,
+            _normalize_escapes(parts.query),
+            _normalize_escapes(parts.fragment),
+        )
+    )
+
+def url_hash(value):
+    """
+    Hash the canonical form of a web address.
+
+    Links are stored with this hash, so that a long URL is found through a
+    small index of fixed-size keys however long it is, and is found whatever
+    its spelling.
+
+    :param str value: The URL.
+
+    :raises UrlInvalidError: If `value` is not a valid URL.
+
+    :return: The `URL_HASH_SIZE`-byte hash.
+    :rtype: bytes
+    """
+    return hashlib.blake2b(
+        canonical_url(value).encode("utf-8"), digest_size=URL_HASH_SIZE
+    ).digest()
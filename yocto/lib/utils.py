@@ -5,12 +5,48 @@ PASSWORD_HASH_IDENTIFIER = "password_hash"
 ACCOUNT_CREATION_DATE_IDENTIFIER = "creation_date"
 
 ## Urls collection identifiers ##
+URL_ID_IDENTIFIER = "_id"
 LONG_URL_IDENTIFIER = "long_url"
+LONG_URL_HASH_IDENTIFIER = "long_url_hash"
 SHORT_ID_IDENTIFIER = "short_id"
 URL_CREATION_DATE_IDENTIFIER = "creation_date"
 CREATOR_ID_IDENTIFIER = "creator_id"
 VISITS_COUNT_IDENTIFIER = "visits_count"
 
+## Tokens collection identifiers ##
+TOKEN_ID_IDENTIFIER = "_id"
+TOKEN_HASH_IDENTIFIER = "token_hash"
+TOKEN_USER_ID_IDENTIFIER = "user_id"
+TOKEN_NAME_IDENTIFIER = "name"
+TOKEN_CREATION_DATE_IDENTIFIER = "creation_date"
+
+## Visits collection identifiers ##
+VISIT_SHORT_ID_IDENTIFIER = "short_id"
+VISIT_GRANULARITY_IDENTIFIER = "granularity"
+VISIT_START_IDENTIFIER = "start"
+VISIT_COUNT_IDENTIFIER = "count"
+VISIT_EXPIRY_IDENTIFIER = "expires"
+
+## Deletions collection identifiers ##
+DELETION_USER_ID_IDENTIFIER = "_id"
+DELETION_REQUEST_DATE_IDENTIFIER = "request_date"
+DELETION_LEASE_OWNER_IDENTIFIER = "lease_owner"
+DELETION_LEASE_EXPIRY_IDENTIFIER = "lease_expires"
+DELETION_LINKS_DELETED_IDENTIFIER = "links_deleted"
+
+## Tombstones collection identifiers ##
+TOMBSTONE_SHORT_ID_IDENTIFIER = "short_id"
+TOMBSTONE_DELETION_DATE_IDENTIFIER = "deletion_date"
+
+## Invalidations collection identifiers ##
+INVALIDATION_CACHE_IDENTIFIER = "cache"
+INVALIDATION_KEY_IDENTIFIER = "key"
+INVALIDATION_DATE_IDENTIFIER = "date"
+
+## Counters collection identifiers ##
+COUNTER_ID_IDENTIFIER = "_id"
+COUNTER_VALUE_IDENTIFIER = "value"
+
 def _verify_type(parameter, expected_type):
     if not isinstance(parameter, expected_type):
         raise TypeError(f"Expected type '{expected_type}'")
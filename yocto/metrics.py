@@ -0,0 +1,320 @@
+import atexit
+import glob
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+
+from flask import Response, g, request
+from pymongo import monitoring
+
+from yocto.lib.background import BackgroundLoop
+from yocto.lib.metrics import (
+    Counter,
+    Gauge,
+    Histogram,
+    Registry,
+    merge,
+    render,
+)
+
+METRICS_FILE_EXTENSION = "yocto.metrics_file"
+
+logger = logging.getLogger(__name__)
+
+# Metrics of this process
+REGISTRY = Registry()
+os.register_at_fork(after_in_child=REGISTRY.reset_after_fork)
+
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+REQUEST_DURATION = Histogram(
+    REGISTRY,
+    "yocto_http_request_duration_seconds",
+    "Time to handle a request, including streaming the response.",
+    ["endpoint", "method"],
+)
+REQUESTS = Counter(
+    REGISTRY,
+    "yocto_http_requests_total",
+    "Requests handled.",
+    ["endpoint", "method", "status"],
+)
+DB_COMMAND_DURATION = Histogram(
+    REGISTRY,
+    "yocto_mongodb_command_duration_seconds",
+    "Time for MongoDB to answer a command.",
+    ["collection", "command"],
+    buckets=DB_BUCKETS,
+)
+DB_COMMAND_FAILURES = Counter(
+    REGISTRY,
+    "yocto_mongodb_command_failures_total",
+    "MongoDB commands which failed.",
+    ["collection", "command"],
+)
+CACHE_HITS = Counter(REGISTRY, "yocto_cache_hits_total", "Cache lookups answered.", ["cache"])
+CACHE_MISSES = Counter(REGISTRY, "yocto_cache_misses_total", "Cache lookups not answered.", ["cache"])
+CACHE_EVICTIONS = Counter(REGISTRY, "yocto_cache_evictions_total", "Entries evicted from a full cache.", ["cache"])
+CACHE_SIZE = Gauge(REGISTRY, "yocto_cache_entries", "Entries held in caches.", ["cache"])
+CACHE_ERRORS = Counter(REGISTRY, "yocto_cache_errors_total", "Commands to a shared cache server which failed.", ["cache"])
+PASSWORD_HASHING_DURATION = Histogram(
+    REGISTRY,
+    "yocto_password_hashing_seconds",
+    "Time to hash or verify a password, including waiting for a worker.",
+    ["operation"],
+)
+PASSWORD_HASHING_REJECTED = Counter(
+    REGISTRY,
+    "yocto_password_hashing_rejected_total",
+    "Password operations refused or timed out because the hashing pool was busy.",
+    ["operation"],
+)
+LOGIN_REJECTED = Counter(
+    REGISTRY,
+    "yocto_login_rejected_total",
+    "Login attempts rejected before password verification by a rate limit.",
+    ["limit"],
+)
+
+class CommandTimer(monitoring.CommandListener):
+    """
+    Record the duration of MongoDB commands by collection and command name.
+
+    Register with `pymongo.monitoring.register` before clients are created.
+    """
+
+    def __init__(self):
+        self._collections = {}  # (connection, request ID) -> collection
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            # e.g. getMore, which names the cursor first
+            collection = event.command.get("collection", "none")
+        with self._lock:
+            self._collections[(event.connection_id, event.request_id)] = collection
+
+    def _finished(self, event):
+        with self._lock:
+            return self._collections.pop((event.connection_id, event.request_id), "none")
+
+    def succeeded(self, event):
+        DB_COMMAND_DURATION.observe(
+            event.duration_micros / 1e6,
+            collection=self._finished(event),
+            command=event.command_name,
+        )
+
+    def failed(self, event):
+        collection = self._finished(event)
+        DB_COMMAND_DURATION.observe(
+            event.duration_micros / 1e6,
+            collection=collection,
+            command=event.command_name,
+        )
+        DB_COMMAND_FAILURES.inc(collection=collection, command=event.command_name)
+
+_command_timer = None
+
+def _register_command_timer():
+    global _command_timer
+    if _command_timer is None:
+        _command_timer = CommandTimer()
+        monitoring.register(_command_timer)
+
+class MetricsFile:
+    def __init__(self, directory, interval=5.0):
+        """
+        File holding the metrics of this process, for aggregation across
+        worker processes.
+
+        Each process writes a snapshot of `REGISTRY` to its own file in
+        `directory` every `interval` seconds, from a thread started by
+        `ensure_started` when the process handles its first request, as well
+        as when the metrics are scraped and at exit. A scrape served by any
+        process merges the files of all processes. Counts from processes
+        which have exited are kept, so totals do not go backwards when a
+        worker is replaced, but gauges are only taken from running
+        processes. The directory should be emptied when the server starts.
+
+        :param str directory: The directory shared by the worker processes.
+        :param float interval: Seconds between writes.
+        """
+        self.directory = directory
+        self.interval = interval
+        self._path = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._loop = BackgroundLoop(
+            self.write,
+            interval,
+            "yocto-metrics",
+            message="Could not write metrics: %s",
+            logger=logger,
+            wait_first=True,
+            after_fork=self._reset_after_fork,
+        )
+
+    def ensure_started(self):
+        """Start the thread writing the file of this process, if not running."""
+        self._loop.ensure_started()
+
+    def _process_path(self):
+        if self._pid == os.getpid():
+            return self._path
+        with self._lock:
+            if self._pid != os.getpid():
+                # The random part keeps a reused PID from overwriting the
+                # counts of an exited process
+                self._path = os.path.join(
+                    self.directory, f"{os.getpid()}-{secrets.token_hex(4)}.json"
+                )
+                self._pid = os.getpid()
+            return self._path
+
+    def write(self):
+        """Write the snapshot of this process to its file."""
+        path = self._process_path()
+        os.makedirs(self.directory, exist_ok=True)
+        temporary = path + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump({"pid": self._pid, "metrics": REGISTRY.snapshot()}, f)
+        os.replace(temporary, path)
+
+    def close(self):
+        """Stop the thread writing the file."""
+        self._loop.stop()
+
+    def _reset_after_fork(self):
+        self._lock = threading.Lock()
+
+    def collect(self):
+        """
+        Merge the snapshots of every process.
+
+        :return: The combined snapshot (see `yocto.lib.metrics.merge`).
+        :rtype: dict
+        """
+        self.write()
+        snapshots = []
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue  # removed or being replaced
+            metrics = data["metrics"]
+            if data["pid"] != os.getpid() and not _is_running(data["pid"]):
+                metrics = {
+                    name: metric for name, metric in metrics.items()
+                    if metric["type"] != "gauge"
+                }
+            snapshots.append(metrics)
+        return merge(snapshots)
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def _start_timer():
+    g._metrics_start = time.perf_counter()
+
+def _record_status(response):
+    g._metrics_status = response.status_code
+    return response
+
+def _record_request(exc):
+    start = g.pop("_metrics_start", None)
+    if start is None:
+        return
+    endpoint = request.endpoint or "none"
+    status = 500 if exc is not None else g.pop("_metrics_status", 500)
+    REQUEST_DURATION.observe(
+        time.perf_counter() - start, endpoint=endpoint, method=request.method
+    )
+    REQUESTS.inc(endpoint=endpoint, method=request.method, status=status)
+
+def init_app(app):
+    """
+    Initialize the Flask app for metrics collection.
+
+    Request durations are recorded by endpoint, and MongoDB command
+    durations by collection and command for clients created after this is
+    called, so it should be called before the database is first used. Cache
+    counts are read from the app's caches when the metrics are scraped. The
+    metrics are served in the Prometheus text format at `METRICS_PATH`. With
+    `METRICS_DIR` set, the metrics of every process writing to that
+    directory are served together (see `MetricsFile`); otherwise only those
+    of the process answering, and each process starts writing its file on
+    its first request. Nothing is recorded or served unless
+    `METRICS_ENABLED` is set.
+    """
+    if not app.config.get("METRICS_ENABLED", False):
+        return
+    _register_command_timer()
+    app.before_request(_start_timer)
+    app.after_request(_record_status)
+    app.teardown_request(_record_request)
+
+    def collect_cache_stats():
+        from yocto.cache import (
+            REDIRECT_CACHE_EXTENSION,
+            USER_CACHE_EXTENSION,
+            TOKEN_CACHE_EXTENSION,
+            SharedRedirectCache,
+            TieredRedirectCache,
+        )
+        caches = [
+            ("redirect", app.extensions.get(REDIRECT_CACHE_EXTENSION)),
+            ("user", app.extensions.get(USER_CACHE_EXTENSION)),
+            ("token", app.extensions.get(TOKEN_CACHE_EXTENSION)),
+        ]
+        # The tiers of a tiered redirect cache are reported apart, the
+        # shared tier as "redirect_shared"
+        redirect_cache = caches[0][1]
+        if isinstance(redirect_cache, TieredRedirectCache):
+            caches[0] = ("redirect", redirect_cache.local)
+            caches.append(("redirect_shared", redirect_cache.shared))
+        elif isinstance(redirect_cache, SharedRedirectCache):
+            caches[0] = ("redirect_shared", redirect_cache)
+        for name, cache in caches:
+            if cache is None:
+                continue
+            stats = cache.stats()
+            CACHE_HITS.set_total(stats["hits"], cache=name)
+            CACHE_MISSES.set_total(stats["misses"], cache=name)
+            CACHE_EVICTIONS.set_total(stats["evictions"], cache=name)
+            CACHE_SIZE.set(stats["size"], cache=name)
+            if "errors" in stats:
+                CACHE_ERRORS.set_total(stats["errors"], cache=name)
+
+    REGISTRY.set_collector("caches", collect_cache_stats)
+
+    directory = app.config.get("METRICS_DIR")
+    metrics_file = None
+    if directory:
+        metrics_file = MetricsFile(directory, app.config.get("METRICS_WRITE_INTERVAL", 5.0))
+        atexit.register(metrics_file.write)
+        # Every worker writes its file, whether or not it answers scrapes
+        app.before_request(metrics_file.ensure_started)
+    app.extensions[METRICS_FILE_EXTENSION] = metrics_file
+
+    def metrics():
+        snapshot = REGISTRY.snapshot() if metrics_file is None else metrics_file.collect()
+        return Response(render(snapshot), mimetype="text/plain; version=0.0.4")
+
+    app.add_url_rule(app.config.get("METRICS_PATH", "/metrics"), "metrics", metrics)
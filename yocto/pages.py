@@ -2,18 +2,39 @@ import functools
 
 from flask import (
     Blueprint, 
+    Response,
+    current_app,
     render_template, 
+    stream_template,
+    stream_with_context,
     request, 
     redirect, 
     url_for, 
     session,
     g,
 )
+from flask.ctx import _AppCtxGlobals
 from bson.objectid import ObjectId
 
 from yocto.auth import UserAuthenticator
 from yocto.address import AddressManager
-from yocto.db import get_db
+from yocto.allocators import get_id_allocator
+from yocto.bulk import (
+    EXPORT_FORMATS,
+    EXPORT_MIMETYPES,
+    export_filename,
+    export_user_links,
+)
+from yocto.cache import (
+    get_cache_invalidator,
+    get_redirect_cache,
+    get_token_cache,
+    get_user_cache,
+)
+from yocto.db import get_db, get_read_db
+from yocto.deletion import get_deletion_worker
+from yocto.filters import get_short_id_filter
+from yocto.hashing import get_password_hasher
 from yocto.lib.exceptions import (
     UsernameInvalidError,
     PasswordInvalidError,
@@ -21,25 +42,65 @@ from yocto.lib.exceptions import (
     PasswordMismatchError,
     UrlInvalidError,
     UrlExistsError,
+    UrlNotFoundError,
+    HashingBusyError,
 )
 from yocto.lib.utils import (
     USER_ID_IDENTIFIER, 
     USERNAME_IDENTIFIER, 
     LONG_URL_IDENTIFIER, 
     SHORT_ID_IDENTIFIER,
+    URL_ID_IDENTIFIER,
 )
+from yocto.ratelimit import get_login_throttle
 
 bp = Blueprint("pages", __name__, url_prefix="/pages")
 
-@bp.before_app_request
+# Returned by user cache lookups for users not in the cache, since a cached
+# `None` records a session user who no longer exists.
+_NOT_CACHED = object()
+
 def load_logged_in_user():
+    """
+    Look up the record of the user logged in to the current session.
+
+    Records are taken from the user cache where possible, else read from
+    the database for reads which tolerate replication lag. This function is
+    called the first time `g.user` is read during a request, so requests
+    which never read it (e.g. redirects) do not look up the user.
+
+    :return: The user record, or `None` if no user is logged in.
+    :rtype: dict
+    """
     user_id = session.get("user")
     if user_id is None:
-        g.user = None
-    else:
-        db = get_db()
-        user = db.users.find_one({USER_ID_IDENTIFIER: ObjectId(user_id)})
-        g.user = user
+        return None
+    cache = get_user_cache()
+    if cache is not None:
+        user = cache.get(user_id, _NOT_CACHED)
+        if user is not _NOT_CACHED:
+            return user
+    read_db = get_read_db()
+    user = read_db.users.find_one({USER_ID_IDENTIFIER: ObjectId(user_id)})
+    if user is None and read_db is not get_db():
+        # A new account may not have reached the member read from yet
+        user = get_db().users.find_one({USER_ID_IDENTIFIER: ObjectId(user_id)})
+    if cache is not None:
+        cache.set(user_id, user)
+    return user
+
+class AppGlobals(_AppCtxGlobals):
+    """Application globals in which `user` is loaded when first read."""
+
+    def __getattr__(self, name):
+        if name == "user":
+            self.user = load_logged_in_user()
+            return self.user
+        return super().__getattr__(name)
+
+@bp.record_once
+def use_lazy_user(state):
+    state.app.app_ctx_globals_class = AppGlobals
 
 def login_required(view):
     @functools.wraps(view)
@@ -62,7 +123,7 @@ def signup():
         user = request.form["uname"]
         password = request.form["pw"]
         if request.form["pw"] == request.form["rep_pw"]:
-            auth = UserAuthenticator(get_db())
+            auth = UserAuthenticator(get_db(), hasher=get_password_hasher())
             try:
                 user_id = auth.register_user(user, password)
             except UsernameInvalidError:
@@ -77,6 +138,12 @@ def signup():
                     message="Password not valid.",  # TODO: better message
                     form=request.form,
                 )
+            except HashingBusyError:
+                return render_template(
+                    "pages/signup.html", 
+                    message="The server is busy, please try again.",
+                    form=request.form,
+                ), 503
             session["user"] = str(user_id)
             return redirect(url_for("pages.login_success", user=user))
         else:
@@ -98,7 +165,16 @@ def login():
     if request.method == "POST":
         user = request.form["uname"]
         password = request.form["pw"]
-        auth = UserAuthenticator(get_db())
+        throttle = get_login_throttle()
+        if throttle is not None:
+            retry_after = throttle.attempt(user, request.remote_addr)
+            if retry_after is not None:
+                return render_template(
+                    "pages/login.html", 
+                    form=request.form,
+                    message="Too many login attempts, please try again later.",
+                ), 429, {"Retry-After": str(retry_after)}
+        auth = UserAuthenticator(get_db(), hasher=get_password_hasher())
         try:
             user_id = auth.authenticate_user(user, password)
         except UserNotFoundError:
@@ -113,6 +189,14 @@ def login():
                 form=request.form,
                 message="Password incorrect.",
             )
+        except HashingBusyError:
+            return render_template(
+                "pages/login.html", 
+                form=request.form,
+                message="The server is busy, please try again.",
+            ), 503
+        if throttle is not None:
+            throttle.succeeded(user, request.remote_addr)
         session["user"] = str(user_id)
         return redirect(url_for("pages.login_success", user=user))    
     else:
@@ -145,8 +229,16 @@ def delete():
 @bp.route("/delete/confirmed/")
 @login_required
 def delete_confirmed():
-    auth = UserAuthenticator(get_db())
-    auth.delete_user(g.user[USER_ID_IDENTIFIER])
+    auth = UserAuthenticator(
+        get_db(),
+        redirect_cache=get_redirect_cache(),
+        user_cache=get_user_cache(),
+        token_cache=get_token_cache(),
+        invalidator=get_cache_invalidator(),
+    )
+    # The account goes at once, its links in the background
+    auth.request_deletion(g.user[USER_ID_IDENTIFIER])
+    get_deletion_worker().notify()
     session.clear()
     return redirect(url_for("pages.index", disp="account-delete-success"))
 
@@ -159,10 +251,19 @@ def error():
 def create():
     if request.method == "POST":
         long_url = request.form["url"]
-        am = AddressManager(get_db())
-        short_id = am.generate_short_id()
+        am = AddressManager(
+            get_db(),
+            cache=get_redirect_cache(),
+            allocator=get_id_allocator(),
+            short_id_filter=get_short_id_filter(),
+        )
         try:
-            am.store_url_and_id(long_url, short_id, g.user[USER_ID_IDENTIFIER])
+            short_id = am.shorten(long_url, g.user[USER_ID_IDENTIFIER])
+        except UserNotFoundError:
+            # The account was deleted, e.g. in another session, since the
+            # user record was cached
+            session.clear()
+            return redirect(url_for("pages.login"))
         except UrlInvalidError:
             return render_template(
             "pages/create.html",
@@ -171,15 +272,22 @@ def create():
             message="Input is not a valid web address.",
         )
         except UrlExistsError:
-            db = get_db()
-            short_id = db.urls.find_one({LONG_URL_IDENTIFIER: long_url})[SHORT_ID_IDENTIFIER]
+            try:
+                short_id = am.lookup_long_url(long_url)
+            except UrlNotFoundError:
+                # The existing link was deleted since
+                return render_template(
+                    "pages/create.html",
+                    form={"url": long_url},
+                    short_url=None,
+                    message="The link was being deleted, please try again.",
+                )
             return render_template(
                 "pages/create.html",
                 form={"url": ""},
                 short_url=am.compose_shortened_url(get_root_url(), short_id),
                 message=None,
             )
-        # UserNotFoundError should be impossible due to login_required decorator
         return render_template(
             "pages/create.html",
             form={"url": ""},
@@ -194,24 +302,83 @@ def create():
             message=None,
         )
     
+class LinkPage:
+    def __init__(self, addresses, page_size, root_url):
+        """
+        One page of a user's links, produced as the template renders it.
+
+        Links are read from `addresses`, which should hold one more link
+        than fits on the page, so that the start of the next page is known.
+        Once iteration is complete, `next_after` holds the ID to continue
+        from, or `None` on the last page.
+
+        :param addresses: Iterable of link documents in creation order.
+        :param int page_size: The number of links on the page.
+        :param str root_url: The URL prefix of shortened addresses.
+        """
+        self._addresses = addresses
+        self._page_size = page_size
+        self._root_url = root_url
+        self.next_after = None
+
+    def __iter__(self):
+        last_id = None
+        for count, address in enumerate(self._addresses):
+            if count == self._page_size:
+                self.next_after = str(last_id)
+                break
+            last_id = address[URL_ID_IDENTIFIER]
+            yield {
+                "long": address[LONG_URL_IDENTIFIER], 
+                "short": AddressManager.compose_shortened_url(
+                    self._root_url, 
+                    address[SHORT_ID_IDENTIFIER]
+                ) 
+            }
+
 @bp.route("/my-links/")
 @login_required
 def my_links():
+    page_size = request.args.get("limit", type=int)
+    if page_size is None or page_size < 1:
+        page_size = current_app.config["MY_LINKS_PAGE_SIZE"]
+    page_size = min(page_size, current_app.config["MY_LINKS_MAX_PAGE_SIZE"])
+    after = request.args.get("after")
+    after = ObjectId(after) if after and ObjectId.is_valid(after) else None
     am = AddressManager(get_db())
-    addresses = am.lookup_user_urls(g.user[USER_ID_IDENTIFIER])
-    return render_template(
+    addresses = am.iter_user_urls(
+        g.user[USER_ID_IDENTIFIER],
+        after=after,
+        limit=page_size + 1,
+        check_user=False,
+    )
+    return stream_template(
         "pages/my_links.html", 
-        links=[
-            {
-                "long": address[LONG_URL_IDENTIFIER], 
-                "short": am.compose_shortened_url(
-                    get_root_url(), 
-                    address[SHORT_ID_IDENTIFIER]
-                ) 
-            }
-            for address in addresses
-        ]
+        links=LinkPage(addresses, page_size, get_root_url()),
+        after=after,
+        limit=request.args.get("limit"),
+    )
+
+@bp.route("/my-links/export")
+@login_required
+def export_links():
+    fmt = request.args.get("format", "csv")
+    if fmt not in EXPORT_FORMATS:
+        return redirect(url_for("pages.error", message="Links can only be exported as CSV or JSON Lines."))
+    compress = request.args.get("gzip", type=int, default=0) == 1
+    chunks = export_user_links(
+        get_db(),
+        g.user[USER_ID_IDENTIFIER],
+        fmt,
+        get_root_url(),
+        compress=compress,
+    )
+    response = Response(
+        stream_with_context(chunks),
+        mimetype="application/gzip" if compress else EXPORT_MIMETYPES[fmt],
     )
+    response.headers["Content-Disposition"] = f'attachment; filename="{export_filename(fmt, compress)}"'
+    return response
 
 def get_root_url():
     """
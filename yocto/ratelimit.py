@@ -0,0 +1,296 @@
+import logging
+import math
+import time
+
+from flask import current_app
+
+from yocto.lib.ratelimit import SlidingWindowLimiter
+from yocto.lib.resp import RespClient, RespError
+from yocto.metrics import LOGIN_REJECTED
+
+LOGIN_THROTTLE_EXTENSION = "yocto.login_throttle"
+
+logger = logging.getLogger(__name__)
+
+class SharedSlidingWindowLimiter:
+    def __init__(
+            self,
+            client,
+            limit,
+            window,
+            prefix="yocto:ratelimit:",
+            fallback=None,
+            retry_interval=5.0,
+            timer=time.time,
+        ):
+        """
+        Limit with the behaviour of `SlidingWindowLimiter`, counted by a
+        server speaking the Redis protocol so that every worker process using
+        it shares the counts.
+
+        The count of each key in each fixed window is held in a key on the
+        server, incremented with `INCR` and expiring after two windows. If
+        the server cannot be reached, events are counted by `fallback`
+        instead, so that the limit still applies within the process, and the
+        server is not tried again for `retry_interval` seconds.
+
+        :param client: The client of the server.
+        :type client: yocto.lib.resp.RespClient
+        :param int limit: The most events allowed per key in a window.
+        :param float window: The length of the window in seconds.
+        :param str prefix: Prefix of the keys on the server.
+        :param fallback: The limiter used while the server is unavailable
+            (default a `SlidingWindowLimiter` with the same limit and window).
+        :type fallback: yocto.lib.ratelimit.SlidingWindowLimiter
+        :param float retry_interval: Seconds for which the server is not
+            used after a failure.
+        :param timer: Function returning the current POSIX time, which must
+            agree between the processes sharing the server.
+        """
+        if limit < 1:
+            raise ValueError("limit must be at least 1")
+        self.client = client
+        self.limit = limit
+        self.window = window
+        self.prefix = prefix
+        self.fallback = SlidingWindowLimiter(limit, window) if fallback is None else fallback
+        self.retry_interval = retry_interval
+        self._timer = timer
+        self._retry_at = None
+
+    def _key(self, key, number):
+        return f"{self.prefix}{key}:{int(number)}"
+
+    def _available(self):
+        return self._retry_at is None or self._timer() >= self._retry_at
+
+    def _failed(self, e):
+        self._retry_at = self._timer() + self.retry_interval
+        logger.warning("Shared rate limit unavailable: %s", e)
+
+    def hit(self, key):
+        """
+        Record an event for `key`, unless its limit is reached.
+
+        The event is counted before the limit is checked, so that concurrent
+        events in other processes cannot all pass, and taken back if it is
+        over the limit.
+
+        :param key: The key, e.g. a username.
+
+        :return: Whether the event is allowed.
+        :rtype: bool
+        """
+        if not self._available():
+            return self.fallback.hit(key)
+        now = self._timer()
+        number = now // self.window
+        current = self._key(key, number)
+        try:
+            count = self.client.execute("INCR", current)
+            if count == 1:
+                self.client.execute("PEXPIRE", current, math.ceil(2000 * self.window))
+            previous = int(self.client.execute("GET", self._key(key, number - 1)) or 0)
+            covered = 1.0 - (now % self.window) / self.window
+            if count + previous * covered > self.limit:
+                self.client.execute("DECR", current)
+                return False
+        except (OSError, RespError) as e:
+            self._failed(e)
+            return self.fallback.hit(key)
+        self._retry_at = None
+        return True
+
+    def refund(self, key):
+        """
+        Take back one event recorded for `key` in the current or previous
+        window.
+
+        :param key: The key.
+        """
+        if not self._available():
+            self.fallback.refund(key)
+            return
+        number = self._timer() // self.window
+        try:
+            for name in (self._key(key, number), self._key(key, number - 1)):
+                if int(self.client.execute("GET", name) or 0) > 0:
+                    self.client.execute("DECR", name)
+                    break
+        except (OSError, RespError) as e:
+            self._failed(e)
+            self.fallback.refund(key)
+
+    def reset(self, key):
+        """
+        Forget the events of `key`.
+
+        :param key: The key.
+        """
+        self.fallback.reset(key)
+        if not self._available():
+            return
+        number = self._timer() // self.window
+        try:
+            self.client.execute("DEL", self._key(key, number), self._key(key, number - 1))
+        except (OSError, RespError) as e:
+            self._failed(e)
+
+class LoginThrottle:
+    def __init__(self, username_limiter=None, address_limiter=None, account_limiter=None):
+        """
+        Limits on login attempts per client address, per username from each
+        address and per username from every address.
+
+        Attempts are counted against every limit before the password is
+        verified, so that concurrent attempts cannot all pass a limit before
+        their failures are known, and a rejected attempt costs a few
+        dictionary operations rather than a password hash. An attempt
+        rejected by one limit is not counted by the others. The address
+        limit slows guessing the passwords of many accounts from one
+        address. The limit per username and address slows guessing the
+        password of one account from one address, and is cleared when its
+        owner logs in from there, so that they are not locked out by their
+        own typing mistakes. The limit per username from every address,
+        which should be higher, bounds the guesses against one account made
+        from many addresses; a successful login takes back its own attempt
+        only, so that the owner logging in does not restore the guesses of
+        others.
+
+        :param username_limiter: The limiter of attempts per username and
+            address, or `None` for no limit.
+        :param address_limiter: The limiter of attempts per client address,
+            or `None` for no limit.
+        :param account_limiter: The limiter of attempts per username from
+            every address, or `None` for no limit.
+        :type username_limiter: yocto.lib.ratelimit.SlidingWindowLimiter |
+            SharedSlidingWindowLimiter
+        :type address_limiter: yocto.lib.ratelimit.SlidingWindowLimiter |
+            SharedSlidingWindowLimiter
+        :type account_limiter: yocto.lib.ratelimit.SlidingWindowLimiter |
+            SharedSlidingWindowLimiter
+        """
+        self.limiters = {}
+        if username_limiter is not None:
+            self.limiters["username"] = username_limiter
+        if account_limiter is not None:
+            self.limiters["account"] = account_limiter
+        if address_limiter is not None:
+            self.limiters["address"] = address_limiter
+
+    def _keys(self, username, address):
+        # The key of each limit, in the order they are checked
+        keys = {
+            "username": username if address is None else f"{address}/{username}",
+            "account": username,
+            "address": address,
+        }
+        return [
+            (name, keys[name]) for name in self.limiters if keys[name] is not None
+        ]
+
+    def attempt(self, username, address):
+        """
+        Record a login attempt, unless a limit is reached.
+
+        :param str username: The username given.
+        :param str address: The client address, or `None` if unknown.
+
+        :return: `None` if the attempt is allowed, otherwise the number of
+            seconds after which to try again.
+        :rtype: int | None
+        """
+        charged = []
+        for name, key in self._keys(username, address):
+            limiter = self.limiters[name]
+            if not limiter.hit(key):
+                for other, other_key in charged:
+                    self.limiters[other].refund(other_key)
+                LOGIN_REJECTED.inc(limit=name)
+                return math.ceil(limiter.window)
+            charged.append((name, key))
+        return None
+
+    def succeeded(self, username, address):
+        """
+        Clear the attempts of `username` from `address`, and take back its
+        attempt from every address, after a successful login.
+
+        :param str username: The username logged in.
+        :param str address: The client address, or `None` if unknown.
+        """
+        for name, key in self._keys(username, address):
+            if name == "username":
+                self.limiters[name].reset(key)
+            elif name == "account":
+                self.limiters[name].refund(key)
+
+def create_login_throttle(config):
+    """
+    Build a login throttle as configured.
+
+    Attempts are limited to `LOGIN_USERNAME_LIMIT` per username and client
+    address in `LOGIN_USERNAME_WINDOW` seconds, to `LOGIN_ACCOUNT_LIMIT` per
+    username in `LOGIN_ACCOUNT_WINDOW` seconds, and to `LOGIN_ADDRESS_LIMIT`
+    per client address in `LOGIN_ADDRESS_WINDOW` seconds; a limit of zero
+    disables it.
+    Each process counts at most `LOGIN_RATE_LIMIT_MAX_KEYS` keys per limit.
+    If `LOGIN_RATE_LIMIT_URL` is set, the counts are shared on that server,
+    with the `LOGIN_RATE_LIMIT_*` options, and the in-process counts are
+    only used while it is unavailable.
+
+    :param config: The application configuration.
+    :type config: flask.Config
+
+    :return: The login throttle, or `None` if it is disabled.
+    :rtype: LoginThrottle
+    """
+    if not config.get("LOGIN_RATE_LIMIT_ENABLED", False):
+        return None
+    url = config.get("LOGIN_RATE_LIMIT_URL")
+    client = None
+    if url:
+        client = RespClient.from_url(url, timeout=config.get("LOGIN_RATE_LIMIT_TIMEOUT"))
+    limiters = {}
+    for name, prefix in (
+        ("username", "LOGIN_USERNAME"),
+        ("account", "LOGIN_ACCOUNT"),
+        ("address", "LOGIN_ADDRESS"),
+    ):
+        limit = config.get(f"{prefix}_LIMIT", 0)
+        if limit <= 0:
+            limiters[name] = None
+            continue
+        window = config.get(f"{prefix}_WINDOW")
+        limiter = SlidingWindowLimiter(
+            limit,
+            window,
+            maxsize=config.get("LOGIN_RATE_LIMIT_MAX_KEYS", 100000),
+        )
+        if client is not None:
+            limiter = SharedSlidingWindowLimiter(
+                client,
+                limit,
+                window,
+                prefix=f"{config.get('LOGIN_RATE_LIMIT_PREFIX', 'yocto:login:')}{name}:",
+                fallback=limiter,
+                retry_interval=config.get("LOGIN_RATE_LIMIT_RETRY_INTERVAL", 5.0),
+            )
+        limiters[name] = limiter
+    return LoginThrottle(limiters["username"], limiters["address"], limiters["account"])
+
+def get_login_throttle():
+    """
+    Obtain the login throttle of the current application.
+
+    :return: The login throttle, or `None` if it is disabled.
+    :rtype: LoginThrottle
+    """
+    return current_app.extensions.get(LOGIN_THROTTLE_EXTENSION)
+
+def init_app(app):
+    """
+    Initialize the Flask app with a login throttle, configured as described
+    in `create_login_throttle`.
+    """
+    app.extensions[LOGIN_THROTTLE_EXTENSION] = create_login_throttle(app.config)
@@ -1,7 +1,12 @@
 from flask import Blueprint, redirect, url_for
 
 from yocto.address import AddressManager
-from yocto.db import get_db
+from yocto.cache import get_redirect_cache
+from yocto.db import get_db, get_read_db
+from yocto.fastpath import NOT_FOUND_MESSAGE
+from yocto.filters import get_short_id_filter
+from yocto.snapshots import get_redirect_snapshot
+from yocto.visits import get_visit_counter
 from yocto.lib.exceptions import UrlNotFoundError
 
 bp = Blueprint("short", __name__, url_prefix=None)
@@ -13,9 +18,16 @@ def index(short_id=None):
     if short_id is None:
         return redirect(url_for("pages.index"))
     else:
-        am = AddressManager(get_db())
+        am = AddressManager(
+            get_db(),
+            cache=get_redirect_cache(),
+            visit_counter=get_visit_counter(),
+            short_id_filter=get_short_id_filter(),
+            snapshot=get_redirect_snapshot(),
+            read_database=get_read_db(),
+        )
         try:
             long_url = am.lookup_short_id(short_id, count_visit=True)
         except UrlNotFoundError:
-            return redirect(url_for("pages.error", message="Sorry, this shortened address is not valid."))
+            return redirect(url_for("pages.error", message=NOT_FOUND_MESSAGE))
         return redirect(long_url)
@@ -0,0 +1,242 @@
+from datetime import datetime, timedelta, timezone
+import logging
+import os
+import threading
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import PyMongoError
+
+from yocto.db import get_database, get_db
+from yocto.indexes import TOMBSTONE_RETENTION
+from yocto.lib.background import BackgroundLoop
+from yocto.lib.snapshot import SnapshotFile, SnapshotFormatError, write_snapshot
+from yocto.lib.utils import (
+    LONG_URL_IDENTIFIER,
+    SHORT_ID_IDENTIFIER,
+    VISITS_COUNT_IDENTIFIER,
+    TOMBSTONE_SHORT_ID_IDENTIFIER,
+    TOMBSTONE_DELETION_DATE_IDENTIFIER,
+)
+
+REDIRECT_SNAPSHOT_EXTENSION = "yocto.redirect_snapshot"
+
+# Tombstones are read from this long before the snapshot was taken, to allow
+# for clocks differing between hosts
+TOMBSTONE_MARGIN = 60
+
+logger = logging.getLogger(__name__)
+
+def build_redirect_snapshot(collection, path, top=None):
+    """
+    Write a snapshot file of short IDs to long URLs.
+
+    :param collection: The urls collection.
+    :type collection: pymongo.collection.Collection
+    :param str path: The path of the snapshot.
+    :param int top: If given, only the `top` most visited links are
+        included, else every link.
+
+    :return: The number of links written.
+    :rtype: int
+    """
+    created_at = time.time()
+    projection = {SHORT_ID_IDENTIFIER: True, LONG_URL_IDENTIFIER: True, "_id": False}
+    if top is None:
+        # Read in short ID order from its index, so nothing is buffered
+        links = collection.find(projection=projection, batch_size=10000).sort(
+            SHORT_ID_IDENTIFIER, ASCENDING
+        )
+        items = ((link[SHORT_ID_IDENTIFIER], link[LONG_URL_IDENTIFIER]) for link in links)
+    else:
+        links = collection.find(projection=projection).sort(
+            VISITS_COUNT_IDENTIFIER, DESCENDING
+        ).limit(top)
+        items = sorted(
+            ((link[SHORT_ID_IDENTIFIER], link[LONG_URL_IDENTIFIER]) for link in links),
+            key=lambda item: item[0].encode("utf-8"),
+        )
+    return write_snapshot(path, items, created_at)
+
+class RedirectSnapshot:
+    def __init__(
+            self,
+            path,
+            tombstones,
+            refresh_interval=5.0,
+            synchronous=False,
+            timer=time.monotonic,
+        ):
+        """
+        Redirects answered from a snapshot file shared by the workers of a
+        host.
+
+        The file, written by `build_redirect_snapshot`, is memory-mapped
+        read-only, so the workers share one copy through the page cache and
+        a restarted worker starts with every link in the snapshot at hand.
+        Short IDs not in the snapshot, e.g. links created since, are left to
+        the database. Links deleted since the snapshot was taken are known
+        from their tombstones, which are read every `refresh_interval`
+        seconds along with a check for a new snapshot file, by a background
+        thread started on first use in each process. Until the first
+        refresh, if refreshes stop, or if the snapshot is older than the
+        tombstones are kept, nothing is answered from the snapshot.
+
+        :param str path: The path of the snapshot file.
+        :param tombstones: The tombstones collection.
+        :type tombstones: pymongo.collection.Collection
+        :param float refresh_interval: Seconds between refreshes.
+        :param bool synchronous: If `True`, no thread is started, and the
+            lookup which finds the snapshot stale refreshes it.
+        :param timer: Function returning the current time in seconds.
+        """
+        self.path = path
+        self._tombstones = tombstones
+        self.refresh_interval = refresh_interval
+        self.synchronous = synchronous
+        self._timer = timer
+        # Lookups trust the snapshot only if it was refreshed this recently
+        self.max_staleness = 5 * refresh_interval
+        self._file = None
+        self._deleted = frozenset()
+        self._refreshed_at = None
+        self._lock = threading.Lock()
+        self._loop = BackgroundLoop(
+            self.refresh,
+            refresh_interval,
+            "yocto-redirect-snapshot",
+            errors=PyMongoError,
+            message="Could not read deleted short IDs: %s",
+            logger=logger,
+            after_fork=self._reset_after_fork,
+        )
+
+    @property
+    def ready(self):
+        """Whether lookups are answered from the snapshot."""
+        return (
+            self._file is not None
+            and self._refreshed_at is not None
+            and self._timer() - self._refreshed_at <= self.max_staleness
+        )
+
+    def get(self, short_id):
+        """
+        Look up the long URL of a short ID in the snapshot.
+
+        :param str short_id: The short ID.
+
+        :return: The long URL, or `None` if the database must be asked.
+        :rtype: str
+        """
+        if self.synchronous:
+            if self._refreshed_at is None or self._timer() - self._refreshed_at >= self.refresh_interval:
+                self.refresh()
+        else:
+            self._loop.ensure_started()
+        if not self.ready or short_id in self._deleted:
+            return None
+        return self._file.get(short_id)
+
+    def refresh(self):
+        """
+        Map the snapshot file if it was replaced, and read the tombstones of
+        links deleted since it was taken.
+
+        :raises pymongo.errors.PyMongoError: If the tombstones cannot be read.
+        """
+        snapshot = self._file
+        try:
+            stat = os.stat(self.path)
+            if snapshot is None or snapshot.file_id != (stat.st_dev, stat.st_ino, stat.st_mtime_ns):
+                snapshot = SnapshotFile(self.path)
+        except FileNotFoundError:
+            snapshot = None
+        except (OSError, SnapshotFormatError) as e:
+            logger.warning("Could not map the redirect snapshot: %s", e)
+            snapshot = None
+        if snapshot is not None and time.time() - snapshot.created_at > TOMBSTONE_RETENTION:
+            logger.warning("The redirect snapshot %s is too old to be used", self.path)
+            snapshot = None
+        deleted = frozenset()
+        if snapshot is not None:
+            since = datetime.fromtimestamp(snapshot.created_at - TOMBSTONE_MARGIN, timezone.utc)
+            deleted = frozenset(
+                tombstone[TOMBSTONE_SHORT_ID_IDENTIFIER]
+                for tombstone in self._tombstones.find(
+                    {TOMBSTONE_DELETION_DATE_IDENTIFIER: {"$gte": since}},
+                    projection={TOMBSTONE_SHORT_ID_IDENTIFIER: True, "_id": False},
+                )
+            )
+        with self._lock:
+            # The previous map is closed once no lookup is using it
+            self._deleted = deleted
+            self._file = snapshot
+            self._refreshed_at = self._timer()
+
+    def close(self):
+        """Stop the background thread."""
+        self._loop.stop()
+
+    def _reset_after_fork(self):
+        self._lock = threading.Lock()
+
+def get_redirect_snapshot():
+    """
+    Obtain the redirect snapshot of the current application.
+
+    :return: The snapshot, or `None` if disabled.
+    :rtype: RedirectSnapshot
+    """
+    return current_app.extensions.get(REDIRECT_SNAPSHOT_EXTENSION)
+
+def snapshot_path(app):
+    """
+    Find the path of the redirect snapshot file of an application.
+
+    :param flask.Flask app: The application.
+
+    :return: `REDIRECT_SNAPSHOT_PATH`, or "redirects.snapshot" in the
+        instance folder.
+    :rtype: str
+    """
+    path = app.config.get("REDIRECT_SNAPSHOT_PATH")
+    if path is None:
+        path = os.path.join(app.instance_path, "redirects.snapshot")
+    return path
+
+@click.command("build-redirect-snapshot")
+@with_appcontext
+@click.option("--top", type=int, help="Only include the most visited links (default all).")
+@click.option("--output", type=click.Path(dir_okay=False), help="Path of the snapshot file.")
+def build_redirect_snapshot_command(top, output):
+    """Write the snapshot of short IDs to long URLs mapped by the workers."""
+    if output is None:
+        output = snapshot_path(current_app)
+    start = time.perf_counter()
+    count = build_redirect_snapshot(get_db().urls, output, top=top)
+    click.echo(f"Wrote {count} links to {output} in {time.perf_counter() - start:.2f}s.")
+
+def init_app(app):
+    """
+    Initialize the Flask app with a redirect snapshot.
+
+    If `REDIRECT_SNAPSHOT_ENABLED` is set, redirects are answered from the
+    file at `snapshot_path` where possible, checked for deletions and
+    replacement every `REDIRECT_SNAPSHOT_REFRESH_INTERVAL` seconds. The
+    `build-redirect-snapshot` command writes the file, and should be run
+    periodically on each host, more often than tombstones expire.
+    """
+    app.cli.add_command(build_redirect_snapshot_command)
+    snapshot = None
+    if app.config.get("REDIRECT_SNAPSHOT_ENABLED", False):
+        database = get_database(app.config)
+        snapshot = RedirectSnapshot(
+            snapshot_path(app),
+            database.tombstones,
+            refresh_interval=app.config.get("REDIRECT_SNAPSHOT_REFRESH_INTERVAL", 5.0),
+        )
+    app.extensions[REDIRECT_SNAPSHOT_EXTENSION] = snapshot
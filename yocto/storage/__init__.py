@@ -0,0 +1,24 @@
+"""
+Storage backends of the application.
+
+`AddressManager`, `UserAuthenticator` and the background workers are given a
+database object and use its collections through a subset of the PyMongo
+`Database` and `Collection` API: `find` (with `sort`, `limit`, `skip` and
+`batch_size` on the cursor), `find_one`, `find_one_and_update`,
+`find_one_and_delete`, `insert_one`, `insert_many`, `update_one`,
+`update_many`, `delete_one`, `delete_many`, `bulk_write`,
+`count_documents`, `estimated_document_count`, `with_options` and the index
+methods, with the query operators `$in`, `$gt`, `$gte`, `$lt`, `$lte`,
+`$ne`, `$exists`, `$or` and `$and`, and the update operators `$set`,
+`$setOnInsert`, `$inc`, `$unset`, `$min` and `$max`. Constraint violations
+raise `pymongo.errors.DuplicateKeyError` and `BulkWriteError` whatever the
+backend.
+
+The backend is chosen by the `STORAGE_BACKEND` option:
+
+- "mongodb": a PyMongo database on a MongoDB server.
+- "sqlite": a `yocto.storage.sqlite.SQLiteDatabase`, embedded in the
+  process, for single-node deployments and tests without a server.
+"""
+
+STORAGE_BACKENDS = ("mongodb", "sqlite")
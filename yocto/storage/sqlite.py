@@ -0,0 +1,750 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from copy import deepcopy
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pymongo.operations import DeleteMany, DeleteOne, InsertOne, UpdateMany, UpdateOne
+from pymongo.results import (
+    BulkWriteResult,
+    DeleteResult,
+    InsertManyResult,
+    InsertOneResult,
+    UpdateResult,
+)
+
+# Values which JSON cannot hold are stored as strings starting with this
+# character, followed by a letter for their type. Strings which start with
+# it are escaped in the same way.
+_TAG = "\x01"
+_OBJECT_ID = _TAG + "o"
+_DATETIME = _TAG + "d"
+_BYTES = _TAG + "b"
+_STRING = _TAG + "s"
+
+# Table holding the declared indexes of every collection
+_INDEXES_TABLE = "_yocto_indexes"
+
+# Seconds between removals of documents past the expiry of a TTL index, as
+# often as MongoDB's TTL monitor runs
+TTL_INTERVAL = 60
+
+def _encode(value):
+    # Convert a BSON value to the form stored in the JSON document, in which
+    # ordering of values of one type matches MongoDB's
+    if isinstance(value, str):
+        return _STRING + value if value.startswith(_TAG) else value
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, ObjectId):
+        return _OBJECT_ID + str(value)
+    if isinstance(value, datetime):
+        # Stored in UTC to the millisecond, like BSON dates
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return _DATETIME + value.isoformat(timespec="milliseconds")
+    if isinstance(value, bytes):
+        return _BYTES + value.hex()
+    if isinstance(value, dict):
+        return {key: _encode(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(item) for item in value]
+    raise TypeError(f"Cannot store a value of type {type(value).__name__}")
+
+def _decode(value):
+    if isinstance(value, str):
+        if not value.startswith(_TAG):
+            return value
+        tag, body = value[:2], value[2:]
+        if tag == _OBJECT_ID:
+            return ObjectId(body)
+        if tag == _DATETIME:
+            # Naive, in UTC, as PyMongo returns dates by default
+            return datetime.fromisoformat(body)
+        if tag == _BYTES:
+            return bytes.fromhex(body)
+        return body
+    if isinstance(value, dict):
+        return {key: _decode(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    return value
+
+def _field(name):
+    # SQL expression for the value of a field, nested by dots as in MongoDB.
+    # Indexes are built on the same expressions, so that queries use them.
+    if name == "_id":
+        return "id"
+    path = "".join('."' + part.replace('"', '""').replace("'", "''") + '"' for part in name.split("."))
+    return f"json_extract(doc, '${path}')"
+
+_COMPARISONS = {"$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+
+def _condition(expression, operator, value, params):
+    if operator == "$eq":
+        if value is None:
+            return f"{expression} IS NULL"
+        params.append(_encode(value))
+        return f"{expression} = ?"
+    if operator == "$ne":
+        if value is None:
+            return f"{expression} IS NOT NULL"
+        params.append(_encode(value))
+        return f"({expression} IS NULL OR {expression} != ?)"
+    if operator in _COMPARISONS:
+        params.append(_encode(value))
+        return f"{expression} {_COMPARISONS[operator]} ?"
+    if operator in ("$in", "$nin"):
+        values = list(value)
+        present = [item for item in values if item is not None]
+        parts = []
+        if present:
+            params.extend(_encode(item) for item in present)
+            parts.append(f"{expression} IN ({', '.join('?' * len(present))})")
+        if len(present) < len(values):
+            parts.append(f"{expression} IS NULL")
+        clause = "(" + " OR ".join(parts) + ")" if parts else "0"
+        return clause if operator == "$in" else f"NOT {clause}"
+    if operator == "$exists":
+        # Fields holding null are taken as missing
+        return f"{expression} IS {'NOT ' if value else ''}NULL"
+    raise NotImplementedError(f"Query operator {operator} is not supported")
+
+def _where(query, params):
+    # Translate a MongoDB query document to an SQL condition, appending its
+    # parameters to `params`
+    clauses = []
+    for key, value in (query or {}).items():
+        if key in ("$and", "$or"):
+            parts = [_where(part, params) for part in value]
+            joiner = " AND " if key == "$and" else " OR "
+            clauses.append("(" + joiner.join(f"({part})" for part in parts) + ")" if parts else "1")
+        elif key.startswith("$"):
+            raise NotImplementedError(f"Query operator {key} is not supported")
+        elif isinstance(value, dict) and value and all(op.startswith("$") for op in value):
+            expression = _field(key)
+            clauses.extend(_condition(expression, op, item, params) for op, item in value.items())
+        elif isinstance(value, (dict, list, tuple)):
+            raise NotImplementedError("Matching embedded documents or arrays is not supported")
+        else:
+            clauses.append(_condition(_field(key), "$eq", value, params))
+    return " AND ".join(clauses) if clauses else "1"
+
+def _order_by(sort):
+    if not sort:
+        return ""
+    return " ORDER BY " + ", ".join(
+        f"{_field(key)} {'DESC' if direction < 0 else 'ASC'}" for key, direction in sort
+    )
+
+def _sort_spec(key_or_list, direction=None):
+    if isinstance(key_or_list, str):
+        return [(key_or_list, direction if direction is not None else 1)]
+    return list(key_or_list)
+
+def _project(document, projection):
+    if not projection:
+        return document
+    if not isinstance(projection, dict):
+        projection = {key: True for key in projection}
+    include = [key for key, value in projection.items() if value and key != "_id"]
+    if include:
+        result = {key: document[key] for key in include if key in document}
+        if projection.get("_id", True) and "_id" in document:
+            result["_id"] = document["_id"]
+        return result
+    return {key: value for key, value in document.items() if projection.get(key, True)}
+
+def _insert_fields(query):
+    # Fields of a new document created by an upsert, from the equality
+    # conditions of the query
+    fields = {}
+    for key, value in query.items():
+        if key.startswith("$") or "." in key:
+            continue
+        if isinstance(value, dict) and value and all(op.startswith("$") for op in value):
+            if "$eq" in value:
+                fields[key] = value["$eq"]
+        else:
+            fields[key] = value
+    return fields
+
+def _apply_update(document, update, inserting):
+    # Apply the update operators to the document in place, returning whether
+    # it changed
+    if not update or not all(key.startswith("$") for key in update):
+        raise ValueError("update only works with $ operators")
+    before = deepcopy(document)
+    for operator, fields in update.items():
+        for key, value in fields.items():
+            if "." in key or key == "_id" and not inserting:
+                raise NotImplementedError(f"Updating field {key} is not supported")
+            if operator == "$set":
+                document[key] = deepcopy(value)
+            elif operator == "$setOnInsert":
+                if inserting:
+                    document[key] = deepcopy(value)
+            elif operator == "$inc":
+                document[key] = document.get(key, 0) + value
+            elif operator == "$unset":
+                document.pop(key, None)
+            elif operator == "$max":
+                if key not in document or document[key] is None or value > document[key]:
+                    document[key] = value
+            elif operator == "$min":
+                if key not in document or document[key] is None or value < document[key]:
+                    document[key] = value
+            else:
+                raise NotImplementedError(f"Update operator {operator} is not supported")
+    return document != before
+
+class SQLiteDatabase:
+    def __init__(self, path, name=None):
+        """
+        A database in an SQLite file, with the collection API of a PyMongo
+        `Database`.
+
+        Each collection is a table of JSON documents keyed by `_id`, queried
+        with the subset of MongoDB's query and update language used by yocto.
+        Indexes declared with `create_indexes` are built on the same
+        `json_extract` expressions the queries use, so lookups by short ID
+        are B-tree searches in the process. The file is opened in WAL mode,
+        so readers do not wait for writers, and may be shared by the worker
+        processes of a host. Connections are opened per thread and after a
+        fork.
+
+        :param str path: The path of the database file.
+        :param str name: The name of the database (default the file name
+            without extension).
+        """
+        self.path = path
+        self.name = name or os.path.splitext(os.path.basename(path))[0]
+        self._collections = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pid = os.getpid()
+        self._tables = set()
+        with self.connection() as connection:
+            connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {_INDEXES_TABLE} "
+                "(collection TEXT NOT NULL, name TEXT NOT NULL, spec TEXT NOT NULL, "
+                "PRIMARY KEY (collection, name))"
+            )
+
+    def __repr__(self):
+        return f"SQLiteDatabase({self.path!r})"
+
+    def _connection(self):
+        if self._pid != os.getpid():
+            # Connections must not be shared with the parent process
+            self._local = threading.local()
+            self._pid = os.getpid()
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.depth = 0
+        return connection
+
+    @contextmanager
+    def connection(self, write=False):
+        """
+        Obtain this thread's connection, in a transaction if `write` is set.
+
+        Write transactions take the database's write lock when they begin,
+        so that reads within them see no concurrent change. Transactions
+        opened within one are part of it.
+        """
+        connection = self._connection()
+        if not write or self._local.depth:
+            self._local.depth += write
+            try:
+                yield connection
+            finally:
+                self._local.depth -= write
+            return
+        connection.execute("BEGIN IMMEDIATE")
+        self._local.depth = 1
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        else:
+            connection.execute("COMMIT")
+        finally:
+            self._local.depth = 0
+
+    def close(self):
+        """Close this thread's connection."""
+        connection = getattr(self._local, "connection", None)
+        if connection is not None and self._pid == os.getpid():
+            connection.close()
+        self._local = threading.local()
+
+    def get_collection(self, name, **kwargs):
+        with self._lock:
+            collection = self._collections.get(name)
+            if collection is None:
+                collection = self._collections[name] = SQLiteCollection(self, name)
+        return collection
+
+    def __getitem__(self, name):
+        return self.get_collection(name)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self.get_collection(name)
+
+    def with_options(self, **kwargs):
+        # Read preferences and write concerns have no meaning for one file
+        return self
+
+    def list_collection_names(self):
+        with self.connection() as connection:
+            rows = connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'c\\_%' ESCAPE '\\'"
+            ).fetchall()
+        return [name[2:] for name, in rows]
+
+    def drop_collection(self, name):
+        with self.connection(write=True) as connection:
+            connection.execute(f"DROP TABLE IF EXISTS {_table(name)}")
+            connection.execute(f"DELETE FROM {_INDEXES_TABLE} WHERE collection = ?", (name,))
+        with self._lock:
+            self._tables.discard(name)
+            collection = self._collections.get(name)
+        if collection is not None:
+            collection._indexes = None
+
+    def command(self, command, *args, **kwargs):
+        if command == "ping":
+            return {"ok": 1.0}
+        raise NotImplementedError(f"Command {command} is not supported")
+
+def _table(name):
+    return '"c_' + name.replace('"', '""') + '"'
+
+def _index(collection, name):
+    return '"i_' + f"{collection}.{name}".replace('"', '""') + '"'
+
+class SQLiteCursor:
+    def __init__(self, collection, query, projection=None, sort=None, limit=0, skip=0, batch_size=0):
+        """
+        The documents matching a query, read when iterated, with the methods
+        of a PyMongo `Cursor` used by yocto.
+        """
+        self._collection = collection
+        self._query = query
+        self._projection = projection
+        self._sort = _sort_spec(sort) if sort else None
+        self._limit = limit or 0
+        self._skip = skip or 0
+        self._batch_size = batch_size or 1000
+        self._rows = None
+
+    def sort(self, key_or_list, direction=None):
+        self._sort = _sort_spec(key_or_list, direction)
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def batch_size(self, batch_size):
+        self._batch_size = batch_size or 1000
+        return self
+
+    def _documents(self):
+        params = []
+        sql = (
+            f"SELECT id, doc FROM {_table(self._collection.name)} "
+            f"WHERE {_where(self._query, params)}{_order_by(self._sort)}"
+        )
+        if self._limit or self._skip:
+            sql += " LIMIT ? OFFSET ?"
+            params.extend((self._limit or -1, self._skip))
+        rows = self._collection._execute(sql, params)
+        while batch := rows.fetchmany(self._batch_size):
+            for row in batch:
+                yield _project(self._collection._document(row), self._projection)
+
+    def __iter__(self):
+        if self._rows is None:
+            self._rows = self._documents()
+        return self._rows
+
+    def __next__(self):
+        return next(iter(self))
+
+    def close(self):
+        if self._rows is not None:
+            self._rows.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class SQLiteCollection:
+    def __init__(self, database, name):
+        """
+        A collection of an `SQLiteDatabase`, with the methods of a PyMongo
+        `Collection` used by yocto.
+        """
+        self.database = database
+        self.name = name
+        self.full_name = f"{database.name}.{name}"
+        self._indexes = None
+        self._next_expiry = 0.0
+
+    def __repr__(self):
+        return f"SQLiteCollection({self.database!r}, {self.name!r})"
+
+    def with_options(self, **kwargs):
+        # Every write is acknowledged once committed to the file
+        return self
+
+    def _create(self, connection):
+        with self.database._lock:
+            if self.name in self.database._tables:
+                return
+        connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {_table(self.name)} (id NOT NULL PRIMARY KEY, doc TEXT NOT NULL)"
+        )
+        with self.database._lock:
+            self.database._tables.add(self.name)
+
+    def _execute(self, sql, params=(), connection=None):
+        if connection is None:
+            with self.database.connection() as connection:
+                return self._execute(sql, params, connection)
+        self._create(connection)
+        self._expire(connection)
+        try:
+            return connection.execute(sql, params)
+        except sqlite3.OperationalError as e:
+            # The table was dropped by another process
+            if "no such table" not in str(e):
+                raise OperationFailure(str(e))
+            with self.database._lock:
+                self.database._tables.discard(self.name)
+            self._create(connection)
+            return connection.execute(sql, params)
+
+    @staticmethod
+    def _document(row):
+        document = {"_id": _decode(row[0])}
+        document.update(_decode(json.loads(row[1])))
+        return document
+
+    # Indexes
+
+    def _index_specs(self):
+        if self._indexes is None:
+            with self.database.connection() as connection:
+                rows = connection.execute(
+                    f"SELECT name, spec FROM {_INDEXES_TABLE} WHERE collection = ?", (self.name,)
+                ).fetchall()
+            self._indexes = {name: json.loads(spec) for name, spec in rows}
+        return self._indexes
+
+    def create_indexes(self, indexes):
+        names = []
+        with self.database.connection(write=True) as connection:
+            self._create(connection)
+            for model in indexes:
+                document = dict(model.document)
+                if "partialFilterExpression" in document:
+                    raise NotImplementedError("Partial indexes are not supported")
+                key = list(document["key"].items())
+                name = document.get("name") or "_".join(f"{field}_{direction}" for field, direction in key)
+                spec = {
+                    "key": key,
+                    "unique": bool(document.get("unique", False)),
+                    "sparse": bool(document.get("sparse", False)),
+                }
+                if "expireAfterSeconds" in document:
+                    spec["expireAfterSeconds"] = document["expireAfterSeconds"]
+                expressions = [_field(field) for field, _ in key]
+                sql = (
+                    f"CREATE {'UNIQUE ' if spec['unique'] else ''}INDEX IF NOT EXISTS "
+                    f"{_index(self.name, name)} ON {_table(self.name)} "
+                    f"({', '.join(f'{e} DESC' if d < 0 else e for e, (_, d) in zip(expressions, key))})"
+                )
+                if spec["sparse"]:
+                    sql += " WHERE " + " OR ".join(f"{e} IS NOT NULL" for e in expressions)
+                try:
+                    connection.execute(sql)
+                except sqlite3.IntegrityError as e:
+                    raise OperationFailure(f"Index build failed: {e}", 11000)
+                connection.execute(
+                    f"INSERT OR REPLACE INTO {_INDEXES_TABLE} VALUES (?, ?, ?)",
+                    (self.name, name, json.dumps(spec)),
+                )
+                names.append(name)
+        self._indexes = None
+        return names
+
+    def create_index(self, keys, **kwargs):
+        from pymongo import IndexModel
+        return self.create_indexes([IndexModel(keys, **kwargs)])[0]
+
+    def index_information(self):
+        information = {"_id_": {"key": [("_id", 1)]}}
+        for name, spec in self._index_specs().items():
+            entry = {"key": [tuple(item) for item in spec["key"]]}
+            for option in ("unique", "sparse"):
+                if spec[option]:
+                    entry[option] = True
+            if "expireAfterSeconds" in spec:
+                entry["expireAfterSeconds"] = spec["expireAfterSeconds"]
+            information[name] = entry
+        return information
+
+    def drop_index(self, name):
+        if name not in self._index_specs():
+            raise OperationFailure(f"index not found with name [{name}]", 27)
+        with self.database.connection(write=True) as connection:
+            connection.execute(f"DROP INDEX IF EXISTS {_index(self.name, name)}")
+            connection.execute(
+                f"DELETE FROM {_INDEXES_TABLE} WHERE collection = ? AND name = ?", (self.name, name)
+            )
+        self._indexes = None
+
+    def _expire(self, connection):
+        # Remove documents past the expiry of TTL indexes, at most every
+        # TTL_INTERVAL seconds, as they would be by MongoDB
+        now = time.monotonic()
+        if now < self._next_expiry:
+            return
+        self._next_expiry = now + TTL_INTERVAL
+        for spec in self._index_specs().values():
+            if "expireAfterSeconds" not in spec:
+                continue
+            cutoff = datetime.now(timezone.utc) - timedelta(seconds=spec["expireAfterSeconds"])
+            expression = _field(spec["key"][0][0])
+            # Only dates expire
+            connection.execute(
+                f"DELETE FROM {_table(self.name)} WHERE {expression} > ? AND {expression} < ?",
+                (_DATETIME, _encode(cutoff)),
+            )
+
+    def _duplicate_key_error(self, error, document):
+        # Raise the DuplicateKeyError MongoDB would for a failed constraint
+        message = str(error)
+        name, key = "_id_", {"_id": 1}
+        for index_name, spec in self._index_specs().items():
+            if f"index '{_index(self.name, index_name)[1:-1]}'" in message:
+                name, key = index_name, dict((field, direction) for field, direction in spec["key"])
+                break
+        else:
+            if "UNIQUE" not in message and "PRIMARY" not in message:
+                raise OperationFailure(message)
+        values = {field: document.get(field) for field in key}
+        errmsg = f"E11000 duplicate key error collection: {self.full_name} index: {name} dup key: {values}"
+        return DuplicateKeyError(errmsg, 11000, {"code": 11000, "errmsg": errmsg, "keyPattern": key, "keyValue": values})
+
+    # Reads
+
+    def find(self, filter=None, projection=None, sort=None, limit=0, skip=0, batch_size=0, **kwargs):
+        return SQLiteCursor(self, filter, projection, sort, limit, skip, batch_size)
+
+    def find_one(self, filter=None, *args, **kwargs):
+        if filter is not None and not isinstance(filter, dict):
+            filter = {"_id": filter}
+        for document in self.find(filter, *args, **kwargs).limit(1):
+            return document
+        return None
+
+    def count_documents(self, filter, limit=0, skip=0, **kwargs):
+        params = []
+        sql = f"SELECT id FROM {_table(self.name)} WHERE {_where(filter, params)}"
+        if limit or skip:
+            sql += " LIMIT ? OFFSET ?"
+            params.extend((limit or -1, skip))
+        return self._execute(f"SELECT COUNT(*) FROM ({sql})", params).fetchone()[0]
+
+    def estimated_document_count(self, **kwargs):
+        return self._execute(f"SELECT COUNT(*) FROM {_table(self.name)}").fetchone()[0]
+
+    # Writes
+
+    def _insert(self, connection, document):
+        if "_id" not in document:
+            document["_id"] = ObjectId()
+        fields = {key: value for key, value in document.items() if key != "_id"}
+        try:
+            self._execute(
+                f"INSERT INTO {_table(self.name)} (id, doc) VALUES (?, ?)",
+                (_encode(document["_id"]), json.dumps(_encode(fields), separators=(",", ":"))),
+                connection,
+            )
+        except sqlite3.IntegrityError as e:
+            raise self._duplicate_key_error(e, document)
+        return document["_id"]
+
+    def _replace(self, connection, document):
+        fields = {key: value for key, value in document.items() if key != "_id"}
+        try:
+            self._execute(
+                f"UPDATE {_table(self.name)} SET doc = ? WHERE id = ?",
+                (json.dumps(_encode(fields), separators=(",", ":")), _encode(document["_id"])),
+                connection,
+            )
+        except sqlite3.IntegrityError as e:
+            raise self._duplicate_key_error(e, document)
+
+    def _matching(self, connection, filter, sort=None, limit=0):
+        params = []
+        sql = f"SELECT id, doc FROM {_table(self.name)} WHERE {_where(filter, params)}{_order_by(sort)}"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return [self._document(row) for row in self._execute(sql, params, connection).fetchall()]
+
+    def _update(self, connection, filter, update, upsert=False, many=False, sort=None):
+        # Returns the raw result, the document before and after the update
+        documents = self._matching(connection, filter, sort, 0 if many else 1)
+        if not documents:
+            if not upsert:
+                return {"n": 0, "nModified": 0}, None, None
+            document = deepcopy(_insert_fields(filter))
+            _apply_update(document, update, inserting=True)
+            inserted_id = self._insert(connection, document)
+            return {"n": 1, "nModified": 0, "upserted": inserted_id}, None, document
+        modified = 0
+        for document in documents:
+            before = deepcopy(document)
+            if _apply_update(document, update, inserting=False):
+                self._replace(connection, document)
+                modified += 1
+        return {"n": len(documents), "nModified": modified}, before, document
+
+    def _delete(self, connection, filter, many=False):
+        params = []
+        where = _where(filter, params)
+        if not many:
+            where = f"id IN (SELECT id FROM {_table(self.name)} WHERE {where} LIMIT 1)"
+        return self._execute(f"DELETE FROM {_table(self.name)} WHERE {where}", params, connection).rowcount
+
+    def insert_one(self, document, **kwargs):
+        with self.database.connection(write=True) as connection:
+            return InsertOneResult(self._insert(connection, document), True)
+
+    def insert_many(self, documents, ordered=True, **kwargs):
+        documents = list(documents)
+        for document in documents:
+            document.setdefault("_id", ObjectId())
+        self.bulk_write([InsertOne(document) for document in documents], ordered=ordered)
+        return InsertManyResult([document["_id"] for document in documents], True)
+
+    def update_one(self, filter, update, upsert=False, **kwargs):
+        with self.database.connection(write=True) as connection:
+            raw, _, _ = self._update(connection, filter, update, upsert)
+        return UpdateResult(raw, True)
+
+    def update_many(self, filter, update, upsert=False, **kwargs):
+        with self.database.connection(write=True) as connection:
+            raw, _, _ = self._update(connection, filter, update, upsert, many=True)
+        return UpdateResult(raw, True)
+
+    def delete_one(self, filter, **kwargs):
+        with self.database.connection(write=True) as connection:
+            return DeleteResult({"n": self._delete(connection, filter)}, True)
+
+    def delete_many(self, filter, **kwargs):
+        with self.database.connection(write=True) as connection:
+            return DeleteResult({"n": self._delete(connection, filter, many=True)}, True)
+
+    def find_one_and_update(
+            self,
+            filter,
+            update,
+            projection=None,
+            sort=None,
+            upsert=False,
+            return_document=ReturnDocument.BEFORE,
+            **kwargs,
+        ):
+        with self.database.connection(write=True) as connection:
+            _, before, after = self._update(connection, filter, update, upsert, sort=sort)
+        document = after if return_document else before
+        return None if document is None else _project(document, projection)
+
+    def find_one_and_delete(self, filter, projection=None, sort=None, **kwargs):
+        with self.database.connection(write=True) as connection:
+            documents = self._matching(connection, filter, sort, 1)
+            if not documents:
+                return None
+            self._delete(connection, {"_id": documents[0]["_id"]})
+        return _project(documents[0], projection)
+
+    def bulk_write(self, requests, ordered=True, **kwargs):
+        """
+        Apply a list of `InsertOne`, `UpdateOne`, `UpdateMany`, `DeleteOne`
+        and `DeleteMany` operations in one transaction.
+
+        :raises BulkWriteError: If some operations failed on a unique index,
+            with their errors under "writeErrors" of its details. The other
+            operations are applied, up to the first failure if `ordered`.
+        """
+        result = {
+            "writeErrors": [],
+            "writeConcernErrors": [],
+            "nInserted": 0,
+            "nUpserted": 0,
+            "nMatched": 0,
+            "nModified": 0,
+            "nRemoved": 0,
+            "upserted": [],
+        }
+        with self.database.connection(write=True) as connection:
+            for index, request in enumerate(requests):
+                try:
+                    if isinstance(request, InsertOne):
+                        self._insert(connection, request._doc)
+                        result["nInserted"] += 1
+                    elif isinstance(request, (UpdateOne, UpdateMany)):
+                        raw, _, _ = self._update(
+                            connection,
+                            request._filter,
+                            request._doc,
+                            upsert=bool(request._upsert),
+                            many=isinstance(request, UpdateMany),
+                        )
+                        if "upserted" in raw:
+                            result["nUpserted"] += 1
+                            result["upserted"].append({"index": index, "_id": raw["upserted"]})
+                        else:
+                            result["nMatched"] += raw["n"]
+                            result["nModified"] += raw["nModified"]
+                    elif isinstance(request, (DeleteOne, DeleteMany)):
+                        result["nRemoved"] += self._delete(
+                            connection, request._filter, many=isinstance(request, DeleteMany)
+                        )
+                    else:
+                        raise NotImplementedError(f"{type(request).__name__} is not supported")
+                except DuplicateKeyError as e:
+                    error = dict(e.details)
+                    error["index"] = index
+                    result["writeErrors"].append(error)
+                    if ordered:
+                        break
+        if result["writeErrors"]:
+            raise BulkWriteError(result)
+        return BulkWriteResult(result, True)
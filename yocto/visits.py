@@ -0,0 +1,388 @@
+import atexit
+from datetime import datetime, timedelta, timezone
+import logging
+import threading
+import time
+import weakref
+
+from flask import current_app
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+
+from yocto.db import get_database
+from yocto.lib.background import BackgroundLoop
+from yocto.lib.utils import (
+    SHORT_ID_IDENTIFIER,
+    VISITS_COUNT_IDENTIFIER,
+    VISIT_SHORT_ID_IDENTIFIER,
+    VISIT_GRANULARITY_IDENTIFIER,
+    VISIT_START_IDENTIFIER,
+    VISIT_COUNT_IDENTIFIER,
+    VISIT_EXPIRY_IDENTIFIER,
+)
+
+VISIT_COUNTER_EXTENSION = "yocto.visit_counter"
+
+logger = logging.getLogger(__name__)
+
+# Length in seconds of the buckets of each granularity of visit history
+GRANULARITIES = {
+    "minute": 60,
+    "hour": 3600,
+    "day": 86400,
+}
+
+_EPOCH = datetime(1970, 1, 1)
+
+def bucket_start(moment, granularity):
+    """
+    Find the start of the bucket holding a moment.
+
+    Buckets are aligned to UTC, so that a day runs from midnight UTC.
+
+    :param moment: The moment, as a POSIX timestamp or a datetime (naive
+        datetimes are taken to be UTC, as returned by PyMongo).
+    :type moment: float or datetime.datetime
+    :param str granularity: One of the keys of `GRANULARITIES`.
+
+    :raises ValueError: If `granularity` is not known.
+
+    :return: The start of the bucket, as a naive UTC datetime.
+    :rtype: datetime.datetime
+    """
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"Unknown granularity {granularity!r}")
+    if isinstance(moment, datetime):
+        if moment.tzinfo is not None:
+            moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+        moment = (moment - _EPOCH).total_seconds()
+    size = GRANULARITIES[granularity]
+    return _EPOCH + timedelta(seconds=int(moment // size) * size)
+
+class VisitHistory:
+    def __init__(self, collection, retention):
+        """
+        Visit counts of each short ID over time, in pre-aggregated buckets.
+
+        Each bucket is a document counting the visits to one short ID in one
+        minute, hour or day, so the visits over a period are read from one
+        index range rather than counted from individual events. Buckets are
+        updated with upserted `$inc` writes, and removed by a TTL index once
+        their retention has passed. Changing the retention only affects
+        buckets created afterwards.
+
+        :param collection: The visits collection holding the buckets.
+        :type collection: pymongo.collection.Collection
+        :param retention: Seconds for which buckets of each granularity are
+            kept, e.g. the `VISIT_HISTORY_RETENTION` option. Granularities
+            which are missing or `None` are not recorded.
+        :type retention: dict[str, int]
+        """
+        for granularity in retention:
+            if granularity not in GRANULARITIES:
+                raise ValueError(f"Unknown granularity {granularity!r}")
+        self._collection = collection
+        self.retention = {
+            granularity: seconds for granularity, seconds in retention.items()
+            if seconds is not None
+        }
+
+    def updates(self, visits):
+        """
+        Build the writes adding visits to their buckets.
+
+        :param visits: Visit counts by short ID and minute, the minute given
+            as whole minutes since the epoch.
+        :type visits: dict[tuple[str, int], int]
+
+        :return: One upsert per bucket.
+        :rtype: list[pymongo.UpdateOne]
+        """
+        buckets = {}
+        for (short_id, minute), count in visits.items():
+            for granularity in self.retention:
+                key = (short_id, granularity, bucket_start(minute * 60, granularity))
+                buckets[key] = buckets.get(key, 0) + count
+        return [
+            UpdateOne(
+                {
+                    VISIT_SHORT_ID_IDENTIFIER: short_id,
+                    VISIT_GRANULARITY_IDENTIFIER: granularity,
+                    VISIT_START_IDENTIFIER: start,
+                },
+                {
+                    "$inc": {VISIT_COUNT_IDENTIFIER: count},
+                    "$setOnInsert": {
+                        VISIT_EXPIRY_IDENTIFIER: start + timedelta(
+                            seconds=GRANULARITIES[granularity] + self.retention[granularity]
+                        ),
+                    },
+                },
+                upsert=True,
+            )
+            for (short_id, granularity, start), count in buckets.items()
+        ]
+
+    def write(self, visits):
+        """
+        Add visits to their buckets in the database.
+
+        :param visits: Visit counts by short ID and minute (see `updates`).
+        :type visits: dict[tuple[str, int], int]
+
+        :raises pymongo.errors.PyMongoError: If the write fails.
+        """
+        requests = self.updates(visits)
+        if requests:
+            self._collection.bulk_write(requests, ordered=False)
+
+class VisitCounter:
+    def __init__(
+            self,
+            collection,
+            flush_size=1000,
+            flush_interval=5.0,
+            synchronous=False,
+            history=None,
+        ):
+        """
+        Buffer of visit count increments, written to the database in batches.
+
+        Recording a visit only adds to an in-memory count for the short ID.
+        The pending counts are written with a single unordered `bulk_write`
+        of `$inc` updates when `flush_size` visits are pending or every
+        `flush_interval` seconds, by a background thread started on the first
+        visit. The visit counts in the database are therefore eventually
+        accurate. Counts still pending when the process exits are flushed by
+        `close`. If a visit history is provided, the pending counts are kept
+        by minute and also added to its buckets when flushed, so recording a
+        visit remains a single in-memory increment.
+
+        :param collection: The urls collection holding the visit counts.
+        :type collection: pymongo.collection.Collection
+        :param int flush_size: The number of pending visits which triggers a
+            flush.
+        :param float flush_interval: The longest time in seconds between
+            flushes while visits are pending.
+        :param bool synchronous: If `True`, every visit is written before
+            `record` returns and no thread is started.
+        :param history: Time-bucketed visit counts to update (default
+            none).
+        :type history: VisitHistory
+        """
+        self._collection = collection
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.synchronous = synchronous
+        self.history = history
+        self._pending = {}  # (short_id, minute) -> count
+        self._pending_total = 0
+        self._unwritten_history = {}  # visits written to urls but not buckets
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._loop = BackgroundLoop(
+            self.flush,
+            flush_interval,
+            "yocto-visit-counter",
+            errors=PyMongoError,
+            message="Could not write pending visits: %s",
+            logger=logger,
+            wait_first=True,
+            after_fork=self._reset_after_fork,
+        )
+
+    def record(self, short_id, count=1, timestamp=None):
+        """
+        Add visits to the pending count for a short ID.
+
+        :param str short_id: The short ID which was visited.
+        :param int count: The number of visits (default 1).
+        :param float timestamp: The POSIX time of the visits, for the visit
+            history (default now).
+        """
+        minute = None
+        if self.history is not None:
+            minute = int((time.time() if timestamp is None else timestamp) // 60)
+        key = (short_id, minute)
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0) + count
+            self._pending_total += count
+            full = self._pending_total >= self.flush_size
+        if self.synchronous:
+            self.flush()
+            return
+        self._loop.ensure_started()
+        if full:
+            self._loop.wake()
+
+    def pending(self):
+        """
+        Report the visits not yet written to the database.
+
+        :return: The pending count for each short ID.
+        :rtype: dict[str, int]
+        """
+        with self._lock:
+            pending = list(self._pending.items())
+        totals = {}
+        for (short_id, _), count in pending:
+            totals[short_id] = totals.get(short_id, 0) + count
+        return totals
+
+    def flush(self):
+        """
+        Write all pending visits to the database.
+
+        If a write fails, the visits it held are returned to the buffer to
+        be written by a later flush. Visits to links deleted since they were
+        recorded match no link and are dropped, and are not added to the
+        visit history, whose buckets were deleted with the link. The links
+        are only looked up when an update matched nothing or buckets are
+        retried, so a link deleted while the flush is writing can still be
+        left with buckets, until they expire.
+
+        :raises pymongo.errors.PyMongoError: If the write fails.
+
+        :return: The number of short IDs updated.
+        :rtype: int
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending = self._pending
+                self._pending = {}
+                self._pending_total = 0
+                unwritten = self._unwritten_history
+                self._unwritten_history = {}
+            if not pending and not unwritten:
+                return 0
+            totals = {}
+            for (short_id, _), count in pending.items():
+                totals[short_id] = totals.get(short_id, 0) + count
+            requests = [
+                UpdateOne(
+                    {SHORT_ID_IDENTIFIER: short_id},
+                    {"$inc": {VISITS_COUNT_IDENTIFIER: count}},
+                )
+                for short_id, count in totals.items()
+            ]
+            matched = 0
+            if requests:
+                try:
+                    matched = self._collection.bulk_write(requests, ordered=False).matched_count
+                except PyMongoError:
+                    with self._lock:
+                        for key, count in pending.items():
+                            self._pending[key] = self._pending.get(key, 0) + count
+                            self._pending_total += count
+                        self._merge_unwritten(unwritten)
+                    raise
+            if self.history is not None:
+                retried = bool(unwritten)
+                for key, count in pending.items():
+                    unwritten[key] = unwritten.get(key, 0) + count
+                try:
+                    if matched < len(requests) or retried:
+                        unwritten = self._existing(unwritten)
+                    self.history.write(unwritten)
+                except PyMongoError:
+                    # Only the buckets are retried, the totals being written
+                    with self._lock:
+                        self._merge_unwritten(unwritten)
+                    raise
+            return len(requests)
+
+    def _existing(self, visits):
+        # Visits to short IDs which still have a link, so that the buckets
+        # of links deleted since the visits were recorded are not recreated
+        short_ids = list({short_id for short_id, _ in visits})
+        existing = set(
+            self._collection.distinct(SHORT_ID_IDENTIFIER, {SHORT_ID_IDENTIFIER: {"$in": short_ids}})
+        )
+        return {key: count for key, count in visits.items() if key[0] in existing}
+
+    def _merge_unwritten(self, visits):
+        for key, count in visits.items():
+            self._unwritten_history[key] = self._unwritten_history.get(key, 0) + count
+
+    def close(self):
+        """
+        Stop the background thread and flush any pending visits.
+
+        Errors writing to the database are logged, as this runs at exit.
+        """
+        self._loop.stop()
+        thread = self._loop.thread
+        if thread is not None:
+            thread.join(timeout=self.flush_interval)
+        try:
+            self.flush()
+        except PyMongoError as e:
+            logger.error("Could not write %d pending visits: %s", self._pending_total, e)
+
+    def _reset_after_fork(self):
+        # Visits buffered by the parent are written by the parent
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        self._pending_total = 0
+        self._unwritten_history = {}
+
+# Counters of this process, flushed at exit unless collected before
+_counters = weakref.WeakSet()
+
+def _close_counters():
+    for counter in list(_counters):
+        counter.close()
+
+atexit.register(_close_counters)
+
+def get_visit_counter():
+    """
+    Obtain the visit counter of the current application.
+
+    :return: The visit counter, or `None` if visits are counted directly.
+    :rtype: VisitCounter
+    """
+    return current_app.extensions.get(VISIT_COUNTER_EXTENSION)
+
+def create_visit_counter(config):
+    """
+    Build a visit counter as configured.
+
+    The counter is configured by the `VISIT_COUNTER_FLUSH_SIZE`,
+    `VISIT_COUNTER_FLUSH_INTERVAL` and `VISIT_COUNTER_SYNCHRONOUS` options,
+    and flushed when the process exits. If `VISIT_HISTORY_ENABLED` is set,
+    it also updates a `VisitHistory` kept for `VISIT_HISTORY_RETENTION`. If
+    `VISIT_COUNTER_ENABLED` is not set, no counter is built.
+
+    :param config: The application configuration.
+    :type config: flask.Config
+
+    :return: The visit counter, or `None` if visits are counted directly.
+    :rtype: VisitCounter
+    """
+    if not config.get("VISIT_COUNTER_ENABLED", False):
+        return None
+    database = get_database(config)
+    history = None
+    if config.get("VISIT_HISTORY_ENABLED", False):
+        history = VisitHistory(database.visits, config["VISIT_HISTORY_RETENTION"])
+    counter = VisitCounter(
+        database.urls,
+        flush_size=config.get("VISIT_COUNTER_FLUSH_SIZE", 1000),
+        flush_interval=config.get("VISIT_COUNTER_FLUSH_INTERVAL", 5.0),
+        synchronous=config.get("VISIT_COUNTER_SYNCHRONOUS", False),
+        history=history,
+    )
+    _counters.add(counter)
+    return counter
+
+def init_app(app):
+    """
+    Initialize the Flask app with a visit counter.
+
+    The counter is configured as described in `create_visit_counter`. If
+    `VISIT_COUNTER_ENABLED` is not set, every visit is written to the
+    database by the redirect, and no visit history is recorded.
+    """
+    app.extensions[VISIT_COUNTER_EXTENSION] = create_visit_counter(app.config)